@@ -0,0 +1,385 @@
+# This file contains an optional agent: a long-running local process that runs commands (submit-metadata-bundle,
+# check-submission, resume-uploads and upload-item-data) for the user, so each doesn't have to start afresh.
+#
+# The agent (started with submit-cgap-agent) listens on a Unix socket (SUBMITCGAP_AGENT_SOCKET) in a folder that
+# must belong to its user and be closed to everyone else, and each end checks that the other is run by the same user
+# (where the system can say). When one of those commands finds an agent listening there, it sends its arguments
+# (and the folder it was run in) to the agent, which runs it, sending back its output as it goes and forwarding
+# any questions it asks, and then exits as the command did. The agent keeps what it can from one command to the
+# next: its modules already imported, a session keeping connections to the portal open (see portal_network_access.py),
+# the portal's health page, and what the upload tuner has learned. It runs one command at a time (declining others
+# while it's busy, so they're run as usual), and only runs commands for which the environment variables that affect
+# commands are the same as its own, since those are read only when it starts. (Only a digest of those is sent, since
+# they may hold credentials.) Other commands, and all commands when no agent is running (or if SUBMITCGAP_NO_AGENT
+# is set), are run as they always have been.
+#
+# The entry points of those commands (see scripts/agent_commands.py) import only this module, and this module
+# imports only the standard library until it has to, so that a command the agent runs doesn't first pay for
+# importing all the modules the command uses (boto3, submission.py and the rest), which is what the agent saves.
+# They're imported only if the command is run here after all.
+
+import codecs
+import contextlib
+import hashlib
+import importlib
+import io
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import traceback
+from typing import Callable, Dict, List, Optional
+
+
+AGENT_SOCKET_VAR = 'SUBMITCGAP_AGENT_SOCKET'
+NO_AGENT_VAR = 'SUBMITCGAP_NO_AGENT'
+
+# The commands the agent runs, and the functions that run them (given their arguments).
+AGENT_COMMANDS = {
+    'check-submission': 'submit_cgap.scripts.check_submission:main',
+    'resume-uploads': 'submit_cgap.scripts.resume_uploads:main',
+    'submit-metadata-bundle': 'submit_cgap.scripts.submit_metadata_bundle:main',
+    'upload-item-data': 'submit_cgap.scripts.upload_item_data:main',
+}
+
+# Environment variables (by prefix, or by name) that may affect how commands run, which must be the same for the
+# agent and for a command it runs.
+AGENT_ENVIRONMENT_PREFIXES = ('SUBMITCGAP_', 'CGAP_', 'AWS_', 'DEBUG_', 'XDG_')
+AGENT_ENVIRONMENT_NAMES = ('HOME',)
+
+AGENT_OUTPUT_CHUNK_SIZE = 64 * 1024
+
+
+def _compute_default_agent_socket():  # factored out as a function for testing
+    agent_socket = os.environ.get(AGENT_SOCKET_VAR)
+    if not agent_socket:
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+        user = os.getuid() if hasattr(os, 'getuid') else os.environ.get('USERNAME', 'user')
+        agent_socket = os.path.join(runtime_dir, f'submit-cgap-{user}', 'agent.sock')
+    return agent_socket
+
+
+AGENT_SOCKET = _compute_default_agent_socket()
+NO_AGENT = (os.environ.get(NO_AGENT_VAR) or '').lower() == 'true'  # as environ_bool has it, without importing dcicutils
+
+_IN_AGENT = False  # True in the agent itself, where commands are to be run, not sent to an agent
+
+
+def _print(*args, **kwargs):
+    """Calls dcicutils' PRINT, which is imported only when there's something to show (since it's slow to import)."""
+    from dcicutils.misc_utils import PRINT
+    PRINT(*args, **kwargs)
+
+
+def agent_environment(environ=None) -> Dict[str, str]:
+    """Returns the environment variables that may affect how commands run."""
+    environ = os.environ if environ is None else environ
+    return {name: value for name, value in environ.items()
+            if name.startswith(AGENT_ENVIRONMENT_PREFIXES) or name in AGENT_ENVIRONMENT_NAMES}
+
+
+def agent_environment_digest(environ=None) -> str:
+    """Returns a digest of the environment variables that may affect how commands run (see agent_environment)."""
+    return hashlib.sha256(json.dumps(sorted(agent_environment(environ).items())).encode('utf-8')).hexdigest()
+
+
+def socket_folder_problem(agent_socket: str) -> Optional[str]:
+    """
+    Returns why the folder an agent's socket is in can't be trusted (because someone other than the user could
+    have put a socket there), or None if it can: it must be a folder (not a link to one) belonging to the user
+    and closed to everyone else.
+    """
+    folder = os.path.dirname(os.path.abspath(agent_socket))
+    try:
+        info = os.lstat(folder)
+    except OSError as e:
+        return f"{e.__class__.__name__}: {e}"
+    if not stat.S_ISDIR(info.st_mode):
+        return f"{folder} is not a folder."
+    if hasattr(os, 'getuid') and info.st_uid != os.getuid():
+        return f"{folder} does not belong to you."
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        return f"{folder} is open to others (its mode is {stat.S_IMODE(info.st_mode):o}, not 700)."
+    return None
+
+
+def peer_uid(connection: socket.socket) -> Optional[int]:
+    """Returns the user id of the process at the other end of a Unix socket, or None if the system can't say."""
+    if not hasattr(socket, 'SO_PEERCRED'):  # e.g., on macOS, where the socket's folder is all that's checked
+        return None
+    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', credentials)
+    return uid
+
+
+def is_own_process(connection: socket.socket) -> bool:
+    """Returns False if the process at the other end of a Unix socket is known to be run by another user."""
+    uid = peer_uid(connection)
+    return uid is None or uid == os.getuid()
+
+
+class AgentConnection:
+    """A connection between the agent and a command, over which messages (JSON objects, a line each) are sent."""
+
+    def __init__(self, connection: socket.socket):
+        self._connection = connection
+        self._reader = connection.makefile('rb')
+        self._writer = connection.makefile('wb')
+        self._lock = threading.Lock()
+
+    def send(self, **message) -> None:
+        with self._lock:
+            self._writer.write(json.dumps(message).encode('utf-8') + b"\n")
+            self._writer.flush()
+
+    def receive(self) -> Optional[dict]:
+        """Returns the next message, or None if the connection has been closed."""
+        line = self._reader.readline()
+        return json.loads(line) if line else None
+
+    def close(self) -> None:
+        self._reader.close()
+        with contextlib.suppress(OSError):  # e.g., flushing what couldn't be sent, since the other end has gone
+            self._writer.close()
+        self._connection.close()
+
+
+def delegate_to_agent(command: str, args: Optional[List[str]] = None) -> None:
+    """
+    Has the agent run a command, if one is running (and it can run the command as it would be run here), showing
+    the command's output and forwarding its questions, and then exits as the command did. Otherwise, returns,
+    so the command is run here.
+
+    :param command: the name of the command
+    :param args: the command's arguments (default: those of this process)
+    """
+    if _IN_AGENT or NO_AGENT or not hasattr(socket, 'AF_UNIX') or not os.path.exists(AGENT_SOCKET):
+        return
+    problem = socket_folder_problem(AGENT_SOCKET)
+    if problem:
+        _print(f"Not using the agent socket {AGENT_SOCKET}, since its folder can't be trusted. {problem}")
+        return
+    try:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(AGENT_SOCKET)
+    except OSError:
+        return  # No agent is listening (e.g., it stopped without removing its socket).
+    if not is_own_process(connection):
+        _print(f"Not using the agent socket {AGENT_SOCKET}, since another user is listening on it.")
+        connection.close()
+        return
+    agent = AgentConnection(connection)
+    started = False
+    try:
+        agent.send(command=command, args=sys.argv[1:] if args is None else list(args), cwd=os.getcwd(),
+                   environ_digest=agent_environment_digest())
+        while True:
+            message = agent.receive()
+            if message is None or 'declined' in message:
+                break
+            started = True
+            if 'output' in message:
+                sys.stdout.write(message['output'])
+                sys.stdout.flush()
+            elif 'read' in message:
+                agent.send(input=sys.stdin.readline())
+            elif 'exit' in message:
+                exit(message['exit'])
+    except OSError:
+        pass
+    finally:
+        agent.close()
+    if started:  # It can't just be run here instead, since it may have done some of what it does.
+        _print(f"The agent stopped while running {command}.")
+        exit(1)
+
+
+def run_command(command: str, args: Optional[List[str]] = None):
+    """
+    Runs one of the AGENT_COMMANDS: has the agent run it, if one is running (see delegate_to_agent), and otherwise
+    runs it here, only then importing the module that runs it (and all the modules that uses).
+
+    :param command: the name of the command
+    :param args: the command's arguments (default: those of this process)
+    :return: what the function that runs the command returns
+    """
+    delegate_to_agent(command, args)
+    return _command_function(AGENT_COMMANDS[command])(args)
+
+
+class AgentInput(io.TextIOBase):
+    """Standard input for a command the agent runs, read (a line at a time, as asked for) from the command's own."""
+
+    def __init__(self, agent: AgentConnection):
+        super().__init__()
+        self._agent = agent
+
+    def readable(self):
+        return True
+
+    def readline(self, size=-1) -> str:
+        sys.stdout.flush()  # so the question has been seen
+        self._agent.send(read=True)
+        message = self._agent.receive() or {}
+        return message.get('input') or ""
+
+    def read(self, size=-1) -> str:
+        return "".join(iter(self.readline, ""))
+
+
+@contextlib.contextmanager
+def _output_sent_to(agent: AgentConnection):
+    """Sends everything written to standard output or error, by Python or by subprocesses, to a command."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    read_fd, write_fd = os.pipe()
+    saved_fds = [os.dup(1), os.dup(2)]
+    saved_streams = sys.stdout, sys.stderr
+    os.dup2(write_fd, 1)
+    os.dup2(write_fd, 2)
+    os.close(write_fd)
+
+    def send_output():
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        with contextlib.suppress(OSError):
+            while True:
+                data = os.read(read_fd, AGENT_OUTPUT_CHUNK_SIZE)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    agent.send(output=text)
+                if not data:
+                    break
+
+    sender = threading.Thread(target=send_output, daemon=True)
+    sender.start()
+    output = io.TextIOWrapper(io.FileIO(os.dup(1), 'w'), line_buffering=True, write_through=True)
+    sys.stdout = sys.stderr = output
+    try:
+        yield
+    finally:
+        output.close()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        for fd in saved_fds:
+            os.close(fd)
+        sys.stdout, sys.stderr = saved_streams
+        sender.join()  # It's sent everything once all the pipe's write ends are closed.
+        os.close(read_fd)
+
+
+def _command_function(target: str) -> Callable:
+    module_name, function_name = target.split(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def run_agent_command(agent: AgentConnection, request: dict, commands: Dict[str, str]) -> Optional[int]:
+    """
+    Runs a command for a request made by delegate_to_agent, or declines to.
+
+    :return: the command's exit code (for the caller to send, once ready for another command), or None if declined
+    """
+    command = request.get('command')
+    if command not in commands:
+        agent.send(declined=f"The agent doesn't run {command}.")
+        return None
+    if request.get('environ_digest') != agent_environment_digest():
+        agent.send(declined="The agent's environment is not the command's.")
+        return None
+    exit_code = 0
+    saved_cwd, saved_stdin = os.getcwd(), sys.stdin
+    with _output_sent_to(agent):
+        try:
+            os.chdir(request['cwd'])
+            sys.stdin = AgentInput(agent)
+            _command_function(commands[command])(request['args'])
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except BaseException:  # noQA - whatever happens, it's reported to the command, and the agent goes on
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            sys.stdin = saved_stdin
+            os.chdir(saved_cwd)
+    return exit_code
+
+
+def run_agent(agent_socket: Optional[str] = None, commands: Optional[Dict[str, str]] = None) -> None:
+    """
+    Runs the agent, running the commands sent to it until it's interrupted or terminated. It runs one at a time,
+    declining any sent while it's busy (so they're run as usual, rather than waiting).
+
+    :param agent_socket: the Unix socket on which to listen (default: AGENT_SOCKET)
+    :param commands: the commands to run, and the functions that run them (default: AGENT_COMMANDS)
+    """
+    global _IN_AGENT
+    from .portal_network_access import keep_portal_session
+    agent_socket = agent_socket or AGENT_SOCKET
+    commands = AGENT_COMMANDS if commands is None else commands
+    if not hasattr(socket, 'AF_UNIX'):
+        raise RuntimeError("The agent needs Unix sockets, which aren't available here.")
+    for target in commands.values():
+        _command_function(target)  # Import everything now, rather than when a command first needs it.
+    keep_portal_session()
+    _IN_AGENT = True
+    os.makedirs(os.path.dirname(os.path.abspath(agent_socket)), mode=0o700, exist_ok=True)
+    problem = socket_folder_problem(agent_socket)
+    if problem:
+        raise RuntimeError(f"The agent's socket can't go in a folder others could use. {problem}")
+    with contextlib.suppress(OSError), socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        probe.connect(agent_socket)
+        raise RuntimeError(f"An agent is already listening on {agent_socket}.")
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(agent_socket)  # left by an agent that didn't stop cleanly
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        old_umask = os.umask(0o177)  # Only the user can connect.
+        try:
+            listener.bind(agent_socket)
+        finally:
+            os.umask(old_umask)
+        listener.listen()
+        _print(f"Agent listening on {agent_socket}.")
+        busy = threading.Lock()
+
+        def serve(agent: AgentConnection):
+            exit_code = None
+            try:
+                request = agent.receive()
+                if request is not None:
+                    exit_code = run_agent_command(agent, request, commands)
+            except OSError as e:  # e.g., the command was interrupted
+                _print(f"Lost touch with a command. {e.__class__.__name__}: {e}")
+            finally:
+                busy.release()  # before the command exits, so that one run straight after isn't declined
+            try:
+                if exit_code is not None:
+                    with contextlib.suppress(OSError):
+                        agent.send(exit=exit_code)
+            finally:
+                agent.close()
+
+        while True:
+            connection, _ = listener.accept()
+            if not is_own_process(connection):
+                connection.close()
+                continue
+            agent = AgentConnection(connection)
+            if not busy.acquire(blocking=False):
+                with contextlib.suppress(OSError):
+                    agent.send(declined="The agent is busy running another command.")
+                agent.close()
+                continue
+            threading.Thread(target=serve, args=(agent,), daemon=True).start()
+    except KeyboardInterrupt:
+        _print("Agent stopped.")
+    finally:
+        listener.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(agent_socket)
+        _IN_AGENT = False
@@ -0,0 +1,318 @@
+# This file contains support for limiting (and reporting) the rate at which files are uploaded.
+#
+# The limit is given by SUBMITCGAP_BANDWIDTH_LIMIT, either as a single rate (e.g., "200Mb/s" or "25MB/s")
+# or as a schedule of rates for times of day (e.g., "08:00-18:00=200Mb/s, 18:00-08:00=unlimited").
+# Times of day not covered by the schedule are unlimited.
+#
+# A limit for all the SubmitCGAP processes on a host together can be given, in the same way, by
+# SUBMITCGAP_HOST_BANDWIDTH_LIMIT. It is divided equally among the transfers going on on the host
+# (see host_coordination.py), and each process keeps to both its own limit and the shares of its own transfers.
+
+import configparser
+import datetime
+import os
+import re
+import tempfile
+import threading
+import time
+from dcicutils.misc_utils import PRINT
+from typing import Callable, List, Optional, Tuple
+from .host_coordination import HOST_BANDWIDTH_LIMIT_VAR, HOST_COORDINATOR, HostCoordinator
+from .utils import show
+
+
+BANDWIDTH_LIMIT_VAR = 'SUBMITCGAP_BANDWIDTH_LIMIT'
+
+RATE_REPORT_INTERVAL = 1  # seconds between live reports of upload progress
+
+# How many seconds' worth of unused bandwidth a TokenBucket can save up for a burst.
+BURST_SECONDS = 1.0
+
+UNLIMITED = 'unlimited'
+
+RATE_REGEXP = re.compile(r"^([0-9]+(?:[.][0-9]*)?)\s*([kKmMgGtT]?)([bB])(?:/s|ps)?$")
+
+RATE_MULTIPLIERS = {'': 1, 'k': 1000, 'm': 1000 ** 2, 'g': 1000 ** 3, 't': 1000 ** 4}
+
+SCHEDULE_PERIOD_REGEXP = re.compile(r"^([0-2]?[0-9]:[0-5][0-9])\s*-\s*([0-2]?[0-9]:[0-5][0-9])\s*=\s*(.+)$")
+
+
+def parse_rate(spec: str) -> Optional[float]:
+    """
+    Parses a rate such as "200Mb/s" (megabits) or "25MB/s" (megabytes), returning it in bytes per second.
+
+    Returns None for "unlimited" (or for "0", which means the same).
+    """
+    spec = spec.strip()
+    if spec.lower() in (UNLIMITED, '0'):
+        return None
+    matched = RATE_REGEXP.match(spec)
+    if not matched:
+        raise ValueError(f"Not a rate (such as 200Mb/s, 25MB/s or {UNLIMITED}): {spec!r}")
+    number, prefix, unit = matched.groups()
+    rate = float(number) * RATE_MULTIPLIERS[prefix.lower()] / (8 if unit == 'b' else 1)
+    return rate or None
+
+
+def format_rate(bytes_per_second: Optional[float]) -> str:
+    """Returns a rate in bytes per second in human-readable form, as megabytes and megabits per second."""
+    if bytes_per_second is None:
+        return UNLIMITED
+    return "%.1f MB/s (%.0f Mb/s)" % (bytes_per_second / 1000 ** 2, bytes_per_second * 8 / 1000 ** 2)
+
+
+def _parse_time_of_day(spec: str) -> datetime.time:
+    hours, minutes = spec.split(':')
+    return datetime.time(int(hours) % 24, int(minutes))
+
+
+class BandwidthSchedule:
+    """Rates (in bytes per second, or None for unlimited) for periods of the day."""
+
+    def __init__(self, periods: List[Tuple[datetime.time, datetime.time, Optional[float]]]):
+        """
+        :param periods: a list of (start, end, rate) tuples. A period ending earlier than it starts
+            runs through midnight. The first period containing a given time of day gives the rate at that time.
+        """
+        self.periods = periods
+
+    @classmethod
+    def parse(cls, spec: Optional[str]) -> 'BandwidthSchedule':
+        """Parses a rate, or a comma-separated list of periods of the form HH:MM-HH:MM=<rate>."""
+        periods = []
+        for part in (spec or '').split(','):
+            part = part.strip()
+            if not part:
+                continue
+            matched = SCHEDULE_PERIOD_REGEXP.match(part)
+            if matched:
+                start, end, rate = matched.groups()
+                periods.append((_parse_time_of_day(start), _parse_time_of_day(end), parse_rate(rate)))
+            else:
+                midnight = datetime.time(0, 0)
+                periods.append((midnight, midnight, parse_rate(part)))  # all day
+        return cls(periods)
+
+    def rate_at(self, when: datetime.datetime) -> Optional[float]:
+        """Returns the rate, in bytes per second, at the given time, or None if there's no limit."""
+        time_of_day = when.time()
+        for start, end, rate in self.periods:
+            if start < end:
+                in_period = start <= time_of_day < end
+            else:  # runs through midnight (or, if start == end, all day)
+                in_period = time_of_day >= start or time_of_day < end
+            if in_period:
+                return rate
+        return None
+
+
+class HostBandwidthShare:
+    """
+    The share of a host-wide bandwidth limit due to this process: an equal share for each of the transfers going on
+    on the host, times the number of those that are this process's.
+
+    Calling it returns that share, in bytes per second, or None if there's no host-wide limit.
+    The number of transfers on the host is looked up at most once every refresh_interval seconds.
+    """
+
+    def __init__(self, schedule: BandwidthSchedule, coordinator: HostCoordinator,
+                 refresh_interval: float = RATE_REPORT_INTERVAL, clock: Callable[[], float] = time.monotonic,
+                 now: Callable[[], datetime.datetime] = datetime.datetime.now):
+        self.schedule = schedule
+        self.coordinator = coordinator
+        self.refresh_interval = refresh_interval
+        self._clock = clock
+        self._now = now
+        self._lock = threading.Lock()
+        self._transfers = 1
+        self._checked = None
+
+    def __call__(self) -> Optional[float]:
+        rate = self.schedule.rate_at(self._now())
+        if rate is None:
+            return None
+        with self._lock:
+            t = self._clock()
+            if self._checked is None or t - self._checked >= self.refresh_interval:
+                self._transfers = max(1, self.coordinator.active_transfers())
+                self._checked = t
+            # The count of the host's transfers may be a little out of date, so it's no less than this process's.
+            local_transfers = max(1, self.coordinator.local_transfers())
+            return rate * local_transfers / max(self._transfers, local_transfers)
+
+
+class TokenBucket:
+    """
+    A token-bucket rate limiter, shared by all the transfers of a run, for a rate that can change with time of day.
+
+    Each transfer calls consume before sending a chunk of data, which waits until the bucket has the bandwidth for it.
+    Waiting transfers are served in the order they asked, so concurrent transfers share the bandwidth fairly.
+    """
+
+    def __init__(self, schedule: BandwidthSchedule, burst_seconds: float = BURST_SECONDS,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep,
+                 now: Callable[[], datetime.datetime] = datetime.datetime.now,
+                 ceiling: Optional[Callable[[], Optional[float]]] = None):
+        """
+        :param schedule: the rates to keep to
+        :param ceiling: a function returning a further limit on the rate (e.g., a HostBandwidthShare), or None
+        """
+        self.schedule = schedule
+        self.ceiling = ceiling
+        self.burst_seconds = burst_seconds
+        self._clock = clock
+        self._sleep = sleep
+        self._now = now
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = clock()
+        self.transfers = 1  # the most transfers that may share the bucket at once (see transfer_rate)
+
+    def current_rate(self) -> Optional[float]:
+        """Returns the rate limit now in effect, in bytes per second, or None if there is none."""
+        rates = [self.schedule.rate_at(self._now()), self.ceiling() if self.ceiling is not None else None]
+        rates = [rate for rate in rates if rate is not None]
+        return min(rates) if rates else None
+
+    def transfer_rate(self) -> Optional[float]:
+        """
+        Returns the rate limit now in effect for a transfer that can't draw from the bucket (such as one by the AWS
+        CLI), which keeps to an equal share of the limit with the others that may be going on at once.
+        """
+        rate = self.current_rate()
+        return rate / self.transfers if rate is not None else None
+
+    def consume(self, nbytes: int) -> float:
+        """
+        Waits until nbytes can be sent without exceeding the rate limit.
+
+        :return: the number of seconds waited
+        """
+        rate = self.current_rate()
+        with self._lock:
+            t = self._clock()
+            elapsed, self._last = t - self._last, t
+            if rate is None:
+                self._tokens = 0.0
+                return 0.0
+            # Tokens can go negative. That's bandwidth promised to transfers already waiting for it.
+            self._tokens = min(rate * self.burst_seconds, self._tokens + elapsed * rate) - nbytes
+            wait_seconds = -self._tokens / rate if self._tokens < 0 else 0.0
+        if wait_seconds > 0:
+            self._sleep(wait_seconds)
+        return wait_seconds
+
+
+class TransferMeter:
+    """Keeps count of the bytes of a transfer sent so far, reporting progress and rate now and then."""
+
+    def __init__(self, description: str, total_bytes: Optional[int], limiter: Optional[TokenBucket] = None,
+                 clock: Callable[[], float] = time.monotonic, report_interval: float = RATE_REPORT_INTERVAL):
+        self.description = description
+        self.total_bytes = total_bytes
+        self.limiter = limiter
+        self._clock = clock
+        self.report_interval = report_interval
+        self._lock = threading.Lock()
+        self._start = clock()
+        self._last_report = self._start
+        self.bytes_sent = 0
+
+    def rate(self) -> float:
+        """Returns the average rate of the transfer so far, in bytes per second."""
+        elapsed = self._clock() - self._start
+        return self.bytes_sent / elapsed if elapsed > 0 else 0.0
+
+    def progress_message(self) -> str:
+        if self.total_bytes is None:  # e.g., a stream, whose size isn't known until it ends
+            message = f"{self.description} | {self.bytes_sent / 1000 ** 2:.1f} MB | {format_rate(self.rate())}"
+        else:
+            percent = 100 * self.bytes_sent // self.total_bytes if self.total_bytes else 100
+            message = (f"{self.description} | {self.bytes_sent / 1000 ** 2:.1f} of {self.total_bytes / 1000 ** 2:.1f}"
+                       f" MB ({percent}%) | {format_rate(self.rate())}")
+        limit = self.limiter.current_rate() if self.limiter is not None else None
+        if limit is not None:
+            message += f" | Limit: {format_rate(limit)}"
+        return message
+
+    def add(self, nbytes: int) -> None:
+        """Counts more bytes sent, showing a progress report if it's been a while since the last one."""
+        with self._lock:
+            self.bytes_sent += nbytes
+            t = self._clock()
+            if t - self._last_report < self.report_interval:
+                return
+            self._last_report = t
+            message = self.progress_message()
+        show(message, same_line=True)
+
+    def finish(self) -> None:
+        """Shows a final report."""
+        show(self.progress_message() + "\n", same_line=True)
+
+
+def _aws_config_parser() -> configparser.ConfigParser:
+    config = configparser.ConfigParser(interpolation=None, default_section='')  # The AWS CLI has no [DEFAULT].
+    config.optionxform = str  # Keep the case of setting names.
+    return config
+
+
+def _aws_config_setting(key: str, value: str) -> str:
+    if key != 's3' and '\n' not in value:
+        return f"{key} = {value}\n"
+    return f"{key} =\n" + "".join(f"  {line.strip()}\n" for line in value.strip().splitlines())  # nested settings
+
+
+def write_aws_cli_bandwidth_config(rate: float, environ: Optional[dict] = None) -> str:
+    """
+    Writes an AWS CLI configuration file limiting 'aws s3' commands to the given rate (in bytes per second).
+
+    The file is a copy of the user's own AWS CLI configuration (AWS_CONFIG_FILE, or ~/.aws/config), if any, with
+    the limit added to each profile, so a profile given by AWS_PROFILE (and its region, etc.) is still found.
+    The AWS CLI can't be asked to share bandwidth with other transfers, or to change its rate while running,
+    so the rate should be that of the transfer's share of the limit in effect at its start (see transfer_rate).
+
+    :param rate: the rate, in bytes per second
+    :param environ: the environment in which the AWS CLI is to run (default: this process's)
+    :return: the name of the file, which the caller should delete when done
+    """
+    environ = os.environ if environ is None else environ
+    source = environ.get('AWS_CONFIG_FILE') or os.path.join(os.path.expanduser('~'), '.aws', 'config')
+    config = _aws_config_parser()
+    try:
+        config.read(source)
+    except configparser.Error as e:
+        PRINT(f"Not copying AWS CLI configuration {source} because of {e.__class__.__name__}: {e}")
+        config = _aws_config_parser()
+    for profile in [environ.get('AWS_DEFAULT_PROFILE'), environ.get('AWS_PROFILE')]:
+        if profile and profile != 'default' and not config.has_section(f"profile {profile}"):
+            config.add_section(f"profile {profile}")
+    if not config.has_section('default'):
+        config.add_section('default')
+    parts = []
+    for section in sorted(config.sections(), key=lambda name: name != 'default'):
+        options = dict(config.items(section, raw=True))
+        if section == 'default' or section.startswith('profile '):
+            s3 = [line.strip() for line in options.get('s3', '').splitlines()
+                  if line.strip() and not line.strip().startswith('max_bandwidth')]
+            options['s3'] = "\n".join(s3 + [f"max_bandwidth = {int(rate)}B/s"])
+        parts.append(f"[{section}]\n" + "".join(_aws_config_setting(key, value) for key, value in options.items()))
+    fd, filename = tempfile.mkstemp(prefix='submit-cgap-aws-config-', suffix='.ini')
+    try:
+        os.write(fd, "\n".join(parts).encode('utf-8'))
+    finally:
+        os.close(fd)
+    return filename
+
+
+def _compute_bandwidth_schedule(var=BANDWIDTH_LIMIT_VAR):  # factored out as a function for testing
+    try:
+        return BandwidthSchedule.parse(os.environ.get(var))
+    except ValueError as e:
+        PRINT(f"Ignoring {var}. {e}")
+        return BandwidthSchedule([])
+
+
+BANDWIDTH_LIMITER = TokenBucket(_compute_bandwidth_schedule(),
+                                ceiling=HostBandwidthShare(_compute_bandwidth_schedule(HOST_BANDWIDTH_LIMIT_VAR),
+                                                           coordinator=HOST_COORDINATOR))
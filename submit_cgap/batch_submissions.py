@@ -0,0 +1,368 @@
+# This file contains batch submission: submitting many bundles (or gene lists, or anything else that's ingested),
+# listed in a manifest, several at once, keeping track of each in a queue (an SQLite database) so that a batch that's
+# stopped (or that crashes) can be run again and carry on where it left off.
+#
+# A manifest is either a list of files, one per line, or a CSV table (TSV, if its name ends in .tsv) with a filename
+# column and, optionally, ingestion_type and upload_folder columns. (Files are relative to the manifest's folder.)
+# Each file is submitted, its processing is waited for, and then the files it calls for are uploaded, without asking.
+# Errors (e.g., network errors, or files that failed to upload) are retried after a delay that doubles each time, up
+# to a number of attempts. Files whose processing fails (e.g., because a bundle isn't valid) aren't retried, since
+# they'd only fail again, unless the batch is run again with retry_failed (once they've been fixed). A submission
+# is never made twice: an item that was submitted before the batch stopped has its processing checked on, and its
+# uploads done, when the batch is run again, and uploads done before it stopped aren't done again (see
+# upload_ledger.py).
+
+import concurrent.futures
+import contextlib
+import csv
+import os
+import sqlite3
+import threading
+import time
+from dcicutils.lang_utils import n_of
+from typing import Callable, Dict, List, Optional
+from .base import DEFAULT_APP, KEY_MANAGER
+from .submission import (
+    ATTEMPTS_BEFORE_TIMEOUT, DEFAULT_INGESTION_TYPE, DEFAULT_SUBMISSION_PROTOCOL, PROGRESS_CHECK_INTERVAL,
+    _check_ingestion_progress, do_any_uploads, get_ingestion_submission, get_section, post_ingestion_submission,
+    resolve_submission_context,
+)
+from .upload_ledger import UPLOAD_LEDGER
+from .utils import show
+
+
+DEFAULT_BATCH_CONCURRENCY = 4  # files submitted (and waited for, and uploaded for) at once
+DEFAULT_BATCH_ATTEMPTS = 5  # times an item is tried before it's given up on
+DEFAULT_BATCH_RETRY_DELAY = 30  # seconds before an item is first tried again, doubling each time after that
+BATCH_RETRY_DELAY_MAX = 3600  # the most seconds to wait before trying an item again
+
+BATCH_QUEUE_SUFFIX = '.queue.sqlite3'
+
+BATCH_QUEUE_TIMEOUT = 30  # seconds to wait for another thread's (or process's) write to finish
+
+BATCH_RESULT_COLUMNS = ['filename', 'ingestion_type', 'state', 'submission_uuid', 'outcome', 'attempts', 'error',
+                        'started', 'finished']
+
+
+class BatchState:
+    PENDING = 'pending'  # to be submitted
+    SUBMITTED = 'submitted'  # awaiting processing
+    PROCESSED = 'processed'  # processed successfully, with files (perhaps) to be uploaded
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+BATCH_ACTIVE_STATES = [BatchState.PENDING, BatchState.SUBMITTED, BatchState.PROCESSED]
+
+BATCH_QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    server TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    ingestion_type TEXT NOT NULL,
+    upload_folder TEXT,
+    state TEXT NOT NULL,
+    submission_uuid TEXT,
+    outcome TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    started REAL,
+    finished REAL,
+    UNIQUE (server, filename, ingestion_type)
+);
+"""
+
+
+def read_batch_manifest(manifest: str, ingestion_type: str = DEFAULT_INGESTION_TYPE,
+                        upload_folder: Optional[str] = None) -> List[dict]:
+    """
+    Returns the items (each with a filename, ingestion_type and upload_folder) a manifest lists, with filenames
+    made absolute. (See the top of this file for the forms a manifest can take.) Items with no ingestion_type or
+    upload_folder given get those given here.
+    """
+    folder = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, newline='') as fp:
+        rows = [row for row in csv.reader(fp, delimiter='\t' if manifest.endswith('.tsv') else ',')
+                if row and any(cell.strip() for cell in row) and not row[0].startswith('#')]
+    header = [cell.strip() for cell in rows[0]] if rows else []
+    if 'filename' in header:
+        rows = [dict(zip(header, [cell.strip() for cell in row])) for row in rows[1:]]
+    else:  # a list of files
+        rows = [{'filename': row[0].strip()} for row in rows]
+    return [{'filename': os.path.join(folder, row['filename']),
+             'ingestion_type': row.get('ingestion_type') or ingestion_type,
+             'upload_folder': os.path.join(folder, row['upload_folder']) if row.get('upload_folder') else upload_folder}
+            for row in rows]
+
+
+class BatchQueue:
+    """
+    A queue of files to submit, and of how far each has got, in an SQLite database (so it outlasts the process).
+    Items are identified by server, filename and ingestion type, so a manifest can be added again without
+    adding its items twice.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _connection(self):
+        connection = sqlite3.connect(self.filename, timeout=BATCH_QUEUE_TIMEOUT)
+        try:
+            connection.row_factory = sqlite3.Row
+            connection.executescript(BATCH_QUEUE_SCHEMA)
+            with connection:  # commits on success, rolls back on error
+                yield connection
+        finally:
+            connection.close()
+
+    def _execute(self, statement: str, parameters=()) -> List[dict]:
+        with self._lock:
+            with self._connection() as connection:
+                return [dict(row) for row in connection.execute(statement, parameters).fetchall()]
+
+    def add_items(self, server: str, items: List[dict]) -> None:
+        """Adds items (as read_batch_manifest returns them) to the queue, unless they're there already."""
+        for item in items:
+            self._execute("INSERT OR IGNORE INTO items (server, filename, ingestion_type, upload_folder, state)"
+                          " VALUES (?, ?, ?, ?, ?)",
+                          (server, item['filename'], item['ingestion_type'], item['upload_folder'],
+                           BatchState.PENDING))
+
+    def get_items(self, server: str, states: Optional[List[str]] = None) -> List[dict]:
+        """Returns the items for a server (optionally only those in any of the given states), in the order added."""
+        states = states or [BatchState.PENDING, BatchState.SUBMITTED, BatchState.PROCESSED, BatchState.DONE,
+                            BatchState.FAILED]
+        return self._execute(f"SELECT * FROM items WHERE server = ? AND state IN ({', '.join('?' * len(states))})"
+                             f" ORDER BY id", (server, *states))
+
+    def update_item(self, item_id: int, **columns) -> None:
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        self._execute(f"UPDATE items SET {assignments} WHERE id = ?", (*columns.values(), item_id))
+
+    def retry_failed(self, server: str) -> None:
+        """
+        Gives the failed items for a server a fresh set of attempts, from where they failed: items whose
+        processing failed are submitted again, and others pick up where they left off.
+        """
+        for item in self.get_items(server, [BatchState.FAILED]):
+            if not item['submission_uuid'] or (item['outcome'] and item['outcome'] != "success"):
+                self.update_item(item['id'], state=BatchState.PENDING, submission_uuid=None, outcome=None)
+            else:
+                self.update_item(item['id'], state=BatchState.PROCESSED if item['outcome'] else BatchState.SUBMITTED)
+            self.update_item(item['id'], attempts=0, next_attempt=0, error=None, finished=None)
+
+
+class BatchSubmitter:
+    """
+    Submits the items in a BatchQueue, several at once, waiting for their processing and doing their uploads,
+    retrying (after a delay that doubles each time) those that run into errors.
+    """
+
+    def __init__(self, queue: BatchQueue, *, server: str, keydict: dict, app_args: dict,
+                 validate_only: bool = False, subfolders: bool = False,
+                 submission_protocol: str = DEFAULT_SUBMISSION_PROTOCOL,
+                 concurrency: int = DEFAULT_BATCH_CONCURRENCY, attempts: int = DEFAULT_BATCH_ATTEMPTS,
+                 retry_delay: float = DEFAULT_BATCH_RETRY_DELAY, clock: Callable[[], float] = time.time,
+                 sleep: Callable[[float], None] = time.sleep):
+        """
+        :param queue: the BatchQueue whose items are to be submitted
+        :param server: the server to submit to
+        :param keydict: keydict-style auth for the server
+        :param app_args: the (defaulted) app args for submissions (see submit_any_ingestion)
+        :param concurrency: the number of items to work on at once
+        :param attempts: the number of times to try an item before giving up on it
+        :param retry_delay: the seconds to wait before first trying an item again (doubling each time after that)
+        (The other arguments are as for submit_any_ingestion.)
+        """
+        self.queue = queue
+        self.server = server
+        self.keydict = keydict
+        self.keypair = KEY_MANAGER.keydict_to_keypair(keydict)
+        self.app_args = app_args
+        self.validate_only = validate_only
+        self.subfolders = subfolders
+        self.submission_protocol = submission_protocol
+        self.concurrency = concurrency
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self._clock = clock
+        self._sleep = sleep
+
+    def wait_for_processing(self, uuid: str) -> tuple:
+        """Waits for a submission to be processed, returning its outcome and the IngestionSubmission."""
+        poll_state = {}
+        for check in range(ATTEMPTS_BEFORE_TIMEOUT):
+            if check:
+                self._sleep(PROGRESS_CHECK_INTERVAL)
+            done, outcome, response = _check_ingestion_progress(uuid, keypair=self.keypair, server=self.server,
+                                                                poll_state=poll_state)
+            if done:
+                return outcome, response
+        raise TimeoutError(f"Processing of submission {uuid} hadn't finished after"
+                           f" {n_of(ATTEMPTS_BEFORE_TIMEOUT, 'check')}.")
+
+    def run_item(self, item: dict) -> None:
+        """Takes an item as far as it can go: submitted, processed, and its files uploaded (or as far as it fails)."""
+        item_id, filename = item['id'], item['filename']
+        name = os.path.basename(filename)
+        attempt = item['attempts'] + 1
+        self.queue.update_item(item_id, attempts=attempt, started=item['started'] or self._clock())
+        try:
+            state, uuid, response = item['state'], item['submission_uuid'], None
+            if state == BatchState.PENDING:
+                if not os.path.exists(filename):
+                    raise ValueError(f"The file '{filename}' does not exist.")
+                uuid = post_ingestion_submission(filename, ingestion_type=item['ingestion_type'], server=self.server,
+                                                 keydict=self.keydict, validate_only=self.validate_only,
+                                                 app_args=self.app_args, submission_protocol=self.submission_protocol)
+                state = BatchState.SUBMITTED
+                self.queue.update_item(item_id, state=state, submission_uuid=uuid)
+                show(f"Submitted {name}, assigned uuid {uuid} for tracking. Awaiting processing...", with_time=True)
+            if state == BatchState.SUBMITTED:
+                outcome, response = self.wait_for_processing(uuid)
+                if outcome != "success":
+                    errors = get_section(response, 'errors') or []
+                    self.queue.update_item(item_id, state=BatchState.FAILED, outcome=outcome, finished=self._clock(),
+                                           error="; ".join(map(str, errors)) if isinstance(errors, list) else
+                                           str(errors))
+                    show(f"Processing of {name} (uuid {uuid}) finished. Final status: {(outcome or 'unknown').title()}",
+                         with_time=True)
+                    return
+                state = BatchState.PROCESSED
+                self.queue.update_item(item_id, state=state, outcome=outcome)
+                show(f"Processing of {name} (uuid {uuid}) finished. Final status: Success", with_time=True)
+            if not self.validate_only:
+                response = response or get_ingestion_submission(self.server, uuid, keypair=self.keypair)
+                if not do_any_uploads(response, keydict=self.keydict, upload_folder=item['upload_folder'],
+                                      ingestion_filename=filename, no_query=True, subfolders=self.subfolders):
+                    # The upload ledger, if it's being kept, can say which.
+                    not_uploaded = [upload_spec['filename']
+                                    for upload_spec in get_section(response, 'upload_info') or []
+                                    if UPLOAD_LEDGER.enabled
+                                    and not UPLOAD_LEDGER.is_complete(self.server, uuid, upload_spec['uuid'])]
+                    raise RuntimeError("Not all files were uploaded"
+                                       + (f": {', '.join(not_uploaded)}." if not_uploaded else "."))
+            self.queue.update_item(item_id, state=BatchState.DONE, error=None, finished=self._clock())
+        except Exception as e:
+            error = f"{e.__class__.__name__}: {e}"
+            if attempt >= self.attempts:
+                self.queue.update_item(item_id, state=BatchState.FAILED, error=error, finished=self._clock())
+                show(f"Giving up on {name}, after {n_of(attempt, 'attempt')}. {error}", with_time=True)
+            else:
+                delay = min(self.retry_delay * 2 ** (attempt - 1), BATCH_RETRY_DELAY_MAX)
+                self.queue.update_item(item_id, error=error, next_attempt=self._clock() + delay)
+                show(f"{name} will be tried again in {delay:g} seconds. {error}", with_time=True)
+
+    def run(self) -> Dict[str, int]:
+        """
+        Works on the items in the queue until each is done or failed.
+
+        :return: the number of items in each state
+        """
+        running: Dict[concurrent.futures.Future, int] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while True:
+                now = self._clock()
+                waiting = []
+                for item in self.queue.get_items(self.server, BATCH_ACTIVE_STATES):
+                    if item['id'] in running.values():
+                        continue
+                    if item['next_attempt'] > now:
+                        waiting.append(item['next_attempt'])
+                    elif len(running) < self.concurrency:
+                        running[executor.submit(self.run_item, item)] = item['id']
+                if not running and not waiting:
+                    break
+                timeout = max(0, min(waiting) - now) if waiting else None
+                if not running:
+                    self._sleep(timeout)
+                    continue
+                finished, _ = concurrent.futures.wait(running, timeout=timeout,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    del running[future]
+                    future.result()  # run_item handles its own errors, so this only raises if something's very wrong
+        counts = {state: 0 for state in [BatchState.DONE, BatchState.FAILED]}
+        for item in self.queue.get_items(self.server):
+            counts[item['state']] = counts.get(item['state'], 0) + 1
+        return counts
+
+
+def export_batch_results(queue: BatchQueue, server: str, results_file: str) -> None:
+    """Writes a table (TSV, if the file's name ends in .tsv, or else CSV) of what became of each item in a queue."""
+    with open(results_file, 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=BATCH_RESULT_COLUMNS, extrasaction='ignore',
+                                delimiter='\t' if results_file.endswith('.tsv') else ',')
+        writer.writeheader()
+        for item in queue.get_items(server):
+            writer.writerow(dict(item, **{column: time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(item[column]))
+                                          for column in ['started', 'finished'] if item[column]}))
+
+
+def submit_batch(manifest, *, server=None, env=None, institution=None, project=None, lab=None, award=None,
+                 consortium=None, submission_center=None, app=None, ingestion_type=DEFAULT_INGESTION_TYPE,
+                 validate_only=False, upload_folder=None, subfolders=False,
+                 submission_protocol=DEFAULT_SUBMISSION_PROTOCOL, concurrency=DEFAULT_BATCH_CONCURRENCY,
+                 attempts=DEFAULT_BATCH_ATTEMPTS, retry_delay=DEFAULT_BATCH_RETRY_DELAY, queue_file=None,
+                 results_file=None, retry_failed=False) -> Dict[str, int]:
+    """
+    Submits the files a manifest lists, several at once (see BatchSubmitter), carrying on from where any earlier run
+    with the same queue left off. The arguments are as for submit_any_ingestion (ingestion_type and upload_folder
+    being defaults for items that don't give their own), except:
+
+    :param manifest: the manifest listing the files to submit
+    :param concurrency: the number of files to work on at once
+    :param attempts: the number of times to try a file before giving up on it
+    :param retry_delay: the seconds to wait before first trying a file again (doubling each time after that)
+    :param queue_file: the SQLite database in which to keep the queue (default: the manifest's name with
+        .queue.sqlite3 added)
+    :param results_file: a file to which to write a table of results (see export_batch_results), if any
+    :param retry_failed: whether to try again the files that failed in earlier runs
+    :return: the number of files in each state (done, failed, etc.)
+    """
+
+    if app is None:  # For legacy reasons, SubmitCGAP was the first so didn't expect this arg was needed
+        app = DEFAULT_APP
+
+    if KEY_MANAGER.selected_app != app:
+        with KEY_MANAGER.locally_selected_app(app):
+            return submit_batch(manifest, server=server, env=env, institution=institution, project=project,
+                                lab=lab, award=award, consortium=consortium, submission_center=submission_center,
+                                app=app, ingestion_type=ingestion_type, validate_only=validate_only,
+                                upload_folder=upload_folder, subfolders=subfolders,
+                                submission_protocol=submission_protocol, concurrency=concurrency, attempts=attempts,
+                                retry_delay=retry_delay, queue_file=queue_file, results_file=results_file,
+                                retry_failed=retry_failed)
+
+    items = read_batch_manifest(manifest, ingestion_type=ingestion_type, upload_folder=upload_folder)
+    server, keydict, app_args = resolve_submission_context(
+        server=server, env=env, app=app, institution=institution, project=project, lab=lab, award=award,
+        consortium=consortium, submission_center=submission_center)
+
+    queue = BatchQueue(queue_file or manifest + BATCH_QUEUE_SUFFIX)
+    queue.add_items(server, items)
+    if retry_failed:
+        queue.retry_failed(server)
+    done = len(queue.get_items(server, [BatchState.DONE]))
+    show(f"Submitting {n_of(len(items), 'file')} from {manifest} to {server}, {concurrency} at once"
+         f"{f' ({done} done already)' if done else ''}. Progress is kept in {queue.filename}.", with_time=True)
+    submitter = BatchSubmitter(queue, server=server, keydict=keydict, app_args=app_args, validate_only=validate_only,
+                               subfolders=subfolders, submission_protocol=submission_protocol,
+                               concurrency=concurrency, attempts=attempts, retry_delay=retry_delay)
+    try:
+        counts = submitter.run()
+    except KeyboardInterrupt:
+        show("Stopped. Run the same command again to carry on from here.")
+        raise
+    finally:
+        if results_file:
+            export_batch_results(queue, server, results_file)
+    show(f"Batch finished: {counts[BatchState.DONE]} done, {counts[BatchState.FAILED]} failed.", with_time=True)
+    for item in queue.get_items(server, [BatchState.FAILED]):
+        show(f"  {item['filename']}: {item['error'] or item['outcome']}")
+    if results_file:
+        show(f"Results written to {results_file}.")
+    return counts
@@ -0,0 +1,201 @@
+# This file contains compression, as files are uploaded, of uncompressed files (e.g., FASTQ or VCF) that the portal
+# expects compressed (e.g., as .fastq.gz or .vcf.gz), so they needn't be compressed (to a temporary file) first.
+#
+# If SUBMITCGAP_COMPRESS_UPLOADS is set, a file to be uploaded with a name ending in .gz (or .bgz) that isn't found,
+# but that is there uncompressed (without the .gz), is compressed as it's uploaded. It's compressed to BGZF, the
+# blocked gzip format of htslib: a series of gzip members, each of at most 64KiB uncompressed, which any gzip reader
+# can read, and which tools such as samtools and tabix can index and seek in. Blocks are compressed independently,
+# SUBMITCGAP_COMPRESS_THREADS at once (zlib lets go of Python's lock while compressing, so threads use many cores),
+# at level SUBMITCGAP_COMPRESS_LEVEL. Blocks are cut at fixed places, and their headers carry no time stamps,
+# so the same file always compresses to the same bytes, however many threads compress it.
+
+import collections
+import concurrent.futures
+import hashlib
+import io
+import os
+import struct
+import zlib
+from dcicutils.misc_utils import PRINT, environ_bool
+from typing import BinaryIO, Callable, Optional
+from .s3_upload import upload_stream_to_s3
+from .upload_tuning import UploadTuner
+
+
+COMPRESS_UPLOADS_VAR = 'SUBMITCGAP_COMPRESS_UPLOADS'
+COMPRESS_THREADS_VAR = 'SUBMITCGAP_COMPRESS_THREADS'
+COMPRESS_LEVEL_VAR = 'SUBMITCGAP_COMPRESS_LEVEL'
+
+DEFAULT_COMPRESS_LEVEL = 6
+
+COMPRESSED_SUFFIXES = ('.gz', '.bgz')
+
+BGZF_BLOCK_SIZE = 0xff00  # uncompressed bytes per block, as htslib has it, so a block fits in 64KiB even if it grows
+BGZF_BATCH_BLOCKS = 64  # blocks compressed together, by one thread, to keep the cost of handing out work down
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")  # the empty block that ends a file
+
+_BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+_BGZF_TRAILER = struct.Struct('<II')
+
+
+def _compute_compress_threads():  # factored out as a function for testing
+    value = os.environ.get(COMPRESS_THREADS_VAR)
+    default = os.cpu_count() or 1
+    try:
+        threads = int(value) if value else default
+        if threads < 1:
+            raise ValueError("It must be at least 1.")
+    except ValueError as e:
+        PRINT(f"Ignoring {COMPRESS_THREADS_VAR}={value!r}. {e}")
+        threads = default
+    return threads
+
+
+def _compute_compress_level():  # factored out as a function for testing
+    value = os.environ.get(COMPRESS_LEVEL_VAR)
+    try:
+        level = int(value) if value else DEFAULT_COMPRESS_LEVEL
+        if not 1 <= level <= 9:
+            raise ValueError("It must be from 1 to 9.")
+    except ValueError as e:
+        PRINT(f"Ignoring {COMPRESS_LEVEL_VAR}={value!r}. {e}")
+        level = DEFAULT_COMPRESS_LEVEL
+    return level
+
+
+COMPRESS_UPLOADS = environ_bool(COMPRESS_UPLOADS_VAR)
+COMPRESS_THREADS = _compute_compress_threads()
+COMPRESS_LEVEL = _compute_compress_level()
+
+
+def compress_block(data: bytes, level: int = DEFAULT_COMPRESS_LEVEL) -> bytes:
+    """Returns a BGZF block holding the given data (of at most BGZF_BLOCK_SIZE bytes)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = _BGZF_HEADER.size + len(deflated) + _BGZF_TRAILER.size
+    # ID1, ID2, CM, FLG (FEXTRA), MTIME (none), XFL, OS (unknown), XLEN, then the BC subfield giving the block size.
+    header = _BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, block_size - 1)
+    return header + deflated + _BGZF_TRAILER.pack(zlib.crc32(data), len(data))
+
+
+def compress_blocks(data: bytes, level: int = DEFAULT_COMPRESS_LEVEL) -> bytes:
+    """Returns the BGZF blocks holding the given data, cut into blocks of BGZF_BLOCK_SIZE bytes."""
+    view = memoryview(data)
+    return b"".join(compress_block(view[start:start + BGZF_BLOCK_SIZE], level=level)
+                    for start in range(0, len(data), BGZF_BLOCK_SIZE))
+
+
+def _read_fully(stream: BinaryIO, size: int) -> bytes:
+    """Reads size bytes from a stream (which may return fewer at a time, like a pipe), or fewer at its end."""
+    chunks = []
+    n_read = 0
+    while n_read < size:
+        chunk = stream.read(size - n_read)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        n_read += len(chunk)
+    return b"".join(chunks)
+
+
+class BgzfCompressor(io.RawIOBase):
+    """
+    A read-only file whose contents are those of a stream compressed to BGZF, compressed (on several threads)
+    as it's read. The size and md5 checksum of what's read from the stream are kept, as is the number of bytes
+    of compressed data read.
+    """
+
+    def __init__(self, stream: BinaryIO, level: int = DEFAULT_COMPRESS_LEVEL, threads: int = 1):
+        """
+        :param stream: the uncompressed data, read (in order) only as needed
+        :param level: the zlib compression level (1 to 9)
+        :param threads: the number of threads compressing blocks
+        """
+        super().__init__()
+        self._stream = stream
+        self.level = level
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self._max_pending = 2 * threads  # batches read and being (or waiting to be) compressed
+        self._pending = collections.deque()
+        self._compressed = memoryview(b"")
+        self._stream_ended = False
+        self._finished = False
+        self._md5 = hashlib.md5()
+        self.size = 0  # uncompressed bytes read so far
+        self.compressed_size = 0  # compressed bytes read so far
+
+    @property
+    def md5(self) -> str:
+        """The md5 checksum (in hex) of the uncompressed data read so far."""
+        return self._md5.hexdigest()
+
+    def readable(self):
+        return True
+
+    def _read_ahead(self) -> None:
+        while not self._stream_ended and len(self._pending) < self._max_pending:
+            data = _read_fully(self._stream, BGZF_BLOCK_SIZE * BGZF_BATCH_BLOCKS)
+            if len(data) < BGZF_BLOCK_SIZE * BGZF_BATCH_BLOCKS:
+                self._stream_ended = True
+            if data:
+                self._md5.update(data)
+                self.size += len(data)
+                self._pending.append(self._executor.submit(compress_blocks, data, level=self.level))
+
+    def readinto(self, buffer) -> int:
+        while not len(self._compressed):
+            self._read_ahead()
+            if self._pending:
+                self._compressed = memoryview(self._pending.popleft().result())
+            elif not self._finished:
+                self._compressed = memoryview(BGZF_EOF)
+                self._finished = True
+            else:
+                return 0
+        n = min(len(buffer), len(self._compressed))
+        memoryview(buffer).cast('B')[:n] = self._compressed[:n]
+        self._compressed = self._compressed[n:]
+        self.compressed_size += n
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            for future in self._pending:  # (Python 3.8's shutdown can't be asked to cancel them.)
+                future.cancel()
+            self._executor.shutdown(wait=True)
+        super().close()
+
+
+def uncompressed_source(path: str) -> Optional[str]:
+    """
+    Returns the uncompressed file from which a file to be uploaded is to be compressed as it's uploaded,
+    or None if it's not to be (because COMPRESS_UPLOADS isn't set, or the file is there, or its source isn't).
+    """
+    if not COMPRESS_UPLOADS or not path.endswith(COMPRESSED_SUFFIXES) or os.path.exists(path):
+        return None
+    source = os.path.splitext(path)[0]
+    return source if os.path.isfile(source) else None
+
+
+def upload_compressed_file(source: str, upload_credentials: dict, *, s3_encrypt_key_id: Optional[str] = None,
+                           refresh_credentials: Optional[Callable[[], dict]] = None, s3_client=None,
+                           tuner: Optional[UploadTuner] = None, level: Optional[int] = None,
+                           threads: Optional[int] = None) -> dict:
+    """
+    Compresses a local file to BGZF as it's uploaded to the upload_url given in upload_credentials.
+    (The other arguments are as for upload_file_to_s3, and level and threads default to COMPRESS_LEVEL and
+    COMPRESS_THREADS.)
+
+    :return: a dictionary with the 'size' and 'md5' of the file uploaded (compressed), and the 'source_size' and
+        'source_md5' of the file it was compressed from
+    """
+    source_size = os.path.getsize(source)
+    with open(source, 'rb') as fp:
+        with BgzfCompressor(fp, level=COMPRESS_LEVEL if level is None else level,
+                            threads=COMPRESS_THREADS if threads is None else threads) as compressor:
+            # At worst, compressed data is a little bigger than what's compressed, which will do to choose a part size.
+            result = upload_stream_to_s3(compressor, upload_credentials, max_size=source_size + source_size // 64,
+                                         description=os.path.basename(source) + " (compressing)",
+                                         s3_encrypt_key_id=s3_encrypt_key_id, refresh_credentials=refresh_credentials,
+                                         s3_client=s3_client, tuner=tuner)
+            return dict(result, source_size=compressor.size, source_md5=compressor.md5)
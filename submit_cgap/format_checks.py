@@ -0,0 +1,199 @@
+# This file contains sanity checks of the formats of local files, to be done before they are uploaded.
+#
+# A corrupt or truncated FASTQ, BAM, CRAM or VCF file would otherwise be uploaded in full, only to fail much later
+# in processing on the portal. These checks read each file end to end (so they take a while for big files, and are
+# done on a pool of processes, several files at once), and are turned on by SUBMITCGAP_CHECK_FORMATS.
+
+import concurrent.futures
+import gzip
+import os
+import zlib
+from dcicutils.misc_utils import environ_bool, PRINT
+from typing import Dict, Iterable, Optional
+
+
+CHECK_FORMATS_VAR = 'SUBMITCGAP_CHECK_FORMATS'
+CHECK_FORMATS_WORKERS_VAR = 'SUBMITCGAP_CHECK_FORMATS_WORKERS'
+
+CHECK_CHUNK_SIZE = 1024 * 1024  # bytes of decompressed data read at a time
+
+GZIP_MAGIC = b"\x1f\x8b"
+# A BGZF file is a series of gzip members, each with a 'BC' extra subfield, ending with this empty block.
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+BAM_MAGIC = b"BAM\x01"
+CRAM_MAGIC = b"CRAM"
+CRAM3_EOF = bytes.fromhex("0f000000ffffffff0fe0454f4600000000010005bdd94f0001000606010001000100ee63014b")
+VCF_HEADER_PREFIX = b"##fileformat=VCF"
+
+FASTQ_EXTENSIONS = ('.fastq', '.fq', '.fastq.gz', '.fq.gz')
+VCF_EXTENSIONS = ('.vcf.gz', '.gvcf.gz')
+
+
+CHECK_FORMATS = environ_bool(CHECK_FORMATS_VAR)
+
+
+def _compute_check_formats_workers():  # factored out as a function for testing
+    value = os.environ.get(CHECK_FORMATS_WORKERS_VAR)
+    default = os.cpu_count() or 1
+    try:
+        workers = int(value) if value else default
+        if workers < 1:
+            raise ValueError("It must be at least 1.")
+    except ValueError as e:
+        PRINT(f"Ignoring {CHECK_FORMATS_WORKERS_VAR}={value!r}. {e}")
+        workers = default
+    return workers
+
+
+CHECK_FORMATS_WORKERS = _compute_check_formats_workers()
+
+
+class FormatProblem(Exception):
+    """Raised (internally) when a file is found not to be in good form."""
+    pass
+
+
+def _read_ends(path: str, head_size: int, tail_size: int):
+    with open(path, 'rb') as fp:
+        head = fp.read(head_size)
+        fp.seek(max(0, os.path.getsize(path) - tail_size))
+        tail = fp.read(tail_size)
+    return head, tail
+
+
+def is_bgzf_header(header: bytes) -> bool:
+    """Returns True if the given bytes start a gzip member with a BGZF ('BC') extra subfield."""
+    return (len(header) >= 16 and header[:4] == GZIP_MAGIC + b"\x08\x04"
+            and header[12:14] == b"BC")
+
+
+def _check_bgzf(path: str) -> None:
+    head, tail = _read_ends(path, 18, len(BGZF_EOF))
+    if not is_bgzf_header(head):
+        raise FormatProblem("It is not BGZF-compressed.")
+    if tail != BGZF_EOF:
+        raise FormatProblem("It is truncated (the BGZF end-of-file marker is missing).")
+
+
+def _iter_gzip_data(path: str) -> Iterable[bytes]:
+    """Yields all the decompressed data of a gzip file, raising FormatProblem if it's damaged or truncated."""
+    try:
+        with gzip.open(path, 'rb') as fp:
+            while True:
+                chunk = fp.read(CHECK_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+    except EOFError:
+        raise FormatProblem("It is truncated (the compressed data ends too soon).")
+    except (OSError, zlib.error) as e:  # gzip.BadGzipFile is an OSError
+        raise FormatProblem(f"Its compressed data is damaged. {e}")
+
+
+def _check_gzip(path: str, expected_prefix: Optional[bytes] = None, description: str = "",
+                bgzf_required: bool = False) -> None:
+    head, _ = _read_ends(path, 18, 0)
+    if head[:2] != GZIP_MAGIC and not bgzf_required:
+        raise FormatProblem("It is not gzip-compressed.")
+    if bgzf_required or is_bgzf_header(head):
+        _check_bgzf(path)
+    first = True
+    for chunk in _iter_gzip_data(path):
+        if first and expected_prefix is not None and not chunk.startswith(expected_prefix):
+            raise FormatProblem(f"It does not start as {description} should.")
+        first = False
+
+
+def _check_bam(path: str) -> None:
+    _check_gzip(path, expected_prefix=BAM_MAGIC, description="a BAM file", bgzf_required=True)
+
+
+def _check_cram(path: str) -> None:
+    head, tail = _read_ends(path, 6, len(CRAM3_EOF))
+    if head[:4] != CRAM_MAGIC:
+        raise FormatProblem("It does not start as a CRAM file should.")
+    major_version = head[4] if len(head) > 4 else None
+    if major_version == 3 and tail != CRAM3_EOF:
+        raise FormatProblem("It is truncated (the CRAM end-of-file container is missing).")
+
+
+def _fastq_lines(path: str) -> Iterable[bytes]:
+    if path.lower().endswith('.gz'):
+        pending = b""
+        for chunk in _iter_gzip_data(path):
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+    else:
+        with open(path, 'rb') as fp:
+            for line in fp:
+                yield line.rstrip(b"\n")
+
+
+def _check_fastq(path: str) -> None:
+    record = []
+    n_records = 0
+    for line in _fastq_lines(path):
+        record.append(line.rstrip(b"\r"))
+        if len(record) < 4:
+            continue
+        n_records += 1
+        header, sequence, separator, quality = record
+        if not header.startswith(b"@"):
+            raise FormatProblem(f"FASTQ record {n_records} does not start with '@'.")
+        if not separator.startswith(b"+"):
+            raise FormatProblem(f"FASTQ record {n_records} has no '+' line.")
+        if len(sequence) != len(quality):
+            raise FormatProblem(f"FASTQ record {n_records} has {len(sequence)} bases"
+                                f" but {len(quality)} quality scores.")
+        record = []
+    if record and any(record):
+        raise FormatProblem(f"It is truncated (FASTQ record {n_records + 1} is incomplete).")
+    if n_records == 0:
+        raise FormatProblem("It has no FASTQ records.")
+
+
+def check_file_format(path: str) -> Optional[str]:
+    """
+    Checks a file, according to its extension, returning a description of the problem if it is not in good form,
+    or None if it is (or if it isn't of a kind that is checked).
+
+    Checked are: gzip (and BGZF) integrity, end to end, of compressed files; BAM and CRAM magic numbers
+    and end-of-file markers; VCF headers; and FASTQ record structure.
+    """
+    name = path.lower()
+    try:
+        if name.endswith('.bam'):
+            _check_bam(path)
+        elif name.endswith('.cram'):
+            _check_cram(path)
+        elif name.endswith(FASTQ_EXTENSIONS):
+            _check_fastq(path)
+        elif name.endswith(VCF_EXTENSIONS):
+            _check_gzip(path, expected_prefix=VCF_HEADER_PREFIX, description="a VCF file")
+        elif name.endswith('.gz'):
+            _check_gzip(path)
+    except FormatProblem as e:
+        return str(e)
+    except OSError as e:
+        return f"It could not be read. {e.__class__.__name__}: {e}"
+    return None
+
+
+def check_file_formats(paths: Iterable[str], max_workers: Optional[int] = None) -> Dict[str, Optional[str]]:
+    """
+    Checks the given files with check_file_format on a pool of processes, several files at once.
+
+    :param paths: the names of local files
+    :param max_workers: the number of processes to use (default: CHECK_FORMATS_WORKERS).
+        If 1, the files are checked one at a time in this process.
+    :return: a dictionary mapping each path to a description of its problem, or to None if none was found
+    """
+    paths = list(dict.fromkeys(paths))
+    max_workers = min(max_workers or CHECK_FORMATS_WORKERS, len(paths))
+    if max_workers <= 1:
+        return {path: check_file_format(path) for path in paths}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(check_file_format, paths)))
@@ -0,0 +1,134 @@
+# This file contains support for uploading files that are still being written (e.g., by a sequencer, or by a pipeline
+# step), following them as they grow, rather than waiting until they're finished to start uploading them.
+#
+# If SUBMITCGAP_FOLLOW_UPLOADS is set, a file found to be still being written is uploaded a part at a time as it
+# grows, and the upload is completed once writing has finished, which is taken to be when a sentinel file appears
+# (if SUBMITCGAP_FOLLOW_SENTINEL names one), or else when the file has stayed the same size for
+# SUBMITCGAP_FOLLOW_QUIESCENCE seconds. A sentinel starting with "." is a suffix added to the file's name (".done"
+# means "sample.bam.done" marks "sample.bam" finished); any other sentinel is a file in the same folder as the file
+# (such as the "CopyComplete.txt" an Illumina sequencer writes when a run is done).
+
+import io
+import os
+import time
+from dcicutils.misc_utils import PRINT, environ_bool
+from typing import Callable, Optional
+from .s3_upload import upload_stream_to_s3
+from .upload_tuning import UploadTuner
+
+
+FOLLOW_UPLOADS_VAR = 'SUBMITCGAP_FOLLOW_UPLOADS'
+FOLLOW_QUIESCENCE_VAR = 'SUBMITCGAP_FOLLOW_QUIESCENCE'
+FOLLOW_SENTINEL_VAR = 'SUBMITCGAP_FOLLOW_SENTINEL'
+
+DEFAULT_FOLLOW_QUIESCENCE = 300  # seconds a file must go without growing to be taken as finished
+FOLLOW_POLL_INTERVAL = 5  # seconds between looks at whether a file has grown
+
+
+def _compute_follow_quiescence():  # factored out as a function for testing
+    value = os.environ.get(FOLLOW_QUIESCENCE_VAR)
+    if not value:
+        return DEFAULT_FOLLOW_QUIESCENCE
+    try:
+        return float(value)
+    except ValueError:
+        PRINT(f"Ignoring {FOLLOW_QUIESCENCE_VAR}={value!r}, which is not a number of seconds.")
+        return DEFAULT_FOLLOW_QUIESCENCE
+
+
+FOLLOW_UPLOADS = environ_bool(FOLLOW_UPLOADS_VAR)
+FOLLOW_QUIESCENCE = _compute_follow_quiescence()
+FOLLOW_SENTINEL = os.environ.get(FOLLOW_SENTINEL_VAR) or None
+
+
+def sentinel_path(path: str, sentinel: str) -> str:
+    """Returns the name of the sentinel file whose appearance says the given file is finished."""
+    return path + sentinel if sentinel.startswith('.') else os.path.join(os.path.dirname(path), sentinel)
+
+
+def is_being_written(path: str, quiescence: Optional[float] = None, sentinel: Optional[str] = None,
+                     clock: Callable[[], float] = time.time) -> bool:
+    """
+    Returns True if the given file seems to be still being written: if its sentinel hasn't appeared, or, if there's
+    no sentinel, if it was written to in the last quiescence seconds. (Both default to those set for following.)
+    """
+    sentinel = FOLLOW_SENTINEL if sentinel is None else sentinel
+    if sentinel:
+        return not os.path.exists(sentinel_path(path, sentinel))
+    quiescence = FOLLOW_QUIESCENCE if quiescence is None else quiescence
+    return clock() - os.path.getmtime(path) < quiescence
+
+
+class GrowingFile(io.RawIOBase):
+    """
+    A read-only file that, when it gets to the end of what's been written of a file still being written,
+    waits for more, ending only once the file is finished (see is_being_written).
+    """
+
+    def __init__(self, path: str, quiescence: Optional[float] = None, sentinel: Optional[str] = None,
+                 poll_interval: float = FOLLOW_POLL_INTERVAL, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        super().__init__()
+        self.path = path
+        self.quiescence = FOLLOW_QUIESCENCE if quiescence is None else quiescence
+        self.sentinel = FOLLOW_SENTINEL if sentinel is None else sentinel
+        self.poll_interval = poll_interval
+        self._clock = clock
+        self._sleep = sleep
+        self._fp = open(path, 'rb', buffering=0)
+        self.size = 0  # bytes read so far
+        self._last_size = None
+        self._last_change = clock()
+
+    def readable(self):
+        return True
+
+    def _finished(self) -> bool:
+        """Returns True if all of the file has been written, or False if more may yet be written."""
+        size = os.fstat(self._fp.fileno()).st_size
+        if size < self.size:
+            raise OSError(f"{self.path} got smaller (from {self.size} bytes to {size}) while being uploaded.")
+        now = self._clock()
+        if size != self._last_size:
+            self._last_size, self._last_change = size, now
+        if size > self.size:
+            return False  # There's more to read already.
+        if self.sentinel:
+            return os.path.exists(sentinel_path(self.path, self.sentinel))
+        return now - self._last_change >= self.quiescence
+
+    def readinto(self, buffer) -> int:
+        while True:
+            n = self._fp.readinto(buffer)
+            if n:
+                self.size += n
+                return n
+            if self._finished():
+                n = self._fp.readinto(buffer) or 0  # anything written just before it was seen to be finished
+                self.size += n
+                return n
+            if self._last_size == self.size:  # Nothing more has been written yet.
+                self._sleep(self.poll_interval)
+
+    def close(self) -> None:
+        self._fp.close()
+        super().close()
+
+
+def upload_growing_file(path: str, upload_credentials: dict, *, s3_encrypt_key_id: Optional[str] = None,
+                        refresh_credentials: Optional[Callable[[], dict]] = None, s3_client=None,
+                        tuner: Optional[UploadTuner] = None, quiescence: Optional[float] = None,
+                        sentinel: Optional[str] = None, poll_interval: float = FOLLOW_POLL_INTERVAL,
+                        clock: Callable[[], float] = time.monotonic,
+                        sleep: Callable[[float], None] = time.sleep) -> dict:
+    """
+    Uploads a file still being written, a part at a time as it grows, completing the upload once it's finished.
+    (The arguments are as for upload_file_to_s3 and GrowingFile.)
+
+    :return: a dictionary with the 'size' and 'md5' of the file uploaded
+    """
+    with GrowingFile(path, quiescence=quiescence, sentinel=sentinel, poll_interval=poll_interval, clock=clock,
+                     sleep=sleep) as growing_file:
+        return upload_stream_to_s3(growing_file, upload_credentials, description=os.path.basename(path),
+                                   s3_encrypt_key_id=s3_encrypt_key_id, refresh_credentials=refresh_credentials,
+                                   s3_client=s3_client, tuner=tuner)
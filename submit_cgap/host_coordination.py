@@ -0,0 +1,221 @@
+# This file contains coordination of file transfers among all the SubmitCGAP processes running on a host.
+#
+# Several resume-uploads or submit-metadata-bundle processes run at once on one machine otherwise each act alone,
+# and together oversubscribe its network and disks. When SUBMITCGAP_HOST_MAX_TRANSFERS (and/or, see bandwidth.py,
+# SUBMITCGAP_HOST_BANDWIDTH_LIMIT) is set, processes register their transfers in a shared directory of lock files,
+# which caps the number of transfers going on at once and lets the host's bandwidth be shared out among them.
+#
+# Each transfer (and each process waiting to start one) is represented by a file on which its process holds
+# an exclusive flock. The operating system drops those locks when a process dies, so files left behind by
+# processes that crashed or were killed are recognized, and removed, by the others.
+
+import contextlib
+import os
+import tempfile
+import threading
+import time
+from dcicutils.misc_utils import PRINT
+from typing import Callable, List, Optional, Tuple
+from .utils import show
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - e.g., on Windows, where transfers simply aren't coordinated
+    fcntl = None
+
+
+HOST_MAX_TRANSFERS_VAR = 'SUBMITCGAP_HOST_MAX_TRANSFERS'
+HOST_COORDINATION_DIR_VAR = 'SUBMITCGAP_HOST_COORDINATION_DIR'
+HOST_BANDWIDTH_LIMIT_VAR = 'SUBMITCGAP_HOST_BANDWIDTH_LIMIT'  # used in bandwidth.py
+
+HOST_POLL_INTERVAL = 0.5  # seconds between checks for a free transfer slot
+
+ACTIVE_PREFIX = 'active-'
+WAITING_PREFIX = 'waiting-'
+MUTEX_FILE = 'mutex.lock'
+LOCK_FILE_SUFFIX = '.lock'
+
+
+def _compute_default_coordination_dir():  # factored out as a function for testing
+    directory = os.environ.get(HOST_COORDINATION_DIR_VAR)
+    if not directory:
+        try:
+            user = str(os.getuid())
+        except AttributeError:  # pragma: no cover - no getuid on Windows
+            user = 'user'
+        directory = os.path.join(tempfile.gettempdir(), f'submit-cgap-{user}', 'transfers')
+    return directory
+
+
+def _compute_host_max_transfers():  # factored out as a function for testing
+    value = os.environ.get(HOST_MAX_TRANSFERS_VAR)
+    if not value:
+        return None
+    try:
+        max_transfers = int(value)
+        if max_transfers < 1:
+            raise ValueError("It must be at least 1.")
+    except ValueError as e:
+        PRINT(f"Ignoring {HOST_MAX_TRANSFERS_VAR}={value!r}. {e}")
+        return None
+    return max_transfers
+
+
+class HostCoordinator:
+    """
+    Limits the number of transfers going on at once among all the processes on a host sharing a directory.
+
+    Waiting transfers are started in the order they asked to start, whichever process they belong to,
+    so that one submission can't starve another. The coordinator also counts the transfers going on,
+    so that a host-wide bandwidth limit can be divided fairly among them.
+    """
+
+    def __init__(self, directory: str, max_transfers: Optional[int] = None, enabled: bool = True,
+                 poll_interval: float = HOST_POLL_INTERVAL, sleep: Callable[[float], None] = time.sleep):
+        """
+        :param directory: the directory in which to keep lock files (created as needed), shared by all processes
+            to be coordinated. (To coordinate processes run by different users, it must be writable by all of them.)
+        :param max_transfers: the most transfers to allow at once on the host, or None for no limit
+        :param enabled: whether to coordinate at all (which also needs flock support from the operating system)
+        """
+        self.directory = directory
+        self.max_transfers = max_transfers
+        self.enabled = enabled and fcntl is not None
+        self.poll_interval = poll_interval
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self._local_transfers = 0
+
+    def _name(self, prefix: str) -> str:
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        # Names sort into the order in which they were made, which is the order in which waiters are served.
+        return f"{prefix}{time.time_ns():020d}-{os.getpid()}-{sequence}{LOCK_FILE_SUFFIX}"
+
+    @contextlib.contextmanager
+    def _mutex(self):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, MUTEX_FILE), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # also releases the lock
+
+    def _hold(self, prefix: str) -> Tuple[int, str]:
+        """
+        Makes a lock file with the given prefix, returning its name and an open file descriptor holding a lock on it.
+        Must be called with the mutex held, so that no other process sees the file before it is locked.
+        """
+        name = self._name(prefix)
+        fd = os.open(os.path.join(self.directory, name), os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd, name
+
+    def _release(self, fd: int, name: str) -> None:
+        with contextlib.suppress(OSError):
+            os.remove(os.path.join(self.directory, name))
+        os.close(fd)
+
+    def _live(self, prefix: str) -> List[str]:
+        """
+        Returns the names of the lock files with the given prefix whose processes are still alive, in order.
+        Lock files that no process holds any more are removed. Must be called with the mutex held.
+        """
+        live = []
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith(prefix) and name.endswith(LOCK_FILE_SUFFIX)):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError:
+                live.append(name)  # Some process (possibly this one) still holds it.
+            else:
+                with contextlib.suppress(OSError):
+                    os.remove(path)  # Left behind by a process that is no longer running.
+            finally:
+                os.close(fd)
+        return live
+
+    def active_transfers(self) -> int:
+        """Returns the number of transfers going on now on the host (or 0 if not coordinating)."""
+        if not self.enabled:
+            return 0
+        try:
+            with self._mutex():
+                return len(self._live(ACTIVE_PREFIX))
+        except OSError:
+            return 0
+
+    def local_transfers(self) -> int:
+        """Returns the number of this process's transfers going on now (whether or not coordinating)."""
+        with self._lock:
+            return self._local_transfers
+
+    @contextlib.contextmanager
+    def _counted(self):
+        with self._lock:
+            self._local_transfers += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._local_transfers -= 1
+
+    @contextlib.contextmanager
+    def transfer_slot(self, description: str = "file"):
+        """
+        A context manager within which a transfer may go on, waiting first (if need be) until there's room for it.
+
+        If coordination is disabled, or the coordination directory can't be used, it doesn't wait.
+        """
+        if not self.enabled:
+            with self._counted():
+                yield
+            return
+        try:
+            fd, name = self._acquire(description)
+        except OSError as e:
+            PRINT(f"Warning: Not coordinating transfers with other processes because of"
+                  f" {e.__class__.__name__}: {e}")
+            self.enabled = False
+            with self._counted():
+                yield
+            return
+        try:
+            with self._counted():
+                yield
+        finally:
+            self._release(fd, name)
+
+    def _acquire(self, description: str) -> Tuple[int, str]:
+        with self._mutex():
+            waiting_fd, waiting_name = self._hold(WAITING_PREFIX)
+        shown_wait = False
+        try:
+            while True:
+                with self._mutex():
+                    waiting = self._live(WAITING_PREFIX)
+                    active = self._live(ACTIVE_PREFIX)
+                    if waiting[:1] == [waiting_name] and (self.max_transfers is None
+                                                          or len(active) < self.max_transfers):
+                        return self._hold(ACTIVE_PREFIX)
+                if not shown_wait:
+                    show(f"Waiting for a free transfer slot on this host to upload {description}.")
+                    shown_wait = True
+                self._sleep(self.poll_interval)
+        finally:
+            self._release(waiting_fd, waiting_name)
+
+
+HOST_COORDINATOR = HostCoordinator(directory=_compute_default_coordination_dir(),
+                                   max_transfers=_compute_host_max_transfers(),
+                                   enabled=bool(os.environ.get(HOST_MAX_TRANSFERS_VAR)
+                                                or os.environ.get(HOST_BANDWIDTH_LIMIT_VAR)))
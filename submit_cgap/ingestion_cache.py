@@ -0,0 +1,151 @@
+# This file contains a local on-disk cache of IngestionSubmission documents that have finished processing.
+#
+# Once an IngestionSubmission's processing_status.state is "done", its document effectively stops changing,
+# so commands like show-upload-info, resume-uploads and check-submission, which are often run over and over
+# during triage, can be served from here rather than from the portal.
+
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from dcicutils.misc_utils import environ_bool
+from typing import Optional
+
+
+CACHE_DIR_VAR = 'SUBMITCGAP_CACHE_DIR'
+CACHE_MAX_BYTES_VAR = 'SUBMITCGAP_CACHE_MAX_BYTES'
+NO_CACHE_VAR = 'SUBMITCGAP_NO_CACHE'
+
+DEFAULT_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+CACHE_FILE_SUFFIX = '.json.gz'
+
+
+def _compute_default_cache_dir():  # factored out as a function for testing
+    cache_dir = os.environ.get(CACHE_DIR_VAR)
+    if not cache_dir:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_dir = os.path.join(cache_home, 'submit-cgap', 'ingestion-submissions')
+    return cache_dir
+
+
+def _compute_default_cache_max_bytes():  # factored out as a function for testing
+    return int(os.environ.get(CACHE_MAX_BYTES_VAR) or DEFAULT_CACHE_MAX_BYTES)
+
+
+def is_terminal_ingestion_submission(document) -> bool:
+    """Returns True if the given IngestionSubmission document has finished processing, and so won't change."""
+    return isinstance(document, dict) and (document.get('processing_status') or {}).get('state') == 'done'
+
+
+class IngestionSubmissionCache:
+    """
+    A size-bounded cache of gzipped IngestionSubmission documents, keyed by server and uuid.
+
+    Only documents that have finished processing are stored. When the total size of the cache exceeds its
+    maximum, the least recently used documents are evicted. (A file's modification time records its last use.)
+    Files are written atomically, so several processes can share the cache.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_CACHE_MAX_BYTES, enabled: bool = True):
+        """
+        :param directory: the directory in which to keep cached documents (created as needed)
+        :param max_bytes: the maximum total size of cached files, in bytes
+        :param enabled: whether to do any caching at all
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+
+    @classmethod
+    def cache_key(cls, server: str, uuid: str) -> str:
+        server = server.rstrip('/')
+        return hashlib.sha256(f"{server} {uuid}".encode('utf-8')).hexdigest()
+
+    def _path(self, server: str, uuid: str) -> str:
+        return os.path.join(self.directory, self.cache_key(server, uuid) + CACHE_FILE_SUFFIX)
+
+    def get(self, server: str, uuid: str) -> Optional[dict]:
+        """Returns the cached document for the given server and uuid, or None if there isn't one."""
+        if not self.enabled:
+            return None
+        path = self._path(server, uuid)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as fp:
+                entry = json.load(fp)
+        except FileNotFoundError:
+            return None
+        except Exception:  # A damaged file is of no use to anyone.
+            self._remove(path)
+            return None
+        if entry.get('server') != server.rstrip('/') or entry.get('uuid') != uuid:
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(path)  # Mark it as recently used.
+        return entry.get('document')
+
+    def put(self, server: str, uuid: str, document: dict) -> bool:
+        """
+        Caches the given document for the given server and uuid, if it has finished processing.
+
+        :return: True if the document was cached, False otherwise
+        """
+        if not self.enabled or not is_terminal_ingestion_submission(document):
+            return False
+        entry = {'server': server.rstrip('/'), 'uuid': uuid, 'document': document}
+        data = gzip.compress(json.dumps(entry).encode('utf-8'))
+        if len(data) > self.max_bytes:
+            return False
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                try:
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(fd, view):]
+                finally:
+                    os.close(fd)
+                os.replace(temp_path, self._path(server, uuid))
+            except Exception:
+                self._remove(temp_path)
+                raise
+        except OSError:
+            return False  # Caching is an optimization. Failing to cache is not an error.
+        self.evict(keep_bytes=self.max_bytes)
+        return True
+
+    def evict(self, keep_bytes: int = 0) -> None:
+        """Removes the least recently used documents until the cache takes up no more than keep_bytes."""
+        entries = []
+        try:
+            with os.scandir(self.directory) as scanner:
+                for entry in scanner:
+                    if entry.name.endswith(CACHE_FILE_SUFFIX):
+                        with contextlib.suppress(OSError):
+                            stat = entry.stat()
+                            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            return
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= keep_bytes:
+                break
+            self._remove(path)
+            total_bytes -= size
+
+    def clear(self) -> None:
+        """Removes all cached documents."""
+        self.evict(keep_bytes=0)
+
+    @staticmethod
+    def _remove(path):
+        with contextlib.suppress(OSError):
+            os.remove(path)
+
+
+INGESTION_SUBMISSION_CACHE = IngestionSubmissionCache(directory=_compute_default_cache_dir(),
+                                                      max_bytes=_compute_default_cache_max_bytes(),
+                                                      enabled=not environ_bool(NO_CACHE_VAR))
@@ -0,0 +1,237 @@
+# This file contains support for finding and examining the local files that a submission will upload.
+
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+MD5_CHUNK_SIZE = 8 * 1024 * 1024  # bytes
+
+EXCEL_EXTENSIONS = ['.xlsx', '.xlsm']
+
+# Cell values in a bundle can hold several filenames, as in "f1_R1.fastq.gz, f1_R2.fastq.gz".
+BUNDLE_TOKEN_SEPARATOR_REGEXP = re.compile(r"[\s,;]+")
+
+
+def compute_file_md5(path: str, stop_event: Optional[threading.Event] = None) -> Optional[str]:
+    """
+    Returns the hex md5 checksum of the given file, reading it in chunks of MD5_CHUNK_SIZE bytes.
+
+    :param path: the name of a local file
+    :param stop_event: an optional event which, if set while the file is being read, abandons the computation
+    :return: the md5 checksum as a hex string, or None if the computation was abandoned
+    """
+    md5 = hashlib.md5()
+    with io.open(path, 'rb') as fp:
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                return None
+            chunk = fp.read(MD5_CHUNK_SIZE)
+            if not chunk:
+                break
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _bundle_strings(bundle_filename: str) -> Iterable[str]:
+    _, ext = os.path.splitext(bundle_filename)
+    if ext.lower() in EXCEL_EXTENSIONS:
+        import openpyxl  # a dependency of dcicutils, but only needed here, so imported lazily
+        workbook = openpyxl.load_workbook(bundle_filename, read_only=True, data_only=True)
+        try:
+            for worksheet in workbook.worksheets:
+                for row in worksheet.iter_rows(values_only=True):
+                    for value in row:
+                        if isinstance(value, str):
+                            yield value
+        finally:
+            workbook.close()
+    elif ext.lower() == '.json':
+        with io.open(bundle_filename, 'r') as fp:
+            pending = [json.load(fp)]
+        while pending:
+            item = pending.pop()
+            if isinstance(item, str):
+                yield item
+            elif isinstance(item, dict):
+                pending.extend(item.values())
+            elif isinstance(item, list):
+                pending.extend(item)
+    else:
+        with io.open(bundle_filename, 'r', errors='replace') as fp:
+            yield from fp
+
+
+def extract_bundle_filenames(bundle_filename: str) -> Set[str]:
+    """
+    Returns the set of tokens in a submission bundle that look like they might be the names of files.
+
+    This is a heuristic, since the bundle's layout is the server's business, but cells naming files to be uploaded
+    contain those names (possibly several, comma-separated), so it's a good guess at what upload_info will ask for.
+
+    :param bundle_filename: the name of a local bundle file (Excel, JSON or text)
+    :return: a set of file basenames
+    """
+    result = set()
+    for value in _bundle_strings(bundle_filename):
+        for token in BUNDLE_TOKEN_SEPARATOR_REGEXP.split(value):
+            token = os.path.basename(token.strip())
+            if '.' in token.strip('.'):
+                result.add(token)
+    return result
+
+
+class LocalFileIndex:
+    """
+    An index, by name, of the files in an upload folder, with a cache of their sizes and md5 checksums.
+
+    The index answers the same questions as submission.search_for_file, but from a single scan of the folder.
+    Scanning the folder and checksumming likely upload candidates can be done in the background
+    (see start_preparation) while we're waiting for other things, such as ingestion processing.
+    """
+
+    def __init__(self, folder: Optional[str], recursive: bool = False):
+        """
+        :param folder: the folder in which to find files (default: the current directory)
+        :param recursive: whether files in subfolders of the folder are also to be found
+        """
+        self.folder = folder or os.path.curdir
+        self.recursive = recursive
+        self._build_lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._paths_by_name: Optional[Dict[str, List[str]]] = None
+        self._stats: Dict[str, os.stat_result] = {}
+        self._md5s: Dict[str, Tuple[int, float, str]] = {}
+        self._stop_event = threading.Event()
+        self._preparer: Optional[threading.Thread] = None
+
+    @property
+    def search_directory(self) -> str:
+        """The directory in the form search_for_file would be given it."""
+        return os.path.join(self.folder, '**') if self.recursive else self.folder
+
+    def _scan(self) -> Dict[str, List[str]]:
+        paths_by_name = {}
+        for dirpath, dirnames, filenames in os.walk(self.folder, followlinks=True):
+            if self.recursive:
+                # Like glob's '**', don't descend into hidden directories.
+                dirnames[:] = sorted(dirname for dirname in dirnames if not dirname.startswith('.'))
+            else:
+                dirnames[:] = []
+            for filename in filenames:
+                paths_by_name.setdefault(filename, []).append(os.path.join(dirpath, filename))
+        return paths_by_name
+
+    def build(self) -> None:
+        """Scans the folder, if that hasn't been done already."""
+        with self._build_lock:
+            if self._paths_by_name is None:
+                self._paths_by_name = self._scan()
+
+    def find(self, file_name: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """
+        Finds a file by name, giving the same result search_for_file would (which see).
+
+        Returns None, rather than a result, for names the index cannot answer for: names that are not
+        plain filenames, and names that were not present when the folder was scanned. The caller should
+        look for those in the usual way.
+        """
+        if glob.has_magic(file_name) or os.path.basename(file_name) != file_name:
+            return None
+        self.build()
+        paths = self._paths_by_name.get(file_name, [])
+        if len(paths) == 1:
+            [path] = paths
+            return path, None
+        elif len(paths) > 1:
+            return None, ("No upload attempted for file %s because multiple copies were found in folder %s: %s."
+                          % (file_name, self.search_directory, ", ".join(sorted(paths))))
+        else:
+            return None
+
+    def stat(self, path: str) -> os.stat_result:
+        """Returns the stat of a file, caching it."""
+        with self._cache_lock:
+            stat = self._stats.get(path)
+        if stat is None:
+            stat = os.stat(path)
+            with self._cache_lock:
+                self._stats[path] = stat
+        return stat
+
+    def cached_md5(self, path: str) -> Optional[str]:
+        """Returns the md5 checksum of a file if it's been computed and the file appears unchanged since, else None."""
+        with self._cache_lock:
+            entry = self._md5s.get(path)
+        if entry is None:
+            return None
+        size, mtime, md5 = entry
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return md5 if (stat.st_size, stat.st_mtime) == (size, mtime) else None
+
+    def md5(self, path: str, stop_event: Optional[threading.Event] = None) -> Optional[str]:
+        """Returns the md5 checksum of a file, computing it if there's no valid cached value."""
+        md5 = self.cached_md5(path)
+        if md5 is None:
+            stat = os.stat(path)
+            md5 = compute_file_md5(path, stop_event=stop_event)
+            if md5 is not None:
+                with self._cache_lock:
+                    self._stats[path] = stat
+                    self._md5s[path] = (stat.st_size, stat.st_mtime, md5)
+        return md5
+
+    def prepare(self, candidate_names: Iterable[str] = ()) -> None:
+        """
+        Scans the folder, stats its files, and computes checksums for files with the given candidate names.
+
+        This stops early (without error) if stop_preparation is called.
+        """
+        self.build()
+        for paths in self._paths_by_name.values():
+            for path in paths:
+                if self._stop_event.is_set():
+                    return
+                try:
+                    self.stat(path)
+                except OSError:
+                    pass
+        for name in sorted(set(candidate_names)):
+            if self._stop_event.is_set():
+                return
+            path, error_msg = self.find(name) or (None, None)
+            if path and not error_msg:
+                self.md5(path, stop_event=self._stop_event)
+
+    def start_preparation(self, bundle_filename: Optional[str] = None) -> None:
+        """
+        Starts prepare running in a background thread, taking candidates from the names mentioned in the given bundle.
+
+        The thread is a daemon, so it won't hold up an exit, and it produces no output, so it won't interfere with
+        progress messages. Problems reading the bundle just mean there are no candidates to checksum in advance.
+        """
+
+        def run_preparation():
+            try:
+                candidate_names = extract_bundle_filenames(bundle_filename) if bundle_filename else set()
+            except Exception:
+                candidate_names = set()
+            try:
+                self.prepare(candidate_names)
+            except Exception:
+                pass  # Anything not prepared will just be done later, on demand.
+
+        self._preparer = threading.Thread(target=run_preparation, name="upload-preparation", daemon=True)
+        self._preparer.start()
+
+    def stop_preparation(self) -> None:
+        """Stops any background preparation as soon as convenient. Cached results so far remain available."""
+        self._stop_event.set()
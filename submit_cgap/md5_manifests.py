@@ -0,0 +1,207 @@
+# This file contains support for checking files to be uploaded against md5 manifests from their provider.
+#
+# Sequencing providers often deliver md5sum.txt manifests (in the format written by md5sum) alongside their files.
+# When --md5-manifests (or SUBMITCGAP_MD5_MANIFESTS) names such manifests (as a comma-separated list of files, or as
+# "auto" to use any found in the upload folder), every file they list that is to be uploaded is checked, and files
+# that don't match are not uploaded (or, if --md5-mismatch or SUBMITCGAP_MD5_MISMATCH is "flag", are uploaded with
+# a warning). If the AWS CLI is to upload them, they're checksummed before their File items are PATCHed, on a pool of
+# processes, several files at once, since the AWS CLI reads them itself. If they're uploaded in-process (with
+# SUBMITCGAP_UPLOAD_ENGINE=boto3), they're checksummed from the same reads as their upload, and a file that doesn't
+# match has its upload abandoned before it's completed, so it's read only once. Extra files are checked the same way.
+
+import concurrent.futures
+import glob
+import io
+import os
+import re
+from dcicutils.misc_utils import PRINT
+from typing import Callable, Dict, Iterable, List, Optional
+from .local_files import compute_file_md5
+from .utils import show
+
+
+MD5_MANIFESTS_VAR = 'SUBMITCGAP_MD5_MANIFESTS'
+MD5_MISMATCH_VAR = 'SUBMITCGAP_MD5_MISMATCH'
+MD5_WORKERS_VAR = 'SUBMITCGAP_MD5_WORKERS'
+
+AUTO_MANIFESTS = 'auto'
+
+
+class Md5Mismatch:
+    BLOCK = 'block'
+    FLAG = 'flag'
+
+
+MD5_MISMATCHES = [Md5Mismatch.BLOCK, Md5Mismatch.FLAG]
+
+
+# Names of files taken to be manifests, with MD5_MANIFESTS=auto: md5sum.txt, md5sums.txt, MD5SUM-batch1.txt, *.md5 ...
+MANIFEST_NAME_REGEXP = re.compile(r"^md5sums?([._-].*)?[.]txt$|[.]md5$", re.IGNORECASE)
+
+# A line as md5sum writes it ("<md5>  <name>", or "<md5> *<name>" for binary mode), or in BSD style.
+MANIFEST_LINE_REGEXP = re.compile(r"^\\?([0-9a-fA-F]{32}) [ *](.+)$")
+BSD_MANIFEST_LINE_REGEXP = re.compile(r"^MD5 ?[(](.+)[)] ?= ?([0-9a-fA-F]{32})$")
+
+
+MD5_MANIFESTS = os.environ.get(MD5_MANIFESTS_VAR) or None
+MD5_MISMATCH = Md5Mismatch.FLAG if os.environ.get(MD5_MISMATCH_VAR) == Md5Mismatch.FLAG else Md5Mismatch.BLOCK
+
+
+def _compute_md5_workers():  # factored out as a function for testing
+    value = os.environ.get(MD5_WORKERS_VAR)
+    default = os.cpu_count() or 1
+    try:
+        workers = int(value) if value else default
+        if workers < 1:
+            raise ValueError("It must be at least 1.")
+    except ValueError as e:
+        PRINT(f"Ignoring {MD5_WORKERS_VAR}={value!r}. {e}")
+        workers = default
+    return workers
+
+
+MD5_WORKERS = _compute_md5_workers()
+
+
+def parse_md5_manifest(manifest_file: str) -> Dict[str, str]:
+    """
+    Reads an md5 manifest, returning a dictionary mapping the (absolute) path of each file listed to its md5.
+    Files are taken to be named relative to the folder the manifest is in. Lines not understood are ignored.
+    """
+    folder = os.path.dirname(os.path.abspath(manifest_file))
+    entries = {}
+    with io.open(manifest_file, 'r', encoding='utf-8', errors='replace') as fp:
+        for line in fp:
+            line = line.strip()
+            matched = MANIFEST_LINE_REGEXP.match(line)
+            if matched:
+                md5, name = matched.groups()
+            else:
+                matched = BSD_MANIFEST_LINE_REGEXP.match(line)
+                if not matched:
+                    continue
+                name, md5 = matched.groups()
+            path = os.path.normpath(os.path.join(folder, name))
+            entries[path] = md5.lower()
+    return entries
+
+
+def find_md5_manifests(folder: str, recursive: bool = False) -> List[str]:
+    """Returns the files in the given folder (and, optionally, its subfolders) that look like md5 manifests."""
+    pattern = os.path.join(folder, '**', '*') if recursive else os.path.join(folder, '*')
+    return sorted(path for path in glob.glob(pattern, recursive=recursive)
+                  if MANIFEST_NAME_REGEXP.search(os.path.basename(path)) and os.path.isfile(path))
+
+
+class Md5Manifests:
+    """The md5 checksums, from one or more manifests, that files are expected to have."""
+
+    def __init__(self, entries: Dict[str, str]):
+        """:param entries: a dictionary mapping absolute paths to md5 checksums"""
+        self.entries = entries
+        self._by_name: Dict[str, Dict[str, str]] = {}
+        for path, md5 in entries.items():
+            self._by_name.setdefault(os.path.basename(path), {})[path] = md5
+
+    @classmethod
+    def load(cls, manifest_files: Iterable[str]) -> 'Md5Manifests':
+        """Loads the given manifests. Any that can't be read are reported, and the files they list aren't checked."""
+        entries = {}
+        for manifest_file in manifest_files:
+            try:
+                entries.update(parse_md5_manifest(manifest_file))
+            except OSError as e:
+                show(f"Warning: Not checking files against md5 manifest {manifest_file}, which can't be read."
+                     f" {e.__class__.__name__}: {e}")
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def expected_md5s(self, paths: Iterable[str]) -> Dict[str, Optional[str]]:
+        """
+        Returns the md5 checksums the given files are expected to have (each None if no manifest says).
+
+        A file not listed by its own path is looked up by name (as when files were moved after their manifest was
+        written), but only if none of the other files has that name, the manifests agree on the checksum for that
+        name, and none of the files they list by that name is where they say. Otherwise, a file in one folder could
+        be checked against the manifest for a file of the same name in another.
+        """
+        paths = list(paths)
+        names = [os.path.basename(path) for path in paths]
+        result = {}
+        for path, name in zip(paths, names):
+            md5 = self.entries.get(os.path.normpath(os.path.abspath(path)))
+            listed = self._by_name.get(name) or {}
+            if (md5 is None and names.count(name) == 1 and len(set(listed.values())) == 1
+                    and not any(os.path.exists(listed_path) for listed_path in listed)):
+                md5 = next(iter(listed.values()))
+            result[path] = md5
+        return result
+
+    def expected_md5(self, path: str) -> Optional[str]:
+        """Returns the md5 checksum the given file is expected to have, or None if no manifest says."""
+        return self.expected_md5s([path])[path]
+
+
+def resolve_md5_manifests(spec: Optional[str], folder: str, recursive: bool = False) -> Optional[Md5Manifests]:
+    """
+    Returns the Md5Manifests named by a SUBMITCGAP_MD5_MANIFESTS-style spec (a comma-separated list of files,
+    or "auto" for any manifests found in the given folder), or None if there's no spec or no manifest.
+    Manifests that can't be read are reported (see Md5Manifests.load).
+    """
+    if not spec:
+        return None
+    if spec.strip().lower() == AUTO_MANIFESTS:
+        manifest_files = find_md5_manifests(folder, recursive=recursive)
+    else:
+        manifest_files = [name.strip() for name in spec.split(',') if name.strip()]
+    return Md5Manifests.load(manifest_files) if manifest_files else None
+
+
+def md5_mismatch_message(md5: str, expected_md5: str) -> str:
+    return "Its md5 checksum is %s, but its manifest says it should be %s." % (md5, expected_md5)
+
+
+def md5_checker(path: str, expected_md5: str, md5_mismatch: str = Md5Mismatch.BLOCK) -> Callable[[str], None]:
+    """
+    Returns a function to check the md5 checksum of a file, once computed (e.g., as it's uploaded; see
+    upload_file_to_s3), against the one its manifest gives, which raises ValueError if they don't match
+    (or, if md5_mismatch is 'flag', only shows a warning).
+    """
+
+    def check_md5(md5: str) -> None:
+        if md5 != expected_md5:
+            if md5_mismatch == Md5Mismatch.BLOCK:
+                raise ValueError("File %s does not match its manifest. %s"
+                                 % (path, md5_mismatch_message(md5, expected_md5)))
+            show("Warning: File %s does not match its manifest. %s" % (path, md5_mismatch_message(md5, expected_md5)))
+
+    return check_md5
+
+
+def compute_md5s(paths: Iterable[str], max_workers: Optional[int] = None,
+                 known_md5: Optional[Callable[[str], Optional[str]]] = None) -> Dict[str, str]:
+    """
+    Computes the md5 checksums of the given files on a pool of processes, several files at once.
+
+    :param paths: the names of local files
+    :param max_workers: the number of processes to use (default: MD5_WORKERS). If 1, files are done in this process.
+    :param known_md5: a function returning the md5 of a file if it's already known (e.g., LocalFileIndex.cached_md5),
+        or else None, so that files already read needn't be read again
+    :return: a dictionary mapping each path to its md5 checksum
+    """
+    paths = list(dict.fromkeys(paths))
+    md5s = {}
+    for path in paths:
+        md5 = known_md5(path) if known_md5 is not None else None
+        if md5 is not None:
+            md5s[path] = md5
+    to_compute = [path for path in paths if path not in md5s]
+    max_workers = min(max_workers or MD5_WORKERS, len(to_compute))
+    if max_workers <= 1:
+        md5s.update((path, compute_file_md5(path)) for path in to_compute)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            md5s.update(zip(to_compute, executor.map(compute_file_md5, to_compute)))
+    return md5s
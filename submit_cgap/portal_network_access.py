@@ -1,11 +1,34 @@
 # This file contains centralized functions for all Portal interactions used by SubmitCGAP.
 
 import requests
-from typing import Tuple
+from typing import Optional, Tuple
 from dcicutils import ff_utils
 from dcicutils.trace_utils import Trace
 
 
+PORTAL_SESSION_POOL_SIZE = 16  # connections kept open to each host, enough for the requests a command makes at once
+
+_PORTAL_SESSION: Optional[requests.Session] = None
+
+
+def keep_portal_session() -> None:
+    """
+    Has portal requests from now on share one requests.Session, so connections to the portal (and their TLS
+    handshakes) are kept and reused, rather than being made anew for each request. (The agent does this.)
+    """
+    global _PORTAL_SESSION
+    if _PORTAL_SESSION is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=PORTAL_SESSION_POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _PORTAL_SESSION = session
+
+
+def _requester():
+    return _PORTAL_SESSION or requests
+
+
 @Trace()
 def portal_metadata_post(schema: str, data: dict, auth: Tuple) -> dict:
     return ff_utils.post_metadata(post_item=data, schema_name=schema, key=auth)
@@ -18,9 +41,9 @@ def portal_metadata_patch(uuid: str, data: dict, auth: Tuple) -> dict:
 
 @Trace()
 def portal_request_get(url: str, auth: Tuple, **kwargs) -> requests.models.Response:
-    return requests.get(url, auth=auth, **kwargs)
+    return _requester().get(url, auth=auth, **kwargs)
 
 
 @Trace()
 def portal_request_post(url: str, auth: Tuple, **kwargs) -> requests.models.Response:
-    return requests.post(url, auth=auth, **kwargs)
+    return _requester().post(url, auth=auth, **kwargs)
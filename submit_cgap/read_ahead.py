@@ -0,0 +1,293 @@
+# This file contains a read-ahead reader of the parts of a file to be uploaded.
+#
+# On network filesystems (such as Lustre or NFS), a single stream of sequential reads is often much slower than the
+# network an upload goes over, so reading each part only when it's time to upload it leaves the network idle.
+# A ReadAheadReader instead has a few threads read parts ahead of the uploads (with parallel range reads, and hints
+# to the operating system that the file will be read sequentially), so that reading and uploading overlap.
+# The parts read but not yet uploaded are kept within a memory budget, set by SUBMITCGAP_READ_AHEAD_BUFFER
+# (e.g., "512MiB", or "0" to read each part only when it's to be uploaded), with SUBMITCGAP_READ_AHEAD_THREADS
+# threads reading.
+#
+# So that terabytes of uploads don't mean terabytes of memory allocated (and freed) a part at a time, parts are
+# read into buffers that are reused from part to part, and are handed out as memoryviews of those buffers (or,
+# when not reading ahead, of the file mapped into memory). A PartBody lets such a part be sent, and checksummed,
+# by code expecting a file, without its being copied whole.
+
+import io
+import mmap
+import os
+import threading
+from dcicutils.misc_utils import PRINT
+from typing import Dict, List, Optional, Tuple
+from .upload_tuning import MIB, parse_size
+
+
+READ_AHEAD_BUFFER_VAR = 'SUBMITCGAP_READ_AHEAD_BUFFER'
+READ_AHEAD_THREADS_VAR = 'SUBMITCGAP_READ_AHEAD_THREADS'
+
+DEFAULT_READ_AHEAD_BUFFER = 512 * MIB  # bytes of parts read but not yet uploaded
+DEFAULT_READ_AHEAD_THREADS = 4
+
+
+def _compute_read_ahead_buffer():  # factored out as a function for testing
+    value = os.environ.get(READ_AHEAD_BUFFER_VAR)
+    if not value:
+        return DEFAULT_READ_AHEAD_BUFFER
+    try:
+        return parse_size(value)
+    except ValueError as e:
+        PRINT(f"Ignoring {READ_AHEAD_BUFFER_VAR}={value!r}. {e}")
+        return DEFAULT_READ_AHEAD_BUFFER
+
+
+def _compute_read_ahead_threads():  # factored out as a function for testing
+    value = os.environ.get(READ_AHEAD_THREADS_VAR)
+    try:
+        threads = int(value) if value else DEFAULT_READ_AHEAD_THREADS
+        if threads < 1:
+            raise ValueError("It must be at least 1.")
+    except ValueError as e:
+        PRINT(f"Ignoring {READ_AHEAD_THREADS_VAR}={value!r}. {e}")
+        threads = DEFAULT_READ_AHEAD_THREADS
+    return threads
+
+
+READ_AHEAD_BUFFER = _compute_read_ahead_buffer()
+READ_AHEAD_THREADS = _compute_read_ahead_threads()
+
+
+def advise_sequential(fd: int, offset: int = 0, length: int = 0) -> None:
+    """Tells the operating system (where it can be told) that the given range of a file is to be read in order."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+        except OSError:  # e.g., a filesystem that doesn't take advice
+            pass
+
+
+def read_range_into(fd: int, buffer: memoryview, offset: int) -> int:
+    """
+    Reads, into the given buffer, as many bytes as it holds from the given offset of an open file
+    (fewer only at the end of the file), returning the number read.
+    """
+    n_read = 0
+    while n_read < len(buffer):
+        if hasattr(os, 'preadv'):
+            n = os.preadv(fd, [buffer[n_read:]], offset + n_read)
+        else:  # pragma: no cover - e.g., on Windows or macOS before Python 3.7's preadv support there
+            chunk = os.pread(fd, len(buffer) - n_read, offset + n_read)
+            n = len(chunk)
+            buffer[n_read:n_read + n] = chunk
+        if not n:
+            break
+        n_read += n
+    return n_read
+
+
+class PartBody(io.RawIOBase):
+    """
+    A read-only, seekable file whose contents are those of a memoryview (e.g., a part of a file to be uploaded),
+    for code that wants a file (such as boto3, which reads a part in pieces to checksum and send it), without the
+    whole of it being copied.
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        n = min(len(buffer), len(self._view) - self._position)
+        if n > 0:
+            memoryview(buffer).cast('B')[:n] = self._view[self._position:self._position + n]
+            self._position += n
+        return max(n, 0)
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._view) if size is None or size < 0 else min(len(self._view), self._position + size)
+        data = bytes(self._view[self._position:end]) if end > self._position else b""
+        self._position = max(self._position, end)
+        return data
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+class MappedFile:
+    """A file mapped into memory, whose parts are had as memoryviews, for reading parts without read-ahead."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+    def view(self, offset: int, size: int) -> memoryview:
+        """Returns a memoryview of the given range. It must be released before the MappedFile is closed."""
+        return self._view[offset:offset + size]
+
+    def close(self) -> None:
+        self._view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ReadAheadReader:
+    """
+    Reads the parts of a file, in order, on several threads, ahead of their being wanted, keeping the parts read
+    but not yet released within a memory budget. (A part bigger than the budget is still read, once no other part
+    is being held.)
+
+    Parts are numbered from 1, as in S3 multipart uploads. Each part wanted is taken (waiting, if need be, until it's
+    been read) and, once it's no longer needed, released, which makes room for more parts to be read.
+    Parts are read into a pool of buffers, which are reused once released, and taken as memoryviews of them,
+    so a part's memoryview must not be used after it's released.
+    """
+
+    def __init__(self, path: str, part_size: int, file_size: Optional[int] = None,
+                 budget: int = DEFAULT_READ_AHEAD_BUFFER, threads: int = DEFAULT_READ_AHEAD_THREADS, offset: int = 0):
+        """
+        :param path: the name of a local file
+        :param part_size: the size of all parts but (perhaps) the last
+        :param file_size: the size of the file, or of the range of it to read (default: its size now, less offset)
+        :param budget: the most bytes of parts to hold at once
+        :param threads: the number of threads reading parts
+        :param offset: where in the file the range to read begins (e.g., a member of a tar file)
+        """
+        self.path = path
+        self.part_size = part_size
+        self.offset = offset
+        self.file_size = os.path.getsize(path) - offset if file_size is None else file_size
+        self.part_count = max(1, -(-self.file_size // part_size))
+        self.budget = budget
+        self._condition = threading.Condition()
+        self._next_part = 1  # the next part to be read
+        self._held = 0  # the bytes of parts being read, or read and not yet released
+        self._parts: Dict[int, memoryview] = {}
+        self._buffers: Dict[int, bytearray] = {}  # the buffers that parts read (or being read) are in
+        self._free_buffers: List[bytearray] = []
+        self._taken = set()
+        self.buffers_allocated = 0
+        self._errors: Dict[int, BaseException] = {}
+        self._closed = False
+        fds = []  # Opened here, so that a file that can't be read is reported at once.
+        try:
+            for _ in range(max(1, min(threads, self.part_count))):
+                fds.append(os.open(path, os.O_RDONLY))
+        except OSError:
+            for fd in fds:
+                os.close(fd)
+            raise
+        self._threads: List[threading.Thread] = [threading.Thread(target=self._read_parts, args=(fd,), daemon=True)
+                                                 for fd in fds]
+        for thread in self._threads:
+            thread.start()
+
+    def _size(self, part_number: int) -> int:
+        return min(self.part_size, self.file_size - (part_number - 1) * self.part_size)
+
+    def _claim(self) -> Tuple[Optional[int], Optional[bytearray]]:
+        """
+        Waits for room in the budget for the next part, and claims it to read, with a buffer to read it into
+        (or returns None, None if there are no more parts to read).
+        """
+        with self._condition:
+            while True:
+                if self._closed or self._next_part > self.part_count:
+                    return None, None
+                size = self._size(self._next_part)
+                if self._held == 0 or self._held + size <= self.budget:
+                    part_number, self._next_part = self._next_part, self._next_part + 1
+                    self._held += size
+                    if self._free_buffers:
+                        buffer = self._free_buffers.pop()
+                    else:
+                        buffer = bytearray(self.part_size)
+                        self.buffers_allocated += 1
+                    self._buffers[part_number] = buffer
+                    return part_number, buffer
+                self._condition.wait()
+
+    def _read_parts(self, fd: int):
+        try:
+            advise_sequential(fd, self.offset, self.file_size)
+            while True:
+                part_number, buffer = self._claim()
+                if part_number is None:
+                    return
+                offset = self.offset + (part_number - 1) * self.part_size
+                try:
+                    data = memoryview(buffer)[:self._size(part_number)]
+                    data, error = data[:read_range_into(fd, data, offset)], None
+                    # Ask for the part after the ones being read now, so the disk is kept busy.
+                    advise_sequential(fd, offset + len(self._threads) * self.part_size, self.part_size)
+                except BaseException as e:  # reported to whoever takes the part
+                    data, error = None, e
+                with self._condition:
+                    if error is not None:
+                        self._errors[part_number] = error
+                        self._free_buffers.append(self._buffers.pop(part_number))
+                        self._held -= self._size(part_number)
+                    else:
+                        self._parts[part_number] = data
+                    self._condition.notify_all()
+        finally:
+            os.close(fd)
+
+    def take(self, part_number: int) -> memoryview:
+        """Returns (a memoryview of) the data of the given part, waiting until it's been read."""
+        with self._condition:
+            while part_number not in self._parts:
+                if part_number in self._errors:
+                    raise self._errors[part_number]
+                if self._closed:
+                    raise RuntimeError(f"Part {part_number} of {self.path} is no longer being read.")
+                self._condition.wait()
+            self._taken.add(part_number)
+            return self._parts.pop(part_number)
+
+    def release(self, part_number: int) -> None:
+        """Says the given part, once taken, is no longer needed, so its buffer can be reused."""
+        with self._condition:
+            if part_number not in self._taken and self._parts.pop(part_number, None) is None:
+                return  # It's not been read yet (or has been released already).
+            self._taken.discard(part_number)
+            buffer = self._buffers.pop(part_number, None)
+            if buffer is not None:
+                self._free_buffers.append(buffer)
+                self._held -= self._size(part_number)
+                self._condition.notify_all()
+
+    def close(self) -> None:
+        """Stops reading, and lets go of all parts."""
+        with self._condition:
+            self._closed = True
+            self._parts.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
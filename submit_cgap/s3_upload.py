@@ -0,0 +1,462 @@
+# This file contains an in-process uploader of files to S3, an alternative to running 'aws s3 cp'.
+#
+# Uploading in-process lets us do things the AWS CLI can't be asked to do, such as renewing the temporary (STS)
+# credentials for an upload while it is going on, so that multi-hour uploads don't fail when those expire.
+
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import io
+import os
+import random
+import threading
+import time
+from dcicutils.misc_utils import PRINT
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+from .bandwidth import BANDWIDTH_LIMITER, TokenBucket, TransferMeter
+from .read_ahead import READ_AHEAD_BUFFER, READ_AHEAD_THREADS, MappedFile, PartBody, ReadAheadReader
+from .upload_tuning import (
+    UPLOAD_CONCURRENCY_VAR, UPLOAD_PART_SIZE_VAR, UploadTuner, is_throttling_error, make_upload_tuner,
+)
+
+
+class UploadEngine:
+    AWSCLI = 'awscli'
+    BOTO3 = 'boto3'
+
+
+UPLOAD_ENGINES = [UploadEngine.AWSCLI, UploadEngine.BOTO3]
+UPLOAD_ENGINE_VAR = 'SUBMITCGAP_UPLOAD_ENGINE'
+DEFAULT_UPLOAD_ENGINE = UploadEngine.AWSCLI
+
+MULTIPART_CHUNK_SIZE = 64 * 1024 * 1024  # bytes (S3 needs at least 5MB for all but the last part)
+MULTIPART_MAX_PARTS = 10000  # S3's limit
+MULTIPART_CONCURRENCY = 4  # parts uploaded at once (to begin with, if tuning)
+MULTIPART_PART_ATTEMPTS = 3  # attempts to upload a part that S3 throttles
+MULTIPART_RETRY_DELAY = 1.0  # seconds (at most) to wait before retrying a throttled part, doubling with each retry
+MULTIPART_RETRY_MAX_DELAY = 30.0  # seconds (at most) to wait before any retry
+MULTIPART_GROWTH_INTERVAL = 1000  # parts after which the part size of a stream of unknown size is doubled
+
+# Credentials expiring within this many seconds are replaced before being (re)used.
+CREDENTIALS_REFRESH_MARGIN = 15 * 60
+
+# Used in place of an expiration time when refreshed credentials don't say when they expire.
+CREDENTIALS_DEFAULT_LIFETIME = 60 * 60
+
+
+def _compute_upload_engine():  # factored out as a function for testing
+    engine = os.environ.get(UPLOAD_ENGINE_VAR) or DEFAULT_UPLOAD_ENGINE
+    if engine not in UPLOAD_ENGINES:
+        PRINT(f"Ignoring {UPLOAD_ENGINE_VAR}={engine!r}, which is not one of {', '.join(UPLOAD_ENGINES)}.")
+        engine = DEFAULT_UPLOAD_ENGINE
+    return engine
+
+
+UPLOAD_ENGINE = _compute_upload_engine()
+
+UPLOAD_TUNER = make_upload_tuner(concurrency=MULTIPART_CONCURRENCY, part_size=MULTIPART_CHUNK_SIZE,
+                                 concurrency_spec=os.environ.get(UPLOAD_CONCURRENCY_VAR),
+                                 part_size_spec=os.environ.get(UPLOAD_PART_SIZE_VAR))
+
+
+def parse_upload_url(upload_url: str) -> Tuple[str, str]:
+    """Returns the bucket and key named by an upload_url of the form s3://<bucket>/<key>."""
+    parsed = urlparse(upload_url)
+    if parsed.scheme != 's3' or not parsed.netloc or not parsed.path.lstrip('/'):
+        raise ValueError(f"Upload URL is not of the form s3://<bucket>/<key>: {upload_url}")
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+def credentials_expiration(upload_credentials: dict) -> Optional[datetime.datetime]:
+    """Returns the (timezone-aware) time at which the given upload credentials expire, or None if that's unknown."""
+    expiration = upload_credentials.get('Expiration')
+    if isinstance(expiration, str):
+        try:
+            expiration = datetime.datetime.fromisoformat(expiration.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if not isinstance(expiration, datetime.datetime):
+        return None
+    if expiration.tzinfo is None:
+        expiration = expiration.replace(tzinfo=datetime.timezone.utc)
+    return expiration
+
+
+def credentials_expire_soon(upload_credentials: dict, margin: float = CREDENTIALS_REFRESH_MARGIN) -> bool:
+    """Returns True if the given upload credentials are known to expire within the given number of seconds."""
+    expiration = credentials_expiration(upload_credentials)
+    if expiration is None:
+        return False
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return (expiration - now).total_seconds() < margin
+
+
+def _credentials_metadata(upload_credentials: dict) -> dict:
+    expiration = (credentials_expiration(upload_credentials)
+                  or (datetime.datetime.now(datetime.timezone.utc)
+                      + datetime.timedelta(seconds=CREDENTIALS_DEFAULT_LIFETIME)))
+    return {
+        'access_key': upload_credentials['AccessKeyId'],
+        'secret_key': upload_credentials['SecretAccessKey'],
+        'token': upload_credentials['SessionToken'],
+        'expiry_time': expiration.isoformat(),
+    }
+
+
+def make_s3_client(upload_credentials: dict, refresh_credentials: Optional[Callable[[], dict]] = None):
+    """
+    Returns an S3 client that uses the given upload credentials.
+
+    If refresh_credentials is given and the credentials say when they expire, the client calls refresh_credentials
+    for new upload credentials shortly before that, even in the middle of a multipart upload.
+    """
+    import boto3  # a dependency of dcicutils, but only needed here, so imported lazily
+    import botocore.credentials
+    import botocore.session
+    if refresh_credentials is None or credentials_expiration(upload_credentials) is None:
+        return boto3.client('s3',
+                            aws_access_key_id=upload_credentials['AccessKeyId'],
+                            aws_secret_access_key=upload_credentials['SecretAccessKey'],
+                            aws_session_token=upload_credentials['SessionToken'])
+
+    class UploadCredentialProvider(botocore.credentials.CredentialProvider):
+        """Supplies the upload credentials, renewing them with refresh_credentials."""
+
+        METHOD = 'submit-cgap-refresh'
+        CANONICAL_NAME = 'submit-cgap-refresh'
+
+        def load(self):
+            return botocore.credentials.RefreshableCredentials.create_from_metadata(
+                metadata=_credentials_metadata(upload_credentials),
+                refresh_using=lambda: _credentials_metadata(refresh_credentials()),
+                method=self.METHOD)
+
+    botocore_session = botocore.session.Session()
+    # Ahead of any other source of credentials (environment variables, profiles, ...) the session would look in.
+    botocore_session.get_component('credential_provider').insert_before('env', UploadCredentialProvider())
+    return boto3.Session(botocore_session=botocore_session).client('s3')
+
+
+def compute_part_size(file_size: int, chunk_size: Optional[int] = None) -> int:
+    """
+    Returns a part size of at least chunk_size (default MULTIPART_CHUNK_SIZE)
+    that will need no more than MULTIPART_MAX_PARTS parts.
+    """
+    return max(chunk_size or MULTIPART_CHUNK_SIZE, -(-file_size // MULTIPART_MAX_PARTS))
+
+
+def retry_delay(attempt: int) -> float:
+    """
+    Returns how long to wait before retrying after the given (1-based) attempt failed: a random time up to a limit
+    that doubles with each attempt, so that parts throttled together aren't all retried together.
+    """
+    return random.uniform(0, min(MULTIPART_RETRY_MAX_DELAY, MULTIPART_RETRY_DELAY * 2 ** (attempt - 1)))
+
+
+def _upload_part(s3_client, *, bucket: str, key: str, upload_id: str, part_number: int, body: memoryview,
+                 bandwidth_limiter: TokenBucket, tuner: Optional[UploadTuner], meter: TransferMeter) -> dict:
+    """Uploads one part of a multipart upload, retrying if S3 throttles it, and returns what S3 needs to complete it."""
+    size = len(body)
+    for attempt in range(1, MULTIPART_PART_ATTEMPTS + 1):
+        bandwidth_limiter.consume(size)
+        started = time.monotonic()
+        try:
+            response = s3_client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                             PartNumber=part_number, Body=PartBody(body))
+        except Exception as e:
+            throttled = is_throttling_error(e)
+            if tuner is not None:
+                tuner.record_failure(throttled=throttled)
+            if throttled and attempt < MULTIPART_PART_ATTEMPTS:
+                # The tuner has cut back, and fewer parts will be uploaded at once from now on.
+                time.sleep(retry_delay(attempt))
+                continue
+            raise
+        if tuner is not None:
+            tuner.record_part(size, started=started, finished=time.monotonic())
+        meter.add(size)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+
+def _upload_parts(upload_part: Callable[..., dict], jobs: Iterator[tuple], tuner: Optional[UploadTuner]) -> List[dict]:
+    """
+    Calls upload_part for each job (a tuple of its arguments), several at once, taking each job from the iterator
+    only when there's room for another part in flight, and returns the results sorted by part number.
+    """
+
+    def concurrency():
+        return tuner.concurrency if tuner is not None else MULTIPART_CONCURRENCY
+
+    parts = []
+    max_workers = tuner.max_concurrency if tuner is not None else MULTIPART_CONCURRENCY
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = set()
+        while True:
+            # The number of parts in flight follows the tuner's concurrency as it changes.
+            while len(in_flight) < concurrency():
+                job = next(jobs, None)
+                if job is None:
+                    break
+                in_flight.add(executor.submit(upload_part, *job))
+            if not in_flight:
+                break
+            done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            parts.extend(future.result() for future in done)
+    parts.sort(key=lambda part: part['PartNumber'])
+    return parts
+
+
+class _PartsMd5:
+    """
+    The md5 checksum of a file computed from its parts as they're uploaded, several at once and so not necessarily
+    in order: each part waits to be added until the parts before it have been.
+    """
+
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._next_part_number = 1
+        self._failed = False
+        self._condition = threading.Condition()
+
+    def add(self, part_number: int, data: memoryview) -> None:
+        with self._condition:
+            self._condition.wait_for(lambda: self._failed or self._next_part_number == part_number)
+            if self._failed:  # The upload will be abandoned for the part that failed, so there's no checksum.
+                return
+            self._md5.update(data)
+            self._next_part_number += 1
+            self._condition.notify_all()
+
+    def fail(self) -> None:
+        """Gives up on the checksum (because a part couldn't be uploaded), so that no part waits for it."""
+        with self._condition:
+            self._failed = True
+            self._condition.notify_all()
+
+    def hexdigest(self) -> str:
+        return self._md5.hexdigest()
+
+
+def upload_file_to_s3(path: str, upload_credentials: dict, *, s3_encrypt_key_id: Optional[str] = None,
+                      refresh_credentials: Optional[Callable[[], dict]] = None, s3_client=None,
+                      bandwidth_limiter: Optional[TokenBucket] = None, tuner: Optional[UploadTuner] = None,
+                      read_ahead_buffer: Optional[int] = None, offset: int = 0, length: Optional[int] = None,
+                      description: Optional[str] = None, check_md5: Optional[Callable[[str], None]] = None) -> None:
+    """
+    Uploads a local file to the upload_url given in upload_credentials, using a multipart upload for large files.
+
+    :param path: the name of a local file
+    :param upload_credentials: a dictionary containing 'AccessKeyId', 'SecretAccessKey', 'SessionToken',
+        and 'upload_url' (and, optionally, 'Expiration')
+    :param s3_encrypt_key_id: a KMS key id with which the uploaded file is to be encrypted, or None
+    :param refresh_credentials: a function returning new upload credentials for the same upload_url, or None
+    :param s3_client: an S3 client to use (default: one made by make_s3_client)
+    :param bandwidth_limiter: a TokenBucket limiting the rate of upload (default: BANDWIDTH_LIMITER, which is
+        shared by all uploads). The limit applies part by part, so it holds on average over the time to upload a part.
+    :param tuner: an UploadTuner to choose, and adjust from what it observes, the part size and the number of parts
+        uploaded at once (default: MULTIPART_CHUNK_SIZE and MULTIPART_CONCURRENCY, unadjusted)
+    :param read_ahead_buffer: the most bytes of parts to have read ahead of (or held for) their upload at once
+        (default: READ_AHEAD_BUFFER), or 0 to read each part only when it's to be uploaded (see read_ahead.py)
+    :param offset: where in the file the data to upload begins (e.g., a member of a tar file), default 0
+    :param length: the number of bytes to upload from there (default: the rest of the file)
+    :param description: what to call the upload in progress reports (default: the file's name)
+    :param check_md5: a function to call with the md5 checksum (in hex) of the data uploaded, computed from the same
+        reads as the upload, once all of it has been read but before the upload is completed, which can raise an
+        error to have the upload abandoned (e.g., if the checksum isn't what an md5 manifest says; see
+        md5_manifests.py)
+    """
+    bucket, key = parse_upload_url(upload_credentials['upload_url'])
+    s3_client = s3_client or make_s3_client(upload_credentials, refresh_credentials=refresh_credentials)
+    bandwidth_limiter = bandwidth_limiter or BANDWIDTH_LIMITER
+    extra_args = {'ServerSideEncryption': 'aws:kms', 'SSEKMSKeyId': s3_encrypt_key_id} if s3_encrypt_key_id else {}
+    file_size = os.path.getsize(path) - offset if length is None else length
+    part_size = compute_part_size(file_size, chunk_size=tuner.part_size if tuner is not None else None)
+    meter = TransferMeter(description or os.path.basename(path), total_bytes=file_size, limiter=bandwidth_limiter)
+    if file_size <= part_size:
+        bandwidth_limiter.consume(file_size)
+        if check_md5 is not None:  # The data, no more than a part, is read once, to be checksummed and uploaded.
+            with open(path, 'rb') as fp:
+                fp.seek(offset)
+                data = fp.read(file_size)
+            check_md5(hashlib.md5(data).hexdigest())
+            s3_client.put_object(Bucket=bucket, Key=key, Body=io.BytesIO(data), **extra_args)
+        elif offset == 0 and length is None:
+            with open(path, 'rb') as fp:
+                s3_client.put_object(Bucket=bucket, Key=key, Body=fp, **extra_args)
+        elif file_size == 0:
+            s3_client.put_object(Bucket=bucket, Key=key, Body=io.BytesIO(b""), **extra_args)
+        else:
+            with MappedFile(path) as mapped_file:
+                with mapped_file.view(offset, file_size) as body:
+                    s3_client.put_object(Bucket=bucket, Key=key, Body=PartBody(body), **extra_args)
+        meter.add(file_size)
+        meter.finish()
+        return
+    upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key, **extra_args)['UploadId']
+
+    read_ahead_buffer = READ_AHEAD_BUFFER if read_ahead_buffer is None else read_ahead_buffer
+    reader = None
+    mapped_file = None
+    parts_md5 = _PartsMd5() if check_md5 is not None else None
+
+    def upload_body(part_number, body):
+        if parts_md5 is not None:
+            parts_md5.add(part_number, body)
+        return _upload_part(s3_client, bucket=bucket, key=key, upload_id=upload_id, part_number=part_number,
+                            body=body, bandwidth_limiter=bandwidth_limiter, tuner=tuner, meter=meter)
+
+    def upload_part(part_number):
+        # Parts are memoryviews (of a reused buffer, or of the file mapped into memory), so they're not copied whole.
+        try:
+            if reader is None:
+                part_offset = (part_number - 1) * part_size
+                with mapped_file.view(offset + part_offset, min(part_size, file_size - part_offset)) as body:
+                    return upload_body(part_number, body)
+            body = reader.take(part_number)
+            try:
+                return upload_body(part_number, body)
+            finally:
+                reader.release(part_number)
+        except BaseException:
+            if parts_md5 is not None:
+                parts_md5.fail()
+            raise
+
+    try:
+        if read_ahead_buffer > 0:
+            reader = ReadAheadReader(path, part_size, file_size=file_size, budget=read_ahead_buffer,
+                                     threads=READ_AHEAD_THREADS, offset=offset)
+        else:
+            mapped_file = MappedFile(path)
+        parts = _upload_parts(upload_part, ((part_number,) for part_number in range(1, -(-file_size // part_size) + 1)),
+                              tuner=tuner)
+        if check_md5 is not None:
+            check_md5(parts_md5.hexdigest())
+        s3_client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                            MultipartUpload={'Parts': parts})
+    except BaseException:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    finally:
+        if reader is not None:
+            reader.close()
+        if mapped_file is not None:
+            mapped_file.close()
+        if tuner is not None:
+            tuner.file_finished()
+    meter.finish()
+
+
+def _read_into(stream: BinaryIO, buffer: memoryview) -> int:
+    """Reads from a stream until the buffer is full or the stream ends, returning the number of bytes read."""
+    n_read = 0
+    while n_read < len(buffer):
+        if hasattr(stream, 'readinto'):
+            n = stream.readinto(buffer[n_read:])
+        else:
+            chunk = stream.read(len(buffer) - n_read)
+            n = len(chunk)
+            buffer[n_read:n_read + n] = chunk
+        if not n:
+            break
+        n_read += n
+    return n_read
+
+
+def upload_stream_to_s3(stream: BinaryIO, upload_credentials: dict, *, size: Optional[int] = None,
+                        max_size: Optional[int] = None, description: str = "stream",
+                        s3_encrypt_key_id: Optional[str] = None,
+                        refresh_credentials: Optional[Callable[[], dict]] = None, s3_client=None,
+                        bandwidth_limiter: Optional[TokenBucket] = None, tuner: Optional[UploadTuner] = None) -> dict:
+    """
+    Uploads what's read from a stream (e.g., a compressed member of a tar file, which can only be read in order)
+    to the upload_url given in upload_credentials, using a multipart upload for all but a stream that fits in a part.
+
+    Parts are read in order, into buffers reused from part to part, each only once there's room for it to be
+    uploaded, so no more than a part more than those being uploaded is held at once. If neither size nor max_size
+    is given, the part size doubles every MULTIPART_GROWTH_INTERVAL parts.
+
+    :param stream: a binary file-like object, read to its end
+    :param size: the number of bytes the stream is expected to have, if known, which is used to choose the part
+        size (and to report progress), and which it's an error for the stream not to have
+    :param max_size: the most bytes the stream might have, if its size isn't known exactly, used to choose
+        a part size that won't need more than MULTIPART_MAX_PARTS parts
+    :param description: what to call the upload in progress reports
+    (The other arguments are as for upload_file_to_s3.)
+    :return: a dictionary with the 'size' and 'md5' (checksum, in hex) of what was uploaded
+    """
+    bucket, key = parse_upload_url(upload_credentials['upload_url'])
+    s3_client = s3_client or make_s3_client(upload_credentials, refresh_credentials=refresh_credentials)
+    bandwidth_limiter = bandwidth_limiter or BANDWIDTH_LIMITER
+    extra_args = {'ServerSideEncryption': 'aws:kms', 'SSEKMSKeyId': s3_encrypt_key_id} if s3_encrypt_key_id else {}
+    part_size = compute_part_size(size or max_size or 0, chunk_size=tuner.part_size if tuner is not None else None)
+    growing = size is None and max_size is None
+
+    def part_size_of(part_number):
+        # With no idea how big the stream is, parts get bigger as it goes on, so that MULTIPART_MAX_PARTS parts
+        # are enough for any stream S3 can hold, but a small stream needs only small parts (and buffers).
+        return part_size * 2 ** ((part_number - 1) // MULTIPART_GROWTH_INTERVAL) if growing else part_size
+
+    meter = TransferMeter(description, total_bytes=size, limiter=bandwidth_limiter)
+    md5 = hashlib.md5()
+    free_buffers = collections.deque()  # appended to by the threads uploading parts, as each is done
+    total = 0
+
+    def read_part(part_number) -> Tuple[bytearray, memoryview]:
+        nonlocal total
+        wanted = part_size_of(part_number)
+        buffer = free_buffers.pop() if free_buffers else None
+        if buffer is None or len(buffer) < wanted:  # A buffer too small for parts from now on is let go.
+            buffer = bytearray(wanted)
+        data = memoryview(buffer)[:_read_into(stream, memoryview(buffer)[:wanted])]
+        md5.update(data)
+        total += len(data)
+        if size is not None and total > size:
+            raise ValueError(f"The {description} has more than the {size} bytes expected.")
+        return buffer, data
+
+    def check_size():
+        if size is not None and total != size:
+            raise ValueError(f"The {description} has {total} bytes, not the {size} expected.")
+
+    first_buffer, first_part = read_part(1)
+    if len(first_part) < part_size:
+        check_size()
+        bandwidth_limiter.consume(total)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=PartBody(first_part), **extra_args)
+        meter.add(total)
+        meter.finish()
+        return {'size': total, 'md5': md5.hexdigest()}
+    upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key, **extra_args)['UploadId']
+
+    def parts_read():
+        part_number, buffer, data = 1, first_buffer, first_part
+        while len(data) > 0:
+            yield part_number, buffer, data
+            if len(data) < part_size_of(part_number):
+                return
+            part_number += 1
+            buffer, data = read_part(part_number)
+
+    def upload_part(part_number, buffer, data):
+        try:
+            return _upload_part(s3_client, bucket=bucket, key=key, upload_id=upload_id, part_number=part_number,
+                                body=data, bandwidth_limiter=bandwidth_limiter, tuner=tuner, meter=meter)
+        finally:
+            free_buffers.append(buffer)
+
+    try:
+        parts = _upload_parts(upload_part, parts_read(), tuner=tuner)
+        check_size()
+        s3_client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                            MultipartUpload={'Parts': parts})
+    except BaseException:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    finally:
+        if tuner is not None:
+            tuner.file_finished()
+    meter.finish()
+    return {'size': total, 'md5': md5.hexdigest()}
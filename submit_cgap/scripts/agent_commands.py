@@ -0,0 +1,37 @@
+# This file contains the entry points of the commands an agent can run (see agent.py). Each has the agent run its
+# command, if one is running, and otherwise runs it here, with the main function of its module in this folder.
+# They import nothing but agent.py (and the standard library), so a command the agent runs is handed over without
+# importing all the modules the command uses, which are imported only if it's run here after all.
+
+import os
+import stat
+import sys
+from ..agent import run_command
+
+
+def check_submission():
+    return run_command('check-submission')
+
+
+def resume_uploads():
+    return run_command('resume-uploads')
+
+
+def submit_metadata_bundle():
+    return run_command('submit-metadata-bundle')
+
+
+def upload_item_data():
+    # Data read as it's written (from standard input, or a named pipe) is read here, not sent to an agent. It's not
+    # worth importing argparse to find which argument names the file, so any that might will do.
+    if any(arg == '-' or _is_named_pipe(arg) for arg in sys.argv[1:]):
+        from .upload_item_data import main
+        return main()
+    return run_command('upload-item-data')
+
+
+def _is_named_pipe(path):
+    try:
+        return stat.S_ISFIFO(os.stat(path).st_mode)
+    except (OSError, ValueError):
+        return False
@@ -0,0 +1,26 @@
+import argparse
+from ..submission import show_upload_progress
+from ..utils import script_catch_errors
+
+
+EPILOG = __doc__
+
+
+def main(simulated_args_for_testing=None):
+    parser = argparse.ArgumentParser(  # noqa - PyCharm wrongly thinks the formatter_class is invalid
+        description="Shows the locally recorded progress of uploads for a submission, without contacting the server",
+        epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('uuid', nargs='?', help='uuid identifier (default: all recorded submissions)', default=None)
+    parser.add_argument('--server', '-s', help="an http or https address of the server to use", default=None)
+    parser.add_argument('--env', '-e', help="a CGAP beanstalk environment name for the server to use", default=None)
+    args = parser.parse_args(args=simulated_args_for_testing)
+
+    with script_catch_errors():
+
+        show_upload_progress(uuid=args.uuid, server=args.server, env=args.env)
+
+
+if __name__ == '__main__':
+    main()
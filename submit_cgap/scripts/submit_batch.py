@@ -0,0 +1,73 @@
+import argparse
+from dcicutils.common import APP_CGAP
+from ..batch_submissions import (
+    DEFAULT_BATCH_ATTEMPTS, DEFAULT_BATCH_CONCURRENCY, DEFAULT_BATCH_RETRY_DELAY, BatchState, submit_batch,
+)
+from ..submission import DEFAULT_INGESTION_TYPE, DEFAULT_SUBMISSION_PROTOCOL, SUBMISSION_PROTOCOLS
+from ..utils import script_catch_errors
+
+
+EPILOG = __doc__
+
+
+def main(simulated_args_for_testing=None):
+    parser = argparse.ArgumentParser(  # noqa - PyCharm wrongly thinks the formatter_class is invalid
+        description="Submits the files a manifest lists, several at once, keeping track of them so a stopped batch"
+                    " can be carried on",
+        epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('manifest', help='a file listing the files to submit (one per line, or a CSV or TSV table'
+                                         ' with a filename column)')
+    parser.add_argument('--institution', '-i', help='institution identifier', default=None)
+    parser.add_argument('--project', '-p', help='project identifier', default=None)
+    parser.add_argument('--server', '-s', help="an http or https address of the server to use", default=None)
+    parser.add_argument('--env', '-e', help="a CGAP beanstalk environment name for the server to use", default=None)
+    parser.add_argument('--validate-only', '-v', action="store_true",
+                        help="whether to stop after validating without submitting", default=False)
+    parser.add_argument('--upload_folder', '-u', help="location of the upload files", default=None)
+    parser.add_argument('--ingestion_type', '--ingestion-type', '-t',
+                        help="the ingestion type of files for which the manifest doesn't give one",
+                        default=DEFAULT_INGESTION_TYPE)
+    parser.add_argument('--subfolders', '-sf', action="store_true",
+                        help="search subfolders of folder for upload files", default=False)
+    parser.add_argument('--concurrency', '-c', type=int, default=DEFAULT_BATCH_CONCURRENCY,
+                        help=f"the number of files to work on at once (default {DEFAULT_BATCH_CONCURRENCY})")
+    parser.add_argument('--attempts', type=int, default=DEFAULT_BATCH_ATTEMPTS,
+                        help=f"the number of times to try a file before giving up on it"
+                             f" (default {DEFAULT_BATCH_ATTEMPTS})")
+    parser.add_argument('--retry-delay', '--retry_delay', type=float, default=DEFAULT_BATCH_RETRY_DELAY,
+                        help=f"the seconds to wait before first trying a file again, doubling each time after that"
+                             f" (default {DEFAULT_BATCH_RETRY_DELAY})")
+    parser.add_argument('--queue', '-q', dest='queue_file', default=None,
+                        help="the file in which to keep track of the batch (default: the manifest's name with"
+                             " .queue.sqlite3 added)")
+    parser.add_argument('--results', '-r', dest='results_file', default=None,
+                        help="a file to which to write a table (CSV, or TSV if it ends in .tsv) of results")
+    parser.add_argument('--retry-failed', '--retry_failed', action="store_true", default=False,
+                        help="try again the files that failed in an earlier run")
+    parser.add_argument('--app', default=APP_CGAP,
+                        help=f"An application (default {APP_CGAP!r}. Only for debugging."
+                             f" Normally this should not be given.")
+    parser.add_argument('--submission_protocol', '--submission-protocol', '-sp',
+                        choices=SUBMISSION_PROTOCOLS, default=DEFAULT_SUBMISSION_PROTOCOL,
+                        help=f"the submission protocol (default {DEFAULT_SUBMISSION_PROTOCOL!r})")
+    args = parser.parse_args(args=simulated_args_for_testing)
+    if args.concurrency < 1 or args.attempts < 1:
+        parser.error("--concurrency and --attempts must be at least 1.")
+
+    with script_catch_errors():
+
+        counts = submit_batch(args.manifest, institution=args.institution, project=args.project,
+                              server=args.server, env=args.env, validate_only=args.validate_only,
+                              upload_folder=args.upload_folder, ingestion_type=args.ingestion_type,
+                              subfolders=args.subfolders, app=args.app, submission_protocol=args.submission_protocol,
+                              concurrency=args.concurrency, attempts=args.attempts, retry_delay=args.retry_delay,
+                              queue_file=args.queue_file, results_file=args.results_file,
+                              retry_failed=args.retry_failed)
+        if counts[BatchState.FAILED]:
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
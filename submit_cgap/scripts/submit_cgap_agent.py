@@ -0,0 +1,26 @@
+import argparse
+from ..agent import run_agent
+from ..utils import script_catch_errors
+
+
+EPILOG = __doc__
+
+
+def main(simulated_args_for_testing=None):
+    parser = argparse.ArgumentParser(  # noqa - PyCharm wrongly thinks the formatter_class is invalid
+        description="Runs an agent that runs submit-metadata-bundle, check-submission, resume-uploads and"
+                    " upload-item-data commands, keeping what it can (such as connections to the portal)"
+                    " from one to the next",
+        epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--socket', help="the Unix socket on which to listen for commands", default=None)
+    args = parser.parse_args(args=simulated_args_for_testing)
+
+    with script_catch_errors():
+
+        run_agent(agent_socket=args.socket)
+
+
+if __name__ == '__main__':
+    main()
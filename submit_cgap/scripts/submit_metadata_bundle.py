@@ -1,7 +1,8 @@
 import argparse
 from dcicutils.common import APP_CGAP
+from ..md5_manifests import MD5_MISMATCHES
 from ..submission import (
-    submit_any_ingestion, DEFAULT_INGESTION_TYPE, DEFAULT_SUBMISSION_PROTOCOL, SUBMISSION_PROTOCOLS
+    submit_any_ingestion, DEFAULT_INGESTION_TYPE, DEFAULT_SUBMISSION_PROTOCOL, PREFLIGHT_MODES, SUBMISSION_PROTOCOLS
 )
 from ..utils import script_catch_errors
 
@@ -29,6 +30,23 @@ def main(simulated_args_for_testing=None):
                         help="suppress requests for user input", default=False)
     parser.add_argument('--subfolders', '-sf', action="store_true",
                         help="search subfolders of folder for upload files", default=False)
+    parser.add_argument('--prepare_uploads', '--prepare-uploads', '-pu', action="store_true",
+                        help="while awaiting processing, index upload folder and checksum files named in the bundle",
+                        default=False)
+    parser.add_argument('--preflight', '-pf', choices=PREFLIGHT_MODES, default=None,
+                        help="check all upload files before uploading any, reporting problems and then asking"
+                             " whether to go on ('check') or uploading nothing ('strict') if there are any"
+                             " (default: $SUBMITCGAP_PREFLIGHT, or 'off')")
+    parser.add_argument('--check_formats', '--check-formats', '-cf', action="store_true", default=None,
+                        help="check that upload files are in good form (e.g., not truncated) before uploading them,"
+                             " and don't upload those that aren't (default: $SUBMITCGAP_CHECK_FORMATS)")
+    parser.add_argument('--md5_manifests', '--md5-manifests', '-mm', default=None,
+                        help="md5 manifests (a comma-separated list, or 'auto' for any in the upload folder)"
+                             " to check upload files against before uploading them"
+                             " (default: $SUBMITCGAP_MD5_MANIFESTS)")
+    parser.add_argument('--md5_mismatch', '--md5-mismatch', choices=MD5_MISMATCHES, default=None,
+                        help="whether files that don't match their md5 manifests are not uploaded ('block')"
+                             " or uploaded with a warning ('flag') (default: $SUBMITCGAP_MD5_MISMATCH, or 'block')")
     parser.add_argument('--app', default=APP_CGAP,
                         help=f"An application (default {APP_CGAP!r}. Only for debugging."
                              f" Normally this should not be given.")
@@ -44,7 +62,10 @@ def main(simulated_args_for_testing=None):
                              server=args.server, env=args.env,
                              validate_only=args.validate_only, upload_folder=args.upload_folder,
                              no_query=args.no_query, subfolders=args.subfolders, app=args.app,
-                             submission_protocol=args.submission_protocol)
+                             submission_protocol=args.submission_protocol,
+                             prepare_uploads=args.prepare_uploads, preflight=args.preflight,
+                             check_formats=args.check_formats, md5_manifests=args.md5_manifests,
+                             md5_mismatch=args.md5_mismatch)
 
 
 if __name__ == '__main__':
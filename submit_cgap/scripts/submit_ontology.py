@@ -39,8 +39,6 @@ def main(simulated_args_for_testing=None):
 
     with script_catch_errors():
 
-        verify_ontology_file(args.ontology_filename)
-
         return submit_any_ingestion(
                 ingestion_filename=args.ontology_filename,
                 ingestion_type='ontology',
@@ -53,6 +51,7 @@ def main(simulated_args_for_testing=None):
                 validate_only=args.validate_only,
                 app=args.app,
                 submission_protocol=args.submission_protocol,
+                ingestion_file_verifier=verify_ontology_file,
         )
 
 
@@ -12,18 +12,21 @@ def main(simulated_args_for_testing=None):
         epilog=EPILOG,
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
-    parser.add_argument('part_filename', help='a local Excel filename that is the part file')
+    parser.add_argument('part_filename', help='a local Excel filename that is the part file'
+                                              ' (or "-", or a named pipe, to upload data as it is written to it)')
     parser.add_argument('--uuid', '-u', help='uuid identifier', default=None)
     parser.add_argument('--server', '-s', help="an http or https address of the server to use", default=None)
     parser.add_argument('--env', '-e', help="a CGAP beanstalk environment name for the server to use", default=None)
     parser.add_argument('--no_query', '-nq', action="store_true",
                         help="suppress requests for user input", default=False)
+    parser.add_argument('--name', '-n', help="the file name to give data read from standard input or a named pipe",
+                        default=None)
     args = parser.parse_args(args=simulated_args_for_testing)
 
     with script_catch_errors():
 
         upload_item_data(item_filename=args.part_filename, uuid=args.uuid, server=args.server,
-                         env=args.env, no_query=args.no_query)
+                         env=args.env, no_query=args.no_query, file_name=args.name)
 
 
 if __name__ == '__main__':
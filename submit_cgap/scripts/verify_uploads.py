@@ -0,0 +1,32 @@
+import argparse
+from ..submission import verify_submission_uploads
+from ..utils import script_catch_errors
+
+
+EPILOG = __doc__
+
+
+def main(simulated_args_for_testing=None):
+    parser = argparse.ArgumentParser(  # noqa - PyCharm wrongly thinks the formatter_class is invalid
+        description="Checks that the server registered the files uploaded for a submission as uploaded",
+        epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('uuid', help='uuid identifier')
+    parser.add_argument('--server', '-s', help="an http or https address of the server to use", default=None)
+    parser.add_argument('--env', '-e', help="a CGAP beanstalk environment name for the server to use", default=None)
+    parser.add_argument('--upload_folder', '-u', help="location of the uploaded files, to compare them with",
+                        default=None)
+    parser.add_argument('--subfolders', '-sf', action="store_true",
+                        help="search subfolders of folder for uploaded files", default=False)
+    args = parser.parse_args(args=simulated_args_for_testing)
+
+    with script_catch_errors():
+
+        if not verify_submission_uploads(uuid=args.uuid, server=args.server, env=args.env,
+                                         upload_folder=args.upload_folder, subfolders=args.subfolders):
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
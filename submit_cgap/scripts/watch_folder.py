@@ -0,0 +1,49 @@
+import argparse
+from dcicutils.common import APP_CGAP
+from ..submission import DEFAULT_INGESTION_TYPE, DEFAULT_SUBMISSION_PROTOCOL, SUBMISSION_PROTOCOLS
+from ..utils import script_catch_errors
+from ..watch_folder import watch_folder
+
+
+EPILOG = __doc__
+
+
+def main(simulated_args_for_testing=None):
+    parser = argparse.ArgumentParser(  # noqa - PyCharm wrongly thinks the formatter_class is invalid
+        description="Watches a folder, submitting the data bundles that land in it and uploading their files",
+        epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('folder', help='a local folder in which data bundles land')
+    parser.add_argument('--institution', '-i', help='institution identifier', default=None)
+    parser.add_argument('--project', '-p', help='project identifier', default=None)
+    parser.add_argument('--server', '-s', help="an http or https address of the server to use", default=None)
+    parser.add_argument('--env', '-e', help="a CGAP beanstalk environment name for the server to use", default=None)
+    parser.add_argument('--validate-only', '-v', action="store_true",
+                        help="whether to stop after validating without submitting", default=False)
+    parser.add_argument('--upload_folder', '-u', help="location of the upload files", default=None)
+    parser.add_argument('--ingestion_type', '--ingestion-type', '-t', help="the ingestion type",
+                        default=DEFAULT_INGESTION_TYPE)
+    parser.add_argument('--subfolders', '-sf', action="store_true",
+                        help="search subfolders of folder for upload files", default=False)
+    parser.add_argument('--until-done', '--until_done', action="store_true",
+                        help="stop once there's nothing left to do, rather than going on watching", default=False)
+    parser.add_argument('--app', default=APP_CGAP,
+                        help=f"An application (default {APP_CGAP!r}. Only for debugging."
+                             f" Normally this should not be given.")
+    parser.add_argument('--submission_protocol', '--submission-protocol', '-sp',
+                        choices=SUBMISSION_PROTOCOLS, default=DEFAULT_SUBMISSION_PROTOCOL,
+                        help=f"the submission protocol (default {DEFAULT_SUBMISSION_PROTOCOL!r})")
+    args = parser.parse_args(args=simulated_args_for_testing)
+
+    with script_catch_errors():
+
+        watch_folder(args.folder, institution=args.institution, project=args.project,
+                     server=args.server, env=args.env, validate_only=args.validate_only,
+                     upload_folder=args.upload_folder, ingestion_type=args.ingestion_type,
+                     subfolders=args.subfolders, app=args.app, submission_protocol=args.submission_protocol,
+                     until_done=args.until_done)
+
+
+if __name__ == '__main__':
+    main()
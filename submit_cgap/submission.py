@@ -1,9 +1,15 @@
+import concurrent.futures
+import contextlib
+import datetime
+import functools
 import glob
 import io
 import json
 import os
 import re
+import stat
 import subprocess
+import sys
 import time
 from typing import Tuple
 
@@ -16,15 +22,37 @@ from dcicutils.common import APP_CGAP, APP_FOURFRONT, APP_SMAHT, OrchestratedApp
 from dcicutils.exceptions import InvalidParameterError
 from dcicutils.ff_utils import get_health_page as get_portal_health_page
 from dcicutils.lang_utils import n_of, conjoined_list, disjoined_list, there_are
-from dcicutils.misc_utils import check_true, environ_bool, PRINT, url_path_join, ignorable, remove_prefix
+from dcicutils.misc_utils import check_true, environ_bool, ignored, PRINT, url_path_join, remove_prefix
 from dcicutils.s3_utils import HealthPageKey
-from typing import BinaryIO, Dict, Optional
+from typing import Any, BinaryIO, Callable, Dict, NamedTuple, Optional
 from typing_extensions import Literal
 from urllib.parse import urlparse
+from .bandwidth import BANDWIDTH_LIMITER, format_rate, write_aws_cli_bandwidth_config
 from .base import DEFAULT_ENV, DEFAULT_ENV_VAR, PRODUCTION_ENV, KEY_MANAGER, DEFAULT_APP
+from .bgzf import COMPRESS_UPLOADS, COMPRESSED_SUFFIXES, uncompressed_source, upload_compressed_file
 from .exceptions import CGAPPermissionError
+from .format_checks import CHECK_FORMATS, check_file_format, check_file_formats
+from .growing_files import FOLLOW_UPLOADS, is_being_written, upload_growing_file
+from .host_coordination import HOST_COORDINATOR
+from .ingestion_cache import INGESTION_SUBMISSION_CACHE
+from .local_files import LocalFileIndex, compute_file_md5
+from .md5_manifests import (
+    MD5_MANIFESTS, MD5_MISMATCH, Md5Manifests, Md5Mismatch, compute_md5s, md5_checker, md5_mismatch_message,
+    resolve_md5_manifests,
+)
+from .s3_upload import (
+    CREDENTIALS_REFRESH_MARGIN, UPLOAD_ENGINE, UPLOAD_TUNER, UploadEngine, credentials_expiration,
+    credentials_expire_soon, upload_file_to_s3, upload_stream_to_s3,
+)
 from .portal_network_access import portal_metadata_post, portal_metadata_patch, portal_request_get, portal_request_post
-from .utils import show, keyword_as_title, check_repeatedly
+from .tar_sources import TAR_SOURCES, find_tar_member, stream_order, tar_member, upload_tar_member
+from .upload_backends import UPLOAD_BACKEND, UPLOAD_WORKERS, UploadBackend, run_upload_jobs
+from .upload_ledger import UPLOAD_LEDGER, UPLOAD_STATUSES, FileUploadTracker, UploadStatus
+from .upload_scheduling import (
+    UPLOAD_ORDER, UPLOAD_PRIORITIES, UploadOrder, file_size_or_zero, makespan_message, schedule_uploads,
+)
+from .upload_verification import VERIFY_TIMEOUT, VERIFY_UPLOADS, verification_report, verify_file_items
+from .utils import show, keyword_as_title, check_repeatedly, TaskGraph
 from dcicutils.function_cache_decorator import function_cache
 
 
@@ -99,7 +127,22 @@ def resolve_server(server, env):
     return server
 
 
-def get_user_record(server, auth):
+def get_user_record_response(server, auth):
+    """
+    Given a server and some auth info, requests the /me page for the authorized user, returning the raw response.
+
+    This does no checking or output, so it is safe to call in the background (see submit_any_ingestion).
+
+    :param server: a server spec
+    :param auth: auth info to be used when contacting the server
+    :return: the response to a GET of the /me page
+    """
+
+    user_url = server + "/me?format=json"
+    return portal_request_get(user_url, auth=auth, headers=STANDARD_HTTP_HEADERS)
+
+
+def get_user_record(server, auth, user_record_response=None):
     """
     Given a server and some auth info, gets the user record for the authorized user.
 
@@ -107,11 +150,12 @@ def get_user_record(server, auth):
 
     :param server: a server spec
     :param auth: auth info to be used when contacting the server
+    :param user_record_response: a response from get_user_record_response, if the request was already made
     :return: the /me page in JSON format
     """
 
-    user_url = server + "/me?format=json"
-    user_record_response = portal_request_get(user_url, auth=auth, headers=STANDARD_HTTP_HEADERS)
+    if user_record_response is None:
+        user_record_response = get_user_record_response(server, auth=auth)
     try:
         user_record = user_record_response.json()
     except Exception:
@@ -362,8 +406,27 @@ def show_section(res, section, caveat_outcome=None):
         show(section_data)
 
 
-def ingestion_submission_item_url(server, uuid):
-    return url_path_join(server, "ingestion-submissions", uuid) + "?format=json"
+# Polling for progress needs only these fields, not the whole (possibly very large) IngestionSubmission.
+INGESTION_STATUS_FIELDS = ['processing_status']
+
+# The requests library asks for these by default, but we depend on it, so we say so explicitly when polling.
+COMPRESSED_HTTP_HEADERS = {"Accept-Encoding": "gzip, deflate"}
+
+
+def ingestion_submission_item_url(server, uuid, fields=None):
+    """
+    Returns the URL of an IngestionSubmission in JSON format.
+
+    :param server: a server spec
+    :param uuid: the uuid of the IngestionSubmission
+    :param fields: an optional list of fields to ask for (in object frame, so nothing is embedded),
+        rather than the whole item. A server that doesn't do field selection will send the whole item anyway.
+    :return: a URL string
+    """
+    url = url_path_join(server, "ingestion-submissions", uuid) + "?format=json"
+    if fields:
+        url += "&frame=object" + "".join(f"&field={field}" for field in fields)
+    return url
 
 
 DEBUG_PROTOCOL = environ_bool("DEBUG_PROTOCOL", default=False)
@@ -507,7 +570,10 @@ def submit_any_ingestion(ingestion_filename, *, ingestion_type, server, env, val
                          consortium=None, submission_center=None,
                          app: OrchestratedApp = None,
                          upload_folder=None, no_query=False, subfolders=False,
-                         submission_protocol=DEFAULT_SUBMISSION_PROTOCOL):
+                         submission_protocol=DEFAULT_SUBMISSION_PROTOCOL,
+                         ingestion_file_verifier: Optional[Callable[[str], Any]] = None,
+                         prepare_uploads=False, preflight=None, check_formats=None, md5_manifests=None,
+                         md5_mismatch=None):
     """
     Does the core action of submitting a metadata bundle.
 
@@ -527,6 +593,14 @@ def submit_any_ingestion(ingestion_filename, *, ingestion_type, server, env, val
     :param no_query: bool to suppress requests for user input
     :param subfolders: bool to search subdirectories within upload_folder for files
     :param submission_protocol: which submission protocol to use (default: 's3')
+    :param ingestion_file_verifier: a function of the ingestion filename to be called (concurrently with other
+        preliminary steps, but before the user is queried) to check its content, raising an error if it's unsuitable
+    :param prepare_uploads: bool to index the upload folder and checksum files named in the bundle
+        in the background while awaiting processing
+    :param preflight: whether to check all files before uploading any, as for do_uploads
+    :param check_formats: whether to check that files are in good form before uploading them, as for do_uploads
+    :param md5_manifests: md5 manifests to check files against before uploading them, as for do_uploads
+    :param md5_mismatch: what to do with files that don't match their manifests, as for do_uploads
     """
 
     if app is None:  # For legacy reasons, SubmitCGAP was the first so didn't expect this arg was needed
@@ -539,36 +613,127 @@ def submit_any_ingestion(ingestion_filename, *, ingestion_type, server, env, val
                                         institution=institution, project=project, lab=lab, award=award, app=app,
                                         consortium=consortium, submission_center=submission_center,
                                         upload_folder=upload_folder, no_query=no_query, subfolders=subfolders,
-                                        submission_protocol=submission_protocol)
+                                        submission_protocol=submission_protocol,
+                                        ingestion_file_verifier=ingestion_file_verifier,
+                                        prepare_uploads=prepare_uploads, preflight=preflight,
+                                        check_formats=check_formats, md5_manifests=md5_manifests,
+                                        md5_mismatch=md5_mismatch)
 
     app_args = _resolve_app_args(institution=institution, project=project, lab=lab, award=award, app=app,
                                  consortium=consortium, submission_center=submission_center)
 
-    server = resolve_server(server=server, env=env)
+    # The preliminary steps are independent round trips and local checks, so they're run as a small graph of
+    # concurrent tasks. The network requests get started while the user is still answering the query below.
+    # Results are consumed here in the same order as these steps were once done serially, so any errors
+    # (and any output) still appear in that order.
+    with TaskGraph() as presubmission:
 
-    validation_qualifier = " (for validation only)" if validate_only else ""
+        presubmission.add('server', resolve_server, server=server, env=env)
+        presubmission.add('file_exists', lambda: os.path.exists(ingestion_filename))
+        if ingestion_file_verifier:
+            presubmission.add('file_verified', lambda: ingestion_file_verifier(ingestion_filename))
+        presubmission.add('keydict', lambda server: KEY_MANAGER.get_keydict_for_server(server),
+                          depends_on=['server'])
+        presubmission.add('health_page', lambda keydict: get_health_page(key=keydict),
+                          depends_on=['keydict'])
+        presubmission.add('user_record_response',
+                          lambda server, keydict: get_user_record_response(
+                              server, auth=KEY_MANAGER.keydict_to_keypair(keydict)),
+                          depends_on=['server', 'keydict'])
 
-    maybe_ingestion_type = ''
-    if ingestion_type != DEFAULT_INGESTION_TYPE:
-        maybe_ingestion_type = " (%s)" % ingestion_type
+        server = presubmission.result('server')
 
-    if not no_query:
-        if not yes_or_no("Submit %s%s to %s%s?"
-                         % (ingestion_filename, maybe_ingestion_type, server, validation_qualifier)):
-            show("Aborting submission.")
-            exit(1)
+        if ingestion_file_verifier:
+            presubmission.result('file_verified')
+
+        validation_qualifier = " (for validation only)" if validate_only else ""
+
+        maybe_ingestion_type = ''
+        if ingestion_type != DEFAULT_INGESTION_TYPE:
+            maybe_ingestion_type = " (%s)" % ingestion_type
 
+        if not no_query:
+            if not yes_or_no("Submit %s%s to %s%s?"
+                             % (ingestion_filename, maybe_ingestion_type, server, validation_qualifier)):
+                show("Aborting submission.")
+                exit(1)
+
+        keydict = presubmission.result('keydict')
+        keypair = KEY_MANAGER.keydict_to_keypair(keydict)
+
+        metadata_bundles_bucket = presubmission.result('health_page').get("metadata_bundles_bucket")
+
+        user_record = get_user_record(server, auth=keypair,
+                                      user_record_response=presubmission.result('user_record_response'))
+
+        do_app_arg_defaulting(app_args, user_record)
+
+        if not presubmission.result('file_exists'):
+            raise ValueError("The file '%s' does not exist." % ingestion_filename)
+
+    uuid = post_ingestion_submission(ingestion_filename, ingestion_type=ingestion_type, server=server, keydict=keydict,
+                                     validate_only=validate_only, app_args=app_args,
+                                     submission_protocol=submission_protocol)
+
+    if DEBUG_PROTOCOL:  # pragma: no cover
+        show(f"Created IngestionSubmission object: s3://{metadata_bundles_bucket}/{uuid}", with_time=True)
+    show(f"Bundle uploaded to bucket {metadata_bundles_bucket}, assigned uuid {uuid} for tracking."
+         f" Awaiting processing...",
+         with_time=True)
+
+    file_index = None
+    if prepare_uploads and not validate_only:
+        # Use the wait for processing to find (and checksum) the files the bundle is likely to want uploaded.
+        file_index = LocalFileIndex(upload_folder or os.path.dirname(ingestion_filename), recursive=subfolders)
+        file_index.start_preparation(bundle_filename=ingestion_filename)
+
+    check_done, check_status, check_response = check_submit_ingestion(uuid, server, env, app, use_cache=False)
+
+    if validate_only:
+        exit(0)
+
+    if check_status == "success":
+        do_any_uploads(check_response, keydict=keydict, ingestion_filename=ingestion_filename,
+                       upload_folder=upload_folder, no_query=no_query,
+                       subfolders=subfolders, file_index=file_index, preflight=preflight,
+                       check_formats=check_formats, md5_manifests=md5_manifests, md5_mismatch=md5_mismatch)
+
+    exit(0)
+
+
+def resolve_submission_context(*, server, env, app, institution=None, project=None, lab=None, award=None,
+                               consortium=None, submission_center=None) -> Tuple[str, dict, dict]:
+    """
+    Works out, once, what submitting any number of files needs that doesn't depend on the file: the server,
+    the keydict for it, and the (defaulted) app args, as submit_any_ingestion does for a single file.
+    The keys for the given app must already be selected (see KEY_MANAGER.locally_selected_app).
+
+    :return: the server, the keydict and the app args
+    """
+    app_args = _resolve_app_args(institution=institution, project=project, lab=lab, award=award, app=app,
+                                 consortium=consortium, submission_center=submission_center)
+    server = resolve_server(server=server, env=env)
     keydict = KEY_MANAGER.get_keydict_for_server(server)
-    keypair = KEY_MANAGER.keydict_to_keypair(keydict)
+    do_app_arg_defaulting(app_args, get_user_record(server, auth=KEY_MANAGER.keydict_to_keypair(keydict)))
+    return server, keydict, app_args
 
-    metadata_bundles_bucket = get_metadata_bundles_bucket_from_health_path(key=keydict)
 
-    user_record = get_user_record(server, auth=keypair)
+def post_ingestion_submission(ingestion_filename, *, ingestion_type, server, keydict, validate_only, app_args,
+                              submission_protocol=DEFAULT_SUBMISSION_PROTOCOL) -> str:
+    """
+    Creates an IngestionSubmission for the given file, and sends the file for processing, without waiting for it.
 
-    do_app_arg_defaulting(app_args, user_record)
+    :param ingestion_filename: the name of the main data file to be ingested
+    :param ingestion_type: the type of ingestion to be performed (an ingestion_type in the IngestionSubmission schema)
+    :param server: the server to submit to
+    :param keydict: keydict-style auth for the server
+    :param validate_only: whether to stop after validation instead of proceeding to post metadata
+    :param app_args: the (defaulted) institution & project, lab & award, or consortium & submission_center
+    :param submission_protocol: which submission protocol to use
+    :return: the uuid of the IngestionSubmission
+    """
 
-    if not os.path.exists(ingestion_filename):
-        raise ValueError("The file '%s' does not exist." % ingestion_filename)
+    keypair = KEY_MANAGER.keydict_to_keypair(keydict)
 
     creation_post_data = {
         'ingestion_type': ingestion_type,
@@ -643,55 +808,80 @@ def submit_any_ingestion(ingestion_filename, *, ingestion_type, server, env, val
         # It does not require careful unit test coverage. -kmp 23-Feb-2022
         raise Exception("Bad JSON body in %s submission result." % response.status_code)
 
-    uuid = res['submission_id']
-
-    if DEBUG_PROTOCOL:  # pragma: no cover
-        show(f"Created IngestionSubmission object: s3://{metadata_bundles_bucket}/{uuid}", with_time=True)
-    show(f"Bundle uploaded to bucket {metadata_bundles_bucket}, assigned uuid {uuid} for tracking."
-         f" Awaiting processing...",
-         with_time=True)
-
-    check_done, check_status, check_response = check_submit_ingestion(uuid, server, env, app)
-
-    if validate_only:
-        exit(0)
-
-    if check_status == "success":
-        do_any_uploads(check_response, keydict=keydict, ingestion_filename=ingestion_filename,
-                       upload_folder=upload_folder, no_query=no_query,
-                       subfolders=subfolders)
-
-    exit(0)
+    return res['submission_id']
 
 
-def _check_ingestion_progress(uuid, *, keypair, server) -> Tuple[bool, str, dict]:
+def _check_ingestion_progress(uuid, *, keypair, server, poll_state: Optional[dict] = None) -> Tuple[bool, str, dict]:
     """
     Calls endpoint to get this status of the IngestionSubmission uuid (in outer scope);
     this is used as an argument to check_repeatedly below to call over and over.
     Returns tuple with: done-indicator (True or False), short-status (str), full-response (dict)
     From outer scope: server, keypair, uuid (of IngestionSubmission)
+
+    Each poll asks only for the status fields, conditionally on the ETag of the previous poll (kept in poll_state,
+    a dictionary the caller passes on every call), so an unchanged status costs almost nothing to re-check.
+    Only once processing is done is the full document fetched (for its output sections), and just that once.
+    Until then, the "full-response" is just the status fields.
     """
-    tracking_url = ingestion_submission_item_url(server=server, uuid=uuid)
-    response = portal_request_get(tracking_url, auth=keypair, headers=STANDARD_HTTP_HEADERS).json()
+    if poll_state is None:
+        poll_state = {}
+    tracking_url = ingestion_submission_item_url(server=server, uuid=uuid, fields=INGESTION_STATUS_FIELDS)
+    headers = dict(STANDARD_HTTP_HEADERS, **COMPRESSED_HTTP_HEADERS)
+    if poll_state.get('etag'):
+        headers['If-None-Match'] = poll_state['etag']
+    response = portal_request_get(tracking_url, auth=keypair, headers=headers)
+    if response.status_code == 304 and 'status_data' in poll_state:
+        status_data = poll_state['status_data']
+    else:
+        status_data = response.json()
+        poll_state['status_data'] = status_data
+        poll_state['etag'] = response.headers.get('ETag')
     # FYI this processing_status and its state, progress, outcome properties were ultimately set
     # from within the ingester process, from within types.ingestion.SubmissionFolio.processing_status.
-    status = response.get("processing_status", {})
+    status = status_data.get("processing_status", {})
     if status.get("state") == "done":
-        outcome = status.get("outcome")
-        return True, outcome, response
+        full_url = ingestion_submission_item_url(server=server, uuid=uuid)
+        full_response = portal_request_get(full_url, auth=keypair, headers=STANDARD_HTTP_HEADERS).json()
+        INGESTION_SUBMISSION_CACHE.put(server, uuid, full_response)
+        outcome = full_response.get("processing_status", status).get("outcome")
+        return True, outcome, full_response
     else:
         progress = status.get("progress")
-        return False, progress, response
+        return False, progress, status_data
+
+
+def get_ingestion_submission(server: str, uuid: str, *, keypair) -> dict:
+    """
+    Returns the IngestionSubmission document with the given uuid.
+
+    Documents for submissions that have finished processing are served from (and kept in) the local cache
+    (see ingestion_cache.py). Anything else is always fetched from the portal.
+    """
+    document = INGESTION_SUBMISSION_CACHE.get(server, uuid)
+    if document is None:
+        url = ingestion_submission_item_url(server, uuid)
+        response = portal_request_get(url, auth=keypair, headers=STANDARD_HTTP_HEADERS)
+        response.raise_for_status()
+        document = response.json()
+        INGESTION_SUBMISSION_CACHE.put(server, uuid, document)
+    return document
 
 
 def check_submit_ingestion(uuid: str, server: str, env: str,
-                           app: Optional[OrchestratedApp] = None) -> Tuple[bool, str, dict]:
+                           app: Optional[OrchestratedApp] = None, use_cache: bool = True) -> Tuple[bool, str, dict]:
+    """
+    Waits for processing of the IngestionSubmission with the given uuid to finish, showing its outcome.
+
+    If use_cache is True (the default) and processing is already known locally to have finished
+    (see ingestion_cache.py), the portal is not polled at all. There's no point in looking for a submission
+    that has only just been made, though, so submit_any_ingestion passes use_cache=False.
+    """
 
     if app is None:  # For legacy reasons, SubmitCGAP was the first so didn't expect this arg was needed
         app = DEFAULT_APP
     if KEY_MANAGER.selected_app != app:
         with KEY_MANAGER.locally_selected_app(app):
-            return check_submit_ingestion(uuid, server, env, app)
+            return check_submit_ingestion(uuid, server, env, app, use_cache=use_cache)
 
     server = resolve_server(server=server, env=env if not server else None)
     keydict = KEY_MANAGER.get_keydict_for_server(server)
@@ -699,16 +889,24 @@ def check_submit_ingestion(uuid: str, server: str, env: str,
 
     show("Checking ingestion process for IngestionSubmission uuid %s ..." % uuid, with_time=True)
 
-    def check_ingestion_progress():
-        return _check_ingestion_progress(uuid, keypair=keypair, server=server)
+    cached_response = INGESTION_SUBMISSION_CACHE.get(server, uuid) if use_cache else None
+    if cached_response is not None:
+        show("Processing already finished. Using locally cached results.")
+        check_done, check_response = True, cached_response
+        check_status = cached_response["processing_status"].get("outcome")
+    else:
+        poll_state = {}
 
-    # Check the ingestion processing repeatedly, up to ATTEMPTS_BEFORE_TIMEOUT times,
-    # and waiting PROGRESS_CHECK_INTERVAL seconds between each check.
-    [check_done, check_status, check_response] = (
-        check_repeatedly(check_ingestion_progress,
-                         wait_seconds=PROGRESS_CHECK_INTERVAL,
-                         repeat_count=ATTEMPTS_BEFORE_TIMEOUT)
-    )
+        def check_ingestion_progress():
+            return _check_ingestion_progress(uuid, keypair=keypair, server=server, poll_state=poll_state)
+
+        # Check the ingestion processing repeatedly, up to ATTEMPTS_BEFORE_TIMEOUT times,
+        # and waiting PROGRESS_CHECK_INTERVAL seconds between each check.
+        [check_done, check_status, check_response] = (
+            check_repeatedly(check_ingestion_progress,
+                             wait_seconds=PROGRESS_CHECK_INTERVAL,
+                             repeat_count=ATTEMPTS_BEFORE_TIMEOUT)
+        )
 
     if not check_done:
         command_summary = summarize_submission(uuid=uuid, server=server, env=env, app=app)
@@ -799,10 +997,7 @@ def show_upload_info(uuid, server=None, env=None, keydict=None, app: str = None,
 
     server = resolve_server(server=server, env=env)
     keydict = keydict or KEY_MANAGER.get_keydict_for_server(server)
-    url = ingestion_submission_item_url(server, uuid)
-    response = portal_request_get(url, auth=KEY_MANAGER.keydict_to_keypair(keydict), headers=STANDARD_HTTP_HEADERS)
-    response.raise_for_status()
-    res = response.json()
+    res = get_ingestion_submission(server, uuid, keypair=KEY_MANAGER.keydict_to_keypair(keydict))
     show_upload_result(res,
                        show_primary_result=show_primary_result,
                        show_validation_output=show_validation_output,
@@ -847,23 +1042,50 @@ def show_upload_result(result,
             show(datafile_url)
 
 
-def do_any_uploads(res, keydict, upload_folder=None, ingestion_filename=None, no_query=False, subfolders=False):
+def do_any_uploads(res, keydict, upload_folder=None, ingestion_filename=None, no_query=False, subfolders=False,
+                   file_index: Optional[LocalFileIndex] = None, preflight=None, check_formats=None,
+                   md5_manifests=None, md5_mismatch=None):
+    """
+    Uploads the files a submission calls for, as do_uploads does, asking first unless no_query.
+
+    :return: True if all the files (and their extra files) were uploaded, or had been already (and, if
+        SUBMITCGAP_VERIFY_UPLOADS is set, passed verification), and False otherwise
+    """
     upload_info = get_section(res, 'upload_info')
     folder = upload_folder or (os.path.dirname(ingestion_filename) if ingestion_filename else None)
+    submission_uuid = res.get('uuid')  # Identifies the submission in the upload ledger
+    uploaded = True
     if upload_info:
+        if submission_uuid:
+            UPLOAD_LEDGER.record_submission(keydict['server'], submission_uuid,
+                                            bundle_filename=ingestion_filename, upload_folder=folder)
         if no_query:
-            do_uploads(upload_info, auth=keydict, no_query=no_query, folder=folder,
-                       subfolders=subfolders)
+            uploaded = do_uploads(upload_info, auth=keydict, no_query=no_query, folder=folder,
+                                  subfolders=subfolders, file_index=file_index, submission_uuid=submission_uuid,
+                                  preflight=preflight, check_formats=check_formats, md5_manifests=md5_manifests,
+                                  md5_mismatch=md5_mismatch)
         else:
             if yes_or_no("Upload %s?" % n_of(len(upload_info), "file")):
-                do_uploads(upload_info, auth=keydict, no_query=no_query, folder=folder,
-                           subfolders=subfolders)
+                uploaded = do_uploads(upload_info, auth=keydict, no_query=no_query, folder=folder,
+                                      subfolders=subfolders, file_index=file_index, submission_uuid=submission_uuid,
+                                      preflight=preflight, check_formats=check_formats, md5_manifests=md5_manifests,
+                                      md5_mismatch=md5_mismatch)
             else:
                 show("No uploads attempted.")
+                upload_info = None
+                uploaded = False
+        if upload_info and VERIFY_UPLOADS:
+            if not verify_uploads(upload_info, auth=keydict, folder=folder or os.path.curdir, subfolders=subfolders,
+                                  file_index=file_index, submission_uuid=submission_uuid):
+                uploaded = False
+    if file_index is not None:
+        file_index.stop_preparation()
+    return uploaded
 
 
 def resume_uploads(uuid, server=None, env=None, bundle_filename=None, keydict=None,
-                   upload_folder=None, no_query=False, subfolders=False):
+                   upload_folder=None, no_query=False, subfolders=False, preflight=None, check_formats=None,
+                   md5_manifests=None, md5_mismatch=None):
     """
     Uploads the files associated with a given ingestion submission. This is useful if you answered "no" to the query
     about uploading your data and then later are ready to do that upload.
@@ -876,20 +1098,93 @@ def resume_uploads(uuid, server=None, env=None, bundle_filename=None, keydict=No
     :param upload_folder: folder in which to find files to upload (default: same as ingestion_filename)
     :param no_query: bool to suppress requests for user input
     :param subfolders: bool to search subdirectories within upload_folder for files
+    :param preflight: whether to check all files before uploading any, as for do_uploads
+    :param check_formats: whether to check that files are in good form before uploading them, as for do_uploads
+    :param md5_manifests: md5 manifests to check files against before uploading them, as for do_uploads
+    :param md5_mismatch: what to do with files that don't match their manifests, as for do_uploads
     """
 
     server = resolve_server(server=server, env=env)
     keydict = keydict or KEY_MANAGER.get_keydict_for_server(server)
-    url = ingestion_submission_item_url(server, uuid)
     keypair = KEY_MANAGER.keydict_to_keypair(keydict)
-    response = portal_request_get(url, auth=keypair, headers=STANDARD_HTTP_HEADERS)
-    response.raise_for_status()
-    do_any_uploads(response.json(),
+    do_any_uploads(get_ingestion_submission(server, uuid, keypair=keypair),
                    keydict=keydict,
                    ingestion_filename=bundle_filename,
                    upload_folder=upload_folder,
                    no_query=no_query,
-                   subfolders=subfolders)
+                   subfolders=subfolders,
+                   preflight=preflight,
+                   check_formats=check_formats,
+                   md5_manifests=md5_manifests,
+                   md5_mismatch=md5_mismatch)
+
+
+def verify_submission_uploads(uuid, server=None, env=None, keydict=None, upload_folder=None, subfolders=False):
+    """
+    Checks that the portal registered as uploaded each of the files associated with a given ingestion submission
+    (and their extra files), and that the sizes and md5 checksums it has match those of the local files.
+
+    :param uuid: a string guid that identifies the ingestion submission
+    :param server: the server the files were uploaded to
+    :param env: the beanstalk environment the files were uploaded to
+    :param keydict: keydict-style auth, a dictionary of 'key', 'secret', and 'server'
+    :param upload_folder: folder in which the uploaded files are (default: don't compare with local files)
+    :param subfolders: bool to search subdirectories within upload_folder for files
+    :return: True if all the files passed, and False otherwise
+    """
+
+    server = resolve_server(server=server, env=env)
+    keydict = keydict or KEY_MANAGER.get_keydict_for_server(server)
+    keypair = KEY_MANAGER.keydict_to_keypair(keydict)
+    upload_info = get_section(get_ingestion_submission(server, uuid, keypair=keypair), 'upload_info') or []
+    if not upload_info:
+        show("There are no uploads to verify for IngestionSubmission uuid %s." % uuid)
+        return True
+    return verify_uploads(upload_info, auth=keydict, folder=upload_folder, subfolders=subfolders,
+                          submission_uuid=uuid)
+
+
+def show_upload_progress(uuid=None, server=None, env=None):
+    """
+    Shows what the local upload ledger records about the uploads for a submission, without contacting the portal.
+
+    :param uuid: a string guid that identifies the ingestion submission (default: all recorded submissions)
+    :param server: the server the submission was made to (default: any server)
+    :param env: the beanstalk environment the submission was made to (default: any environment)
+    """
+
+    if server or env:
+        server = resolve_server(server=server, env=env)
+    submissions = UPLOAD_LEDGER.get_submissions(server=server, submission_uuid=uuid)
+    if not submissions:
+        show("No uploads are recorded for %s." % (f"IngestionSubmission uuid {uuid}" if uuid else "any submission"))
+        return
+    for submission in submissions:
+        uploads = UPLOAD_LEDGER.get_uploads(submission['server'], submission['submission_uuid'])
+        show("IngestionSubmission uuid %s on %s:" % (submission['submission_uuid'], submission['server']))
+        if submission['bundle_filename']:
+            show("  Bundle: %s" % submission['bundle_filename'])
+        if submission['upload_folder']:
+            show("  Upload folder: %s" % submission['upload_folder'])
+        counts = {status: len([upload for upload in uploads if upload['status'] == status])
+                  for status in UPLOAD_STATUSES}
+        done_bytes = sum(upload['size'] or 0 for upload in uploads if upload['status'] == UploadStatus.DONE)
+        show("  %s of %s uploaded (%s)."
+             % (counts[UploadStatus.DONE], n_of(len(uploads), "file"), n_of(done_bytes, "byte")))
+        for upload in uploads:
+            details = []
+            if upload['size'] is not None:
+                details.append(n_of(upload['size'], "byte"))
+            if upload['status'] == UploadStatus.DONE and upload['duration'] is not None:
+                details.append("%.2f seconds" % upload['duration'])
+            if upload['md5']:
+                details.append("md5 %s" % upload['md5'])
+            if upload['attempts'] > 1:
+                details.append(n_of(upload['attempts'], "attempt"))
+            if upload['error']:
+                details.append(upload['error'])
+            show("  %-11s %s%s" % (upload['status'], upload['filename'],
+                                   " (%s)" % ", ".join(details) if details else ""))
 
 
 @function_cache(serialize_key=True)
@@ -927,19 +1222,103 @@ def get_s3_encrypt_key_id(*, upload_credentials, auth):
     return s3_encrypt_key_id
 
 
-def execute_prearranged_upload(path, upload_credentials, auth=None):
+def get_file_item(uuid, auth):
+    """
+    Returns a File item, as it is now in the database (rather than as last indexed).
+
+    :param uuid: the uuid of the File item
+    :param auth: auth info in the form of a dictionary containing 'key', 'secret', and 'server'
+    """
+    url = url_path_join(auth['server'], uuid) + "?format=json&frame=object&datastore=database"
+    response = portal_request_get(url, auth=KEY_MANAGER.keydict_to_keypair(auth), headers=STANDARD_HTTP_HEADERS)
+    response.raise_for_status()
+    return response.json()
+
+
+def verify_uploads(upload_spec_list, auth, folder=None, subfolders=False, file_index=None, submission_uuid=None,
+                   timeout=None):
+    """
+    Checks, several at once, that the portal registered as uploaded each of the File items in upload_spec_list
+    (and their extra files), waiting for their statuses to settle, and compares the sizes and md5 checksums
+    the portal has with those of the local files. A report on all the files is shown.
+
+    :param upload_spec_list: a list of upload_spec dictionaries, as for do_uploads
+    :param auth: auth info in the form of a dictionary containing 'key', 'secret', and 'server'
+    :param folder: the folder in which the uploaded files are (or None not to compare with local files)
+    :param subfolders: whether the files may be in subfolders of that folder
+    :param file_index: an optional LocalFileIndex, for finding files and their md5 checksums quickly
+    :param submission_uuid: the uuid of the IngestionSubmission, for finding md5 checksums in the upload ledger
+    :param timeout: the longest to wait, in seconds, for statuses to settle (default: VERIFY_TIMEOUT)
+    :return: True if all the files passed, and False otherwise
+    """
+    recorded_md5s = {}
+    if submission_uuid:
+        recorded_md5s = {upload['path']: upload['md5']
+                         for upload in UPLOAD_LEDGER.get_uploads(auth['server'], submission_uuid)
+                         if upload['path'] and upload['md5'] and upload['status'] == UploadStatus.DONE}
+    search_folder = os.path.join(folder, '**') if folder and subfolders else folder
+
+    def find_local(uuid, file_name):
+        ignored(uuid)
+        file_path, error_msg = find_upload_file(search_folder, file_name, recursive=subfolders, file_index=file_index)
+        return None if error_msg else file_path
+
+    def local_md5(path):
+        return (recorded_md5s.get(path) or (file_index.cached_md5(path) if file_index is not None else None)
+                or compute_file_md5(path))
+
+    show("Verifying that the portal registered %s as uploaded." % n_of(len(upload_spec_list), "File item"))
+    results = verify_file_items([upload_spec['uuid'] for upload_spec in upload_spec_list],
+                                fetch_item=lambda uuid: get_file_item(uuid, auth),
+                                find_local=find_local if folder else None, local_md5=local_md5,
+                                timeout=VERIFY_TIMEOUT if timeout is None else timeout)
+    for line in verification_report(results):
+        show(line)
+    return all(result.passed for result in results)
+
+
+def execute_prearranged_upload(path, upload_credentials, auth=None,
+                               refresh_credentials: Optional[Callable[[], dict]] = None,
+                               check_md5: Optional[Callable[[str], None]] = None):
     """
     This performs a file upload using special credentials received from ff_utils.patch_metadata.
 
+    The upload is done by the AWS CLI unless SUBMITCGAP_UPLOAD_ENGINE is 'boto3', in which case it is done
+    in-process (see s3_upload.py). Either way, credentials about to expire are refreshed before the upload starts,
+    and the in-process upload also refreshes them as needed while it's going on. The in-process upload also tunes
+    its part size and concurrency as it goes (see upload_tuning.py).
+
+    The AWS CLI can't be given new credentials while it's uploading, so if credentials can be refreshed, a file
+    expected to take longer to upload than its credentials last (see cli_upload_outlasts_credentials) is uploaded
+    in-process instead, and a file whose credentials expired while the AWS CLI was uploading it is uploaded again,
+    in-process, with new ones.
+
+    Any bandwidth limit (see bandwidth.py) is applied. An in-process upload follows changes in the limit during
+    the upload, and shares it with any others going on at the same time; the AWS CLI keeps to the limit as it was
+    when the upload started. If transfers are coordinated among the processes on this host (see
+    host_coordination.py), the upload waits its turn to start.
+
+    If the path is that of a member of a tar archive (see tar_sources.py), of a file to be compressed as it's
+    uploaded (see bgzf.py), or of a file still being written (if SUBMITCGAP_FOLLOW_UPLOADS is set; see
+    growing_files.py), it's uploaded in-process, whatever the engine.
+
     :param path: the name of a local file to upload
     :param upload_credentials: a dictionary of credentials to be used for the upload,
         containing the keys 'AccessKeyId', 'SecretAccessKey', 'SessionToken', and 'upload_url'.
     :param auth: auth info in the form of a dictionary containing 'key', 'secret', and 'server',
         and possibly other useful information such as an encryption key id.
+    :param refresh_credentials: a function returning new upload credentials for the same upload, or None.
+    :param check_md5: a function to check the md5 checksum of the file (see md5_checker), which can raise an error
+        to stop it being uploaded, or None. An in-process upload computes the checksum from the same reads as the
+        upload, and checks it before the upload is completed; for the AWS CLI, it's computed and checked beforehand.
+        (It's not used for the files described just above, which aren't uploaded as they are.)
     """
 
     if DEBUG_PROTOCOL:  # pragma: no cover
         PRINT(f"Upload credentials contain {conjoined_list(list(upload_credentials.keys()))}.")
+    if refresh_credentials is not None and credentials_expire_soon(upload_credentials):
+        show("Upload credentials for %s are about to expire. Getting new ones." % path)
+        upload_credentials = refresh_credentials()
     try:
         s3_encrypt_key_id = get_s3_encrypt_key_id(upload_credentials=upload_credentials, auth=auth)
         extra_env = dict(AWS_ACCESS_KEY_ID=upload_credentials['AccessKeyId'],
@@ -949,27 +1328,114 @@ def execute_prearranged_upload(path, upload_credentials, auth=None):
     except Exception as e:
         raise ValueError("Upload specification is not in good form. %s: %s" % (e.__class__.__name__, e))
 
-    start = time.time()
-    try:
-        source = path
-        target = upload_credentials['upload_url']
-        show("Uploading local file %s directly (via AWS CLI) to: %s" % (source, target))
-        command = ['aws', 's3', 'cp']
-        if s3_encrypt_key_id:
-            command = command + ['--sse', 'aws:kms', '--sse-kms-key-id', s3_encrypt_key_id]
-        command = command + ['--only-show-errors', source, target]
-        options = {}
-        if running_on_windows_native():
-            options = {"shell": True}
-        if DEBUG_PROTOCOL:  # pragma: no cover
-            PRINT(f"DEBUG CLI: {' '.join(command)} | ENV INCLUDES: {conjoined_list(list(extra_env.keys()))}")
-        subprocess.check_call(command, env=env, **options)
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError("Upload failed with exit code %d" % e.returncode)
-    else:
-        end = time.time()
-        duration = end - start
-        show("Upload duration: %.2f seconds" % duration)
+    with HOST_COORDINATOR.transfer_slot(path):  # waits for a free slot if other processes are uploading
+        start = time.time()
+        source = uncompressed_source(path)
+        if source is not None:  # The AWS CLI can't compress files, so they're compressed and uploaded in-process.
+            show("Compressing local file %s and uploading it directly (in-process) to: %s"
+                 % (source, upload_credentials['upload_url']))
+            try:
+                result = upload_compressed_file(source, upload_credentials, s3_encrypt_key_id=s3_encrypt_key_id,
+                                                refresh_credentials=refresh_credentials, tuner=UPLOAD_TUNER)
+            except Exception as e:
+                raise RuntimeError("Upload failed. %s: %s" % (e.__class__.__name__, e))
+            show("Compressed %s bytes (md5 %s) to %s bytes (md5 %s)."
+                 % (result['source_size'], result['source_md5'], result['size'], result['md5']))
+            show("Upload duration: %.2f seconds" % (time.time() - start))
+            return
+        if FOLLOW_UPLOADS and os.path.isfile(path) and is_being_written(path):
+            show("Following local file %s, which is still being written, and uploading it directly (in-process) to: %s"
+                 % (path, upload_credentials['upload_url']))
+            try:
+                result = upload_growing_file(path, upload_credentials, s3_encrypt_key_id=s3_encrypt_key_id,
+                                             refresh_credentials=refresh_credentials, tuner=UPLOAD_TUNER)
+            except Exception as e:
+                raise RuntimeError("Upload failed. %s: %s" % (e.__class__.__name__, e))
+            show("Uploaded %s bytes (md5 %s), once it was finished." % (result['size'], result['md5']))
+            show("Upload duration: %.2f seconds" % (time.time() - start))
+            return
+        member = tar_member(path)
+        if member is not None:  # The AWS CLI can't read a member of an archive, so it's always uploaded in-process.
+            show("Uploading %s from archive %s directly (in-process) to: %s"
+                 % (member.name, member.archive, upload_credentials['upload_url']))
+            try:
+                upload_tar_member(member, upload_credentials, s3_encrypt_key_id=s3_encrypt_key_id,
+                                  refresh_credentials=refresh_credentials, tuner=UPLOAD_TUNER)
+            except Exception as e:
+                raise RuntimeError("Upload failed. %s: %s" % (e.__class__.__name__, e))
+            show("Upload duration: %.2f seconds" % (time.time() - start))
+            return
+
+        def upload_in_process(credentials):
+            try:
+                upload_file_to_s3(path, credentials, s3_encrypt_key_id=s3_encrypt_key_id,
+                                  refresh_credentials=refresh_credentials, tuner=UPLOAD_TUNER, check_md5=check_md5)
+            except Exception as e:
+                raise RuntimeError("Upload failed. %s: %s" % (e.__class__.__name__, e))
+            show("Upload duration: %.2f seconds" % (time.time() - start))
+
+        if UPLOAD_ENGINE == UploadEngine.BOTO3:
+            show("Uploading local file %s directly (in-process) to: %s" % (path, upload_credentials['upload_url']))
+            upload_in_process(upload_credentials)
+            return
+        if refresh_credentials is not None and cli_upload_outlasts_credentials(path, upload_credentials,
+                                                                               server=(auth or {}).get('server')):
+            show("Uploading local file %s directly (in-process) to: %s, since it's expected to take longer than"
+                 " its upload credentials last, and the AWS CLI couldn't renew them."
+                 % (path, upload_credentials['upload_url']))
+            upload_in_process(upload_credentials)
+            return
+        if check_md5 is not None:  # The AWS CLI reads the file itself, so it's read here first to check it.
+            check_md5(compute_file_md5(path))
+        try:
+            source = path
+            target = upload_credentials['upload_url']
+            show("Uploading local file %s directly (via AWS CLI) to: %s" % (source, target))
+            command = ['aws', 's3', 'cp']
+            if s3_encrypt_key_id:
+                command = command + ['--sse', 'aws:kms', '--sse-kms-key-id', s3_encrypt_key_id]
+            command = command + ['--only-show-errors', source, target]
+            options = {}
+            if running_on_windows_native():
+                options = {"shell": True}
+            bandwidth_limit = BANDWIDTH_LIMITER.transfer_rate()  # this transfer's share, if others are going on
+            if bandwidth_limit is not None:
+                show("Limiting upload bandwidth to %s." % format_rate(bandwidth_limit))
+                aws_config_file = write_aws_cli_bandwidth_config(bandwidth_limit, env)
+                env = dict(env, AWS_CONFIG_FILE=aws_config_file)
+            if DEBUG_PROTOCOL:  # pragma: no cover
+                PRINT(f"DEBUG CLI: {' '.join(command)} | ENV INCLUDES: {conjoined_list(list(extra_env.keys()))}")
+            try:
+                subprocess.check_call(command, env=env, **options)
+            finally:
+                if bandwidth_limit is not None:
+                    os.remove(aws_config_file)
+        except subprocess.CalledProcessError as e:
+            if refresh_credentials is not None and credentials_expire_soon(upload_credentials, margin=0):
+                show("The upload credentials for %s expired while the AWS CLI was uploading it. Uploading it again,"
+                     " directly (in-process), with new credentials that will be renewed as needed." % path)
+                upload_in_process(refresh_credentials())
+                return
+            raise RuntimeError("Upload failed with exit code %d" % e.returncode)
+        else:
+            end = time.time()
+            duration = end - start
+            show("Upload duration: %.2f seconds" % duration)
+
+
+def cli_upload_outlasts_credentials(path, upload_credentials, server=None):
+    """
+    Returns True if uploading a file is expected to take longer than the given upload credentials last (less the
+    margin within which they'd be renewed), going by the bandwidth limit for the upload, if any, and by the throughput
+    of recent uploads (to the given server) recorded in the upload ledger, whichever is lower. If the credentials
+    don't say when they expire, or there's nothing to go by, returns False.
+    """
+    expiration = credentials_expiration(upload_credentials)
+    rates = [rate for rate in [BANDWIDTH_LIMITER.transfer_rate(), UPLOAD_LEDGER.observed_throughput(server)] if rate]
+    if expiration is None or not rates:
+        return False
+    lifetime = (expiration - datetime.datetime.now(datetime.timezone.utc)).total_seconds() - CREDENTIALS_REFRESH_MARGIN
+    return file_size_or_zero(path) / min(rates) > lifetime
 
 
 def running_on_windows_native():
@@ -1015,28 +1481,117 @@ def upload_file_to_new_uuid(filename, schema_name, auth, **context_attributes):
     return metadata
 
 
-def upload_file_to_uuid(filename, uuid, auth):
+def upload_file_to_uuid(filename, uuid, auth, upload_metadata=None, check_md5=None):
     """
     Upload file to a target environment.
 
     :param filename: the name of a file to upload.
     :param uuid: the item into which the filename is to be uploaded.
     :param auth: auth info in the form of a dictionary containing 'key', 'secret', and 'server'.
+    :param upload_metadata: the result of get_upload_metadata for this file, if it has already been requested
+        (or a Future for it, such as UploadMetadataPrefetcher.take returns), or None to request it now.
+    :param check_md5: a function to check the file's md5 checksum, as for execute_prearranged_upload, or None.
     :returns: item metadata dict or None
     """
-    metadata = None
-    ignorable(metadata)  # PyCharm might need this if it worries it isn't set below
+    if isinstance(upload_metadata, concurrent.futures.Future):
+        upload_metadata = upload_metadata.result()
+    metadata = upload_metadata or get_upload_metadata(filename=filename, uuid=uuid, auth=auth)
+
+    def refresh_credentials():
+        return get_upload_metadata(filename=filename, uuid=uuid, auth=auth)['upload_credentials']
+
+    execute_prearranged_upload(filename, upload_credentials=metadata['upload_credentials'], auth=auth,
+                               refresh_credentials=refresh_credentials, check_md5=check_md5)
+
+    return metadata
+
+
+STDIN_SOURCE = '-'  # the item_filename that means data is to be read from standard input
+
+
+def is_stream_source(item_filename):
+    """
+    Returns True if the data to upload is to be read, as it's written, from standard input (if item_filename is "-")
+    or from a named pipe, rather than from a finished file.
+    """
+    if item_filename == STDIN_SOURCE:
+        return True
+    try:
+        return stat.S_ISFIFO(os.stat(item_filename).st_mode)
+    except OSError:
+        return False
+
+
+@contextlib.contextmanager
+def open_stream_source(item_filename):
+    """Opens standard input (if item_filename is "-") or a named pipe for reading, as a binary stream."""
+    if item_filename == STDIN_SOURCE:
+        yield sys.stdin.buffer
+    else:
+        with open(item_filename, 'rb') as stream:  # This waits for the pipe to be opened for writing.
+            yield stream
+
+
+def upload_stream_to_uuid(item_filename, uuid, auth, file_name=None):
+    """
+    Uploads the data read from standard input or a named pipe (see is_stream_source) as it's written, without its
+    being stored in a file first, so that whatever writes it and the upload can go on at the same time.
+
+    The data, whose size needn't be known in advance, is sent in a multipart upload, with no more than a few
+    parts held in memory at once (see upload_stream_to_s3). Its size and md5 checksum are shown at the end.
+
+    :param item_filename: "-" for standard input, or the name of a named pipe
+    :param uuid: the item into which the data is to be uploaded.
+    :param auth: auth info in the form of a dictionary containing 'key', 'secret', and 'server'.
+    :param file_name: the file name to give the data (default: that of the named pipe), needed for standard input
+    :returns: item metadata dict
+    """
+    file_name = file_name or (os.path.basename(item_filename) if item_filename != STDIN_SOURCE else None)
+    if not file_name:
+        raise ValueError("A file name must be given for data read from standard input.")
+    metadata = get_upload_metadata(filename=file_name, uuid=uuid, auth=auth)
+    upload_credentials = metadata['upload_credentials']
+
+    def refresh_credentials():
+        return get_upload_metadata(filename=file_name, uuid=uuid, auth=auth)['upload_credentials']
+
+    s3_encrypt_key_id = get_s3_encrypt_key_id(upload_credentials=upload_credentials, auth=auth)
+    source = "standard input" if item_filename == STDIN_SOURCE else item_filename
+    with HOST_COORDINATOR.transfer_slot(file_name):  # waits for a free slot if other processes are uploading
+        show("Uploading %s, read from %s as it's written, directly (in-process) to: %s"
+             % (file_name, source, upload_credentials['upload_url']))
+        start = time.time()
+        with open_stream_source(item_filename) as stream:
+            try:
+                result = upload_stream_to_s3(stream, upload_credentials, description=file_name,
+                                             s3_encrypt_key_id=s3_encrypt_key_id,
+                                             refresh_credentials=refresh_credentials, tuner=UPLOAD_TUNER)
+            except Exception as e:
+                raise RuntimeError("Upload failed. %s: %s" % (e.__class__.__name__, e))
+        show("Uploaded %s bytes (md5 %s)." % (result['size'], result['md5']))
+        show("Upload duration: %.2f seconds" % (time.time() - start))
+    return metadata
+
+
+def get_upload_metadata(filename, uuid, auth):
+    """
+    PATCHes the filename of a File item, which gets it new upload credentials (for it and for any extra files).
+
+    The upload credentials are temporary, so this is also how to renew them.
+
+    :param filename: the name of the file to be uploaded (any directory part is ignored).
+    :param uuid: the File item into which the filename is to be uploaded.
+    :param auth: auth info in the form of a dictionary containing 'key', 'secret', and 'server'.
+    :returns: item metadata dict, including 'upload_credentials' (and possibly 'extra_files_creds')
+    """
 
     # filename here should not include path
     patch_data = {'filename': os.path.basename(filename)}
 
     response = portal_metadata_patch(uuid=uuid, data=patch_data, auth=auth)
 
-    metadata, upload_credentials = extract_metadata_and_upload_credentials(response,
-                                                                           method='PATCH', uuid=uuid,
-                                                                           filename=filename, payload_data=patch_data)
-
-    execute_prearranged_upload(filename, upload_credentials=upload_credentials, auth=auth)
+    metadata, _ = extract_metadata_and_upload_credentials(response, method='PATCH', uuid=uuid,
+                                                          filename=filename, payload_data=patch_data)
 
     return metadata
 
@@ -1063,7 +1618,263 @@ def extract_metadata_and_upload_credentials(response, filename, method, payload_
 CGAP_SELECTIVE_UPLOADS = environ_bool("CGAP_SELECTIVE_UPLOADS")
 
 
-def do_uploads(upload_spec_list, auth, folder=None, no_query=False, subfolders=False):
+UPLOAD_PREFETCH_COUNT_VAR = "SUBMITCGAP_PREFETCH_COUNT"
+
+DEFAULT_UPLOAD_PREFETCH_COUNT = 4
+
+
+def _compute_upload_prefetch_count():  # factored out as a function for testing
+    value = os.environ.get(UPLOAD_PREFETCH_COUNT_VAR)
+    try:
+        count = int(value) if value else DEFAULT_UPLOAD_PREFETCH_COUNT
+        if count < 0:
+            raise ValueError("It must not be negative.")
+    except ValueError as e:
+        PRINT(f"Ignoring {UPLOAD_PREFETCH_COUNT_VAR}={value!r}. {e}")
+        count = DEFAULT_UPLOAD_PREFETCH_COUNT
+    return count
+
+
+# How many uploads ahead of the current one to get upload credentials for, so uploads needn't wait on the portal.
+# (0 means none are gotten ahead of time.)
+UPLOAD_PREFETCH_COUNT = _compute_upload_prefetch_count()
+
+
+class UploadMetadataPrefetcher:
+    """
+    Gets upload metadata (including upload credentials) for upcoming uploads in the background.
+
+    No more than count requests are made ahead of their use. Since upload credentials expire, that also
+    keeps what's prefetched from getting stale (and execute_prearranged_upload renews any that are about to expire).
+    """
+
+    def __init__(self, auth, count=UPLOAD_PREFETCH_COUNT):
+        self.auth = auth
+        self.count = count
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=count,
+                                                               thread_name_prefix="upload-prefetch")
+        self._futures: Dict[Tuple[str, str], concurrent.futures.Future] = {}
+
+    def prefetch(self, filename, uuid) -> bool:
+        """
+        Starts getting the upload metadata for the given file, unless that's already started.
+
+        :returns: False if that would be more than count requests ahead of their use (so nothing was done), else True
+        """
+        key = (filename, uuid)
+        if key not in self._futures:
+            if len(self._futures) >= self.count:
+                return False
+            self._futures[key] = self._executor.submit(get_upload_metadata, filename=filename, uuid=uuid,
+                                                       auth=self.auth)
+        return True
+
+    def take(self, filename, uuid) -> concurrent.futures.Future:
+        """Returns a Future for the upload metadata for the given file, starting to get it if that's not started."""
+        future = self._futures.pop((filename, uuid), None)
+        if future is None:
+            future = self._executor.submit(get_upload_metadata, filename=filename, uuid=uuid, auth=self.auth)
+        return future
+
+    def shutdown(self):
+        """Abandons any requests not yet started."""
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
+
+def find_upload_file(folder, file_name, recursive=False, file_index: Optional[LocalFileIndex] = None):
+    """
+    Finds a file to upload, using the given file_index if there is one, or else search_for_file.
+    If it's not found there and SUBMITCGAP_COMPRESS_UPLOADS is set, a compressed file is looked for uncompressed
+    (see bgzf.py), and the path returned is that of the file to be made by compressing it. Failing that, if
+    SUBMITCGAP_TAR_SOURCES is set, it's looked for in tar archives (see tar_sources.py), and the path returned
+    for it is that of an archive member.
+
+    :param folder: the folder to search, in the form search_for_file expects
+    :param file_name: the name of the file to find
+    :param recursive: whether to search subdirectories of the folder
+    :param file_index: a LocalFileIndex for the folder, or None
+    :returns: (Path to file or None, Error message or None)
+    """
+    found = file_index.find(file_name) if file_index is not None else None
+    file_path, error_msg = found or search_for_file(folder, file_name, recursive=recursive)
+    if COMPRESS_UPLOADS and not error_msg and not os.path.exists(file_path) and file_name.endswith(COMPRESSED_SUFFIXES):
+        # Not found compressed, so look for it uncompressed, to compress it as it's uploaded (see bgzf.py).
+        source_name, suffix = os.path.splitext(file_name)
+        found = file_index.find(source_name) if file_index is not None else None
+        source_path, source_error_msg = found or search_for_file(folder, source_name, recursive=recursive)
+        if source_error_msg:
+            return None, source_error_msg
+        if os.path.isfile(source_path):
+            return source_path + suffix, None
+    if TAR_SOURCES and not error_msg and not os.path.exists(file_path):
+        # Not found in the folder, so look in tar archives (see tar_sources.py).
+        member, archive_error_msg = find_tar_member(folder, file_name, recursive=recursive)
+        if archive_error_msg:
+            return None, archive_error_msg
+        if member is not None:
+            return member.path, None
+    return file_path, error_msg
+
+
+class PreflightMode:
+    OFF = 'off'
+    CHECK = 'check'
+    STRICT = 'strict'
+
+
+PREFLIGHT_MODES = [PreflightMode.OFF, PreflightMode.CHECK, PreflightMode.STRICT]
+
+
+def _compute_preflight_mode():  # factored out as a function for testing
+    mode = os.environ.get("SUBMITCGAP_PREFLIGHT") or PreflightMode.OFF
+    if mode not in PREFLIGHT_MODES:
+        PRINT(f"Ignoring SUBMITCGAP_PREFLIGHT={mode!r}, which is not one of {', '.join(PREFLIGHT_MODES)}.")
+        mode = PreflightMode.OFF
+    return mode
+
+
+# Whether to check all files before uploading any: 'off', 'check' (report problems, and ask whether to go on),
+# or 'strict' (report problems, and upload nothing if there are any), unless --preflight says otherwise.
+PREFLIGHT_MODE = _compute_preflight_mode()
+
+# How many files to look for, and look up extra files for, at once.
+PREFLIGHT_CONCURRENCY = 16
+
+
+class PreflightEntry:
+    """The outcome of the pre-flight check of a file to be uploaded (to a File item, or as one of its extra files)."""
+
+    def __init__(self, uuid, file_name, path=None, size=None, problem=None, extra_file=False):
+        self.uuid = uuid
+        self.file_name = file_name
+        self.path = path
+        self.size = size
+        self.problem = problem
+        self.extra_file = extra_file
+
+
+def get_extra_file_names(uuid, auth):
+    """
+    Returns the names of the extra files of a File item.
+
+    :param uuid: the uuid of the File item
+    :param auth: auth info in the form of a dictionary containing 'key', 'secret', and 'server'
+    """
+    url = url_path_join(auth['server'], uuid) + "?format=json&frame=object&field=extra_files"
+    response = portal_request_get(url, auth=KEY_MANAGER.keydict_to_keypair(auth), headers=STANDARD_HTTP_HEADERS)
+    response.raise_for_status()
+    return [extra_file['filename'] for extra_file in response.json().get('extra_files') or []
+            if extra_file.get('filename')]
+
+
+def check_upload_file(uuid, file_name, folder, recursive=False, file_index=None, extra_file=False):
+    """Finds a file to be uploaded and checks that it's a readable, non-empty file, returning a PreflightEntry."""
+    entry = PreflightEntry(uuid, file_name, extra_file=extra_file)
+    path, error_msg = find_upload_file(folder, file_name, recursive=recursive, file_index=file_index)
+    if error_msg:
+        entry.problem = error_msg
+        return entry
+    entry.path = path
+    member = tar_member(path)
+    if member is not None:
+        entry.size = member.size
+        if entry.size == 0:
+            entry.problem = "It is empty."
+        return entry
+    path = uncompressed_source(path) or path  # A file to be compressed as it's uploaded is checked uncompressed.
+    try:
+        if not os.path.isfile(path):
+            entry.problem = ("It is not a regular file." if os.path.exists(path)
+                             else f"No file by that name was found in {os.path.dirname(path) or os.path.curdir}.")
+            return entry
+        entry.size = os.path.getsize(path)
+        with open(path, 'rb') as fp:
+            fp.read(1)
+    except OSError as e:
+        entry.problem = f"It could not be read. {e.__class__.__name__}: {e}"
+        return entry
+    if entry.size == 0:
+        entry.problem = "It is empty."
+    return entry
+
+
+def preflight_uploads(upload_spec_list, auth, folder, recursive=False, file_index=None, check_extra_files=True):
+    """
+    Checks, before any are uploaded, all the files in the given upload_spec_list (and, optionally, their extra files),
+    looking for them and looking up extra files concurrently.
+
+    :return: a list of PreflightEntry objects, the files in the order given, each followed by its extra files
+    """
+    def check_upload_spec(upload_spec):
+        uuid = upload_spec['uuid']
+        entries = [check_upload_file(uuid, upload_spec['filename'], folder, recursive=recursive,
+                                     file_index=file_index)]
+        if check_extra_files:
+            try:
+                extra_file_names = get_extra_file_names(uuid, auth)
+            except Exception as e:
+                entries.append(PreflightEntry(uuid, "(extra files)",
+                                              problem=f"They could not be looked up. {e.__class__.__name__}: {e}",
+                                              extra_file=True))
+            else:
+                entries.extend(check_upload_file(uuid, extra_file_name, folder, recursive=recursive,
+                                                 file_index=file_index, extra_file=True)
+                               for extra_file_name in extra_file_names)
+        return entries
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PREFLIGHT_CONCURRENCY) as executor:
+        return [entry for entries in executor.map(check_upload_spec, upload_spec_list) for entry in entries]
+
+
+def show_preflight(entries):
+    """Shows the upload plan resulting from a pre-flight check, with totals and any problems found."""
+    ok = [entry for entry in entries if not entry.problem]
+    problems = [entry for entry in entries if entry.problem]
+    n_extra = sum(1 for entry in ok if entry.extra_file)
+    total_size = sum(entry.size for entry in ok)
+    show("Upload plan: %s (%s extra), %.1f MB in all." % (n_of(len(ok), "file"), n_extra, total_size / 1000 ** 2))
+    for entry in ok:
+        extra = " [extra file]" if entry.extra_file else ""
+        show("  %s%s (%.1f MB) for item %s" % (entry.path, extra, entry.size / 1000 ** 2, entry.uuid))
+    if problems:
+        show("Problems found with %s:" % n_of(len(problems), "file"))
+        for entry in problems:
+            extra = " [extra file]" if entry.extra_file else ""
+            show("  %s%s for item %s: %s" % (entry.file_name, extra, entry.uuid, entry.problem))
+    else:
+        show("No problems found.")
+
+
+class PlannedUpload(NamedTuple):
+    """What do_uploads plans to do about a file to be uploaded to a File item."""
+    uuid: str  # the uuid of the File item
+    file_path: Optional[str] = None  # where the file was found, if it was looked for
+    tracker: Optional[FileUploadTracker] = None  # where its progress is recorded in the upload ledger, if anywhere
+    error_msg: Optional[str] = None  # why no upload is to be attempted (e.g., the file wasn't found), if so
+    skip_msg: Optional[str] = None  # why it needn't be uploaded (e.g., it already was), if so
+    expected_md5: Optional[str] = None  # the md5 checksum its manifest gives, if it's to be checked as it's uploaded
+
+    @property
+    def message(self) -> Optional[str]:
+        """What to show in place of uploading the file, if it's not to be uploaded."""
+        return self.error_msg or self.skip_msg
+
+    @property
+    def uploading(self) -> bool:
+        return not self.message
+
+    @property
+    def checkable(self) -> bool:
+        """Whether the file is to be uploaded and can be checked beforehand (see _is_finished_file)."""
+        return self.uploading and _is_finished_file(self.file_path)
+
+
+def do_uploads(upload_spec_list, auth, folder=None, no_query=False, subfolders=False,
+               file_index: Optional[LocalFileIndex] = None, submission_uuid: Optional[str] = None,
+               preflight: Optional[str] = None, check_formats: Optional[bool] = None,
+               md5_manifests: Optional[str] = None, md5_mismatch: Optional[str] = None):
     """
     Uploads the files mentioned in the give upload_spec_list.
 
@@ -1076,35 +1887,349 @@ def do_uploads(upload_spec_list, auth, folder=None, no_query=False, subfolders=F
     :param folder: a string naming a folder in which to find the filenames to be uploaded.
     :param no_query: bool to suppress requests for user input
     :param subfolders: bool to search subdirectories within upload_folder for files
-    :return: None
+    :param file_index: a LocalFileIndex of the folder (e.g., prepared in advance), or None to search as we go
+    :param submission_uuid: the uuid of the IngestionSubmission calling for these uploads, if known.
+        If given, progress is recorded in the upload ledger (see upload_ledger.py), and files the ledger
+        shows were completely uploaded already (along with any extra files) are skipped.
+    :param preflight: whether to check all files before uploading any: 'off', 'check' or 'strict'
+        (default: SUBMITCGAP_PREFLIGHT, or 'off')
+    :param check_formats: whether to check that files (and extra files) are in good form before uploading them
+        (default: whether SUBMITCGAP_CHECK_FORMATS is set)
+    :param md5_manifests: md5 manifests to check files against before uploading them: a comma-separated list of
+        manifest files, or 'auto' for those in the folder (default: SUBMITCGAP_MD5_MANIFESTS, if set)
+    :param md5_mismatch: 'block' to not upload files that don't match their manifests, or 'flag' to upload them
+        with a warning (default: SUBMITCGAP_MD5_MISMATCH, or 'block')
+    :return: True if all the files (and their extra files) were uploaded, or had been already, and False
+        otherwise (e.g., if any upload failed, or a file wasn't found, or wasn't uploaded because of a check)
+
+    Files are uploaded in the order given, unless SUBMITCGAP_UPLOAD_ORDER or SUBMITCGAP_UPLOAD_PRIORITY
+    say otherwise (see upload_scheduling.py).
+
+    If preflight is 'check' or 'strict', all the files (and their extra files) are first looked for
+    and checked, and the plan is shown with any problems found. Then, if there are problems, nothing is uploaded
+    ('strict') or the user is asked whether to go on ('check', unless no_query).
+
+    If check_formats is true, files not in good form (e.g., truncated BAM files) are not uploaded
+    (see format_checks.py). If md5_manifests names md5 manifests, files listed in them that don't
+    match are not uploaded, or are only warned about (see md5_manifests.py).
+
+    If SUBMITCGAP_UPLOAD_BACKEND is 'threads' or 'processes', SUBMITCGAP_UPLOAD_WORKERS files are uploaded at once
+    (see upload_backends.py), unless the user is to be asked about each upload.
     """
     folder = folder or os.path.curdir
+    preflight = preflight or PREFLIGHT_MODE
+    check_formats = CHECK_FORMATS if check_formats is None else check_formats
+    md5_mismatch = md5_mismatch or MD5_MISMATCH
+    md5_manifests = resolve_md5_manifests(md5_manifests or MD5_MANIFESTS, folder=folder, recursive=subfolders)
     if subfolders:
         folder = os.path.join(folder, '**')
+    if file_index is not None:
+        # Any checksumming done in advance would now just compete with uploads for the disk.
+        file_index.stop_preparation()
+    server = auth['server'] if submission_uuid else None
+    if submission_uuid:
+        for upload_spec in upload_spec_list:
+            UPLOAD_LEDGER.tracker(server, submission_uuid, upload_spec['uuid']).planned([upload_spec['filename']])
+    if preflight != PreflightMode.OFF:
+        remaining = [upload_spec for upload_spec in upload_spec_list
+                     if not (submission_uuid
+                             and UPLOAD_LEDGER.is_complete(server, submission_uuid, upload_spec['uuid']))]
+        entries = preflight_uploads(remaining, auth=auth, folder=folder, recursive=subfolders, file_index=file_index)
+        show_preflight(entries)
+        if any(entry.problem for entry in entries):
+            if preflight == PreflightMode.STRICT:
+                show("No uploads attempted, because of the problems found.")
+                return False
+            if not no_query and not yes_or_no("Upload the other files anyway?"):
+                show("No uploads attempted.")
+                return False
+    verified_md5s = {}  # md5 checksums computed to check files against manifests, so they needn't be recomputed
+
+    def known_md5(path):
+        return verified_md5s.get(path) or (file_index.cached_md5(path) if file_index is not None else None)
+
+    # Decide up front what's to be uploaded from where, so that credentials for upcoming uploads can be prefetched.
+    # Messages about what's not to be uploaded are still shown in turn, below.
+    upload_plan = []
     for upload_spec in upload_spec_list:
         file_name = upload_spec["filename"]
-        file_path, error_msg = search_for_file(folder, file_name, recursive=subfolders)
-        if error_msg:
-            show(error_msg)
-            continue
         uuid = upload_spec['uuid']
-        uploader_wrapper = UploadMessageWrapper(uuid, no_query=no_query)
-        wrapped_upload_file_to_uuid = uploader_wrapper.wrap_upload_function(
-            upload_file_to_uuid, file_path,
-        )
-        file_metadata = wrapped_upload_file_to_uuid(
-            filename=file_path, uuid=uuid, auth=auth,
-        )
-        if file_metadata:
-            extra_files_credentials = file_metadata.get("extra_files_creds", [])
-            if extra_files_credentials:
-                upload_extra_files(
-                    extra_files_credentials,
-                    uploader_wrapper,
-                    folder,
-                    auth,
-                    recursive=subfolders,
-                )
+        tracker = None
+        if submission_uuid:
+            tracker = UPLOAD_LEDGER.tracker(server, submission_uuid, uuid, md5_lookup=known_md5)
+            if tracker.is_complete():
+                upload_plan.append(PlannedUpload(uuid, skip_msg="Skipping %s, which was already uploaded to item %s."
+                                                                % (file_name, uuid)))
+                continue
+        file_path, error_msg = find_upload_file(folder, file_name, recursive=subfolders, file_index=file_index)
+        upload_plan.append(PlannedUpload(uuid, file_path=file_path, tracker=tracker, error_msg=error_msg))
+    if check_formats:
+        upload_plan = _check_upload_plan_formats(upload_plan)
+    if md5_manifests:
+        upload_plan = _check_upload_plan_md5s(upload_plan, md5_manifests, known_md5=known_md5,
+                                              verified_md5s=verified_md5s, md5_mismatch=md5_mismatch,
+                                              in_process=UPLOAD_ENGINE == UploadEngine.BOTO3)
+    backend = UPLOAD_BACKEND
+    if backend != UploadBackend.SERIAL and not no_query and CGAP_SELECTIVE_UPLOADS:
+        backend = UploadBackend.SERIAL  # Asking about each upload only makes sense one at a time.
+    if UPLOAD_ORDER != UploadOrder.LISTED or UPLOAD_PRIORITIES:
+        upload_plan = _schedule_upload_plan(upload_plan, server=auth['server'],
+                                            workers=1 if backend == UploadBackend.SERIAL else UPLOAD_WORKERS)
+    prefetcher = None
+    if backend == UploadBackend.SERIAL and UPLOAD_PREFETCH_COUNT > 0 and (no_query or not CGAP_SELECTIVE_UPLOADS):
+        prefetcher = UploadMetadataPrefetcher(auth=auth, count=UPLOAD_PREFETCH_COUNT)  # Uploads won't be declined
+    try:
+        return _do_planned_uploads(upload_plan, auth=auth, folder=folder, no_query=no_query, subfolders=subfolders,
+                                   file_index=file_index, prefetcher=prefetcher, backend=backend,
+                                   check_formats=check_formats, md5_manifests=md5_manifests,
+                                   md5_mismatch=md5_mismatch)
+    finally:
+        if prefetcher is not None:
+            prefetcher.shutdown()
+
+
+def _is_finished_file(file_path):
+    """
+    Returns True if a file to upload is a local file that's finished, and so can be checked before it's uploaded
+    (rather than, say, an archive member, or a file still being written that's to be followed as it's uploaded).
+    """
+    return os.path.isfile(file_path) and not (FOLLOW_UPLOADS and is_being_written(file_path))
+
+
+def format_problem_message(file_path, problem):
+    return "No upload attempted for file %s because it is not in good form. %s" % (file_path, problem)
+
+
+def _check_upload_plan_formats(upload_plan):
+    """
+    Checks the formats of the files in an upload plan, several at once (see format_checks.py),
+    replacing the plans to upload any found not to be in good form with messages saying so.
+    """
+    paths = [planned.file_path for planned in upload_plan if planned.checkable]
+    if not paths:
+        return upload_plan
+    show("Checking the formats of %s before uploading them." % n_of(len(paths), "file"))
+    problems = check_file_formats(paths)
+    return [planned._replace(error_msg=format_problem_message(planned.file_path, problems[planned.file_path]))
+            if planned.uploading and problems.get(planned.file_path) else planned
+            for planned in upload_plan]
+
+
+def _check_upload_plan_md5s(upload_plan, md5_manifests: Md5Manifests, known_md5, verified_md5s,
+                            md5_mismatch=Md5Mismatch.BLOCK, in_process=False):
+    """
+    Checks the md5 checksums of the files in an upload plan against those their manifests give, several files
+    at once (see md5_manifests.py). Files that don't match have their plans to upload them replaced by messages
+    saying so (or, if md5_mismatch is 'flag', are only warned about). The checksums computed are added to
+    verified_md5s.
+
+    If the files are to be uploaded in-process, those whose checksums aren't already known are not read now, but
+    have the checksums their manifests give put in their plans, to be checked as they're uploaded.
+    """
+    expected_md5s = md5_manifests.expected_md5s(planned.file_path
+                                                for planned in upload_plan if planned.checkable)
+    expected_md5s = {file_path: md5 for file_path, md5 in expected_md5s.items() if md5}
+    if not expected_md5s:
+        return upload_plan
+    to_check = list(expected_md5s)
+    if in_process:
+        to_check = [file_path for file_path in to_check if known_md5(file_path)]
+        if len(to_check) < len(expected_md5s):
+            show("Checking the md5 checksums of %s against their manifests as they're uploaded."
+                 % n_of(len(expected_md5s) - len(to_check), "file"))
+    if to_check:
+        show("Checking the md5 checksums of %s against their manifests." % n_of(len(to_check), "file"))
+    actual_md5s = compute_md5s(to_check, known_md5=known_md5)
+    verified_md5s.update(actual_md5s)
+    result = []
+    for planned in upload_plan:
+        file_path = planned.file_path
+        expected_md5 = expected_md5s.get(file_path) if planned.uploading else None
+        if expected_md5 and file_path not in actual_md5s:
+            planned = planned._replace(expected_md5=expected_md5)
+        elif expected_md5 and actual_md5s[file_path] != expected_md5:
+            mismatch = md5_mismatch_message(actual_md5s[file_path], expected_md5)
+            if md5_mismatch == Md5Mismatch.BLOCK:
+                planned = planned._replace(error_msg=("No upload attempted for file %s because it does not match"
+                                                      " its manifest. %s" % (file_path, mismatch)))
+            else:
+                show("Warning: File %s does not match its manifest. %s" % (file_path, mismatch))
+        result.append(planned)
+    return result
+
+
+def _schedule_upload_plan(upload_plan, server, workers=1):
+    """
+    Reorders an upload plan as UPLOAD_ORDER and UPLOAD_PRIORITIES say (see upload_scheduling.py), for the given
+    number of uploads at once, and reports how long the uploads are predicted to take. Files that won't be uploaded
+    stay at the front, and members of each compressed archive go in the order they're in it (see tar_sources.py).
+    """
+    not_uploading = [planned for planned in upload_plan if not planned.uploading]
+    uploading = [planned for planned in upload_plan if planned.uploading]
+
+    sizes = [_planned_file_size(planned.file_path) for planned in uploading]
+    positions = schedule_uploads([(planned.file_path, size, position) for position, (planned, size)
+                                  in enumerate(zip(uploading, sizes))],
+                                 order=UPLOAD_ORDER, priorities=UPLOAD_PRIORITIES, workers=workers)
+    show(makespan_message([sizes[position] for position in positions], order=UPLOAD_ORDER, workers=workers,
+                          throughput=UPLOAD_LEDGER.observed_throughput(server)))
+    scheduled = [uploading[position] for position in positions]
+    return not_uploading + [scheduled[position]
+                            for position in stream_order([planned.file_path for planned in scheduled])]
+
+
+def _planned_file_size(file_path):
+    """Returns the size of a file to upload (or of the archive member, or of the file to be compressed, it names)."""
+    member = tar_member(file_path)
+    if member is not None:
+        return member.size
+    return file_size_or_zero(uncompressed_source(file_path) or file_path)
+
+
+def _do_planned_uploads(upload_plan, auth, folder, no_query, subfolders, file_index, prefetcher,
+                        backend=UploadBackend.SERIAL, check_formats=None, md5_manifests=None, md5_mismatch=None):
+    """
+    Does the uploads in an upload plan, showing why any planned not to be done aren't.
+
+    :return: True if all were done (or had been already), and False otherwise
+    """
+    if backend != UploadBackend.SERIAL:
+        return _do_planned_uploads_at_once(upload_plan, auth=auth, folder=folder, no_query=no_query,
+                                           subfolders=subfolders, file_index=file_index, backend=backend,
+                                           check_formats=check_formats, md5_manifests=md5_manifests,
+                                           md5_mismatch=md5_mismatch)
+    all_uploaded = True
+    for position, planned in enumerate(upload_plan):
+        if not planned.uploading:
+            show(planned.message)
+            if planned.error_msg:
+                all_uploaded = False
+            continue
+        upload_function = upload_file_to_uuid
+        if prefetcher is not None:
+            upload_function = functools.partial(upload_file_to_uuid,
+                                                upload_metadata=prefetcher.take(planned.file_path, planned.uuid))
+            for upcoming in upload_plan[position + 1:]:
+                if upcoming.uploading and not prefetcher.prefetch(upcoming.file_path, upcoming.uuid):
+                    break  # As many are being prefetched as we want.
+        if not _upload_planned_file(planned.uuid, planned.file_path, planned.tracker, auth=auth, folder=folder,
+                                    no_query=no_query, subfolders=subfolders, file_index=file_index,
+                                    upload_function=upload_function, check_formats=check_formats,
+                                    expected_md5=planned.expected_md5, md5_manifests=md5_manifests,
+                                    md5_mismatch=md5_mismatch):
+            all_uploaded = False
+    if UPLOAD_ENGINE == UploadEngine.BOTO3 and UPLOAD_TUNER.parts_observed:
+        show(UPLOAD_TUNER.summary())
+    return all_uploaded
+
+
+def _upload_planned_file(uuid, file_path, tracker, auth, folder, no_query, subfolders, file_index,
+                         upload_function=None, check_formats=None, expected_md5=None, md5_manifests=None,
+                         md5_mismatch=None):
+    """
+    Uploads a file to its File item, then any extra files the item calls for (checking their formats first if
+    check_formats says to, and their md5 checksums against md5_manifests, as upload_extra_files does).
+    If expected_md5 is given, the file's md5 checksum is checked against it as it's uploaded.
+
+    :return: True if all the uploads succeeded, and False otherwise (including if any weren't attempted)
+    """
+    upload_function = upload_function or upload_file_to_uuid
+    if expected_md5:
+        upload_function = functools.partial(upload_function, check_md5=md5_checker(file_path, expected_md5,
+                                                                                   md5_mismatch or MD5_MISMATCH))
+    uploader_wrapper = UploadMessageWrapper(uuid, no_query=no_query, tracker=tracker)
+    wrapped_upload_file_to_uuid = uploader_wrapper.wrap_upload_function(upload_function, file_path)
+    file_metadata = wrapped_upload_file_to_uuid(
+        filename=file_path, uuid=uuid, auth=auth,
+    )
+    if file_metadata:
+        extra_files_credentials = file_metadata.get("extra_files_creds", [])
+        if extra_files_credentials:
+            upload_extra_files(
+                extra_files_credentials,
+                uploader_wrapper,
+                folder,
+                auth,
+                recursive=subfolders,
+                file_index=file_index,
+                refresh_credentials=functools.partial(
+                    refresh_extra_files_credentials, filename=file_path, uuid=uuid, auth=auth
+                ),
+                check_formats=check_formats,
+                md5_manifests=md5_manifests,
+                md5_mismatch=md5_mismatch,
+            )
+    return uploader_wrapper.failures == 0 and uploader_wrapper.declined == 0
+
+
+def upload_found_file(uuid, file_path, auth, folder=None, subfolders=False, submission_uuid=None):
+    """
+    Uploads a file already found (e.g., by find_upload_file) to its File item, then any extra files the item
+    calls for, without asking. If submission_uuid is given, progress is recorded in the upload ledger.
+
+    :return: True if all the uploads succeeded, and False otherwise
+    """
+    folder = folder or os.path.curdir
+    if subfolders:
+        folder = os.path.join(folder, '**')
+    tracker = UPLOAD_LEDGER.tracker(auth['server'], submission_uuid, uuid) if submission_uuid else None
+    return _upload_planned_file(uuid, file_path, tracker, auth=auth, folder=folder, no_query=True,
+                                subfolders=subfolders, file_index=None)
+
+
+def _upload_planned_file_in_process(uuid, file_path, ledger_key, auth, folder, no_query, subfolders, check_formats,
+                                    expected_md5=None, md5_manifests=None, md5_mismatch=None):
+    # A FileUploadTracker (or LocalFileIndex) can't be sent to another process, so the worker process makes its own.
+    tracker = UPLOAD_LEDGER.tracker(*ledger_key, uuid) if ledger_key else None
+    return _upload_planned_file(uuid, file_path, tracker, auth=auth, folder=folder, no_query=no_query,
+                                subfolders=subfolders, file_index=None, check_formats=check_formats,
+                                expected_md5=expected_md5, md5_manifests=md5_manifests, md5_mismatch=md5_mismatch)
+
+
+def _do_planned_uploads_at_once(upload_plan, auth, folder, no_query, subfolders, file_index, backend,
+                                check_formats=None, md5_manifests=None, md5_mismatch=None):
+    """
+    Does the uploads in an upload plan several at once, on threads or in processes (see upload_backends.py).
+
+    :return: True if all were done (or had been already), and False otherwise
+    """
+    planned = []
+    all_planned = True
+    for entry in upload_plan:
+        if entry.uploading:
+            planned.append(entry)
+        else:
+            show(entry.message)
+            if entry.error_msg:
+                all_planned = False
+    if not planned:
+        return all_planned
+    show("Uploading %s, %s at once, with the %s backend."
+         % (n_of(len(planned), "file"), min(UPLOAD_WORKERS, len(planned)), backend))
+
+    def failed(args, error):
+        show("Upload of %s failed. %s: %s" % (args[1], error.__class__.__name__, error))
+        return False
+
+    if backend == UploadBackend.PROCESSES:
+        jobs = [(entry.uuid, entry.file_path,
+                 (entry.tracker.server, entry.tracker.submission_uuid) if entry.tracker is not None else None,
+                 auth, folder, no_query, subfolders, check_formats, entry.expected_md5, md5_manifests, md5_mismatch)
+                for entry in planned]
+        results = run_upload_jobs(_upload_planned_file_in_process, jobs, backend=backend, workers=UPLOAD_WORKERS,
+                                  on_error=failed)
+    else:
+        jobs = [(entry.uuid, entry.file_path, entry.tracker, auth, folder, no_query, subfolders, file_index, None,
+                 check_formats, entry.expected_md5, md5_manifests, md5_mismatch)
+                for entry in planned]
+        results = run_upload_jobs(_upload_planned_file, jobs, backend=backend, workers=UPLOAD_WORKERS,
+                                  on_error=failed)
+    n_failed = results.count(False)
+    show("Uploaded %s of %s%s." % (len(results) - n_failed, n_of(len(results), "file"),
+                                   " (%s failed)" % n_failed if n_failed else ""))
+    if backend == UploadBackend.THREADS and UPLOAD_ENGINE == UploadEngine.BOTO3 and UPLOAD_TUNER.parts_observed:
+        show(UPLOAD_TUNER.summary())
+    return all_planned and n_failed == 0
 
 
 def search_for_file(directory, file_name, recursive=False):
@@ -1138,15 +2263,20 @@ class UploadMessageWrapper:
     uploading file(s) to given File UUID.
     """
 
-    def __init__(self, uuid, no_query=False):
+    def __init__(self, uuid, no_query=False, tracker=None):
         """Initialize instance for given UUID
 
         :param uuid: UUID of File item for uploads
         :param no_query: Whether to suppress asking for user
             confirmation prior to upload
+        :param tracker: FileUploadTracker in which to record the
+            progress of uploads, if any
         """
         self.uuid = uuid
         self.no_query = no_query
+        self.tracker = tracker
+        self.failures = 0  # the number of uploads that failed (or, for extra files, that couldn't be attempted)
+        self.declined = 0  # the number of uploads the user declined
 
     def wrap_upload_function(self, function, file_name):
         """Wrap upload given function with messages conerning upload.
@@ -1164,23 +2294,49 @@ class UploadMessageWrapper:
                     and not yes_or_no(f"Upload {file_name}?")
                 ):
                     show("OK, not uploading it.")
+                    self.declined += 1
                     perform_upload = False
             if perform_upload:
                 try:
                     show("Uploading %s to item %s ..." % (file_name, self.uuid))
+                    if self.tracker is not None:
+                        self.tracker.started(file_name)
                     result = function(*args, **kwargs)
+                    if self.tracker is not None:
+                        # The item's extra files are recorded before its own file is recorded as uploaded,
+                        # so that it isn't taken to be completely uploaded before they are.
+                        if isinstance(result, dict):
+                            self.tracker.planned(extra_file['filename']
+                                                 for extra_file in result.get('extra_files_creds') or []
+                                                 if extra_file.get('filename'))
+                        self.tracker.succeeded(file_name)
                     show(
                         "Upload of %s to item %s was successful."
                         % (file_name, self.uuid)
                     )
                 except Exception as e:
+                    self.failures += 1
+                    if self.tracker is not None:
+                        self.tracker.failed(file_name, e)
                     show("%s: %s" % (e.__class__.__name__, e))
             return result
         return wrapper
 
 
+def refresh_extra_files_credentials(filename, uuid, auth):
+    """Returns new extra_files_creds for the File item with the given uuid, by re-PATCHing its filename."""
+    return get_upload_metadata(filename=filename, uuid=uuid, auth=auth).get("extra_files_creds", [])
+
+
+def _refreshed_extra_file_credentials(refresh_credentials, extra_file_name):
+    [fresh_credentials] = [item["upload_credentials"] for item in refresh_credentials()
+                           if item.get("filename") == extra_file_name]
+    return fresh_credentials
+
+
 def upload_extra_files(
-    credentials, uploader_wrapper, folder, auth, recursive=False
+    credentials, uploader_wrapper, folder, auth, recursive=False, file_index=None, refresh_credentials=None,
+    check_formats=None, md5_manifests=None, md5_mismatch=None
 ):
     """Attempt upload of all extra files.
 
@@ -1195,35 +2351,74 @@ def upload_extra_files(
     :param folder: Directory to search for files
     :param auth: CGAP authorization tuple
     :param recursive: Whether to search subdirectories for file
+    :param file_index: LocalFileIndex of the folder, if any
+    :param refresh_credentials: Function returning new extra files
+        credentials (in the same form as credentials), if any, used
+        when those given are about to expire
+    :param check_formats: Whether to check that files are in good
+        form before uploading them (default: whether
+        SUBMITCGAP_CHECK_FORMATS is set)
+    :param md5_manifests: Md5Manifests to check the md5 checksums
+        of files against as they're uploaded, if any
+    :param md5_mismatch: What to do with files that don't match
+        their manifests, as for do_uploads
     """
+    if check_formats is None:
+        check_formats = CHECK_FORMATS
     for extra_file_item in credentials:
         extra_file_name = extra_file_item.get("filename")
         extra_file_credentials = extra_file_item.get("upload_credentials")
         if not extra_file_name or not extra_file_credentials:
             continue
-        extra_file_path, error_msg = search_for_file(
-            folder, extra_file_name, recursive=recursive
+        extra_file_path, error_msg = find_upload_file(
+            folder, extra_file_name, recursive=recursive, file_index=file_index
         )
         if error_msg:
             show(error_msg)
+            uploader_wrapper.failures += 1
             continue
+        if check_formats and os.path.isfile(extra_file_path):
+            problem = check_file_format(extra_file_path)
+            if problem:
+                show(format_problem_message(extra_file_path, problem))
+                uploader_wrapper.failures += 1
+                continue
+        refresh_extra_file_credentials = None
+        if refresh_credentials is not None:
+            refresh_extra_file_credentials = functools.partial(
+                _refreshed_extra_file_credentials, refresh_credentials, extra_file_name
+            )
+        upload_function = execute_prearranged_upload
+        expected_md5 = None
+        if md5_manifests and _is_finished_file(extra_file_path):
+            expected_md5 = md5_manifests.expected_md5(extra_file_path)
+        if expected_md5:
+            upload_function = functools.partial(
+                execute_prearranged_upload,
+                check_md5=md5_checker(extra_file_path, expected_md5, md5_mismatch or MD5_MISMATCH),
+            )
         wrapped_execute_prearranged_upload = uploader_wrapper.wrap_upload_function(
-            execute_prearranged_upload, extra_file_path
+            upload_function, extra_file_path
         )
-        wrapped_execute_prearranged_upload(extra_file_path, extra_file_credentials, auth=auth)
+        wrapped_execute_prearranged_upload(extra_file_path, extra_file_credentials, auth=auth,
+                                           refresh_credentials=refresh_extra_file_credentials)
 
 
-def upload_item_data(item_filename, uuid, server, env, no_query=False):
+def upload_item_data(item_filename, uuid, server, env, no_query=False, file_name=None):
     """
     Given a part_filename, uploads that filename to the Item specified by uuid on the given server.
 
     Only one of server or env may be specified.
 
-    :param item_filename: the name of a file to be uploaded
+    If item_filename is "-" (for standard input) or names a named pipe, the data is uploaded as it's read
+    (see upload_stream_to_uuid).
+
+    :param item_filename: the name of a file to be uploaded, or "-" to read the data from standard input
     :param uuid: the UUID of the Item with which the uploaded data is to be associated
     :param server: the server to upload to (where the Item is defined)
     :param env: the beanstalk environment to upload to (where the Item is defined)
     :param no_query: bool to suppress requests for user input
+    :param file_name: the file name to give data read from standard input or a named pipe
     :return:
     """
 
@@ -1233,9 +2428,16 @@ def upload_item_data(item_filename, uuid, server, env, no_query=False):
 
     # print("keydict=", json.dumps(keydict, indent=2))
 
+    if item_filename == STDIN_SOURCE and not no_query:  # The answer would be read from the data.
+        show("Data read from standard input can only be uploaded with no_query.")
+        exit(1)
+
     if not no_query:
         if not yes_or_no("Upload %s to %s?" % (item_filename, server)):
             show("Aborting submission.")
             exit(1)
 
-    upload_file_to_uuid(filename=item_filename, uuid=uuid, auth=keydict)
+    if is_stream_source(item_filename):
+        upload_stream_to_uuid(item_filename, uuid=uuid, auth=keydict, file_name=file_name)
+    else:
+        upload_file_to_uuid(filename=item_filename, uuid=uuid, auth=keydict)
@@ -0,0 +1,325 @@
+# This file contains support for uploading files straight out of the tar archives they were delivered in
+# (e.g., a sequencing provider's .tar or .tar.gz bundles), without first extracting them, which takes as much
+# disk again and, for terabytes of data, hours.
+#
+# If SUBMITCGAP_TAR_SOURCES is set, a file to be uploaded that isn't found in the upload folder is looked for
+# among the members of tar archives: those it names (a comma-separated list of archives, or of glob patterns
+# for them), or, if it's "auto", those (*.tar, *.tar.gz, *.tgz) in the upload folder. The names of an archive's
+# members are read once and kept in an index, so looking up many files costs one pass over each archive.
+#
+# A member is named by a path within its archive (e.g., "bundle.tar/sample1/reads.fastq.gz"), so that its base
+# name is that of the file. Members of an uncompressed archive are uploaded as ranges of the archive (in parallel
+# parts, like any other file); members of a compressed archive are decompressed as they're uploaded, as a stream.
+# Either way, they're uploaded in-process (see s3_upload.py), since the AWS CLI can't read them.
+#
+# A compressed archive can only be read from its start, so a stream is kept open (see TarStreams) after a member
+# is read from it, to read later members from where it left off, and the members of each compressed archive are
+# uploaded in the order they're in it (see stream_order), so that uploading them all decompresses it once. (Members
+# uploaded at once, with SUBMITCGAP_UPLOAD_BACKEND, each need a stream of their own, which starts from the start.)
+# An archive that can't be read is reported once, and not looked in.
+
+import contextlib
+import glob
+import os
+import re
+import tarfile
+import threading
+from typing import BinaryIO, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+from .s3_upload import upload_file_to_s3, upload_stream_to_s3
+from .upload_tuning import UploadTuner
+from .utils import show
+
+
+TAR_SOURCES_VAR = 'SUBMITCGAP_TAR_SOURCES'
+TAR_SOURCES_AUTO = 'auto'
+
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz')
+
+_MEMBER_PATH_REGEXP = re.compile(r'^(.+(?:%s))/(.+)$' % '|'.join(re.escape(suffix) for suffix in TAR_SUFFIXES))
+
+
+def _compute_tar_sources():  # factored out as a function for testing
+    value = os.environ.get(TAR_SOURCES_VAR) or ""
+    return [source.strip() for source in value.split(',') if source.strip()]
+
+
+# The archives (or glob patterns for them) in which to look for files to upload, or ['auto'], or [] to not look.
+TAR_SOURCES = _compute_tar_sources()
+
+# How many streams, at most, to keep open for each compressed archive between reading members from them.
+MAX_IDLE_TAR_STREAMS = 4
+
+
+def _archive_signature(archive: str) -> tuple:
+    stat = os.stat(archive)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class TarMember:
+    """A regular file within a tar archive."""
+
+    def __init__(self, archive: str, name: str, size: int, offset: Optional[int] = None, index: int = 0):
+        """
+        :param archive: the name of the archive
+        :param name: the name of the member within the archive
+        :param size: the size of the member, in bytes
+        :param offset: where in the archive the member's data is, if it's there as is (in an uncompressed archive),
+            or None if it can only be had by reading the archive as a stream
+        :param index: the position of the member's header among those in the archive
+        """
+        self.archive = archive
+        self.name = name
+        self.size = size
+        self.offset = offset
+        self.index = index
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.archive, self.name)
+
+    @property
+    def streamed(self) -> bool:
+        return self.offset is None
+
+    def open(self) -> ContextManager[BinaryIO]:
+        """
+        Opens the member for reading, reading the archive as a stream (in one pass, even if it's compressed),
+        from where a stream already open left off, if it's not yet past the member (see TarStreams).
+        """
+        return TAR_STREAMS.member_stream(self)
+
+    def __repr__(self):
+        return f"<TarMember {self.path} size={self.size} offset={self.offset}>"
+
+
+def read_tar_members(archive: str) -> List[TarMember]:
+    """Returns the regular files in a tar archive, reading only its headers if it's not compressed."""
+    try:
+        with tarfile.open(archive, 'r:') as tar:
+            infos = tar.getmembers()
+        compressed = False
+    except tarfile.ReadError:
+        with tarfile.open(archive, 'r:*') as tar:
+            infos = tar.getmembers()
+        compressed = True
+    members = {}  # Where an archive has a name more than once, the last is the one extracted, so the one kept.
+    for index, info in enumerate(infos):
+        if info.isfile():
+            offset = None if compressed or info.issparse() else info.offset_data
+            members[info.name] = TarMember(archive, info.name, size=info.size, offset=offset, index=index)
+    return list(members.values())
+
+
+class _TarStream:
+    """A tar archive open as a stream, and how far through its members it's been read."""
+
+    def __init__(self, archive: str):
+        self.archive = archive
+        self.signature = _archive_signature(archive)
+        self.tar = tarfile.open(archive, 'r|*')
+        self.position = 0  # the index of the next member header to be read
+
+    def seek_member(self, member: TarMember) -> tarfile.TarInfo:
+        """Reads on (from a position no later than the member's) to the member's header, and returns it."""
+        info = None
+        while self.position <= member.index:
+            info = self.tar.next()
+            if info is None:
+                break
+            self.position += 1
+        if info is None or info.name != member.name:
+            raise FileNotFoundError(f"There is no {member.name} in {member.archive}.")
+        return info
+
+    def close(self):
+        self.tar.close()
+
+
+class TarStreams:
+    """
+    Streams open on compressed tar archives, kept between reading members from them, so that reading the members
+    of an archive in order (from one thread at a time) reads the archive once, not once per member.
+    """
+
+    def __init__(self, max_idle: int = MAX_IDLE_TAR_STREAMS):
+        self._lock = threading.Lock()
+        self._idle: Dict[str, List[_TarStream]] = {}  # by archive
+        self.max_idle = max_idle
+
+    def _take(self, member: TarMember) -> _TarStream:
+        """Returns the idle stream furthest on that isn't past the member, or else a new stream."""
+        signature = _archive_signature(member.archive)
+        with self._lock:
+            idle = self._idle.get(member.archive, [])
+            usable = [stream for stream in idle if stream.position <= member.index and stream.signature == signature]
+            if usable:
+                stream = max(usable, key=lambda stream: stream.position)
+                idle.remove(stream)
+                return stream
+        return _TarStream(member.archive)
+
+    def _keep(self, stream: _TarStream) -> None:
+        """Keeps a stream for the next member, closing the one least recently used if there are then too many."""
+        with self._lock:
+            idle = self._idle.setdefault(stream.archive, [])
+            idle.append(stream)
+            closing = idle[:-self.max_idle]
+            del idle[:-self.max_idle]
+        for stream in closing:
+            stream.close()
+
+    @contextlib.contextmanager
+    def member_stream(self, member: TarMember) -> Iterator[BinaryIO]:
+        """Opens a member of an archive for reading as a stream."""
+        stream = self._take(member)
+        try:
+            member_stream = stream.tar.extractfile(stream.seek_member(member))
+        except BaseException:
+            stream.close()
+            raise
+        try:
+            yield member_stream
+        except BaseException:
+            stream.close()  # It's not known how far through the member the stream is now.
+            raise
+        else:
+            self._keep(stream)
+        finally:
+            member_stream.close()
+
+    def close(self) -> None:
+        """Closes the streams kept."""
+        with self._lock:
+            streams = [stream for idle in self._idle.values() for stream in idle]
+            self._idle.clear()
+        for stream in streams:
+            stream.close()
+
+
+TAR_STREAMS = TarStreams()
+
+
+def stream_order(paths: List[str]) -> List[int]:
+    """
+    Returns the positions of the given paths (to be uploaded, in that order), reordered so that the members of each
+    compressed archive among them come in the order they're in the archive, in the places they had between them.
+    (Other paths keep their places.)
+    """
+    order = list(range(len(paths)))
+    by_archive: Dict[str, List[Tuple[int, TarMember]]] = {}
+    for position, path in enumerate(paths):
+        member = tar_member(path)
+        if member is not None and member.streamed:
+            by_archive.setdefault(member.archive, []).append((position, member))
+    for entries in by_archive.values():
+        in_archive_order = sorted(entries, key=lambda entry: entry[1].index)
+        for (place, _), (position, _) in zip(entries, in_archive_order):
+            order[place] = position
+    return order
+
+
+class TarIndex:
+    """An index of the members of tar archives, each archive read (again) only when it's new (or changed)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._archives: Dict[str, Tuple[tuple, Dict[str, List[TarMember]]]] = {}  # by archive: (stat, by base name)
+        self._members: Dict[str, TarMember] = {}  # by path
+
+    def members_named(self, archive: str, file_name: str) -> List[TarMember]:
+        """
+        Returns the members of the given archive with the given (base) name.
+        An archive that can't be read is reported (once, unless it changes) and taken to have no members.
+        """
+        signature = _archive_signature(archive)
+        with self._lock:
+            indexed = self._archives.get(archive)
+            if indexed is None or indexed[0] != signature:
+                by_name = {}
+                try:
+                    members = read_tar_members(archive)
+                except (tarfile.TarError, OSError, EOFError) as e:
+                    show(f"Warning: Not looking for files in {archive}, which can't be read as a tar archive: {e}")
+                    members = []
+                for member in members:
+                    by_name.setdefault(os.path.basename(member.name), []).append(member)
+                    self._members[member.path] = member
+                self._archives[archive] = indexed = (signature, by_name)
+        return list(indexed[1].get(os.path.basename(file_name), []))
+
+    def member(self, path: str, index_archive: bool = True) -> Optional[TarMember]:
+        """
+        Returns the member a path (as TarMember.path gives it) names, or None if it doesn't name one.
+        If index_archive is False, only members of archives already indexed are returned.
+        """
+        member = self._members.get(path)
+        if member is None and index_archive:
+            matched = _MEMBER_PATH_REGEXP.match(path)
+            if matched and os.path.isfile(matched.group(1)):  # e.g., in a process that's not yet looked in it
+                self.members_named(matched.group(1), path)
+                member = self._members.get(path)
+        return member
+
+
+TAR_INDEX = TarIndex()
+
+
+def find_tar_archives(sources: List[str], folder: str, recursive: bool = False) -> List[str]:
+    """
+    Returns the archives the given sources name.
+
+    :param sources: archives, or glob patterns for them, or ['auto'] for those in the folder
+    :param folder: the upload folder, in the form search_for_file expects
+    :param recursive: whether to search subdirectories of the folder (or, for glob patterns, to let ** match them)
+    """
+    patterns = ([os.path.join(folder, '*' + suffix) for suffix in TAR_SUFFIXES]
+                if sources == [TAR_SOURCES_AUTO] else sources)
+    archives = []
+    for pattern in patterns:
+        for archive in sorted(glob.glob(pattern, recursive=recursive)):
+            if os.path.isfile(archive) and archive not in archives:
+                archives.append(archive)
+    return archives
+
+
+def find_tar_member(folder: str, file_name: str, recursive: bool = False,
+                    sources: Optional[List[str]] = None) -> Tuple[Optional[TarMember], Optional[str]]:
+    """
+    Looks for a file to upload among the members of tar archives.
+
+    :param folder: the upload folder, in the form search_for_file expects
+    :param file_name: the name of the file to find
+    :param recursive: whether to search subdirectories of the folder
+    :param sources: the archives in which to look, as for find_tar_archives (default: TAR_SOURCES)
+    :returns: (the member found or None, error message or None)
+    """
+    members = []
+    for archive in find_tar_archives(TAR_SOURCES if sources is None else sources, folder, recursive=recursive):
+        members.extend(TAR_INDEX.members_named(archive, file_name))
+    if len(members) > 1:
+        return None, ("No upload attempted for file %s because multiple copies were found in archives: %s."
+                      % (file_name, ", ".join(member.path for member in members)))
+    return (members[0] if members else None), None
+
+
+def tar_member(path: str) -> Optional[TarMember]:
+    """Returns the archive member a path to be uploaded names, or None if it's an ordinary file."""
+    return TAR_INDEX.member(path, index_archive=bool(TAR_SOURCES))
+
+
+def upload_tar_member(member: TarMember, upload_credentials: dict, *, s3_encrypt_key_id: Optional[str] = None,
+                      refresh_credentials: Optional[Callable[[], dict]] = None, s3_client=None,
+                      tuner: Optional[UploadTuner] = None) -> None:
+    """
+    Uploads a member of a tar archive to the upload_url given in upload_credentials: as a range of the archive
+    if it's there as is, or else as a stream read from the archive. (The arguments are as for upload_file_to_s3.)
+    """
+    if not member.streamed:
+        upload_file_to_s3(member.archive, upload_credentials, s3_encrypt_key_id=s3_encrypt_key_id,
+                          refresh_credentials=refresh_credentials, s3_client=s3_client, tuner=tuner,
+                          offset=member.offset, length=member.size, description=os.path.basename(member.name))
+        return
+    with member.open() as stream:
+        upload_stream_to_s3(stream, upload_credentials, size=member.size, description=os.path.basename(member.name),
+                            s3_encrypt_key_id=s3_encrypt_key_id, refresh_credentials=refresh_credentials,
+                            s3_client=s3_client, tuner=tuner)
@@ -0,0 +1,57 @@
+import pytest
+
+from unittest import mock
+
+from .. import agent as agent_module
+from .. import submission as submission_module
+from ..bandwidth import BANDWIDTH_LIMITER, BandwidthSchedule
+from ..host_coordination import HOST_COORDINATOR
+from ..ingestion_cache import INGESTION_SUBMISSION_CACHE
+from ..upload_ledger import UPLOAD_LEDGER
+
+
+@pytest.fixture(autouse=True)
+def isolated_ingestion_submission_cache(tmp_path):
+    """Keeps tests from reading or writing the user's real cache of IngestionSubmission documents."""
+    with mock.patch.object(INGESTION_SUBMISSION_CACHE, "directory", str(tmp_path / "ingestion-submission-cache")):
+        yield INGESTION_SUBMISSION_CACHE
+
+
+@pytest.fixture(autouse=True)
+def isolated_upload_ledger(tmp_path):
+    """Keeps tests from reading or writing the user's real upload ledger."""
+    with mock.patch.object(UPLOAD_LEDGER, "filename", str(tmp_path / "ledger.sqlite3")):
+        with mock.patch.object(UPLOAD_LEDGER, "enabled", True):
+            yield UPLOAD_LEDGER
+
+
+@pytest.fixture(autouse=True)
+def no_upload_metadata_prefetching():
+    """
+    Keeps do_uploads from PATCHing File items in the background, which tests that mock upload_file_to_uuid
+    wouldn't expect. Tests of prefetching turn it back on.
+    """
+    with mock.patch.object(submission_module, "UPLOAD_PREFETCH_COUNT", 0):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def no_bandwidth_limit():
+    """Keeps any SUBMITCGAP_BANDWIDTH_LIMIT the user has set from affecting tests."""
+    with mock.patch.object(BANDWIDTH_LIMITER, "schedule", BandwidthSchedule([])):
+        yield BANDWIDTH_LIMITER
+
+
+@pytest.fixture(autouse=True)
+def no_host_coordination():
+    """Keeps tests from coordinating with (or waiting on) any SubmitCGAP processes actually running on this host."""
+    with mock.patch.object(HOST_COORDINATOR, "enabled", False):
+        with mock.patch.object(BANDWIDTH_LIMITER, "ceiling", None):
+            yield HOST_COORDINATOR
+
+
+@pytest.fixture(autouse=True)
+def no_agent(tmp_path):
+    """Keeps commands being tested from being sent to an agent the user may have running."""
+    with mock.patch.object(agent_module, "AGENT_SOCKET", str(tmp_path / "no-agent.sock")):
+        yield
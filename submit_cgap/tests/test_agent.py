@@ -0,0 +1,195 @@
+import io
+import os
+import pytest
+import socket
+import subprocess
+import sys
+import time
+
+from unittest import mock
+
+from .testing_helpers import system_exit_expected
+from .. import agent as agent_module
+from .. import portal_network_access as portal_network_access_module
+from ..agent import (
+    AgentConnection, agent_environment, agent_environment_digest, delegate_to_agent, peer_uid, run_command,
+    socket_folder_problem,
+)
+from ..portal_network_access import keep_portal_session, portal_request_get
+from ..scripts import agent_commands as agent_commands_module
+from ..scripts import upload_item_data as upload_item_data_module
+
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def echo_command(args):
+    """A command to be run here, in tests, when there's no agent."""
+    return args
+
+
+def fake_command(args):
+    """A command for the agent to run in tests."""
+    print("Running with", *args, "in", os.path.basename(os.getcwd()))
+    answer = input("Go on? ")
+    subprocess.check_call(['echo', f"Answered {answer}, in a subprocess."])
+    if args == ['crash']:
+        raise RuntimeError("Something went wrong.")
+    exit(3)
+
+
+@pytest.fixture()
+def running_agent(tmp_path):
+    agent_socket = str(tmp_path / "agent" / "agent.sock")
+    agent = subprocess.Popen([sys.executable, "-c",
+                              "import sys; from submit_cgap.agent import run_agent;"
+                              " run_agent(sys.argv[1], {'fake': 'submit_cgap.tests.test_agent:fake_command'})",
+                              agent_socket],
+                             cwd=REPOSITORY_DIR, stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 60
+        while not os.path.exists(agent_socket):
+            assert agent.poll() is None and time.time() < deadline, "The agent didn't start."
+            time.sleep(0.05)
+        with mock.patch.object(agent_module, "AGENT_SOCKET", agent_socket):
+            yield agent_socket
+    finally:
+        agent.terminate()
+        agent.wait(timeout=30)
+    assert not os.path.exists(agent_socket)  # It cleans up after itself.
+
+
+def test_agent_environment():
+    environ = {'SUBMITCGAP_UPLOAD_ENGINE': 'boto3', 'HOME': '/home/me', 'HOMEBREW_PREFIX': '/opt', 'TERM': 'xterm'}
+    assert agent_environment(environ) == {'SUBMITCGAP_UPLOAD_ENGINE': 'boto3', 'HOME': '/home/me'}
+    digest = agent_environment_digest(environ)
+    assert digest == agent_environment_digest(dict(environ, TERM='dumb'))
+    assert digest != agent_environment_digest(dict(environ, AWS_SECRET_ACCESS_KEY='secret'))
+    assert 'secret' not in agent_environment_digest(dict(environ, AWS_SECRET_ACCESS_KEY='secret'))
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason="The agent needs Unix sockets.")
+def test_socket_folder_problem(tmp_path):
+    folder = tmp_path / "agent"
+    folder.mkdir(mode=0o700)
+    assert socket_folder_problem(str(folder / "agent.sock")) is None
+    folder.chmod(0o755)
+    assert "is open to others" in socket_folder_problem(str(folder / "agent.sock"))
+    (tmp_path / "link").symlink_to(folder)
+    folder.chmod(0o700)
+    assert "is not a folder" in socket_folder_problem(str(tmp_path / "link" / "agent.sock"))
+    assert "FileNotFoundError" in socket_folder_problem(str(tmp_path / "missing" / "agent.sock"))
+    with mock.patch.object(os, "getuid", return_value=os.getuid() + 1):
+        assert "does not belong to you" in socket_folder_problem(str(folder / "agent.sock"))
+
+
+def test_delegate_to_agent_with_no_agent(tmp_path):
+    assert delegate_to_agent('fake', ['a']) is None  # There's no socket.
+    (tmp_path / "stale.sock").write_text("")
+    with mock.patch.object(agent_module, "AGENT_SOCKET", str(tmp_path / "stale.sock")):
+        assert delegate_to_agent('fake', ['a']) is None  # There's no agent listening.
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason="The agent needs Unix sockets.")
+def test_delegate_to_agent(running_agent, tmp_path, capsys, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with mock.patch.object(sys, "stdin", io.StringIO("yes\n")):
+        with system_exit_expected(exit_code=3):
+            delegate_to_agent('fake', ['a', 'b'])
+        assert capsys.readouterr().out == (f"Running with a b in {tmp_path.name}\n"
+                                           f"Go on? Answered yes, in a subprocess.\n")
+    with mock.patch.object(sys, "stdin", io.StringIO("no\n")):
+        with system_exit_expected(exit_code=1):
+            delegate_to_agent('fake', ['crash'])
+        output = capsys.readouterr().out
+        assert "Answered no, in a subprocess." in output and "RuntimeError: Something went wrong." in output
+    assert delegate_to_agent('resume-uploads', ['some-uuid']) is None  # The agent doesn't run that (here).
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_UPLOAD_ENGINE": "something-else"}):
+        assert delegate_to_agent('fake', ['a']) is None  # It would run differently in the agent.
+    with mock.patch.object(agent_module, "NO_AGENT", True):
+        assert delegate_to_agent('fake', ['a']) is None
+    assert capsys.readouterr().out == ""
+    with mock.patch.object(agent_module, "peer_uid", return_value=os.getuid() + 1):
+        assert delegate_to_agent('fake', ['a']) is None  # Someone else is listening.
+    assert "another user is listening" in capsys.readouterr().out
+    os.chmod(os.path.dirname(running_agent), 0o755)
+    assert delegate_to_agent('fake', ['a']) is None  # Someone else could have put the socket there.
+    assert "can't be trusted" in capsys.readouterr().out
+    os.chmod(os.path.dirname(running_agent), 0o700)
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason="The agent needs Unix sockets.")
+def test_delegate_to_busy_agent(running_agent, tmp_path, capsys):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(running_agent)
+    if hasattr(socket, 'SO_PEERCRED'):
+        assert peer_uid(connection) == os.getuid()
+    other = AgentConnection(connection)
+    try:
+        other.send(command='fake', args=['a'], cwd=str(tmp_path), environ_digest=agent_environment_digest())
+        while 'read' not in other.receive():  # until it's waiting for an answer
+            pass
+        assert delegate_to_agent('fake', ['b']) is None  # It's declined, rather than waiting, while it's busy.
+        assert capsys.readouterr().out == ""
+        other.send(input="yes\n")
+        while 'exit' not in other.receive():
+            pass
+    finally:
+        other.close()
+
+
+def test_run_command(tmp_path, capsys):
+    with mock.patch.dict(agent_module.AGENT_COMMANDS, {'echo': 'submit_cgap.tests.test_agent:echo_command'}):
+        assert run_command('echo', ['a', 'b']) == ['a', 'b']  # With no agent, it's run here.
+    assert capsys.readouterr().out == ""
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason="The agent needs Unix sockets.")
+def test_run_command_with_agent(running_agent):
+    with mock.patch.dict(agent_module.AGENT_COMMANDS, {'fake': 'submit_cgap.tests.test_agent:echo_command'}):
+        with mock.patch.object(sys, "stdin", io.StringIO("yes\n")):
+            with system_exit_expected(exit_code=3):
+                run_command('fake', ['a'])  # The agent's fake command is run, not the echo_command here.
+
+
+def test_agent_commands_import_only_the_agent():
+    # Handing a command over to an agent mustn't cost the imports the agent is there to save.
+    imported = subprocess.check_output([sys.executable, "-c",
+                                        "import sys; import submit_cgap.scripts.agent_commands;"
+                                        " print(' '.join(sorted(name for name in sys.modules"
+                                        " if name.startswith(('boto3', 'botocore', 'dcicutils', 'submit_cgap.')))))"],
+                                       cwd=REPOSITORY_DIR, text=True)
+    assert imported.split() == ['submit_cgap.agent', 'submit_cgap.scripts', 'submit_cgap.scripts.agent_commands']
+
+
+def test_agent_commands_upload_item_data(tmp_path):
+    pipe = str(tmp_path / "pipe")
+    if hasattr(os, 'mkfifo'):
+        os.mkfifo(pipe)
+    for args, delegated in [(['some.fastq.gz', '-u', 'some-uuid'], True),
+                            (['-', '-u', 'some-uuid', '-nq'], False),
+                            ([pipe, '-u', 'some-uuid', '-nq'], not hasattr(os, 'mkfifo'))]:
+        with mock.patch.object(sys, "argv", ['upload-item-data'] + args):
+            with mock.patch.object(agent_commands_module, "run_command") as mock_run_command:
+                with mock.patch.object(upload_item_data_module, "main") as mock_main:
+                    agent_commands_module.upload_item_data()
+                    if delegated:
+                        mock_run_command.assert_called_once_with('upload-item-data')
+                        mock_main.assert_not_called()
+                    else:  # Data read as it's written is read here.
+                        mock_run_command.assert_not_called()
+                        mock_main.assert_called_once_with()
+
+
+def test_keep_portal_session():
+    with mock.patch.object(portal_network_access_module, "_PORTAL_SESSION", None):
+        with mock.patch("requests.get") as mock_get:
+            portal_request_get("https://portal/some/path", auth=('key', 'secret'))
+            assert mock_get.call_count == 1
+        keep_portal_session()
+        session = portal_network_access_module._PORTAL_SESSION
+        keep_portal_session()
+        assert portal_network_access_module._PORTAL_SESSION is session
+        with mock.patch.object(session, "get") as mock_session_get:
+            portal_request_get("https://portal/some/path", auth=('key', 'secret'))
+        mock_session_get.assert_called_once_with("https://portal/some/path", auth=('key', 'secret'))
@@ -0,0 +1,182 @@
+import datetime
+import os
+import pytest
+
+from dcicutils.qa_utils import raises_regexp
+from unittest import mock
+
+from .test_utils import shown_output
+from ..bandwidth import (
+    BandwidthSchedule, TokenBucket, TransferMeter, format_rate, parse_rate, write_aws_cli_bandwidth_config,
+)
+from ..s3_upload import upload_file_to_s3
+from ..submission import execute_prearranged_upload
+from .test_s3_upload import FakeS3Client, make_credentials
+
+
+def test_parse_rate():
+
+    assert parse_rate("200Mb/s") == 25 * 1000 ** 2
+    assert parse_rate("25MB/s") == 25 * 1000 ** 2
+    assert parse_rate("1.5 GBps") == 1.5 * 1000 ** 3
+    assert parse_rate("800kb") == 100 * 1000
+    assert parse_rate("unlimited") is None
+    assert parse_rate(" Unlimited ") is None
+    assert parse_rate("0") is None
+    for bad_rate in ["fast", "200", "200Mx/s", ""]:
+        with raises_regexp(ValueError, "Not a rate"):
+            parse_rate(bad_rate)
+
+
+def test_format_rate():
+
+    assert format_rate(None) == "unlimited"
+    assert format_rate(25 * 1000 ** 2) == "25.0 MB/s (200 Mb/s)"
+
+
+def at(hh_mm):
+    return datetime.datetime.combine(datetime.date(2026, 1, 1), datetime.time.fromisoformat(hh_mm))
+
+
+def test_bandwidth_schedule():
+
+    assert BandwidthSchedule.parse(None).rate_at(at("12:00")) is None
+    assert BandwidthSchedule.parse("").rate_at(at("12:00")) is None
+
+    constant = BandwidthSchedule.parse("200Mb/s")
+    assert constant.rate_at(at("00:00")) == constant.rate_at(at("23:59")) == 25 * 1000 ** 2
+
+    daytime = BandwidthSchedule.parse("08:00-18:00=200Mb/s, 18:00-08:00=unlimited")
+    assert daytime.rate_at(at("07:59")) is None
+    assert daytime.rate_at(at("08:00")) == 25 * 1000 ** 2
+    assert daytime.rate_at(at("17:59")) == 25 * 1000 ** 2
+    assert daytime.rate_at(at("18:00")) is None
+
+    overnight = BandwidthSchedule.parse("22:00-6:00=1GB/s, 10MB/s")  # The first matching period wins
+    assert overnight.rate_at(at("23:00")) == overnight.rate_at(at("05:00")) == 1000 ** 3
+    assert overnight.rate_at(at("12:00")) == 10 * 1000 ** 2
+
+    with raises_regexp(ValueError, "Not a rate"):
+        BandwidthSchedule.parse("08:00-18:00=fast")
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.t = 1000.0
+
+    def time(self):
+        return self.t
+
+    def sleep(self, seconds):
+        self.t += seconds
+
+
+def test_token_bucket():
+
+    clock = FakeClock()
+    schedule = BandwidthSchedule.parse("08:00-18:00=1MB/s")
+    now = mock.MagicMock(return_value=at("12:00"))
+    bucket = TokenBucket(schedule, burst_seconds=1, clock=clock.time, sleep=clock.sleep, now=now)
+
+    clock.t += 10  # Idle time saves up no more than burst_seconds' worth of bandwidth
+    assert bucket.consume(1000 ** 2) == 0
+    assert bucket.consume(1000 ** 2) == 1
+    assert bucket.consume(3 * 1000 ** 2) == 3
+    # Waits are shared out among concurrent transfers, each waiting its turn. (These consumers don't actually sleep.)
+    concurrent_bucket = TokenBucket(schedule, burst_seconds=1, clock=lambda: 2000.0, sleep=lambda seconds: None,
+                                    now=now)
+    assert [concurrent_bucket.consume(1000 ** 2) for _ in range(3)] == [1, 2, 3]
+
+    now.return_value = at("20:00")  # No limit at night
+    assert bucket.consume(100 * 1000 ** 2) == 0
+    assert bucket.current_rate() is None
+
+
+def test_transfer_meter():
+
+    clock = FakeClock()
+    limiter = TokenBucket(BandwidthSchedule.parse("10MB/s"))
+    with shown_output() as shown:
+        meter = TransferMeter("f1.bam", total_bytes=4 * 1000 ** 2, limiter=limiter, clock=clock.time,
+                              report_interval=1)
+        meter.add(1000 ** 2)  # Too soon to report
+        clock.t += 1
+        meter.add(1000 ** 2)
+        clock.t += 0.5
+        meter.add(1000 ** 2)  # Too soon again
+        clock.t += 0.5
+        meter.add(1000 ** 2)
+        meter.finish()
+        assert shown.lines == [
+            "\033[Kf1.bam | 2.0 of 4.0 MB (50%) | 2.0 MB/s (16 Mb/s) | Limit: 10.0 MB/s (80 Mb/s)\r",
+            "\033[Kf1.bam | 4.0 of 4.0 MB (100%) | 2.0 MB/s (16 Mb/s) | Limit: 10.0 MB/s (80 Mb/s)\r",
+            "\033[Kf1.bam | 4.0 of 4.0 MB (100%) | 2.0 MB/s (16 Mb/s) | Limit: 10.0 MB/s (80 Mb/s)\n\r",
+        ]
+
+
+def test_upload_file_to_s3_limits_bandwidth(tmp_path):
+
+    path = tmp_path / "f1.fastq.gz"
+    path.write_bytes(b"x" * 2500)
+    limiter = mock.MagicMock()
+    limiter.current_rate.return_value = None
+    with mock.patch("submit_cgap.s3_upload.MULTIPART_CHUNK_SIZE", 1000):
+        with shown_output():
+            upload_file_to_s3(str(path), make_credentials(), s3_client=FakeS3Client(), bandwidth_limiter=limiter)
+    assert sorted(call.args[0] for call in limiter.consume.call_args_list) == [500, 1000, 1000]
+
+
+@pytest.mark.parametrize("limit", [None, "200Mb/s"])
+def test_execute_prearranged_upload_limits_aws_cli_bandwidth(no_bandwidth_limit, limit, tmp_path, monkeypatch):
+
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmp_path / "no-config"))
+
+    config_files = []
+
+    def mocked_call(command, env, **kwargs):
+        ignored_kwargs = kwargs
+        assert ignored_kwargs.keys() <= {'shell'}
+        config_file = env.get('AWS_CONFIG_FILE')
+        if limit:
+            with open(config_file) as fp:
+                assert fp.read() == "[default]\ns3 =\n  max_bandwidth = 25000000B/s\n"
+            config_files.append(config_file)
+        else:
+            assert config_file == os.environ.get('AWS_CONFIG_FILE')
+        return 0
+
+    with mock.patch.object(no_bandwidth_limit, "schedule", BandwidthSchedule.parse(limit)):
+        with shown_output() as shown:
+            with mock.patch("subprocess.call", side_effect=mocked_call):
+                execute_prearranged_upload('some-file', make_credentials())
+            assert ("Limiting upload bandwidth to 25.0 MB/s (200 Mb/s)." in shown.lines) == bool(limit)
+    for config_file in config_files:
+        assert not os.path.exists(config_file)  # Cleaned up
+
+
+def test_write_aws_cli_bandwidth_config(tmp_path):
+
+    config_file = write_aws_cli_bandwidth_config(1234.5, {'AWS_CONFIG_FILE': str(tmp_path / "missing")})
+    try:
+        with open(config_file) as fp:
+            assert fp.read() == "[default]\ns3 =\n  max_bandwidth = 1234B/s\n"
+    finally:
+        os.remove(config_file)
+
+    # The user's own configuration is kept, with the limit added to each profile.
+    users_config = tmp_path / "config"
+    users_config.write_text("[profile lab]\nregion = us-east-1\nca_bundle = /etc/lab.pem\n"
+                            "s3 =\n    max_concurrent_requests = 20\n    max_bandwidth = 1GB/s\n\n"
+                            "[sso-session lab]\nsso_region = us-east-1\n")
+    config_file = write_aws_cli_bandwidth_config(1000, {'AWS_CONFIG_FILE': str(users_config),
+                                                        'AWS_PROFILE': 'other'})
+    try:
+        with open(config_file) as fp:
+            assert fp.read() == ("[default]\ns3 =\n  max_bandwidth = 1000B/s\n\n"
+                                 "[profile lab]\nregion = us-east-1\nca_bundle = /etc/lab.pem\n"
+                                 "s3 =\n  max_concurrent_requests = 20\n  max_bandwidth = 1000B/s\n\n"
+                                 "[sso-session lab]\nsso_region = us-east-1\n\n"
+                                 "[profile other]\ns3 =\n  max_bandwidth = 1000B/s\n")
+    finally:
+        os.remove(config_file)
@@ -0,0 +1,261 @@
+import csv
+import pytest
+
+from unittest import mock
+
+from .test_utils import shown_output
+from .testing_helpers import argparse_errors_muffled, system_exit_expected
+from .. import batch_submissions as batch_submissions_module
+from .. import submission as submission_module
+from ..batch_submissions import BatchQueue, BatchState, BatchSubmitter, read_batch_manifest, submit_batch
+from ..scripts import submit_batch as submit_batch_script_module
+from ..scripts.submit_batch import main as submit_batch_main
+from ..upload_ledger import UPLOAD_LEDGER
+
+
+SOME_SERVER = 'http://localhost:7777'
+SOME_AUTH = {'key': 'my-key-id', 'secret': 'good-secret', 'server': SOME_SERVER}
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds or 0
+
+
+class FakePortal:
+    """Stands in for the portal, processing each submission on the second check."""
+
+    def __init__(self, outcomes=None, upload_info=()):
+        self.outcomes = outcomes or {}
+        self.upload_info = list(upload_info)
+        self.submitted = []
+        self.checks = {}
+        self.failures = {}  # the number of times submitting each file is to fail first
+
+    def post_ingestion_submission(self, filename, **kwargs):
+        if self.failures.get(filename):
+            self.failures[filename] -= 1
+            raise ConnectionError("The portal is unreachable.")
+        self.submitted.append((filename, kwargs['ingestion_type']))
+        return f"submission-{len(self.submitted)}"
+
+    def check_ingestion_progress(self, uuid, *, keypair, server, poll_state):
+        self.checks[uuid] = self.checks.get(uuid, 0) + 1
+        if self.checks[uuid] < 2:
+            return False, "processing", {}
+        filename = self.submitted[int(uuid.split('-')[1]) - 1][0]
+        outcome = self.outcomes.get(filename.rsplit('/', 1)[-1], "success")
+        errors = [] if outcome == "success" else ["Row 3 is not valid."]
+        return True, outcome, {'uuid': uuid, 'additional_data': {'upload_info': self.upload_info, 'errors': errors}}
+
+
+@pytest.fixture()
+def portal():
+    portal = FakePortal()
+    with mock.patch.object(batch_submissions_module, "post_ingestion_submission", portal.post_ingestion_submission):
+        with mock.patch.object(batch_submissions_module, "_check_ingestion_progress",
+                               portal.check_ingestion_progress):
+            with mock.patch.object(batch_submissions_module, "do_any_uploads") as mock_uploads:
+                portal.do_any_uploads = mock_uploads
+                with mock.patch.object(batch_submissions_module, "get_ingestion_submission",
+                                       lambda server, uuid, keypair: {'uuid': uuid, 'additional_data': {
+                                           'upload_info': portal.upload_info}}):
+                    with mock.patch.object(batch_submissions_module, "PROGRESS_CHECK_INTERVAL", 0):
+                        yield portal
+
+
+def make_files(tmp_path, *names):
+    for name in names:
+        (tmp_path / name).write_bytes(b"some bundle")
+
+
+def queue_items(tmp_path, *names):
+    return [{'filename': str(tmp_path / name), 'ingestion_type': 'metadata_bundle', 'upload_folder': None}
+            for name in names]
+
+
+def make_submitter(queue, clock, **kwargs):
+    return BatchSubmitter(queue, server=SOME_SERVER, keydict=SOME_AUTH, app_args={}, clock=clock.time,
+                          sleep=clock.sleep, **kwargs)
+
+
+def test_read_batch_manifest(tmp_path):
+    listing = tmp_path / "listing.txt"
+    listing.write_text("a.xlsx\n\n# not this one\nsub/b.xlsx\n")
+    assert read_batch_manifest(str(listing), upload_folder='/data') == [
+        {'filename': str(tmp_path / "a.xlsx"), 'ingestion_type': 'metadata_bundle', 'upload_folder': '/data'},
+        {'filename': str(tmp_path / "sub" / "b.xlsx"), 'ingestion_type': 'metadata_bundle', 'upload_folder': '/data'},
+    ]
+    table = tmp_path / "table.tsv"
+    table.write_text("filename\tingestion_type\tupload_folder\n"
+                     "genes.txt\tgenelist\t\n"
+                     "/abs/c.xlsx\t\tfastqs\n")
+    assert read_batch_manifest(str(table)) == [
+        {'filename': str(tmp_path / "genes.txt"), 'ingestion_type': 'genelist', 'upload_folder': None},
+        {'filename': '/abs/c.xlsx', 'ingestion_type': 'metadata_bundle', 'upload_folder': str(tmp_path / "fastqs")},
+    ]
+
+
+def test_batch_queue(tmp_path):
+    queue = BatchQueue(str(tmp_path / "batch.queue.sqlite3"))
+    items = [{'filename': '/a.xlsx', 'ingestion_type': 'metadata_bundle', 'upload_folder': None},
+             {'filename': '/b.xlsx', 'ingestion_type': 'metadata_bundle', 'upload_folder': None}]
+    queue.add_items(SOME_SERVER, items)
+    queue.add_items(SOME_SERVER, items)  # Items already there aren't added again.
+    [a, b] = queue.get_items(SOME_SERVER)
+    assert (a['filename'], a['state'], a['attempts']) == ('/a.xlsx', 'pending', 0)
+    queue.update_item(a['id'], state=BatchState.FAILED, submission_uuid='s1', outcome='error', attempts=5)
+    queue.update_item(b['id'], state=BatchState.FAILED, submission_uuid='s2', outcome='success', attempts=5)
+    assert queue.get_items('http://elsewhere') == []
+    queue.retry_failed(SOME_SERVER)
+    [a, b] = queue.get_items(SOME_SERVER)
+    assert (a['state'], a['submission_uuid'], a['attempts']) == ('pending', None, 0)  # to be submitted again
+    assert (b['state'], b['submission_uuid'], b['attempts']) == ('processed', 's2', 0)  # to finish uploading
+
+
+def test_batch_submitter(tmp_path, portal):
+    make_files(tmp_path, "a.xlsx", "bad.xlsx", "genes.txt")
+    portal.outcomes = {'bad.xlsx': "error"}
+    queue = BatchQueue(str(tmp_path / "batch.queue.sqlite3"))
+    queue.add_items(SOME_SERVER, queue_items(tmp_path, "a.xlsx", "bad.xlsx", "genes.txt"))
+    with shown_output() as shown:
+        counts = make_submitter(queue, FakeClock(), concurrency=2).run()
+    assert counts == {'done': 2, 'failed': 1}
+    assert sorted(name.rsplit('/', 1)[-1] for name, _ in portal.submitted) == ["a.xlsx", "bad.xlsx", "genes.txt"]
+    [bad] = queue.get_items(SOME_SERVER, [BatchState.FAILED])
+    assert (bad['outcome'], bad['error'], bad['attempts']) == ('error', "Row 3 is not valid.", 1)
+    assert portal.do_any_uploads.call_count == 2
+    assert any(line.endswith("Final status: Error") for line in shown.lines)
+
+
+def test_batch_submitter_retries(tmp_path, portal):
+    make_files(tmp_path, "a.xlsx", "b.xlsx")
+    portal.failures = {str(tmp_path / "a.xlsx"): 2, str(tmp_path / "b.xlsx"): 9}
+    queue = BatchQueue(str(tmp_path / "batch.queue.sqlite3"))
+    queue.add_items(SOME_SERVER, queue_items(tmp_path, "a.xlsx", "b.xlsx", "missing.xlsx"))
+    clock = FakeClock()
+    started = clock.now
+    with shown_output() as shown:
+        counts = make_submitter(queue, clock, concurrency=1, attempts=3, retry_delay=10).run()
+    assert counts == {'done': 1, 'failed': 2}
+    [a, b, missing] = queue.get_items(SOME_SERVER)
+    assert (a['state'], a['attempts'], a['error']) == ('done', 3, None)
+    assert (b['state'], b['attempts']) == ('failed', 3)
+    assert b['error'] == "ConnectionError: The portal is unreachable."
+    assert missing['error'].startswith("ValueError: The file") and missing['state'] == 'failed'
+    assert clock.now - started >= 10 + 20  # The delay doubled.
+    assert any(line.endswith("will be tried again in 20 seconds. ConnectionError: The portal is unreachable.")
+               for line in shown.lines)
+
+
+def test_batch_submitter_resumes(tmp_path, portal):
+    make_files(tmp_path, "a.xlsx", "b.xlsx", "c.xlsx")
+    queue = BatchQueue(str(tmp_path / "batch.queue.sqlite3"))
+    queue.add_items(SOME_SERVER, queue_items(tmp_path, "a.xlsx", "b.xlsx", "c.xlsx"))
+    [a, b, c] = queue.get_items(SOME_SERVER)
+    # As a crashed batch would have left them: a done, b submitted and c pending.
+    queue.update_item(a['id'], state=BatchState.DONE, submission_uuid='submission-0')
+    portal.submitted.append((str(tmp_path / "b.xlsx"), 'metadata_bundle'))
+    queue.update_item(b['id'], state=BatchState.SUBMITTED, submission_uuid='submission-1')
+    with shown_output():
+        counts = make_submitter(queue, FakeClock()).run()
+    assert counts == {'done': 3, 'failed': 0}
+    assert [name.rsplit('/', 1)[-1] for name, _ in portal.submitted] == ["b.xlsx", "c.xlsx"]  # b wasn't resubmitted
+    assert portal.checks == {'submission-1': 2, 'submission-2': 2}
+
+
+def test_batch_submitter_incomplete_uploads(tmp_path, portal):
+    make_files(tmp_path, "a.xlsx")
+    portal.upload_info = [{'uuid': 'uuid-a', 'filename': 'a.fastq.gz'}]
+    queue = BatchQueue(str(tmp_path / "batch.queue.sqlite3"))
+    queue.add_items(SOME_SERVER, queue_items(tmp_path, "a.xlsx"))
+
+    def upload_later(res, keydict, **kwargs):
+        UPLOAD_LEDGER.record_planned(SOME_SERVER, 'submission-1', 'uuid-a', ['a.fastq.gz'])
+        if portal.do_any_uploads.call_count == 2:
+            UPLOAD_LEDGER.record_started(SOME_SERVER, 'submission-1', 'uuid-a', 'a.fastq.gz')
+            UPLOAD_LEDGER.record_done(SOME_SERVER, 'submission-1', 'uuid-a', 'a.fastq.gz')
+            return True
+        return False
+
+    portal.do_any_uploads.side_effect = upload_later
+    with shown_output() as shown:
+        counts = make_submitter(queue, FakeClock(), retry_delay=2).run()
+    assert counts == {'done': 1, 'failed': 0}
+    assert portal.do_any_uploads.call_count == 2 and len(portal.submitted) == 1
+    assert any(line.endswith("RuntimeError: Not all files were uploaded: a.fastq.gz.") for line in shown.lines)
+
+
+def test_batch_submitter_incomplete_uploads_without_ledger(tmp_path, portal):
+    make_files(tmp_path, "a.xlsx")
+    portal.upload_info = [{'uuid': 'uuid-a', 'filename': 'a.fastq.gz'}]
+    queue = BatchQueue(str(tmp_path / "batch.queue.sqlite3"))
+    queue.add_items(SOME_SERVER, queue_items(tmp_path, "a.xlsx"))
+    portal.do_any_uploads.side_effect = lambda res, keydict, **kwargs: portal.do_any_uploads.call_count == 2
+    with mock.patch.object(UPLOAD_LEDGER, "enabled", False):
+        with shown_output() as shown:
+            counts = make_submitter(queue, FakeClock(), retry_delay=2).run()
+    # Without the ledger, the uploads having failed is still noticed, and they're tried again.
+    assert counts == {'done': 1, 'failed': 0}
+    assert portal.do_any_uploads.call_count == 2 and len(portal.submitted) == 1
+    assert any(line.endswith("RuntimeError: Not all files were uploaded.") for line in shown.lines)
+
+
+def test_submit_batch(tmp_path, portal):
+    make_files(tmp_path, "a.xlsx", "b.xlsx")
+    manifest = tmp_path / "batch.csv"
+    manifest.write_text("filename\na.xlsx\nb.xlsx\n")
+    results = tmp_path / "results.tsv"
+    with mock.patch.object(batch_submissions_module.KEY_MANAGER, "get_keydict_for_server", return_value=SOME_AUTH):
+        with mock.patch.object(submission_module, "get_user_record", return_value={}):
+            with mock.patch.object(submission_module, "do_app_arg_defaulting"):
+                with shown_output() as shown:
+                    counts = submit_batch(str(manifest), server=SOME_SERVER, results_file=str(results))
+                    assert counts == {'done': 2, 'failed': 0}
+                    assert (tmp_path / "batch.csv.queue.sqlite3").exists()
+                    assert any(line.endswith("Batch finished: 2 done, 0 failed.") for line in shown.lines)
+                    # Run again, nothing is submitted again.
+                    assert submit_batch(str(manifest), server=SOME_SERVER) == counts
+    assert len(portal.submitted) == 2
+    with open(results, newline='') as fp:
+        rows = list(csv.DictReader(fp, delimiter='\t'))
+    assert [(row['filename'], row['state'], row['attempts']) for row in rows] == [
+        (str(tmp_path / "a.xlsx"), 'done', '1'), (str(tmp_path / "b.xlsx"), 'done', '1')]
+    assert rows[0]['submission_uuid'].startswith('submission-') and rows[0]['finished']
+
+
+def test_submit_batch_script():
+
+    def test_it(args_in, expect_exit_code, expect_call_args=None, counts=None):
+        with argparse_errors_muffled():
+            with mock.patch.object(submit_batch_script_module, "submit_batch",
+                                   return_value=counts or {'done': 1, 'failed': 0}) as mock_submit_batch:
+                with system_exit_expected(exit_code=expect_exit_code):
+                    submit_batch_main(args_in)
+                    raise AssertionError("submit_batch_main should not exit normally.")  # pragma: no cover
+                if expect_call_args:
+                    mock_submit_batch.assert_called_with('batch.csv', **expect_call_args)
+                else:
+                    assert mock_submit_batch.call_count == 0
+
+    default_args = {
+        'institution': None, 'project': None, 'server': None, 'env': None, 'validate_only': False,
+        'upload_folder': None, 'ingestion_type': 'metadata_bundle', 'subfolders': False, 'app': 'cgap',
+        'submission_protocol': 'upload', 'concurrency': 4, 'attempts': 5, 'retry_delay': 30, 'queue_file': None,
+        'results_file': None, 'retry_failed': False,
+    }
+    test_it([], expect_exit_code=2)
+    test_it(['batch.csv', '-c', '0'], expect_exit_code=2)
+    test_it(['batch.csv'], expect_exit_code=0, expect_call_args=default_args)
+    test_it(['batch.csv', '-t', 'genelist', '-c', '8', '--attempts', '2', '--retry-delay', '5', '-q', 'q.sqlite3',
+             '-r', 'results.csv', '--retry-failed'], expect_exit_code=0,
+            expect_call_args=dict(default_args, ingestion_type='genelist', concurrency=8, attempts=2, retry_delay=5,
+                                  queue_file='q.sqlite3', results_file='results.csv', retry_failed=True))
+    test_it(['batch.csv'], expect_exit_code=1, expect_call_args=default_args, counts={'done': 1, 'failed': 1})
@@ -0,0 +1,147 @@
+import gzip
+import hashlib
+import io
+import os
+import pytest
+import struct
+
+from unittest import mock
+
+from .test_s3_upload import FakeS3Client, make_credentials
+from .test_utils import shown_output
+from .. import bgzf as bgzf_module
+from .. import s3_upload as s3_upload_module
+from .. import submission as submission_module
+from ..bgzf import (
+    BGZF_BLOCK_SIZE, BGZF_EOF, BgzfCompressor, _compute_compress_level, _compute_compress_threads, compress_block,
+    uncompressed_source, upload_compressed_file,
+)
+from ..submission import check_upload_file, execute_prearranged_upload, find_upload_file
+
+
+SOME_AUTH = {'key': 'my-key-id', 'secret': 'good-secret', 'server': 'http://localhost:7777'}
+
+DATA = b"".join(b"@read%d\nACGTACGTTTGACCA\n+\nFFFFFFFFF:FFFFF\n" % i for i in range(40000))  # about 2MB
+
+
+class TricklingStream(io.RawIOBase):
+    """A stream that, like a pipe, returns fewer bytes than asked for."""
+
+    def __init__(self, data):
+        super().__init__()
+        self._stream = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._stream.read(min(size, 1000) if size is not None and size >= 0 else -1)
+
+
+def bgzf_blocks(data):
+    """Returns the (size, uncompressed size) of each BGZF block in some data, checking their headers."""
+    blocks = []
+    offset = 0
+    while offset < len(data):
+        assert data[offset:offset + 4] == b"\x1f\x8b\x08\x04" and data[offset + 12:offset + 14] == b"BC"
+        [block_size] = struct.unpack('<H', data[offset + 16:offset + 18])
+        [uncompressed_size] = struct.unpack('<I', data[offset + block_size + 1 - 4:offset + block_size + 1])
+        blocks.append((block_size + 1, uncompressed_size))
+        offset += block_size + 1
+    return blocks
+
+
+def test_compute_compress_settings():
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_COMPRESS_THREADS": "3", "SUBMITCGAP_COMPRESS_LEVEL": "1"}):
+        assert _compute_compress_threads() == 3
+        assert _compute_compress_level() == 1
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_COMPRESS_THREADS": "0", "SUBMITCGAP_COMPRESS_LEVEL": "10"}):
+        with mock.patch.object(bgzf_module, "PRINT") as mock_print:
+            assert _compute_compress_threads() == (os.cpu_count() or 1)
+            assert _compute_compress_level() == bgzf_module.DEFAULT_COMPRESS_LEVEL
+            assert mock_print.call_count == 2
+
+
+def test_compress_block():
+    block = compress_block(b"ACGT" * 1000)
+    assert gzip.decompress(block) == b"ACGT" * 1000
+    assert bgzf_blocks(block) == [(len(block), 4000)]
+    assert bgzf_blocks(BGZF_EOF) == [(28, 0)]
+    assert gzip.decompress(BGZF_EOF) == b""
+    random_block = compress_block(os.urandom(BGZF_BLOCK_SIZE), level=9)  # Incompressible data still fits.
+    assert len(random_block) <= 65536
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_bgzf_compressor(threads):
+    with BgzfCompressor(TricklingStream(DATA), threads=threads) as compressor:
+        compressed = compressor.read()
+        assert compressor.size == len(DATA)
+        assert compressor.md5 == hashlib.md5(DATA).hexdigest()
+        assert compressor.compressed_size == len(compressed)
+    assert gzip.decompress(compressed) == DATA
+    blocks = bgzf_blocks(compressed)
+    assert blocks[-1] == (28, 0)
+    assert all(uncompressed_size == BGZF_BLOCK_SIZE for _, uncompressed_size in blocks[:-2])
+    assert sum(uncompressed_size for _, uncompressed_size in blocks) == len(DATA)
+    with BgzfCompressor(io.BytesIO(DATA), threads=1) as compressor:
+        assert compressor.read() == compressed  # The same, however many threads compress it.
+    with BgzfCompressor(io.BytesIO(b"")) as compressor:
+        assert compressor.read() == BGZF_EOF
+
+
+def test_uncompressed_source(tmp_path):
+    (tmp_path / "a.fastq").write_bytes(DATA)
+    (tmp_path / "b.vcf.gz").write_bytes(b"already compressed")
+    (tmp_path / "b.vcf").write_bytes(b"##fileformat=VCFv4.2\n")
+    with mock.patch.object(bgzf_module, "COMPRESS_UPLOADS", True):
+        assert uncompressed_source(str(tmp_path / "a.fastq.gz")) == str(tmp_path / "a.fastq")
+        assert uncompressed_source(str(tmp_path / "a.fastq.bgz")) == str(tmp_path / "a.fastq")
+        assert uncompressed_source(str(tmp_path / "b.vcf.gz")) is None
+        assert uncompressed_source(str(tmp_path / "c.fastq.gz")) is None
+        assert uncompressed_source(str(tmp_path / "a.fastq")) is None
+    assert uncompressed_source(str(tmp_path / "a.fastq.gz")) is None
+
+
+def test_upload_compressed_file(tmp_path):
+    source = tmp_path / "a.fastq"
+    source.write_bytes(DATA)
+    with mock.patch.object(s3_upload_module, "MULTIPART_CHUNK_SIZE", 100 * 1024):
+        client = FakeS3Client()
+        result = upload_compressed_file(str(source), make_credentials(), s3_client=client, threads=2)
+    uploaded = client.objects[('some-bucket', 'some/key.fastq.gz')]
+    assert gzip.decompress(uploaded) == DATA
+    assert len(client.parts) > 1
+    assert result == {'size': len(uploaded), 'md5': hashlib.md5(uploaded).hexdigest(),
+                      'source_size': len(DATA), 'source_md5': hashlib.md5(DATA).hexdigest()}
+
+
+def test_find_upload_file_to_compress(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "a.fastq").write_bytes(DATA)
+    folder = os.path.join(str(tmp_path), "**")
+    with mock.patch.object(submission_module, "COMPRESS_UPLOADS", True):
+        with mock.patch.object(bgzf_module, "COMPRESS_UPLOADS", True):
+            path, error_msg = find_upload_file(folder, "a.fastq.gz", recursive=True)
+            assert path == str(tmp_path / "sub" / "a.fastq.gz") and error_msg is None
+            entry = check_upload_file('uuid-a', "a.fastq.gz", folder, recursive=True)
+            assert entry.path == path and entry.size == len(DATA) and entry.problem is None
+    assert find_upload_file(folder, "a.fastq.gz", recursive=True) == (os.path.join(folder, "a.fastq.gz"), None)
+
+
+def test_execute_prearranged_upload_compressing(tmp_path):
+    (tmp_path / "a.fastq").write_bytes(DATA)
+    result = {'size': 1000, 'md5': 'md5-compressed', 'source_size': len(DATA), 'source_md5': 'md5-source'}
+    with mock.patch.object(bgzf_module, "COMPRESS_UPLOADS", True):
+        with mock.patch.object(submission_module, "upload_compressed_file", return_value=result) as mock_upload:
+            with mock.patch("subprocess.check_call") as mock_check_call:
+                with shown_output() as shown:
+                    execute_prearranged_upload(str(tmp_path / "a.fastq.gz"), make_credentials(), auth=SOME_AUTH)
+                    assert shown.lines[:2] == [
+                        f"Compressing local file {tmp_path}/a.fastq and uploading it directly (in-process)"
+                        f" to: s3://some-bucket/some/key.fastq.gz",
+                        f"Compressed {len(DATA)} bytes (md5 md5-source) to 1000 bytes (md5 md5-compressed).",
+                    ]
+                assert mock_check_call.call_count == 0
+    mock_upload.assert_called_once_with(str(tmp_path / "a.fastq"), make_credentials(), s3_encrypt_key_id=None,
+                                        refresh_credentials=None, tuner=mock.ANY)
@@ -0,0 +1,132 @@
+import gzip
+import os
+import pytest
+import struct
+import zlib
+
+from unittest import mock
+
+from .test_utils import shown_output
+from .. import format_checks as format_checks_module
+from .. import submission as submission_module
+from ..format_checks import (
+    BGZF_EOF, CRAM3_EOF, _compute_check_formats_workers, check_file_format, check_file_formats,
+)
+from ..submission import do_uploads
+
+
+SOME_AUTH = {'key': 'my-key-id', 'secret': 'good-secret', 'server': 'http://localhost:7777'}
+
+FASTQ = b"@read1\nACGT\n+\nIIII\n@read2\nGGCCA\n+read2\nIIIII\n"
+
+
+def bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+    block_size = len(header) + 2 + len(deflated) + 8
+    return (header + struct.pack("<H", block_size - 1) + deflated
+            + struct.pack("<II", zlib.crc32(data), len(data)))
+
+
+def bgzf(data, eof=True):
+    return b"".join(bgzf_block(data[i:i + 1000]) for i in range(0, len(data), 1000)) + (BGZF_EOF if eof else b"")
+
+
+def test_compute_check_formats_workers():
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_CHECK_FORMATS_WORKERS": "3"}):
+        assert _compute_check_formats_workers() == 3
+    for bad_value in ["x", "0"]:
+        with mock.patch.dict(os.environ, {"SUBMITCGAP_CHECK_FORMATS_WORKERS": bad_value}):
+            with mock.patch.object(format_checks_module, "PRINT") as mock_print:
+                assert _compute_check_formats_workers() == (os.cpu_count() or 1)
+                assert mock_print.call_count == 1
+
+
+def damaged(data, at):
+    return data[:at] + bytes([data[at] ^ 0xff]) + data[at + 1:]
+
+
+BAM_DATA = b"BAM\x01" + bytes(range(256)) * 20
+
+
+@pytest.mark.parametrize("name, content, expected_problem", [
+    ("good.bam", bgzf(BAM_DATA), None),
+    ("truncated.bam", bgzf(BAM_DATA, eof=False), "It is truncated (the BGZF end-of-file marker is missing)."),
+    ("plain.bam", gzip.compress(BAM_DATA), "It is not BGZF-compressed."),
+    ("not-a.bam", bgzf(b"SAM\x01" + BAM_DATA), "It does not start as a BAM file should."),
+    ("damaged.bam", damaged(bgzf(BAM_DATA), at=100), "Its compressed data is damaged."),
+    ("good.cram", b"CRAM\x03\x00" + b"x" * 100 + CRAM3_EOF, None),
+    ("old.cram", b"CRAM\x02\x01" + b"x" * 100, None),
+    ("truncated.cram", b"CRAM\x03\x00" + b"x" * 100, "It is truncated (the CRAM end-of-file container is missing)."),
+    ("not-a.cram", b"BAM\x01" + b"x" * 100, "It does not start as a CRAM file should."),
+    ("good.fastq", FASTQ, None),
+    ("good.fastq.gz", gzip.compress(FASTQ), None),
+    ("good-bgzf.fq.gz", bgzf(FASTQ), None),
+    ("crlf.fastq", FASTQ.replace(b"\n", b"\r\n"), None),
+    ("no-plus.fastq", FASTQ.replace(b"+read2", b"read2"), "FASTQ record 2 has no '+' line."),
+    ("no-at.fastq", FASTQ.replace(b"@read1", b"read1"), "FASTQ record 1 does not start with '@'."),
+    ("short-quality.fastq", FASTQ.replace(b"IIIII", b"IIII"), "FASTQ record 2 has 5 bases but 4 quality scores."),
+    ("incomplete.fastq", FASTQ[:-8], "It is truncated (FASTQ record 2 is incomplete)."),
+    ("truncated.fastq.gz", gzip.compress(FASTQ * 100)[:-30], "It is truncated (the compressed data ends too soon)."),
+    ("empty.fastq", b"", "It has no FASTQ records."),
+    ("good.vcf.gz", bgzf(b"##fileformat=VCFv4.2\n#CHROM\tPOS\n"), None),
+    ("headless.vcf.gz", bgzf(b"#CHROM\tPOS\n"), "It does not start as a VCF file should."),
+    ("other.txt.gz", gzip.compress(b"anything"), None),
+    ("not-really.gz", b"anything", "It is not gzip-compressed."),
+    ("unchecked.bai", b"anything", None),
+])
+def test_check_file_format(tmp_path, name, content, expected_problem):
+
+    path = tmp_path / name
+    path.write_bytes(content)
+    problem = check_file_format(str(path))
+    if expected_problem is None:
+        assert problem is None
+    else:
+        assert problem is not None and problem.startswith(expected_problem)
+
+
+def test_check_file_format_unreadable(tmp_path):
+
+    assert check_file_format(str(tmp_path / "missing.bam")).startswith("It could not be read. FileNotFoundError:")
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_check_file_formats(tmp_path, max_workers):
+
+    (tmp_path / "good.bam").write_bytes(bgzf(BAM_DATA))
+    (tmp_path / "bad.bam").write_bytes(bgzf(BAM_DATA, eof=False))
+    (tmp_path / "good.fastq").write_bytes(FASTQ)
+    paths = [str(tmp_path / name) for name in ["good.bam", "bad.bam", "good.fastq", "good.bam"]]
+    assert check_file_formats(paths, max_workers=max_workers) == {
+        str(tmp_path / "good.bam"): None,
+        str(tmp_path / "bad.bam"): "It is truncated (the BGZF end-of-file marker is missing).",
+        str(tmp_path / "good.fastq"): None,
+    }
+
+
+@pytest.mark.parametrize("from_environment", [False, True])
+def test_do_uploads_checks_formats(tmp_path, from_environment):
+
+    (tmp_path / "good.bam").write_bytes(bgzf(BAM_DATA))
+    (tmp_path / "bad.fastq").write_bytes(FASTQ[:-8])
+    upload_spec_list = [{'uuid': 'uuid-1', 'filename': 'good.bam'}, {'uuid': 'uuid-2', 'filename': 'bad.fastq'},
+                        {'uuid': 'uuid-3', 'filename': 'missing.cram'}]
+    uploaded = []
+
+    def mocked_upload_file_to_uuid(filename, uuid, auth, **kwargs):
+        ignored_kwargs = kwargs
+        assert ignored_kwargs.keys() <= {'upload_metadata'}
+        uploaded.append(uuid)
+        return {}
+
+    with mock.patch.object(submission_module, "CHECK_FORMATS", from_environment):
+        with mock.patch.object(submission_module, "upload_file_to_uuid", mocked_upload_file_to_uuid):
+            with shown_output() as shown:
+                do_uploads(upload_spec_list, auth=SOME_AUTH, folder=str(tmp_path), no_query=True,
+                           check_formats=None if from_environment else True)
+                assert shown.lines[0] == "Checking the formats of 2 files before uploading them."
+                assert (f"No upload attempted for file {tmp_path}/bad.fastq because it is not in good form."
+                        f" It is truncated (FASTQ record 2 is incomplete).") in shown.lines
+    assert uploaded == ['uuid-1', 'uuid-3']  # A missing file fails to upload as it always has.
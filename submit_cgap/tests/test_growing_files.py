@@ -0,0 +1,141 @@
+import hashlib
+import os
+import pytest
+
+from dcicutils.qa_utils import raises_regexp
+from unittest import mock
+
+from .test_s3_upload import FakeS3Client, make_credentials
+from .test_utils import shown_output
+from .. import growing_files as growing_files_module
+from .. import s3_upload as s3_upload_module
+from .. import submission as submission_module
+from ..growing_files import (
+    GrowingFile, _compute_follow_quiescence, is_being_written, sentinel_path, upload_growing_file,
+)
+from ..submission import execute_prearranged_upload
+
+
+SOME_AUTH = {'key': 'my-key-id', 'secret': 'good-secret', 'server': 'http://localhost:7777'}
+
+DATA = bytes(range(256)) * 40  # 10240 bytes
+
+
+class Writer:
+    """Stands in for time.sleep (and time.monotonic), writing more of a file each time it's slept."""
+
+    def __init__(self, path, chunks, sentinel=None):
+        self.path = path
+        self.chunks = list(chunks)
+        self.sentinel = sentinel
+        self.now = 0
+        self.sleeps = 0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.sleeps += 1
+        if self.chunks:
+            with open(self.path, 'ab') as fp:
+                fp.write(self.chunks.pop(0))
+        elif self.sentinel:
+            open(self.sentinel, 'w').close()
+
+
+def test_compute_follow_quiescence():
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_FOLLOW_QUIESCENCE": "60"}):
+        assert _compute_follow_quiescence() == 60
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_FOLLOW_QUIESCENCE": "a while"}):
+        with mock.patch.object(growing_files_module, "PRINT") as mock_print:
+            assert _compute_follow_quiescence() == growing_files_module.DEFAULT_FOLLOW_QUIESCENCE
+            assert mock_print.call_count == 1
+
+
+def test_sentinel_path():
+    assert sentinel_path("/runs/r1/sample.bam", ".done") == "/runs/r1/sample.bam.done"
+    assert sentinel_path("/runs/r1/sample.bam", "CopyComplete.txt") == "/runs/r1/CopyComplete.txt"
+
+
+def test_is_being_written(tmp_path):
+    path = tmp_path / "sample.bam"
+    path.write_bytes(DATA)
+    mtime = os.path.getmtime(path)
+    assert is_being_written(str(path), quiescence=60, sentinel="", clock=lambda: mtime + 30)
+    assert not is_being_written(str(path), quiescence=60, sentinel="", clock=lambda: mtime + 90)
+    assert is_being_written(str(path), sentinel=".done")
+    (tmp_path / "sample.bam.done").write_text("")
+    assert not is_being_written(str(path), sentinel=".done")
+
+
+def test_growing_file_until_quiet(tmp_path):
+    path = tmp_path / "sample.bam"
+    path.write_bytes(DATA[:1000])
+    writer = Writer(str(path), [DATA[1000:5000], b"", DATA[5000:]])
+    with GrowingFile(str(path), quiescence=20, sentinel="", poll_interval=5, clock=writer.clock,
+                     sleep=writer.sleep) as growing_file:
+        assert growing_file.read() == DATA
+        assert growing_file.size == len(DATA)
+    assert writer.now == 15 + 20  # It keeps waiting while the file grows (even after a pause), and then until quiet.
+
+
+def test_growing_file_until_sentinel(tmp_path):
+    path = tmp_path / "sample.bam"
+    path.write_bytes(b"")
+    writer = Writer(str(path), [DATA[:3000], DATA[3000:]], sentinel=str(tmp_path / "sample.bam.done"))
+    with GrowingFile(str(path), quiescence=0, sentinel=".done", poll_interval=5, clock=writer.clock,
+                     sleep=writer.sleep) as growing_file:
+        assert growing_file.read() == DATA
+    assert writer.sleeps == 3
+
+
+def test_growing_file_that_shrinks(tmp_path):
+    path = tmp_path / "sample.bam"
+    path.write_bytes(DATA)
+
+    def truncate(seconds):
+        path.write_bytes(DATA[:100])
+
+    with GrowingFile(str(path), quiescence=20, sentinel="", clock=lambda: 0, sleep=truncate) as growing_file:
+        with raises_regexp(OSError, "got smaller"):
+            growing_file.read()
+
+
+def test_upload_growing_file(tmp_path):
+    path = tmp_path / "sample.bam"
+    path.write_bytes(DATA[:2500])
+    writer = Writer(str(path), [DATA[2500:4000], DATA[4000:9000], DATA[9000:]], sentinel=str(tmp_path / "done"))
+    with mock.patch.object(s3_upload_module, "MULTIPART_CHUNK_SIZE", 1000):
+        client = FakeS3Client()
+        result = upload_growing_file(str(path), make_credentials(), s3_client=client, sentinel="done",
+                                     clock=writer.clock, sleep=writer.sleep)
+    assert result == {'size': len(DATA), 'md5': hashlib.md5(DATA).hexdigest()}
+    assert client.objects[('some-bucket', 'some/key.fastq.gz')] == DATA
+    assert len(client.parts) == 11
+
+
+@pytest.mark.parametrize("finished", [False, True])
+def test_execute_prearranged_upload_following(tmp_path, finished):
+    path = tmp_path / "sample.bam"
+    path.write_bytes(DATA)
+    if finished:
+        (tmp_path / "sample.bam.done").write_text("")
+    result = {'size': len(DATA), 'md5': 'some-md5'}
+    with mock.patch.object(submission_module, "FOLLOW_UPLOADS", True):
+        with mock.patch.object(growing_files_module, "FOLLOW_SENTINEL", ".done"):
+            with mock.patch.object(submission_module, "upload_growing_file", return_value=result) as mock_upload:
+                with mock.patch("subprocess.check_call") as mock_check_call:
+                    with shown_output() as shown:
+                        execute_prearranged_upload(str(path), make_credentials(), auth=SOME_AUTH)
+    if finished:  # It's uploaded as usual.
+        assert mock_upload.call_count == 0 and mock_check_call.call_count == 1
+    else:
+        assert mock_check_call.call_count == 0
+        mock_upload.assert_called_once_with(str(path), make_credentials(), s3_encrypt_key_id=None,
+                                            refresh_credentials=None, tuner=mock.ANY)
+        assert shown.lines[:2] == [
+            f"Following local file {path}, which is still being written, and uploading it directly (in-process)"
+            f" to: s3://some-bucket/some/key.fastq.gz",
+            f"Uploaded {len(DATA)} bytes (md5 some-md5), once it was finished.",
+        ]
@@ -0,0 +1,133 @@
+import os
+import pytest
+import threading
+
+from unittest import mock
+
+from .test_utils import shown_output
+from ..bandwidth import BandwidthSchedule, HostBandwidthShare, TokenBucket
+from ..host_coordination import (
+    ACTIVE_PREFIX, WAITING_PREFIX, HOST_MAX_TRANSFERS_VAR, HostCoordinator, _compute_host_max_transfers,
+)
+
+
+def lock_files(directory, prefix):
+    return [name for name in os.listdir(directory) if name.startswith(prefix)]
+
+
+@pytest.mark.parametrize("value, expected", [(None, None), ("", None), ("3", 3), ("0", None), ("many", None)])
+def test_compute_host_max_transfers(value, expected):
+
+    with mock.patch.dict(os.environ, {HOST_MAX_TRANSFERS_VAR: value} if value is not None else {}, clear=True):
+        with shown_output():
+            assert _compute_host_max_transfers() == expected
+
+
+def test_host_coordinator_counts_and_cleans_up(tmp_path):
+
+    coordinator = HostCoordinator(directory=str(tmp_path))
+    assert coordinator.active_transfers() == 0
+    with coordinator.transfer_slot():
+        with coordinator.transfer_slot():
+            assert coordinator.active_transfers() == coordinator.local_transfers() == 2
+            assert len(lock_files(tmp_path, ACTIVE_PREFIX)) == 2
+        assert coordinator.active_transfers() == coordinator.local_transfers() == 1
+    assert coordinator.local_transfers() == 0
+    assert lock_files(tmp_path, ACTIVE_PREFIX) == []
+    assert lock_files(tmp_path, WAITING_PREFIX) == []
+
+    # Lock files no process holds were left behind by processes that died, and are removed.
+    (tmp_path / f"{ACTIVE_PREFIX}00000000000000000001-99999-1.lock").write_text("")
+    (tmp_path / f"{WAITING_PREFIX}00000000000000000001-99999-2.lock").write_text("")
+    with coordinator.transfer_slot():
+        assert coordinator.active_transfers() == 1
+    assert lock_files(tmp_path, ACTIVE_PREFIX) == []
+    assert lock_files(tmp_path, WAITING_PREFIX) == []
+
+
+def test_host_coordinator_disabled(tmp_path):
+
+    coordinator = HostCoordinator(directory=str(tmp_path / "transfers"), max_transfers=1, enabled=False)
+    with coordinator.transfer_slot():
+        with coordinator.transfer_slot():
+            assert coordinator.active_transfers() == 0
+            assert coordinator.local_transfers() == 2  # still counted, for sharing bandwidth
+    assert not os.path.exists(tmp_path / "transfers")
+
+
+def test_host_coordinator_limits_transfers(tmp_path):
+
+    # Coordinators in separate threads lock separately, as they would in separate processes.
+    first_started, first_may_finish = threading.Event(), threading.Event()
+    events = []
+
+    def first_transfer():
+        with HostCoordinator(directory=str(tmp_path), max_transfers=1).transfer_slot():
+            events.append("first started")
+            first_started.set()
+            first_may_finish.wait(timeout=10)
+            events.append("first finished")
+
+    def waiting(seconds):
+        events.append("second waited")
+        first_may_finish.set()
+
+    thread = threading.Thread(target=first_transfer)
+    thread.start()
+    first_started.wait(timeout=10)
+    second = HostCoordinator(directory=str(tmp_path), max_transfers=1, poll_interval=0.01, sleep=waiting)
+    with shown_output() as shown:
+        with second.transfer_slot("f2.fastq.gz"):
+            events.append("second started")
+        assert shown.lines == ["Waiting for a free transfer slot on this host to upload f2.fastq.gz."]
+    thread.join(timeout=10)
+    assert events[:2] == ["first started", "second waited"]
+    assert events.index("first finished") < events.index("second started")
+
+
+def test_host_coordinator_serves_waiters_in_order(tmp_path):
+
+    earlier = HostCoordinator(directory=str(tmp_path))
+    with earlier._mutex():  # noQA - testing protected member
+        earlier_fd, earlier_name = earlier._hold(WAITING_PREFIX)  # noQA - testing protected member
+
+    def waiting(seconds):
+        earlier._release(earlier_fd, earlier_name)  # noQA - testing protected member
+
+    later = HostCoordinator(directory=str(tmp_path), sleep=waiting)
+    with shown_output():
+        with later.transfer_slot():
+            assert lock_files(tmp_path, WAITING_PREFIX) == []
+
+
+def test_host_bandwidth_share():
+
+    clock = mock.MagicMock(return_value=100.0)
+    coordinator = mock.MagicMock()
+    coordinator.active_transfers.return_value = 4
+    coordinator.local_transfers.return_value = 1
+    share = HostBandwidthShare(BandwidthSchedule.parse("100MB/s"), coordinator=coordinator, refresh_interval=1,
+                               clock=clock)
+    assert share() == 25 * 1000 ** 2
+    coordinator.active_transfers.return_value = 2
+    assert share() == 25 * 1000 ** 2  # Not looked up again yet
+    clock.return_value = 101.0
+    assert share() == 50 * 1000 ** 2
+    coordinator.local_transfers.return_value = 2
+    clock.return_value = 102.0
+    assert share() == 100 * 1000 ** 2  # both of the host's transfers are this process's
+    coordinator.active_transfers.return_value = 8
+    clock.return_value = 103.0
+    assert share() == 25 * 1000 ** 2  # 2 of the host's 8
+    coordinator.local_transfers.return_value = 0
+    coordinator.active_transfers.return_value = 0
+    clock.return_value = 104.0
+    assert share() == 100 * 1000 ** 2
+
+    assert HostBandwidthShare(BandwidthSchedule.parse(None), coordinator=coordinator)() is None
+
+    # A process keeps to the lower of its own limit and its share of the host's.
+    assert TokenBucket(BandwidthSchedule.parse("10MB/s"), ceiling=share).current_rate() == 10 * 1000 ** 2
+    assert TokenBucket(BandwidthSchedule.parse("1GB/s"), ceiling=share).current_rate() == 100 * 1000 ** 2
+    assert TokenBucket(BandwidthSchedule.parse(None), ceiling=share).current_rate() == 100 * 1000 ** 2
+    assert TokenBucket(BandwidthSchedule.parse(None), ceiling=lambda: None).current_rate() is None
@@ -0,0 +1,114 @@
+import os
+
+from unittest import mock
+
+from .. import submission as submission_module
+from ..ingestion_cache import IngestionSubmissionCache, is_terminal_ingestion_submission
+from ..submission import check_submit_ingestion, get_ingestion_submission
+from ..utils import FakeResponse
+
+
+SOME_SERVER = 'http://localhost:7777'
+SOME_UUID = '123-4444-5678'
+SOME_AUTH = ('my-key-id', 'good-secret')
+
+DONE_DOCUMENT = {
+    'uuid': SOME_UUID,
+    'processing_status': {'state': 'done', 'outcome': 'success', 'progress': 'complete'},
+    'additional_data': {'upload_info': [{'uuid': '1234', 'filename': 'f1.fastq.gz'}]},
+}
+
+PROCESSING_DOCUMENT = {
+    'uuid': SOME_UUID,
+    'processing_status': {'state': 'processing', 'outcome': 'unknown', 'progress': '20%'},
+}
+
+
+def test_is_terminal_ingestion_submission():
+
+    assert is_terminal_ingestion_submission(DONE_DOCUMENT)
+    assert not is_terminal_ingestion_submission(PROCESSING_DOCUMENT)
+    assert not is_terminal_ingestion_submission({})
+    assert not is_terminal_ingestion_submission(None)
+
+
+def test_ingestion_submission_cache(tmp_path):
+
+    cache = IngestionSubmissionCache(directory=str(tmp_path / "cache"))
+    assert cache.get(SOME_SERVER, SOME_UUID) is None
+    assert cache.put(SOME_SERVER, SOME_UUID, PROCESSING_DOCUMENT) is False  # Might still change
+    assert cache.get(SOME_SERVER, SOME_UUID) is None
+    assert cache.put(SOME_SERVER, SOME_UUID, DONE_DOCUMENT) is True
+    assert cache.get(SOME_SERVER, SOME_UUID) == DONE_DOCUMENT
+    assert cache.get(SOME_SERVER + "/", SOME_UUID) == DONE_DOCUMENT  # A trailing slash is the same server
+    assert cache.get('http://localhost:8888', SOME_UUID) is None
+    assert cache.get(SOME_SERVER, 'some-other-uuid') is None
+
+    [filename] = os.listdir(cache.directory)
+    with open(os.path.join(cache.directory, filename), 'wb') as fp:
+        fp.write(b"damaged")
+    assert cache.get(SOME_SERVER, SOME_UUID) is None
+    assert os.listdir(cache.directory) == []  # The damaged file is discarded
+
+    disabled_cache = IngestionSubmissionCache(directory=str(tmp_path / "disabled"), enabled=False)
+    assert disabled_cache.put(SOME_SERVER, SOME_UUID, DONE_DOCUMENT) is False
+    assert not os.path.exists(disabled_cache.directory)
+
+
+def test_ingestion_submission_cache_eviction(tmp_path):
+
+    cache = IngestionSubmissionCache(directory=str(tmp_path / "cache"))
+    for i in range(3):
+        cache.put(SOME_SERVER, f"uuid-{i}", dict(DONE_DOCUMENT, uuid=f"uuid-{i}"))
+    paths = {i: cache._path(SOME_SERVER, f"uuid-{i}") for i in range(3)}  # noQA - testing internals
+    for i, path in paths.items():
+        os.utime(path, (1000 + i, 1000 + i))
+    one_size = os.path.getsize(paths[0])
+    cache.get(SOME_SERVER, "uuid-0")  # Using it makes uuid-1 the least recently used
+    cache.evict(keep_bytes=2 * one_size)
+    assert sorted(os.listdir(cache.directory)) == sorted(os.path.basename(paths[i]) for i in [0, 2])
+
+    cache.max_bytes = one_size  # Now only room for one.
+    cache.put(SOME_SERVER, "uuid-3", dict(DONE_DOCUMENT, uuid="uuid-3"))
+    assert cache.get(SOME_SERVER, "uuid-3") is not None
+    assert cache.get(SOME_SERVER, "uuid-0") is None
+    assert cache.get(SOME_SERVER, "uuid-2") is None
+
+    cache.max_bytes = 10  # Too small for anything
+    assert cache.put(SOME_SERVER, "uuid-4", dict(DONE_DOCUMENT, uuid="uuid-4")) is False
+
+    cache.clear()
+    assert os.listdir(cache.directory) == []
+
+
+def test_get_ingestion_submission(isolated_ingestion_submission_cache):
+
+    documents = [PROCESSING_DOCUMENT, DONE_DOCUMENT]
+
+    def mocked_get(url, auth, headers):
+        assert url.startswith(SOME_SERVER + '/ingestion-submissions/' + SOME_UUID)
+        assert auth == SOME_AUTH
+        return FakeResponse(200, json=documents.pop(0))
+
+    with mock.patch.object(submission_module, "portal_request_get", side_effect=mocked_get) as mock_get:
+        assert get_ingestion_submission(SOME_SERVER, SOME_UUID, keypair=SOME_AUTH) == PROCESSING_DOCUMENT
+        assert get_ingestion_submission(SOME_SERVER, SOME_UUID, keypair=SOME_AUTH) == DONE_DOCUMENT
+        assert mock_get.call_count == 2  # Still processing the first time, so not cached
+        assert get_ingestion_submission(SOME_SERVER, SOME_UUID, keypair=SOME_AUTH) == DONE_DOCUMENT
+        assert mock_get.call_count == 2  # Served from the cache
+    assert isolated_ingestion_submission_cache.get(SOME_SERVER, SOME_UUID) == DONE_DOCUMENT
+
+
+def test_check_submit_ingestion_uses_cache(isolated_ingestion_submission_cache):
+
+    isolated_ingestion_submission_cache.put(SOME_SERVER, SOME_UUID, DONE_DOCUMENT)
+    with mock.patch.object(submission_module, "portal_request_get") as mock_get:
+        with mock.patch.object(submission_module.KEY_MANAGER, "get_keydict_for_server",
+                               return_value={'key': SOME_AUTH[0], 'secret': SOME_AUTH[1], 'server': SOME_SERVER}):
+            with mock.patch.object(submission_module, "show"):
+                assert check_submit_ingestion(SOME_UUID, SOME_SERVER, None) == (True, 'success', DONE_DOCUMENT)
+                assert mock_get.call_count == 0
+                with mock.patch.object(submission_module, "check_repeatedly",
+                                       return_value=(True, 'success', DONE_DOCUMENT)) as mock_check_repeatedly:
+                    check_submit_ingestion(SOME_UUID, SOME_SERVER, None, use_cache=False)
+                    assert mock_check_repeatedly.call_count == 1
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import pytest
+
+from unittest import mock
+
+from .. import local_files as local_files_module
+from .. import submission as submission_module
+from ..local_files import compute_file_md5, extract_bundle_filenames, LocalFileIndex
+from ..submission import do_uploads, find_upload_file
+
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+SOME_AUTH = ('my-key-id', 'good-secret')
+
+
+def test_compute_file_md5(tmp_path):
+
+    data = b"some data\n" * 1000
+    path = tmp_path / "some.fastq"
+    path.write_bytes(data)
+
+    with mock.patch.object(local_files_module, "MD5_CHUNK_SIZE", 7):  # Make sure chunking doesn't matter
+        assert compute_file_md5(str(path)) == hashlib.md5(data).hexdigest()
+
+    stop_event = mock.MagicMock()
+    stop_event.is_set.return_value = True
+    assert compute_file_md5(str(path), stop_event=stop_event) is None
+
+
+def test_extract_bundle_filenames(tmp_path):
+
+    names = extract_bundle_filenames(os.path.join(TEST_DATA_DIR, "cgap_submit_test.xlsx"))
+    assert {'f1_R1.fastq.gz', 'f1_R2.fastq.gz', 'f2_R1.fastq.gz', 'f2_R2.fastq.gz'} <= names
+
+    json_bundle = tmp_path / "bundle.json"
+    json_bundle.write_text(json.dumps({"files": [{"name": "a.vcf.gz"}, "b.bam; c.bam"], "count": 3}))
+    assert extract_bundle_filenames(str(json_bundle)) == {'a.vcf.gz', 'b.bam', 'c.bam'}
+
+    text_bundle = tmp_path / "genes.txt"
+    text_bundle.write_text("GENE1\nGENE2\nsome/dir/x.fastq.gz, ...\n")
+    assert extract_bundle_filenames(str(text_bundle)) == {'x.fastq.gz'}
+
+
+def make_upload_folder(tmp_path):
+    folder = tmp_path / "to_upload"
+    (folder / "sub").mkdir(parents=True)
+    (folder / ".hidden").mkdir()
+    (folder / "top.fastq.gz").write_text("top")
+    (folder / "dup.fastq.gz").write_text("dup1")
+    (folder / "sub" / "dup.fastq.gz").write_text("dup2")
+    (folder / "sub" / "deep.fastq.gz").write_text("deep")
+    (folder / ".hidden" / "secret.fastq.gz").write_text("secret")
+    return folder
+
+
+def test_local_file_index_find(tmp_path):
+
+    folder = make_upload_folder(tmp_path)
+    top = str(folder / "top.fastq.gz")
+
+    index = LocalFileIndex(str(folder))
+    assert index.find("top.fastq.gz") == (top, None)
+    assert index.find("dup.fastq.gz") == (str(folder / "dup.fastq.gz"), None)  # Subfolders not searched
+    assert index.find("deep.fastq.gz") is None  # Not known, so left to search_for_file
+    assert index.find("*.fastq.gz") is None  # Not a plain filename
+    assert index.find("sub/deep.fastq.gz") is None  # Ditto
+
+    index = LocalFileIndex(str(folder), recursive=True)
+    assert index.find("deep.fastq.gz") == (str(folder / "sub" / "deep.fastq.gz"), None)
+    assert index.find("secret.fastq.gz") is None  # Like glob's '**', hidden folders are not searched
+    path, error_msg = index.find("dup.fastq.gz")
+    assert path is None
+    assert error_msg == ("No upload attempted for file dup.fastq.gz because multiple copies were found"
+                         " in folder %s: %s, %s."
+                         % (os.path.join(str(folder), "**"),
+                            str(folder / "dup.fastq.gz"), str(folder / "sub" / "dup.fastq.gz")))
+
+    # The index gives the same answers search_for_file would.
+    for recursive in [False, True]:
+        index = LocalFileIndex(str(folder), recursive=recursive)
+        search_folder = os.path.join(str(folder), '**') if recursive else str(folder)
+        for name in ["top.fastq.gz", "deep.fastq.gz", "missing.fastq.gz"]:
+            expected = submission_module.search_for_file(search_folder, name, recursive=recursive)
+            assert find_upload_file(search_folder, name, recursive=recursive, file_index=index) == expected
+
+
+def test_local_file_index_md5(tmp_path):
+
+    folder = make_upload_folder(tmp_path)
+    top = str(folder / "top.fastq.gz")
+    index = LocalFileIndex(str(folder))
+
+    assert index.cached_md5(top) is None
+    with mock.patch.object(local_files_module, "compute_file_md5", wraps=compute_file_md5) as mock_compute:
+        assert index.md5(top) == hashlib.md5(b"top").hexdigest()
+        assert index.md5(top) == hashlib.md5(b"top").hexdigest()
+        assert mock_compute.call_count == 1  # The second time was cached
+        assert index.stat(top).st_size == 3
+        (folder / "top.fastq.gz").write_text("changed")
+        os.utime(top, (0, 0))  # Make sure the change is noticed, however coarse the file system's timestamps
+        assert index.cached_md5(top) is None
+        assert index.md5(top) == hashlib.md5(b"changed").hexdigest()
+        assert mock_compute.call_count == 2
+
+
+def test_local_file_index_prepare(tmp_path):
+
+    folder = make_upload_folder(tmp_path)
+    index = LocalFileIndex(str(folder), recursive=True)
+    index.prepare(candidate_names=["top.fastq.gz", "dup.fastq.gz", "missing.fastq.gz"])
+    assert index.cached_md5(str(folder / "top.fastq.gz")) == hashlib.md5(b"top").hexdigest()
+    # Ambiguous or missing names are not checksummed, nor is anything not named.
+    assert index.cached_md5(str(folder / "dup.fastq.gz")) is None
+    assert index.cached_md5(str(folder / "sub" / "deep.fastq.gz")) is None
+
+    bundle = tmp_path / "bundle.json"
+    bundle.write_text(json.dumps({"files": ["deep.fastq.gz"]}))
+    index = LocalFileIndex(str(folder), recursive=True)
+    index.start_preparation(bundle_filename=str(bundle))
+    index._preparer.join(timeout=10)  # noQA - we need to know the background work is done
+    assert index.cached_md5(str(folder / "sub" / "deep.fastq.gz")) == hashlib.md5(b"deep").hexdigest()
+
+    index = LocalFileIndex(str(folder), recursive=True)
+    index.stop_preparation()
+    index.prepare(candidate_names=["top.fastq.gz"])
+    assert index.cached_md5(str(folder / "top.fastq.gz")) is None
+
+
+@pytest.mark.parametrize("subfolders", [False, True])
+def test_do_uploads_with_file_index(tmp_path, subfolders):
+
+    folder = make_upload_folder(tmp_path)
+    index = LocalFileIndex(str(folder), recursive=subfolders)
+    with mock.patch.object(submission_module, "upload_file_to_uuid", return_value=None) as mock_upload:
+        with mock.patch.object(submission_module, "search_for_file",
+                               wraps=submission_module.search_for_file) as mock_search:
+            do_uploads([{'uuid': '1234', 'filename': 'top.fastq.gz'}], auth=SOME_AUTH, folder=str(folder),
+                       no_query=True, subfolders=subfolders, file_index=index)
+            mock_upload.assert_called_with(filename=str(folder / "top.fastq.gz"), uuid='1234', auth=SOME_AUTH)
+            assert mock_search.call_count == 0  # The index answered
+            assert index._stop_event.is_set()  # noQA - uploading stops any preparation still going on
@@ -0,0 +1,223 @@
+import hashlib
+import os
+import pytest
+
+from unittest import mock
+
+from .test_utils import shown_output
+from .. import md5_manifests as md5_manifests_module
+from .. import submission as submission_module
+from ..md5_manifests import (
+    Md5Manifests, Md5Mismatch, _compute_md5_workers, compute_md5s, find_md5_manifests, parse_md5_manifest,
+    resolve_md5_manifests,
+)
+from ..s3_upload import UploadEngine
+from ..submission import UploadMessageWrapper, do_uploads, upload_extra_files
+
+
+SOME_AUTH = {'key': 'my-key-id', 'secret': 'good-secret', 'server': 'http://localhost:7777'}
+
+
+def md5_of(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def test_compute_md5_workers():
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_MD5_WORKERS": "2"}):
+        assert _compute_md5_workers() == 2
+    for bad_value in ["x", "-3"]:
+        with mock.patch.dict(os.environ, {"SUBMITCGAP_MD5_WORKERS": bad_value}):
+            with mock.patch.object(md5_manifests_module, "PRINT") as mock_print:
+                assert _compute_md5_workers() == (os.cpu_count() or 1)
+                assert mock_print.call_count == 1
+
+
+def test_parse_md5_manifest(tmp_path):
+    manifest = tmp_path / "md5sum.txt"
+    manifest.write_text(f"{md5_of(b'one')}  one.fastq.gz\n"
+                        f"{md5_of(b'two').upper()} *sub/two.bam\n"
+                        f"MD5 (three.vcf.gz) = {md5_of(b'three')}\n"
+                        f"this line is not understood\n"
+                        f"\n")
+    assert parse_md5_manifest(str(manifest)) == {
+        str(tmp_path / "one.fastq.gz"): md5_of(b'one'),
+        str(tmp_path / "sub" / "two.bam"): md5_of(b'two'),
+        str(tmp_path / "three.vcf.gz"): md5_of(b'three'),
+    }
+
+
+def test_find_md5_manifests(tmp_path):
+    for name in ["md5sum.txt", "MD5SUMS-batch1.txt", "sample.bam.md5", "notes.txt", "sample.bam"]:
+        (tmp_path / name).write_text("")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "md5sums.txt").write_text("")
+    assert find_md5_manifests(str(tmp_path)) == [str(tmp_path / name)
+                                                 for name in ["MD5SUMS-batch1.txt", "md5sum.txt", "sample.bam.md5"]]
+    assert str(tmp_path / "sub" / "md5sums.txt") in find_md5_manifests(str(tmp_path), recursive=True)
+
+
+def test_md5_manifests_expected_md5(tmp_path):
+    manifests = Md5Manifests({str(tmp_path / "a" / "x.bam"): "1" * 32,
+                              str(tmp_path / "a" / "y.bam"): "2" * 32,
+                              str(tmp_path / "b" / "y.bam"): "3" * 32})
+    assert len(manifests) == 3
+    assert manifests.expected_md5(str(tmp_path / "a" / "x.bam")) == "1" * 32
+    assert manifests.expected_md5(str(tmp_path / "elsewhere" / "x.bam")) == "1" * 32  # found by name
+    assert manifests.expected_md5(str(tmp_path / "elsewhere" / "y.bam")) is None  # manifests disagree
+    assert manifests.expected_md5(str(tmp_path / "b" / "y.bam")) == "3" * 32
+    assert manifests.expected_md5(str(tmp_path / "z.bam")) is None
+    # Files aren't found by name when two of those checked have the name, or when the file listed is there.
+    elsewhere = [str(tmp_path / "s1" / "x.bam"), str(tmp_path / "s2" / "x.bam")]
+    assert manifests.expected_md5s(elsewhere) == {path: None for path in elsewhere}
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "x.bam").write_bytes(b"x")
+    assert manifests.expected_md5(str(tmp_path / "elsewhere" / "x.bam")) is None
+
+
+def test_md5_manifests_in_subfolders(tmp_path):
+    # s1's manifest says nothing about s2's file of the same name.
+    for sample in ["s1", "s2"]:
+        (tmp_path / sample).mkdir()
+        (tmp_path / sample / "R1.fastq.gz").write_bytes(sample.encode())
+    (tmp_path / "s1" / "md5sum.txt").write_text(f"{md5_of(b's1')}  R1.fastq.gz\n")
+    manifests = resolve_md5_manifests("auto", folder=str(tmp_path), recursive=True)
+    assert manifests.expected_md5s([str(tmp_path / "s2" / "R1.fastq.gz")]) == {
+        str(tmp_path / "s2" / "R1.fastq.gz"): None}
+
+
+def test_resolve_md5_manifests(tmp_path):
+    assert resolve_md5_manifests(None, folder=str(tmp_path)) is None
+    assert resolve_md5_manifests("auto", folder=str(tmp_path)) is None  # no manifests there
+    (tmp_path / "md5sum.txt").write_text(f"{md5_of(b'one')}  one.fastq\n")
+    other = tmp_path / "other.txt"
+    other.write_text(f"{md5_of(b'two')}  two.fastq\n")
+    assert len(resolve_md5_manifests("auto", folder=str(tmp_path))) == 1
+    assert len(resolve_md5_manifests(f"{tmp_path / 'md5sum.txt'}, {other}", folder=os.curdir)) == 2
+    with shown_output() as shown:
+        assert len(resolve_md5_manifests(f"{tmp_path / 'missing.txt'}, {other}", folder=os.curdir)) == 1
+        assert shown.lines[0].startswith(f"Warning: Not checking files against md5 manifest {tmp_path}/missing.txt,")
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_compute_md5s(tmp_path, max_workers):
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"file{i}.txt"
+        path.write_bytes(b"data %d" % i)
+        paths.append(str(path))
+    assert compute_md5s(paths, max_workers=max_workers) == {path: md5_of(b"data %d" % i)
+                                                            for i, path in enumerate(paths)}
+
+
+def test_compute_md5s_known(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"data")
+    known = {str(path): "0" * 32}
+    assert compute_md5s([str(path)], max_workers=1, known_md5=known.get) == {str(path): "0" * 32}
+
+
+@pytest.mark.parametrize("mismatch", [Md5Mismatch.BLOCK, Md5Mismatch.FLAG])
+@pytest.mark.parametrize("from_environment", [False, True])
+def test_do_uploads_checks_md5_manifests(tmp_path, mismatch, from_environment):
+
+    (tmp_path / "good.fastq").write_bytes(b"good")
+    (tmp_path / "bad.fastq").write_bytes(b"bad")
+    (tmp_path / "unlisted.fastq").write_bytes(b"unlisted")
+    (tmp_path / "md5sum.txt").write_text(f"{md5_of(b'good')}  good.fastq\n{md5_of(b'expected')}  bad.fastq\n")
+    upload_spec_list = [{'uuid': 'uuid-1', 'filename': 'good.fastq'}, {'uuid': 'uuid-2', 'filename': 'bad.fastq'},
+                        {'uuid': 'uuid-3', 'filename': 'unlisted.fastq'}]
+    uploaded = []
+
+    def mocked_upload_file_to_uuid(filename, uuid, auth, **kwargs):
+        ignored_kwargs = kwargs
+        assert ignored_kwargs.keys() <= {'upload_metadata'}
+        uploaded.append(uuid)
+        return {}
+
+    with mock.patch.object(submission_module, "MD5_MANIFESTS", "auto" if from_environment else None):
+        with mock.patch.object(submission_module, "MD5_MISMATCH", mismatch if from_environment else Md5Mismatch.BLOCK):
+            with mock.patch.object(submission_module, "upload_file_to_uuid", mocked_upload_file_to_uuid):
+                with shown_output() as shown:
+                    do_uploads(upload_spec_list, auth=SOME_AUTH, folder=str(tmp_path), no_query=True,
+                               md5_manifests=None if from_environment else "auto",
+                               md5_mismatch=None if from_environment else mismatch)
+                    assert shown.lines[0] == "Checking the md5 checksums of 2 files against their manifests."
+                    mismatch_message = (f"Its md5 checksum is {md5_of(b'bad')},"
+                                        f" but its manifest says it should be {md5_of(b'expected')}.")
+                    if mismatch == Md5Mismatch.BLOCK:
+                        assert (f"No upload attempted for file {tmp_path}/bad.fastq because it does not match"
+                                f" its manifest. {mismatch_message}") in shown.lines
+                    else:
+                        assert (f"Warning: File {tmp_path}/bad.fastq does not match its manifest."
+                                f" {mismatch_message}") in shown.lines
+    if mismatch == Md5Mismatch.BLOCK:
+        assert uploaded == ['uuid-1', 'uuid-3']
+    else:
+        assert uploaded == ['uuid-1', 'uuid-2', 'uuid-3']
+
+
+@pytest.mark.parametrize("mismatch", [Md5Mismatch.BLOCK, Md5Mismatch.FLAG])
+def test_do_uploads_checks_md5_manifests_as_uploaded(tmp_path, mismatch):
+
+    (tmp_path / "good.fastq").write_bytes(b"good")
+    (tmp_path / "bad.fastq").write_bytes(b"bad")
+    (tmp_path / "unlisted.fastq").write_bytes(b"unlisted")
+    (tmp_path / "md5sum.txt").write_text(f"{md5_of(b'good')}  good.fastq\n{md5_of(b'expected')}  bad.fastq\n")
+    upload_spec_list = [{'uuid': 'uuid-1', 'filename': 'good.fastq'}, {'uuid': 'uuid-2', 'filename': 'bad.fastq'},
+                        {'uuid': 'uuid-3', 'filename': 'unlisted.fastq'}]
+    uploaded = []
+
+    def mocked_upload_file_to_uuid(filename, uuid, auth, check_md5=None, **kwargs):
+        ignored_kwargs = kwargs
+        assert ignored_kwargs.keys() <= {'upload_metadata'}
+        assert (check_md5 is None) == filename.endswith("unlisted.fastq")
+        if check_md5 is not None:  # as upload_file_to_s3 does, having read the file to upload it
+            with open(filename, 'rb') as fp:
+                check_md5(md5_of(fp.read()))
+        uploaded.append(uuid)
+        return {}
+
+    with mock.patch.object(submission_module, "UPLOAD_ENGINE", UploadEngine.BOTO3):
+        # The files are read only as they're uploaded, not beforehand.
+        with mock.patch.object(md5_manifests_module, "compute_file_md5", side_effect=AssertionError("Read early.")):
+            with mock.patch.object(submission_module, "upload_file_to_uuid", mocked_upload_file_to_uuid):
+                with shown_output() as shown:
+                    assert do_uploads(upload_spec_list, auth=SOME_AUTH, folder=str(tmp_path), no_query=True,
+                                      md5_manifests="auto", md5_mismatch=mismatch) == (mismatch == Md5Mismatch.FLAG)
+                    assert shown.lines[0] == ("Checking the md5 checksums of 2 files against their manifests"
+                                              " as they're uploaded.")
+                    mismatch_message = (f"File {tmp_path}/bad.fastq does not match its manifest."
+                                        f" Its md5 checksum is {md5_of(b'bad')},"
+                                        f" but its manifest says it should be {md5_of(b'expected')}.")
+                    if mismatch == Md5Mismatch.BLOCK:
+                        assert f"ValueError: {mismatch_message}" in shown.lines
+                    else:
+                        assert f"Warning: {mismatch_message}" in shown.lines
+    if mismatch == Md5Mismatch.BLOCK:
+        assert uploaded == ['uuid-1', 'uuid-3']
+    else:
+        assert uploaded == ['uuid-1', 'uuid-2', 'uuid-3']
+
+
+def test_upload_extra_files_checks_md5_manifests(tmp_path):
+
+    (tmp_path / "good.bam.bai").write_bytes(b"good")
+    (tmp_path / "bad.bam.bai").write_bytes(b"bad")
+    (tmp_path / "md5sum.txt").write_text(f"{md5_of(b'good')}  good.bam.bai\n{md5_of(b'expected')}  bad.bam.bai\n")
+    manifests = resolve_md5_manifests("auto", folder=str(tmp_path))
+    credentials = {'AccessKeyId': 'some-access-key', 'SecretAccessKey': 'some-secret',
+                   'SessionToken': 'some-session-token', 'upload_url': 's3://some-bucket/some-key',
+                   's3_encrypt_key_id': None}  # So there's no need to consult the health page
+    extra_files_creds = [{'filename': 'good.bam.bai', 'upload_credentials': credentials},
+                         {'filename': 'bad.bam.bai', 'upload_credentials': credentials}]
+
+    for mismatch, expected_uploads in [(Md5Mismatch.BLOCK, 1), (Md5Mismatch.FLAG, 2)]:
+        uploader_wrapper = UploadMessageWrapper('some-uuid', no_query=True)
+        with mock.patch("subprocess.call", return_value=0) as mock_aws_call:
+            with shown_output() as shown:
+                upload_extra_files(extra_files_creds, uploader_wrapper, str(tmp_path), SOME_AUTH,
+                                   md5_manifests=manifests, md5_mismatch=mismatch)
+                assert any(f"File {tmp_path}/bad.bam.bai does not match its manifest." in line
+                           for line in shown.lines)
+            assert mock_aws_call.call_count == expected_uploads
+        assert uploader_wrapper.failures == 2 - expected_uploads
@@ -0,0 +1,203 @@
+import hashlib
+import io
+import os
+import pytest
+import threading
+import tracemalloc
+
+from dcicutils.qa_utils import raises_regexp
+from unittest import mock
+
+from .test_s3_upload import FakeS3Client, make_credentials
+from .. import read_ahead as read_ahead_module
+from .. import s3_upload as s3_upload_module
+from ..read_ahead import (
+    MappedFile, PartBody, ReadAheadReader, _compute_read_ahead_buffer, _compute_read_ahead_threads, read_range_into,
+)
+from ..s3_upload import upload_file_to_s3
+
+
+DATA = bytes(range(256)) * 40  # 10240 bytes
+
+
+@pytest.fixture()
+def data_file(tmp_path):
+    path = tmp_path / "data.bam"
+    path.write_bytes(DATA)
+    return str(path)
+
+
+def test_compute_read_ahead_settings():
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_READ_AHEAD_BUFFER": "64MiB", "SUBMITCGAP_READ_AHEAD_THREADS": "2"}):
+        assert _compute_read_ahead_buffer() == 64 * 1024 * 1024
+        assert _compute_read_ahead_threads() == 2
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_READ_AHEAD_BUFFER": "0"}):
+        assert _compute_read_ahead_buffer() == 0
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_READ_AHEAD_BUFFER": "lots", "SUBMITCGAP_READ_AHEAD_THREADS": "0"}):
+        with mock.patch.object(read_ahead_module, "PRINT") as mock_print:
+            assert _compute_read_ahead_buffer() == read_ahead_module.DEFAULT_READ_AHEAD_BUFFER
+            assert _compute_read_ahead_threads() == read_ahead_module.DEFAULT_READ_AHEAD_THREADS
+            assert mock_print.call_count == 2
+
+
+def read_range(fd, offset, size):
+    buffer = bytearray(size)
+    return bytes(buffer[:read_range_into(fd, memoryview(buffer), offset)])
+
+
+def test_read_range_into(data_file):
+    fd = os.open(data_file, os.O_RDONLY)
+    try:
+        assert read_range(fd, 100, 50) == DATA[100:150]
+        assert read_range(fd, len(DATA) - 10, 50) == DATA[-10:]
+        assert read_range(fd, len(DATA), 50) == b""
+    finally:
+        os.close(fd)
+
+
+def test_part_body():
+    body = PartBody(memoryview(DATA)[1000:2000])
+    assert len(body) == 1000
+    assert body.read(10) == DATA[1000:1010]
+    assert body.tell() == 10
+    buffer = bytearray(20)
+    assert body.readinto(buffer) == 20
+    assert buffer == DATA[1010:1030]
+    assert body.seek(0, io.SEEK_END) == 1000
+    assert body.read() == b""
+    body.seek(-5, io.SEEK_END)
+    assert body.read() == DATA[1995:2000]
+    body.seek(0)
+    assert hashlib.md5(body.read()).hexdigest() == hashlib.md5(DATA[1000:2000]).hexdigest()
+
+
+def test_mapped_file(data_file):
+    with MappedFile(data_file) as mapped_file:
+        with mapped_file.view(1000, 500) as view:
+            assert view == DATA[1000:1500]
+        with mapped_file.view(len(DATA) - 40, 500) as view:
+            assert view == DATA[-40:]
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_read_ahead_reader(data_file, threads):
+    with ReadAheadReader(data_file, part_size=1000, budget=3000, threads=threads) as reader:
+        assert reader.part_count == 11
+        parts = []
+        for part_number in range(1, 12):
+            parts.append(bytes(reader.take(part_number)))
+            reader.release(part_number)
+        assert b"".join(parts) == DATA
+        assert len(parts[-1]) == 240
+
+
+def test_read_ahead_reader_keeps_within_budget(data_file):
+    held = []
+    made = threading.Event()
+    readers = []
+
+    def tracking_read_range_into(fd, buffer, offset):
+        made.wait()
+        held.append(readers[0]._held)
+        return read_range_into(fd, buffer, offset)
+
+    with mock.patch.object(read_ahead_module, "read_range_into", tracking_read_range_into):
+        reader = ReadAheadReader(data_file, part_size=1000, budget=2500, threads=4)
+        readers.append(reader)
+        made.set()
+        with reader:
+            for part_number in range(1, 12):
+                reader.take(part_number)
+                assert reader._held <= 2500
+                reader.release(part_number)
+    assert max(held) <= 2500
+    assert reader.buffers_allocated <= 3  # Buffers are reused from part to part (and the last part is small).
+
+
+def test_read_ahead_reader_reads_a_part_bigger_than_its_budget(data_file):
+    parts = []
+    with ReadAheadReader(data_file, part_size=4000, budget=1000, threads=2) as reader:
+        for part_number in range(1, 4):
+            parts.append(bytes(reader.take(part_number)))
+            reader.release(part_number)
+    assert b"".join(parts) == DATA
+
+
+def test_read_ahead_reader_reports_read_errors(data_file):
+    failing = threading.Event()
+
+    def failing_read_range_into(fd, buffer, offset):
+        if offset == 2000:
+            failing.set()
+            raise OSError("Stale file handle")
+        return read_range_into(fd, buffer, offset)
+
+    with mock.patch.object(read_ahead_module, "read_range_into", failing_read_range_into):
+        with ReadAheadReader(data_file, part_size=1000, budget=5000, threads=2) as reader:
+            assert reader.take(1) == DATA[:1000]
+            with raises_regexp(OSError, "Stale file handle"):
+                reader.take(3)
+    assert failing.is_set()
+
+
+def test_read_ahead_reader_missing_file(tmp_path):
+    with raises_regexp(FileNotFoundError, "No such file"):
+        ReadAheadReader(str(tmp_path / "missing.bam"), part_size=1000, file_size=5000)
+
+
+@pytest.mark.parametrize("read_ahead_buffer", [0, 1000, 4000])
+def test_upload_file_to_s3_with_read_ahead(data_file, read_ahead_buffer):
+    with mock.patch.object(s3_upload_module, "MULTIPART_CHUNK_SIZE", 1000):
+        client = FakeS3Client()
+        upload_file_to_s3(data_file, make_credentials(), s3_client=client, read_ahead_buffer=read_ahead_buffer)
+        assert client.objects[('some-bucket', 'some/key.fastq.gz')] == DATA
+        assert len(client.parts) == 11
+
+        client = FakeS3Client(fail_part=3)
+        with raises_regexp(RuntimeError, "Connection reset"):
+            upload_file_to_s3(data_file, make_credentials(), s3_client=client, read_ahead_buffer=read_ahead_buffer)
+        assert client.calls[-1] == ('abort_multipart_upload', {})
+
+
+class DiscardingS3Client(FakeS3Client):
+    """Reads parts as boto3 does (in pieces, to checksum and send them), but keeps only their checksums."""
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):  # noQA - argument names are as boto3 has them
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: Body.read(64 * 1024), b""):
+            md5.update(chunk)
+        self.parts[PartNumber] = md5.hexdigest().encode()
+        return {'ETag': f'etag-{PartNumber}'}
+
+
+@pytest.mark.parametrize("read_ahead_buffer", [0, 4 * 1024 * 1024])
+def test_upload_file_to_s3_part_allocations(tmp_path, read_ahead_buffer):
+    # Measures the memory allocated to upload a 32MiB file in 1MiB parts, which, scaled up, is what a GB of uploads
+    # costs: it should be that of the parts held at once (or none, with the file mapped into memory), not of the file.
+    part_size = 1024 * 1024
+    path = tmp_path / "big.bam"
+    path.write_bytes(os.urandom(32 * part_size))
+    with mock.patch.object(s3_upload_module, "MULTIPART_CHUNK_SIZE", part_size):
+        client = DiscardingS3Client()
+        tracemalloc.start()
+        try:
+            upload_file_to_s3(str(path), make_credentials(), s3_client=client, read_ahead_buffer=read_ahead_buffer)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    assert len(client.parts) == 32
+    assert peak < read_ahead_buffer + 2 * part_size
+
+
+@pytest.mark.parametrize("read_ahead_buffer", [0, 4000])
+def test_upload_file_to_s3_range(data_file, read_ahead_buffer):
+    with mock.patch.object(s3_upload_module, "MULTIPART_CHUNK_SIZE", 1000):
+        client = FakeS3Client()
+        upload_file_to_s3(data_file, make_credentials(), s3_client=client, read_ahead_buffer=read_ahead_buffer,
+                          offset=1500, length=5200)
+        assert client.objects[('some-bucket', 'some/key.fastq.gz')] == DATA[1500:6700]
+        assert len(client.parts) == 6
+        client = FakeS3Client()
+        upload_file_to_s3(data_file, make_credentials(), s3_client=client, offset=9500)
+        assert client.objects[('some-bucket', 'some/key.fastq.gz')] == DATA[9500:]
+        assert client.calls == [('put_object', {})]
@@ -11,6 +11,15 @@ from ..scripts import resume_uploads as resume_uploads_module
 from .testing_helpers import system_exit_expected, argparse_errors_muffled
 
 
+# The options for which a test's expect_call_args needn't give values, if they're not given.
+UPLOAD_OPTION_DEFAULTS = {
+    'preflight': None,
+    'check_formats': None,
+    'md5_manifests': None,
+    'md5_mismatch': None,
+}
+
+
 @pytest.mark.parametrize("keyfile", [None, "foo.bar"])
 def test_resume_uploads_script(keyfile):
 
@@ -30,7 +39,8 @@ def test_resume_uploads_script(keyfile):
                             raise AssertionError("resume_uploads_main should not exit normally.")  # pragma: no cover
                         assert mock_resume_uploads.call_count == (1 if expect_called else 0)
                         if expect_called:
-                            mock_resume_uploads.assert_called_with(**expect_call_args)
+                            mock_resume_uploads.assert_called_with(**dict(UPLOAD_OPTION_DEFAULTS,
+                                                                          **expect_call_args))
                         assert output == []
 
     test_it(args_in=[], expect_exit_code=2, expect_called=False)  # Missing args
@@ -138,6 +148,22 @@ def test_resume_uploads_script(keyfile):
             expect_exit_code=0,
             expect_called=True,
             expect_call_args=expect_call_args)
+    test_it(args_in=['some-guid', '-b', 'some.file', '-s', 'http://some.server', '-u', 'a-folder', '-nq', '-sf',
+                     '--preflight', 'strict'],
+            expect_exit_code=0,
+            expect_called=True,
+            expect_call_args=dict(expect_call_args, preflight='strict'))
+    test_it(args_in=['some-guid', '-b', 'some.file', '-s', 'http://some.server', '-u', 'a-folder', '-nq', '-sf',
+                     '--check-formats'],
+            expect_exit_code=0,
+            expect_called=True,
+            expect_call_args=dict(expect_call_args, check_formats=True))
+    test_it(args_in=['some-guid', '-b', 'some.file', '-s', 'http://some.server', '-u', 'a-folder', '-nq', '-sf',
+                     '--md5-manifests', 'auto', '--md5-mismatch', 'flag'],
+            expect_exit_code=0,
+            expect_called=True,
+            expect_call_args=dict(expect_call_args, md5_manifests='auto', md5_mismatch='flag'))
+    test_it(args_in=['some-guid', '--preflight', 'sometimes'], expect_exit_code=2, expect_called=False)
 
 
 SAMPLE_UPLOAD_INFO = [
@@ -0,0 +1,320 @@
+import datetime
+import hashlib
+import pytest
+
+from dcicutils.qa_utils import raises_regexp
+from unittest import mock
+
+from .test_utils import shown_output
+from .. import s3_upload as s3_upload_module
+from .. import submission as submission_module
+from ..s3_upload import (
+    UploadEngine, compute_part_size, credentials_expiration, credentials_expire_soon, make_s3_client,
+    parse_upload_url, upload_file_to_s3,
+)
+from ..submission import (
+    cli_upload_outlasts_credentials, execute_prearranged_upload, upload_extra_files, UploadMessageWrapper,
+)
+
+
+SOME_UPLOAD_URL = 's3://some-bucket/some/key.fastq.gz'
+SOME_AUTH = {'key': 'my-key-id', 'secret': 'good-secret', 'server': 'http://localhost:7777'}
+
+
+def make_credentials(expires_in=None, name='old'):
+    credentials = {
+        'AccessKeyId': f'{name}-access-key',
+        'SecretAccessKey': f'{name}-secret',
+        'SessionToken': f'{name}-session-token',
+        'upload_url': SOME_UPLOAD_URL,
+        's3_encrypt_key_id': None,  # So there's no need to consult the health page
+    }
+    if expires_in is not None:
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expires_in)
+        credentials['Expiration'] = expiration.isoformat().replace('+00:00', 'Z')
+    return credentials
+
+
+def test_parse_upload_url():
+
+    assert parse_upload_url(SOME_UPLOAD_URL) == ('some-bucket', 'some/key.fastq.gz')
+    for bad_url in ['some-url', 'https://some-bucket/key', 's3://some-bucket', 's3://some-bucket/']:
+        with raises_regexp(ValueError, "Upload URL is not of the form"):
+            parse_upload_url(bad_url)
+
+
+def test_credentials_expiration():
+
+    assert credentials_expiration(make_credentials()) is None
+    assert credentials_expiration({'Expiration': 'not a time'}) is None
+    assert credentials_expiration({'Expiration': '2030-01-02T03:04:05Z'}) == datetime.datetime(
+        2030, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    assert credentials_expiration({'Expiration': datetime.datetime(2030, 1, 2)}).tzinfo is datetime.timezone.utc
+
+    assert not credentials_expire_soon(make_credentials())
+    assert not credentials_expire_soon(make_credentials(expires_in=3600))
+    assert credentials_expire_soon(make_credentials(expires_in=60))
+    assert credentials_expire_soon(make_credentials(expires_in=-60))
+
+
+def test_compute_part_size():
+
+    assert compute_part_size(100, chunk_size=10) == 10
+    assert compute_part_size(10 ** 6, chunk_size=10) == 100  # Not more than MULTIPART_MAX_PARTS parts
+
+
+def test_make_s3_client_refreshes_credentials():
+
+    refreshed = make_credentials(expires_in=3600, name='new')
+    mock_refresh = mock.MagicMock(return_value=refreshed)
+
+    client = make_s3_client(make_credentials(expires_in=60), refresh_credentials=mock_refresh)
+    assert client._get_credentials().method == 'submit-cgap-refresh'  # noQA
+    credentials = client._get_credentials().get_frozen_credentials()  # noQA - a refresh is due
+    assert mock_refresh.call_count == 1
+    assert credentials.access_key == 'new-access-key'
+    assert credentials.token == 'new-session-token'
+
+    client = make_s3_client(make_credentials(), refresh_credentials=mock_refresh)  # Expiration unknown
+    assert client._get_credentials().get_frozen_credentials().access_key == 'old-access-key'  # noQA
+    assert mock_refresh.call_count == 1
+
+
+class FakeS3Client:
+
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.objects = {}
+        self.parts = {}
+        self.calls = []
+
+    def put_object(self, Bucket, Key, Body, **kwargs):  # noQA - argument names are as boto3 has them
+        self.calls.append(('put_object', kwargs))
+        self.objects[(Bucket, Key)] = Body.read()
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):  # noQA
+        self.calls.append(('create_multipart_upload', kwargs))
+        return {'UploadId': 'some-upload-id'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):  # noQA
+        assert UploadId == 'some-upload-id'
+        if PartNumber == self.fail_part:
+            raise RuntimeError("Connection reset.")
+        self.parts[PartNumber] = Body.read()
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):  # noQA
+        self.calls.append(('complete_multipart_upload', {}))
+        assert [part['PartNumber'] for part in MultipartUpload['Parts']] == sorted(self.parts)
+        assert all(part['ETag'] == f"etag-{part['PartNumber']}" for part in MultipartUpload['Parts'])
+        self.objects[(Bucket, Key)] = b"".join(self.parts[n] for n in sorted(self.parts))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):  # noQA
+        self.calls.append(('abort_multipart_upload', {}))
+
+
+def test_upload_file_to_s3(tmp_path):
+
+    path = tmp_path / "key.fastq.gz"
+    data = bytes(range(256)) * 40
+    path.write_bytes(data)
+    key = ('some-bucket', 'some/key.fastq.gz')
+
+    client = FakeS3Client()
+    upload_file_to_s3(str(path), make_credentials(), s3_client=client)
+    assert client.objects[key] == data
+    assert client.calls == [('put_object', {})]
+
+    with mock.patch.object(s3_upload_module, "MULTIPART_CHUNK_SIZE", 1000):
+        client = FakeS3Client()
+        upload_file_to_s3(str(path), make_credentials(), s3_encrypt_key_id='some-key-id', s3_client=client)
+        assert client.objects[key] == data
+        assert len(client.parts) == 11
+        assert client.calls == [
+            ('create_multipart_upload', {'ServerSideEncryption': 'aws:kms', 'SSEKMSKeyId': 'some-key-id'}),
+            ('complete_multipart_upload', {}),
+        ]
+
+        client = FakeS3Client(fail_part=3)
+        with raises_regexp(RuntimeError, "Connection reset"):
+            upload_file_to_s3(str(path), make_credentials(), s3_client=client)
+        assert client.calls[-1] == ('abort_multipart_upload', {})
+        assert key not in client.objects
+
+
+@pytest.mark.parametrize("read_ahead_buffer", [0, 4000])
+def test_upload_file_to_s3_checks_md5(tmp_path, read_ahead_buffer):
+
+    path = tmp_path / "key.fastq.gz"
+    data = bytes(range(256)) * 40
+    path.write_bytes(data)
+    key = ('some-bucket', 'some/key.fastq.gz')
+    md5 = hashlib.md5(data).hexdigest()
+
+    for chunk_size in [100_000, 1000]:  # in one part, or in 11 parts, uploaded several at once
+        with mock.patch.object(s3_upload_module, "MULTIPART_CHUNK_SIZE", chunk_size):
+            check_md5 = mock.MagicMock()
+            client = FakeS3Client()
+            upload_file_to_s3(str(path), make_credentials(), s3_client=client, read_ahead_buffer=read_ahead_buffer,
+                              check_md5=check_md5)
+            check_md5.assert_called_once_with(md5)
+            assert client.objects[key] == data
+
+            # An upload whose checksum is found wanting isn't completed.
+            client = FakeS3Client()
+            with raises_regexp(ValueError, "does not match"):
+                upload_file_to_s3(str(path), make_credentials(), s3_client=client,
+                                  read_ahead_buffer=read_ahead_buffer,
+                                  check_md5=mock.MagicMock(side_effect=ValueError("It does not match.")))
+            assert key not in client.objects
+            assert ('complete_multipart_upload', {}) not in client.calls
+
+    # If a part fails, no part is left waiting for it to be checksummed.
+    with mock.patch.object(s3_upload_module, "MULTIPART_CHUNK_SIZE", 1000):
+        check_md5 = mock.MagicMock()
+        client = FakeS3Client(fail_part=1)
+        with raises_regexp(RuntimeError, "Connection reset"):
+            upload_file_to_s3(str(path), make_credentials(), s3_client=client, read_ahead_buffer=read_ahead_buffer,
+                              check_md5=check_md5)
+        assert check_md5.call_count == 0
+        assert client.calls[-1] == ('abort_multipart_upload', {})
+
+
+def test_execute_prearranged_upload_refreshes_credentials():
+
+    refreshed = make_credentials(expires_in=3600, name='new')
+    mock_refresh = mock.MagicMock(return_value=refreshed)
+
+    with shown_output() as shown:
+        with mock.patch("subprocess.call", return_value=0) as mock_aws_call:
+            execute_prearranged_upload('some-file', make_credentials(expires_in=3600), auth=SOME_AUTH,
+                                       refresh_credentials=mock_refresh)
+            assert mock_refresh.call_count == 0  # Good for a while yet
+            execute_prearranged_upload('some-file', make_credentials(expires_in=60), auth=SOME_AUTH,
+                                       refresh_credentials=mock_refresh)
+            assert mock_refresh.call_count == 1
+            assert mock_aws_call.call_args.kwargs['env']['AWS_ACCESS_KEY_ID'] == 'new-access-key'
+        assert "Upload credentials for some-file are about to expire. Getting new ones." in shown.lines
+
+    with shown_output() as shown:
+        with mock.patch.object(submission_module, "UPLOAD_ENGINE", UploadEngine.BOTO3):
+            with mock.patch.object(submission_module, "upload_file_to_s3") as mock_upload_file_to_s3:
+                execute_prearranged_upload('some-file', refreshed, auth=SOME_AUTH,
+                                           refresh_credentials=mock_refresh)
+                mock_upload_file_to_s3.assert_called_with('some-file', refreshed, s3_encrypt_key_id=mock.ANY,
+                                                          refresh_credentials=mock_refresh,
+                                                          tuner=s3_upload_module.UPLOAD_TUNER, check_md5=None)
+                mock_upload_file_to_s3.side_effect = ValueError("Bad things happened.")
+                with raises_regexp(RuntimeError, "Upload failed. ValueError: Bad things happened."):
+                    execute_prearranged_upload('some-file', refreshed, auth=SOME_AUTH)
+        assert shown.lines[0] == f"Uploading local file some-file directly (in-process) to: {SOME_UPLOAD_URL}"
+
+
+def test_cli_upload_outlasts_credentials(tmp_path):
+
+    path = str(tmp_path / "f1.fastq.gz")
+    with open(path, 'wb') as fp:
+        fp.write(b"x" * 100_000)
+    credentials = make_credentials(expires_in=3600)  # less the margin, good for 2700 seconds of uploading
+
+    def outlasts(credentials, limit=None, observed=None):
+        with mock.patch.object(submission_module.BANDWIDTH_LIMITER, "transfer_rate", return_value=limit):
+            with mock.patch.object(submission_module.UPLOAD_LEDGER, "observed_throughput", return_value=observed):
+                return cli_upload_outlasts_credentials(path, credentials, server=SOME_AUTH['server'])
+
+    assert not outlasts(credentials)  # There's nothing to go by.
+    assert not outlasts(make_credentials(), observed=1)  # There's no telling when they expire.
+    assert outlasts(credentials, observed=10)  # 10,000 seconds
+    assert not outlasts(credentials, observed=1000)  # 100 seconds
+    assert outlasts(credentials, limit=10, observed=1000)  # The lower rate is gone by.
+    assert not outlasts(credentials, limit=1000)
+
+
+def test_execute_prearranged_upload_in_process_when_credentials_would_expire():
+
+    refreshed = make_credentials(expires_in=3600, name='new')
+    mock_refresh = mock.MagicMock(return_value=refreshed)
+    credentials = make_credentials(expires_in=3600)
+
+    with mock.patch("subprocess.call", return_value=0) as mock_aws_call:
+        with mock.patch.object(submission_module, "upload_file_to_s3") as mock_upload_file_to_s3:
+            with mock.patch.object(submission_module, "cli_upload_outlasts_credentials", return_value=True):
+                with shown_output() as shown:
+                    execute_prearranged_upload('some-file', credentials, auth=SOME_AUTH,
+                                               refresh_credentials=mock_refresh)
+                    assert shown.lines[0] == (f"Uploading local file some-file directly (in-process) to:"
+                                              f" {SOME_UPLOAD_URL}, since it's expected to take longer than its"
+                                              f" upload credentials last, and the AWS CLI couldn't renew them.")
+                mock_upload_file_to_s3.assert_called_once_with('some-file', credentials, s3_encrypt_key_id=mock.ANY,
+                                                               refresh_credentials=mock_refresh,
+                                                               tuner=s3_upload_module.UPLOAD_TUNER, check_md5=None)
+                assert mock_aws_call.call_count == 0
+                with shown_output():  # Credentials that can't be renewed are no better in-process.
+                    execute_prearranged_upload('some-file', credentials, auth=SOME_AUTH)
+                assert mock_upload_file_to_s3.call_count == 1 and mock_aws_call.call_count == 1
+
+
+def test_execute_prearranged_upload_again_when_credentials_expire():
+
+    refreshed = make_credentials(expires_in=3600, name='new')
+    mock_refresh = mock.MagicMock(return_value=refreshed)
+
+    with mock.patch("subprocess.call", return_value=1) as mock_aws_call:  # The AWS CLI fails.
+        with mock.patch.object(submission_module, "upload_file_to_s3") as mock_upload_file_to_s3:
+            # The credentials are good when the upload starts, but have expired by the time it fails.
+            with mock.patch.object(submission_module, "credentials_expire_soon", side_effect=[False, True]):
+                with shown_output() as shown:
+                    execute_prearranged_upload('some-file', make_credentials(expires_in=3600), auth=SOME_AUTH,
+                                               refresh_credentials=mock_refresh)
+                    assert ("The upload credentials for some-file expired while the AWS CLI was uploading it."
+                            " Uploading it again, directly (in-process), with new credentials that will be renewed"
+                            " as needed.") in shown.lines
+            assert mock_aws_call.call_count == 1
+            mock_upload_file_to_s3.assert_called_once_with('some-file', refreshed, s3_encrypt_key_id=mock.ANY,
+                                                           refresh_credentials=mock_refresh,
+                                                           tuner=s3_upload_module.UPLOAD_TUNER, check_md5=None)
+            # If they haven't expired, the upload failed for some other reason, and isn't tried again.
+            with mock.patch.object(submission_module, "credentials_expire_soon", side_effect=[False, False]):
+                with shown_output():
+                    with raises_regexp(RuntimeError, "Upload failed with exit code 1"):
+                        execute_prearranged_upload('some-file', make_credentials(expires_in=3600), auth=SOME_AUTH,
+                                                   refresh_credentials=mock_refresh)
+            assert mock_upload_file_to_s3.call_count == 1
+
+
+def test_execute_prearranged_upload_checks_md5():
+
+    check_md5 = mock.MagicMock(side_effect=ValueError("It does not match."))
+    with mock.patch.object(submission_module, "compute_file_md5", return_value='some-md5'):
+        with mock.patch("subprocess.call", return_value=0) as mock_aws_call:
+            with shown_output():
+                # The AWS CLI reads the file itself, so it's checked first, and not uploaded if it doesn't match.
+                with raises_regexp(ValueError, "does not match"):
+                    execute_prearranged_upload('some-file', make_credentials(), auth=SOME_AUTH, check_md5=check_md5)
+                check_md5.assert_called_once_with('some-md5')
+                assert mock_aws_call.call_count == 0
+                with mock.patch.object(submission_module, "UPLOAD_ENGINE", UploadEngine.BOTO3):
+                    with mock.patch.object(submission_module, "upload_file_to_s3") as mock_upload_file_to_s3:
+                        execute_prearranged_upload('some-file', make_credentials(), auth=SOME_AUTH,
+                                                   check_md5=check_md5)
+                        # Uploaded in-process, it's checked as it's read to be uploaded.
+                        assert mock_upload_file_to_s3.call_args.kwargs['check_md5'] is check_md5
+                        assert check_md5.call_count == 1
+
+
+@pytest.mark.parametrize("expires_in", [60, 3600])
+def test_upload_extra_files_refreshes_credentials(tmp_path, expires_in):
+
+    (tmp_path / "f1.bam.bai").write_text("bai")
+    extra_files_creds = [{'filename': 'f1.bam.bai', 'upload_credentials': make_credentials(expires_in=expires_in)}]
+    fresh_extra_files_creds = [{'filename': 'f1.bam.bai',
+                                'upload_credentials': make_credentials(expires_in=3600, name='new')}]
+    mock_refresh = mock.MagicMock(return_value=fresh_extra_files_creds)
+
+    with shown_output():
+        with mock.patch("subprocess.call", return_value=0) as mock_aws_call:
+            upload_extra_files(extra_files_creds, UploadMessageWrapper('some-uuid', no_query=True), str(tmp_path),
+                               SOME_AUTH, refresh_credentials=mock_refresh)
+            assert mock_refresh.call_count == (1 if expires_in < 900 else 0)
+            assert mock_aws_call.call_args.kwargs['env']['AWS_ACCESS_KEY_ID'] == (
+                'new-access-key' if expires_in < 900 else 'old-access-key')
@@ -1,10 +1,14 @@
 import contextlib
 import datetime
+import functools
+import hashlib
 import io
 import os
 import platform
 import pytest
 import re
+import threading
+import time
 
 from dcicutils.common import APP_CGAP, APP_FOURFRONT, APP_SMAHT
 from dcicutils.misc_utils import ignored, ignorable, local_attrs, override_environ, NamedObject
@@ -13,12 +17,14 @@ from dcicutils.s3_utils import HealthPageKey
 from typing import List, Dict
 from unittest import mock
 
+from .test_s3_upload import FakeS3Client, make_credentials
 from .test_utils import shown_output
 from .test_upload_item_data import TEST_ENCRYPT_KEY
 from .. import submission as submission_module
 from .. import utils as utils_module
 from ..base import PRODUCTION_SERVER, KEY_MANAGER
 from ..exceptions import CGAPPermissionError
+from ..s3_upload import upload_stream_to_s3
 from ..submission import (
     SERVER_REGEXP, PROGRESS_CHECK_INTERVAL, ATTEMPTS_BEFORE_TIMEOUT,
     get_defaulted_institution, get_defaulted_project, do_any_uploads, do_uploads, show_upload_info, show_upload_result,
@@ -33,6 +39,9 @@ from ..submission import (
     get_defaulted_lab, get_defaulted_award, SubmissionProtocol, compute_file_post_data,
     upload_file_to_new_uuid, compute_s3_submission_post_data, GENERIC_SCHEMA_TYPE, DEFAULT_APP, summarize_submission,
     get_defaulted_submission_centers, get_defaulted_consortia, do_app_arg_defaulting, check_submit_ingestion,
+    PreflightMode, check_upload_file, get_extra_file_names, preflight_uploads, is_stream_source, upload_stream_to_uuid,
+    upload_found_file, PlannedUpload, DEFAULT_UPLOAD_PREFETCH_COUNT,
+    _compute_upload_prefetch_count,  # noQA - again, testing a protected member
 )
 from ..utils import FakeResponse, script_catch_errors, ERROR_HERALD
 
@@ -430,6 +439,12 @@ def test_ingestion_submission_item_url():
         uuid='123-4567-890'
     ) == 'http://foo.com/ingestion-submissions/123-4567-890?format=json'
 
+    assert ingestion_submission_item_url(
+        server='http://foo.com',
+        uuid='123-4567-890',
+        fields=['processing_status', 'uuid']
+    ) == 'http://foo.com/ingestion-submissions/123-4567-890?format=json&frame=object&field=processing_status&field=uuid'
+
 
 def test_show_upload_info():
 
@@ -743,7 +758,13 @@ def test_do_any_uploads():
                     auth=SOME_KEYDICT,
                     folder=SOME_BUNDLE_FILENAME_FOLDER,  # the folder part of given SOME_BUNDLE_FILENAME
                     no_query=False,
-                    subfolders=False
+                    subfolders=False,
+                    file_index=None,
+                    submission_uuid=None,
+                    preflight=None,
+                    check_formats=None,
+                    md5_manifests=None,
+                    md5_mismatch=None
                 )
                 assert shown.lines == []
 
@@ -759,7 +780,13 @@ def test_do_any_uploads():
                     auth=SOME_KEYDICT,
                     folder=SOME_OTHER_BUNDLE_FOLDER,  # passed straight through
                     no_query=False,
-                    subfolders=False
+                    subfolders=False,
+                    file_index=None,
+                    submission_uuid=None,
+                    preflight=None,
+                    check_formats=None,
+                    md5_manifests=None,
+                    md5_mismatch=None
                 )
                 assert shown.lines == []
 
@@ -775,7 +802,13 @@ def test_do_any_uploads():
                     auth=SOME_KEYDICT,
                     folder=None,  # No folder
                     no_query=False,
-                    subfolders=False
+                    subfolders=False,
+                    file_index=None,
+                    submission_uuid=None,
+                    preflight=None,
+                    check_formats=None,
+                    md5_manifests=None,
+                    md5_mismatch=None
                 )
                 assert shown.lines == []
 
@@ -792,7 +825,13 @@ def test_do_any_uploads():
                     auth=SOME_KEYDICT,
                     folder=SOME_BUNDLE_FILENAME_FOLDER,  # the folder part of given SOME_BUNDLE_FILENAME
                     no_query=False,
-                    subfolders=True
+                    subfolders=True,
+                    file_index=None,
+                    submission_uuid=None,
+                    preflight=None,
+                    check_formats=None,
+                    md5_manifests=None,
+                    md5_mismatch=None
                 )
                 assert shown.lines == []
 
@@ -812,7 +851,13 @@ def test_do_any_uploads():
                 auth=SOME_KEYDICT,
                 folder=SOME_BUNDLE_FILENAME_FOLDER,  # the folder part of given SOME_BUNDLE_FILENAME
                 no_query=True,
-                subfolders=False
+                subfolders=False,
+                file_index=None,
+                submission_uuid=None,
+                preflight=None,
+                check_formats=None,
+                md5_manifests=None,
+                md5_mismatch=None
             )
             assert shown.lines == []
 
@@ -833,7 +878,11 @@ def test_resume_uploads():
                             ingestion_filename=SOME_BUNDLE_FILENAME,
                             upload_folder=None,
                             no_query=False,
-                            subfolders=False
+                            subfolders=False,
+                            preflight=None,
+                            check_formats=None,
+                            md5_manifests=None,
+                            md5_mismatch=None
                         )
 
     with mock.patch.object(utils_module, "script_catch_errors", script_dont_catch_errors):
@@ -1013,7 +1062,8 @@ def test_upload_file_to_uuid():
             metadata = upload_file_to_uuid(filename=SOME_FILENAME, uuid=SOME_UUID, auth=SOME_AUTH)
             assert metadata == SOME_FILE_METADATA
             mocked_upload.assert_called_with(SOME_FILENAME, auth=SOME_AUTH,
-                                             upload_credentials=SOME_UPLOAD_CREDENTIALS)
+                                             upload_credentials=SOME_UPLOAD_CREDENTIALS,
+                                             refresh_credentials=mock.ANY, check_md5=None)
 
     with mock.patch("dcicutils.ff_utils.patch_metadata", return_value=SOME_BAD_RESULT):
         with mock.patch.object(submission_module, "execute_prearranged_upload") as mocked_upload:
@@ -1263,10 +1313,109 @@ def test_do_uploads(tmp_path):
                         mocked_instance,
                         folder,
                         SOME_AUTH,
-                        recursive=False
+                        recursive=False,
+                        file_index=None,
+                        refresh_credentials=mock.ANY,
+                        check_formats=False,
+                        md5_manifests=None,
+                        md5_mismatch='block',
                     )
 
 
+@pytest.mark.parametrize("backend", ["serial", "threads"])
+def test_do_uploads_result(tmp_path, backend):
+    for name in ["f1.fastq.gz", "f2.bam", "bad.fastq.gz", "sub1/twice.bam", "sub2/twice.bam"]:
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_bytes(b"data")
+    extra_files_creds = [{'filename': 'f2.bam.bai', 'upload_credentials': {'key': 'f2.bam.bai'}}]
+
+    def mocked_upload_file_to_uuid(filename, uuid, auth):
+        ignored(auth)
+        if filename.endswith("bad.fastq.gz") or not os.path.exists(filename):
+            raise RuntimeError("Upload failed with exit code 1")
+        return {'uuid': uuid, 'extra_files_creds': extra_files_creds if filename.endswith(".bam") else []}
+
+    def uploads_succeeded(*file_names, no_query=True):
+        upload_spec_list = [{'uuid': f'uuid-{i}', 'filename': file_name} for i, file_name in enumerate(file_names)]
+        with shown_output():
+            return do_uploads(upload_spec_list, auth=SOME_KEYDICT, folder=str(tmp_path), no_query=no_query,
+                              subfolders=True)
+
+    # The result doesn't depend on the upload ledger, which isn't always kept.
+    with mock.patch.object(submission_module.UPLOAD_LEDGER, "enabled", False):
+        with mock.patch.object(submission_module, "UPLOAD_BACKEND", backend):
+            with mock.patch.object(submission_module, "upload_file_to_uuid", side_effect=mocked_upload_file_to_uuid):
+                with mock.patch.object(submission_module, "execute_prearranged_upload",
+                                       side_effect=lambda path, *args, **kwargs: open(path).close()):
+                    assert uploads_succeeded("f1.fastq.gz") is True
+                    assert uploads_succeeded("f1.fastq.gz", "bad.fastq.gz") is False  # An upload failed.
+                    assert uploads_succeeded("f1.fastq.gz", "missing.fastq.gz") is False  # A file wasn't found.
+                    assert uploads_succeeded("f1.fastq.gz", "twice.bam") is False  # A file was found twice.
+                    assert uploads_succeeded("f2.bam") is False  # Its extra file wasn't found.
+                    (tmp_path / "f2.bam.bai").write_bytes(b"index")
+                    assert uploads_succeeded("f2.bam") is True
+                    with mock.patch.object(submission_module, "CGAP_SELECTIVE_UPLOADS", True):
+                        with mock.patch.object(submission_module, "yes_or_no", return_value=False):
+                            assert uploads_succeeded("f1.fastq.gz", no_query=False) is False  # It was declined.
+
+
+@pytest.mark.parametrize("prefetch_count", [1, 3])
+def test_do_uploads_prefetches_upload_metadata(tmp_path, prefetch_count):
+
+    n_files = 6
+    upload_spec_list = []
+    for i in range(n_files):
+        (tmp_path / f"f{i}.fastq.gz").write_text(f"file {i}")
+        upload_spec_list.append({'uuid': f'uuid-{i}', 'filename': f'f{i}.fastq.gz'})
+    requested = []
+    requested_lock = threading.Lock()
+    all_requested = threading.Condition(requested_lock)
+
+    def mocked_get_upload_metadata(filename, uuid, auth):
+        assert auth == SOME_AUTH
+        with all_requested:
+            requested.append(uuid)
+            all_requested.notify_all()
+        return {'uuid': uuid, 'upload_credentials': {'upload_url': os.path.basename(filename)}}
+
+    def mocked_execute_prearranged_upload(path, upload_credentials, auth, refresh_credentials, check_md5):
+        ignored(auth, refresh_credentials)
+        position = int(upload_credentials['upload_url'][1])
+        assert path.endswith(upload_credentials['upload_url'])
+        # While this file is uploading, credentials for the next prefetch_count files are being gotten.
+        expected = {f'uuid-{i}' for i in range(min(position + prefetch_count, n_files - 1) + 1)}
+        with all_requested:
+            assert all_requested.wait_for(lambda: expected <= set(requested), timeout=10)
+            assert len(requested) == len(expected)  # But no more than that
+
+    with mock.patch.object(submission_module, "UPLOAD_PREFETCH_COUNT", prefetch_count):
+        with mock.patch.object(submission_module, "get_upload_metadata", mocked_get_upload_metadata):
+            with mock.patch.object(submission_module, "execute_prearranged_upload",
+                                   side_effect=mocked_execute_prearranged_upload) as mock_execute_prearranged_upload:
+                with shown_output() as shown:
+                    do_uploads(upload_spec_list, auth=SOME_AUTH, folder=str(tmp_path), no_query=True)
+                    assert mock_execute_prearranged_upload.call_count == n_files
+                    assert [line for line in shown.lines if "successful" in line] == [
+                        f"Upload of {tmp_path}/f{i}.fastq.gz to item uuid-{i} was successful." for i in range(n_files)
+                    ]
+    assert sorted(requested) == sorted(spec['uuid'] for spec in upload_spec_list)  # Each requested just once
+
+
+def test_compute_upload_prefetch_count():
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_PREFETCH_COUNT": "2"}):
+        assert _compute_upload_prefetch_count() == 2
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_PREFETCH_COUNT": "0"}):
+        assert _compute_upload_prefetch_count() == 0
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_PREFETCH_COUNT": ""}):
+        assert _compute_upload_prefetch_count() == DEFAULT_UPLOAD_PREFETCH_COUNT
+    for bad_value in ["four", "-1"]:
+        with mock.patch.dict(os.environ, {"SUBMITCGAP_PREFETCH_COUNT": bad_value}):
+            with mock.patch.object(submission_module, "PRINT") as mock_print:
+                assert _compute_upload_prefetch_count() == DEFAULT_UPLOAD_PREFETCH_COUNT
+                assert mock_print.call_count == 1
+                assert mock_print.call_args[0][0].startswith(f"Ignoring SUBMITCGAP_PREFETCH_COUNT={bad_value!r}.")
+
+
 def test_upload_item_data():
 
     with mock.patch.object(submission_module, "resolve_server", return_value=SOME_SERVER) as mock_resolve:
@@ -1314,6 +1463,67 @@ def test_upload_item_data():
                 mock_upload.assert_called_with(filename=SOME_FILENAME, uuid=SOME_UUID, auth=SOME_KEYDICT)
 
 
+def test_is_stream_source(tmp_path):
+    os.mkfifo(tmp_path / "pipe")
+    (tmp_path / "file.bam").write_bytes(b"data")
+    assert is_stream_source("-")
+    assert is_stream_source(str(tmp_path / "pipe"))
+    assert not is_stream_source(str(tmp_path / "file.bam"))
+    assert not is_stream_source(str(tmp_path / "missing.bam"))
+
+
+def test_upload_item_data_from_stream():
+
+    with mock.patch.object(submission_module, "resolve_server", return_value=SOME_SERVER):
+        with mock.patch.object(KEY_MANAGER, "get_keydict_for_server", return_value=SOME_KEYDICT):
+            with mock.patch.object(submission_module, "upload_stream_to_uuid") as mock_upload_stream:
+                with mock.patch.object(submission_module, "upload_file_to_uuid") as mock_upload:
+
+                    upload_item_data(item_filename='-', uuid=SOME_UUID, server=SOME_SERVER, env=SOME_ENV,
+                                     no_query=True, file_name='some.bam')
+                    mock_upload_stream.assert_called_with('-', uuid=SOME_UUID, auth=SOME_KEYDICT, file_name='some.bam')
+                    assert mock_upload.call_count == 0
+
+                    with shown_output() as shown:
+                        with pytest.raises(SystemExit):
+                            upload_item_data(item_filename='-', uuid=SOME_UUID, server=SOME_SERVER, env=SOME_ENV)
+                        assert shown.lines == ["Data read from standard input can only be uploaded with no_query."]
+                    assert mock_upload_stream.call_count == 1
+
+
+def test_upload_stream_to_uuid(tmp_path):
+    data = os.urandom(5000)
+    pipe = str(tmp_path / "sample.bam")
+    os.mkfifo(pipe)
+
+    def write_to_pipe():
+        with open(pipe, 'wb') as fp:
+            for start in range(0, len(data), 700):
+                fp.write(data[start:start + 700])
+                fp.flush()
+
+    client = FakeS3Client()
+    writer = threading.Thread(target=write_to_pipe)
+    writer.start()
+    with mock.patch.object(submission_module, "get_upload_metadata",
+                           return_value={'upload_credentials': make_credentials()}) as mock_get_upload_metadata:
+        with mock.patch.object(submission_module, "upload_stream_to_s3",
+                               functools.partial(upload_stream_to_s3, s3_client=client)):
+            with mock.patch.object(submission_module, "UPLOAD_TUNER", None):
+                with mock.patch("submit_cgap.s3_upload.MULTIPART_CHUNK_SIZE", 1000):
+                    with shown_output() as shown:
+                        upload_stream_to_uuid(pipe, uuid=SOME_UUID, auth=SOME_KEYDICT)
+                        assert shown.lines[0] == (f"Uploading sample.bam, read from {pipe} as it's written,"
+                                                  f" directly (in-process) to: s3://some-bucket/some/key.fastq.gz")
+                        assert f"Uploaded 5000 bytes (md5 {hashlib.md5(data).hexdigest()})." in shown.lines
+    writer.join()
+    mock_get_upload_metadata.assert_called_with(filename='sample.bam', uuid=SOME_UUID, auth=SOME_KEYDICT)
+    assert client.objects[('some-bucket', 'some/key.fastq.gz')] == data
+    assert len(client.parts) == 5
+    with raises_regexp(ValueError, "A file name must be given"):
+        upload_stream_to_uuid('-', uuid=SOME_UUID, auth=SOME_KEYDICT)
+
+
 def get_today_datetime_for_time(time_to_use):
     today = datetime.date.today()
     time = datetime.time.fromisoformat(time_to_use)
@@ -1546,8 +1756,13 @@ def test_submit_any_ingestion_old_protocol(mock_get_health_page):
                         {'@id': SOME_INSTITUTION}
                     ]
                 ))
+            elif url.endswith('/ingestion-submissions/' + SOME_UUID + "?format=json"):
+                # The full document is fetched only once processing is done.
+                return FakeResponse(200, json=responses[-1])
             else:
-                assert url.endswith('/ingestion-submissions/' + SOME_UUID + "?format=json")
+                # Polls for progress ask only for the status.
+                assert url.endswith('/ingestion-submissions/' + SOME_UUID
+                                    + "?format=json&frame=object&field=processing_status")
                 return FakeResponse(200, json=response_maker())
         return mocked_get
 
@@ -1632,7 +1847,12 @@ def test_submit_any_ingestion_old_protocol(mock_get_health_page):
                                                             keydict=SOME_KEYDICT,
                                                             upload_folder=None,
                                                             no_query=False,
-                                                            subfolders=False
+                                                            subfolders=False,
+                                                            file_index=None,
+                                                            preflight=None,
+                                                            check_formats=None,
+                                                            md5_manifests=None,
+                                                            md5_mismatch=None
                                                         )
         assert shown.lines == Scenario.make_successful_submission_lines(get_request_attempts)
 
@@ -1690,7 +1910,12 @@ def test_submit_any_ingestion_old_protocol(mock_get_health_page):
                                                             keydict=SOME_KEYDICT,
                                                             upload_folder=None,
                                                             no_query=False,
-                                                            subfolders=False
+                                                            subfolders=False,
+                                                            file_index=None,
+                                                            preflight=None,
+                                                            check_formats=None,
+                                                            md5_manifests=None,
+                                                            md5_mismatch=None
                                                         )
         assert shown.lines == Scenario.make_successful_submission_lines(get_request_attempts)
 
@@ -1738,7 +1963,12 @@ def test_submit_any_ingestion_old_protocol(mock_get_health_page):
                                                         keydict=SOME_KEYDICT,
                                                         upload_folder=None,
                                                         no_query=True,
-                                                        subfolders=False
+                                                        subfolders=False,
+                                                        file_index=None,
+                                                        preflight=None,
+                                                        check_formats=None,
+                                                        md5_manifests=None,
+                                                        md5_mismatch=None
                                                     )
         assert shown.lines == Scenario.make_successful_submission_lines(get_request_attempts)
 
@@ -2112,8 +2342,13 @@ def test_submit_any_ingestion_new_protocol(mock_get_health_page):
                         {'@id': SOME_INSTITUTION}
                     ]
                 ))
+            elif url.endswith('/ingestion-submissions/' + SOME_UUID + "?format=json"):
+                # The full document is fetched only once processing is done.
+                return FakeResponse(200, json=responses[-1])
             else:
-                assert url.endswith('/ingestion-submissions/' + SOME_UUID + "?format=json")
+                # Polls for progress ask only for the status.
+                assert url.endswith('/ingestion-submissions/' + SOME_UUID
+                                    + "?format=json&frame=object&field=processing_status")
                 return FakeResponse(200, json=response_maker())
         return mocked_get
 
@@ -2199,7 +2434,12 @@ def test_submit_any_ingestion_new_protocol(mock_get_health_page):
                                                             keydict=SOME_KEYDICT,
                                                             upload_folder=None,
                                                             no_query=False,
-                                                            subfolders=False)
+                                                            subfolders=False,
+                                                            file_index=None,
+                                                            preflight=None,
+                                                            check_formats=None,
+                                                            md5_manifests=None,
+                                                            md5_mismatch=None)
         assert shown.lines == Scenario.make_successful_submission_lines(get_request_attempts)
 
     dt.reset_datetime()
@@ -2273,7 +2513,12 @@ def test_submit_any_ingestion_new_protocol(mock_get_health_page):
                                                                 keydict=SOME_KEYDICT,
                                                                 upload_folder=None,
                                                                 no_query=False,
-                                                                subfolders=False)
+                                                                subfolders=False,
+                                                                file_index=None,
+                                                                preflight=None,
+                                                                check_formats=None,
+                                                                md5_manifests=None,
+                                                                md5_mismatch=None)
         assert shown.lines == Scenario.make_successful_submission_lines(get_request_attempts)
 
     dt.reset_datetime()
@@ -2840,6 +3085,65 @@ def test_submit_any_ingestion():
                 pass  # in this case, it also means pass the test
 
 
+def test_submit_any_ingestion_presubmission_steps():
+
+    print()  # start on a fresh line
+
+    events = []
+
+    def mocked_get(url, auth, **kwargs):
+        ignored(kwargs)
+        assert auth == SOME_AUTH
+        assert url.endswith("/me?format=json")
+        events.append('me')
+        return FakeResponse(200, json=make_user_record())
+
+    def mocked_health_page(key):
+        assert key == SOME_KEYDICT
+        events.append('health')
+        return {'metadata_bundles_bucket': 'some-bucket'}
+
+    def mocked_yes_or_no(prompt):
+        ignored(prompt)
+        # Give the network requests a chance to get started while the user is being asked.
+        for _ in range(100):
+            if len(events) == 2:
+                break
+            time.sleep(0.01)
+        events.append('answered')
+        return False
+
+    with mock.patch.object(submission_module, "resolve_server", return_value=SOME_SERVER):
+        with mock.patch.object(KEY_MANAGER, "get_keydict_for_server", return_value=SOME_KEYDICT):
+            with mock.patch.object(submission_module, "get_health_page", mocked_health_page):
+                with mock.patch("requests.get", mocked_get):
+                    with mock.patch.object(submission_module, "yes_or_no", mocked_yes_or_no):
+
+                        with shown_output() as shown:
+                            with pytest.raises(SystemExit):
+                                submit_any_ingestion(SOME_BUNDLE_FILENAME, ingestion_type=SOME_INGESTION_TYPE,
+                                                     server=SOME_SERVER, env=None, validate_only=False,
+                                                     institution=SOME_INSTITUTION, project=SOME_PROJECT)
+                            # The network requests overlapped the query, but their output did not.
+                            assert sorted(events[:2]) == ['health', 'me']
+                            assert events[2:] == ['answered']
+                            assert shown.lines == ["Aborting submission."]
+
+                        events = []
+
+                        def mocked_verifier(filename):
+                            assert filename == SOME_BUNDLE_FILENAME
+                            raise ValueError("Bad file content.")
+
+                        # A verifier's complaint is raised before the user is asked anything.
+                        with pytest.raises(ValueError, match="Bad file content"):
+                            submit_any_ingestion(SOME_BUNDLE_FILENAME, ingestion_type=SOME_INGESTION_TYPE,
+                                                 server=SOME_SERVER, env=None, validate_only=False,
+                                                 institution=SOME_INSTITUTION, project=SOME_PROJECT,
+                                                 ingestion_file_verifier=mocked_verifier)
+                        assert 'answered' not in events
+
+
 def test_get_defaulted_lab():
 
     assert get_defaulted_lab(lab=SOME_LAB, user_record='does-not-matter') == SOME_LAB
@@ -3245,3 +3549,182 @@ def test_check_ingestion_progress():
                 expect_done=True, expect_short_status='indexed')
         test_it({'processing_status': {'state': 'done'}},
                 expect_done=True, expect_short_status=None)
+
+
+def test_check_ingestion_progress_polls_lightly():
+
+    full_url = ingestion_submission_item_url(server='some-server', uuid='some-uuid')
+    status_url = ingestion_submission_item_url(server='some-server', uuid='some-uuid', fields=['processing_status'])
+    working = {'processing_status': {'state': 'started', 'progress': 'working'}}
+    done = {'processing_status': {'state': 'done', 'outcome': 'success'}}
+    full_done = dict(done, additional_data={'upload_info': SOME_UPLOAD_INFO})
+
+    requests_seen = []
+
+    def make_mocked_get(*status_responses):
+        status_responses = list(status_responses)
+
+        def mocked_get(url, auth, headers):
+            assert auth == 'some-keypair'
+            requests_seen.append((url, headers.get('If-None-Match')))
+            if url == full_url:
+                return FakeResponse(200, json=full_done)
+            assert url == status_url
+            assert 'gzip' in headers['Accept-Encoding']
+            return status_responses.pop(0)
+        return mocked_get
+
+    poll_state = {}
+    with mock.patch("requests.get", make_mocked_get(FakeResponse(200, json=working, headers={'ETag': '"v1"'}),
+                                                    FakeResponse(304, headers={'ETag': '"v1"'}),
+                                                    FakeResponse(200, json=done, headers={'ETag': '"v2"'}))):
+
+        def check():
+            return _check_ingestion_progress('some-uuid', keypair='some-keypair', server='some-server',
+                                             poll_state=poll_state)
+
+        assert check() == (False, 'working', working)
+        assert check() == (False, 'working', working)  # The 304 reuses what was seen before
+        assert check() == (True, 'success', full_done)  # Once done, the full document is fetched
+        assert requests_seen == [
+            (status_url, None),
+            (status_url, '"v1"'),
+            (status_url, '"v1"'),
+            (full_url, None),
+        ]
+
+
+def test_check_upload_file(tmp_path):
+
+    (tmp_path / "good.fastq.gz").write_bytes(b"data")
+    (tmp_path / "empty.fastq.gz").write_bytes(b"")
+    (tmp_path / "folder.fastq.gz").mkdir()
+    (tmp_path / "sub1").mkdir()
+    (tmp_path / "sub2").mkdir()
+    (tmp_path / "sub1" / "twice.bam").write_bytes(b"data")
+    (tmp_path / "sub2" / "twice.bam").write_bytes(b"data")
+    folder = str(tmp_path)
+
+    entry = check_upload_file('uuid-1', 'good.fastq.gz', folder)
+    assert (entry.path, entry.size, entry.problem) == (str(tmp_path / "good.fastq.gz"), 4, None)
+    assert check_upload_file('uuid-1', 'empty.fastq.gz', folder).problem == "It is empty."
+    assert check_upload_file('uuid-1', 'folder.fastq.gz', folder).problem == "It is not a regular file."
+    assert check_upload_file('uuid-1', 'missing.cram', folder).problem == f"No file by that name was found in {folder}."
+    entry = check_upload_file('uuid-1', 'twice.bam', os.path.join(folder, '**'), recursive=True)
+    assert entry.path is None
+    assert entry.problem.startswith(f"No upload attempted for file twice.bam because multiple copies were found"
+                                    f" in folder {folder}/**: ")
+    assert f"{folder}/sub1/twice.bam" in entry.problem and f"{folder}/sub2/twice.bam" in entry.problem
+    # Whatever the search for the file reports (e.g., about tar archives, or the source of a file to be compressed)
+    # is reported as the problem.
+    with mock.patch.object(submission_module, "find_upload_file", return_value=(None, "Some search problem.")):
+        assert check_upload_file('uuid-1', 'good.fastq.gz', folder).problem == "Some search problem."
+    with mock.patch("builtins.open", side_effect=PermissionError("Permission denied")):
+        assert check_upload_file('uuid-1', 'good.fastq.gz', folder).problem == (
+            "It could not be read. PermissionError: Permission denied")
+
+
+def test_get_extra_file_names():
+
+    extra_files = [{'filename': 'f1.bam.bai', 'file_format': 'bai'}, {'file_format': 'tbi'}]
+    with mock.patch.object(submission_module, "portal_request_get",
+                           return_value=FakeResponse(200, json={'extra_files': extra_files})) as mock_get:
+        assert get_extra_file_names('uuid-1', SOME_KEYDICT) == ['f1.bam.bai']
+        mock_get.assert_called_once_with(f"{SOME_SERVER}/uuid-1?format=json&frame=object&field=extra_files",
+                                         auth=(SOME_KEY_ID, SOME_SECRET), headers=mock.ANY)
+    with mock.patch.object(submission_module, "portal_request_get", return_value=FakeResponse(200, json={})):
+        assert get_extra_file_names('uuid-1', SOME_KEYDICT) == []
+
+
+def make_preflight_files(tmp_path):
+    (tmp_path / "f1.bam").write_bytes(b"x" * 1000)
+    (tmp_path / "f1.bam.bai").write_bytes(b"x" * 10)
+    (tmp_path / "f2.fastq.gz").write_bytes(b"x" * 500)
+    return [{'uuid': 'uuid-1', 'filename': 'f1.bam'}, {'uuid': 'uuid-2', 'filename': 'f2.fastq.gz'},
+            {'uuid': 'uuid-3', 'filename': 'f3.cram'}]
+
+
+def mocked_get_extra_file_names(uuid, auth):
+    assert auth == SOME_KEYDICT
+    if uuid == 'uuid-3':
+        raise RuntimeError("Server error.")
+    return {'uuid-1': ['f1.bam.bai', 'f1.bam.crai']}.get(uuid, [])
+
+
+def test_preflight_uploads(tmp_path):
+
+    upload_spec_list = make_preflight_files(tmp_path)
+    with mock.patch.object(submission_module, "get_extra_file_names", mocked_get_extra_file_names):
+        entries = preflight_uploads(upload_spec_list, auth=SOME_KEYDICT, folder=str(tmp_path))
+    assert [(entry.uuid, entry.file_name, entry.size, entry.extra_file, entry.problem) for entry in entries] == [
+        ('uuid-1', 'f1.bam', 1000, False, None),
+        ('uuid-1', 'f1.bam.bai', 10, True, None),
+        ('uuid-1', 'f1.bam.crai', None, True, f"No file by that name was found in {tmp_path}."),
+        ('uuid-2', 'f2.fastq.gz', 500, False, None),
+        ('uuid-3', 'f3.cram', None, False, f"No file by that name was found in {tmp_path}."),
+        ('uuid-3', '(extra files)', None, True, "They could not be looked up. RuntimeError: Server error."),
+    ]
+
+
+@pytest.mark.parametrize("mode, no_query, answer, expect_uploads", [
+    (PreflightMode.STRICT, True, None, False),
+    (PreflightMode.CHECK, False, False, False),
+    (PreflightMode.CHECK, False, True, True),
+    (PreflightMode.CHECK, True, None, True),
+])
+@pytest.mark.parametrize("from_environment", [False, True])
+def test_do_uploads_preflight(tmp_path, mode, no_query, answer, expect_uploads, from_environment):
+
+    upload_spec_list = make_preflight_files(tmp_path)
+    with mock.patch.object(submission_module, "PREFLIGHT_MODE", mode if from_environment else PreflightMode.OFF):
+        with mock.patch.object(submission_module, "get_extra_file_names", mocked_get_extra_file_names):
+            with mock.patch.object(submission_module, "yes_or_no", return_value=answer) as mock_yes_or_no:
+                with mock.patch.object(submission_module, "upload_file_to_uuid",
+                                       return_value={}) as mock_upload_file_to_uuid:
+                    with shown_output() as shown:
+                        do_uploads(upload_spec_list, auth=SOME_KEYDICT, folder=str(tmp_path), no_query=no_query,
+                                   preflight=None if from_environment else mode)
+                        assert shown.lines[:9] == [
+                            "Upload plan: 3 files (1 extra), 0.0 MB in all.",
+                            f"  {tmp_path}/f1.bam (0.0 MB) for item uuid-1",
+                            f"  {tmp_path}/f1.bam.bai [extra file] (0.0 MB) for item uuid-1",
+                            f"  {tmp_path}/f2.fastq.gz (0.0 MB) for item uuid-2",
+                            "Problems found with 3 files:",
+                            f"  f1.bam.crai [extra file] for item uuid-1:"
+                            f" No file by that name was found in {tmp_path}.",
+                            f"  f3.cram for item uuid-3: No file by that name was found in {tmp_path}.",
+                            "  (extra files) [extra file] for item uuid-3: They could not be looked up."
+                            " RuntimeError: Server error.",
+                            ("No uploads attempted, because of the problems found." if mode == PreflightMode.STRICT
+                             else "No uploads attempted." if not expect_uploads
+                             else mock.ANY),
+                        ]
+                    assert mock_yes_or_no.call_count == (0 if no_query or mode == PreflightMode.STRICT else 1)
+                    assert bool(mock_upload_file_to_uuid.call_count) == expect_uploads
+
+
+def test_planned_upload(tmp_path):
+    path = tmp_path / "a.fastq.gz"
+    path.write_bytes(b"some data")
+    planned = PlannedUpload('uuid-a', file_path=str(path))
+    assert planned.uploading and planned.checkable and planned.message is None
+    missing = PlannedUpload('uuid-b', file_path=str(tmp_path / "b.fastq.gz"))
+    assert missing.uploading and not missing.checkable  # It fails to upload, as a missing file always has.
+    blocked = planned._replace(error_msg="No upload attempted.")
+    assert not blocked.uploading and not blocked.checkable and blocked.message == "No upload attempted."
+    skipped = PlannedUpload('uuid-a', skip_msg="Skipping a.fastq.gz.")
+    assert not skipped.uploading and skipped.error_msg is None and skipped.message == "Skipping a.fastq.gz."
+
+
+def test_upload_found_file(tmp_path, isolated_upload_ledger):
+    path = tmp_path / "a.fastq.gz"
+    path.write_bytes(b"some data")
+    auth = {'key': 'my-key-id', 'secret': 'good-secret', 'server': 'http://localhost:7777'}
+    with mock.patch.object(submission_module, "upload_file_to_uuid", return_value={}) as mock_upload:
+        with shown_output():
+            assert upload_found_file('uuid-a', str(path), auth=auth, folder=str(tmp_path), submission_uuid='sub-1')
+    mock_upload.assert_called_once_with(filename=str(path), uuid='uuid-a', auth=auth)
+    assert isolated_upload_ledger.is_complete('http://localhost:7777', 'sub-1', 'uuid-a')
+    with mock.patch.object(submission_module, "upload_file_to_uuid", side_effect=RuntimeError("oops")):
+        with shown_output():
+            assert not upload_found_file('uuid-a', str(path), auth=auth)
@@ -0,0 +1,205 @@
+import hashlib
+import io
+import os
+import pytest
+import tarfile
+
+from dcicutils.qa_utils import raises_regexp
+from unittest import mock
+
+from .test_s3_upload import FakeS3Client, make_credentials
+from .test_utils import shown_output
+from .. import s3_upload as s3_upload_module
+from .. import submission as submission_module
+from .. import tar_sources as tar_sources_module
+from ..s3_upload import upload_stream_to_s3
+from ..submission import check_upload_file, do_uploads, execute_prearranged_upload, find_upload_file
+from ..tar_sources import (
+    TarStreams, _compute_tar_sources, find_tar_member, read_tar_members, stream_order, tar_member, upload_tar_member,
+)
+
+
+SOME_AUTH = {'key': 'my-key-id', 'secret': 'good-secret', 'server': 'http://localhost:7777'}
+
+DATA = bytes(range(256)) * 40  # 10240 bytes
+SMALL_DATA = b"@read1\nACGT\n+\nFFFF\n"
+
+
+def make_archive(path, members, mode='w'):
+    with tarfile.open(path, mode) as archive:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return str(path)
+
+
+@pytest.fixture()
+def archives(tmp_path):
+    members = {'run1/a.fastq.gz': DATA, 'b.fastq': SMALL_DATA}
+    return {'tar': make_archive(tmp_path / "bundle.tar", members),
+            'tar.gz': make_archive(tmp_path / "bundle.tar.gz", {'run2/c.fastq.gz': DATA}, mode='w:gz')}
+
+
+def test_compute_tar_sources():
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_TAR_SOURCES": "a.tar, data/*.tgz"}):
+        assert _compute_tar_sources() == ["a.tar", "data/*.tgz"]
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_TAR_SOURCES": ""}):
+        assert _compute_tar_sources() == []
+
+
+def test_read_tar_members(archives):
+    members = {member.name: member for member in read_tar_members(archives['tar'])}
+    assert sorted(members) == ['b.fastq', 'run1/a.fastq.gz']
+    member = members['run1/a.fastq.gz']
+    assert member.size == len(DATA) and not member.streamed
+    with open(archives['tar'], 'rb') as fp:
+        fp.seek(member.offset)
+        assert fp.read(member.size) == DATA
+    [member] = read_tar_members(archives['tar.gz'])
+    assert member.name == 'run2/c.fastq.gz' and member.size == len(DATA) and member.streamed
+    with member.open() as stream:
+        assert stream.read() == DATA
+
+
+def test_tar_streams(tmp_path):
+    contents = {f"m{n}.fastq": bytes([n]) * 5000 for n in range(4)}
+    members = read_tar_members(make_archive(tmp_path / "many.tgz", contents, mode='w:gz'))
+    streams = TarStreams()
+    with mock.patch.object(tarfile, "open", wraps=tarfile.open) as mock_open:
+        for n in [0, 1, 3]:  # in order, so from one stream
+            with streams.member_stream(members[n]) as stream:
+                assert stream.read() == contents[f"m{n}.fastq"]
+        assert mock_open.call_count == 1
+        with streams.member_stream(members[2]) as stream:  # out of order, so from the start
+            assert stream.read() == contents["m2.fastq"]
+        assert mock_open.call_count == 2
+        with streams.member_stream(members[0]) as first:  # two at once, so a stream each
+            with streams.member_stream(members[1]) as second:
+                assert second.read() == contents["m1.fastq"] and first.read() == contents["m0.fastq"]
+        assert mock_open.call_count == 4
+        with pytest.raises(RuntimeError):
+            with streams.member_stream(members[3]):  # from the stream after m2, which isn't then kept
+                raise RuntimeError("Upload failed.")
+        with streams.member_stream(members[3]) as stream:  # from the stream after m1
+            assert stream.read() == contents["m3.fastq"]
+        assert mock_open.call_count == 4
+    streams.close()
+
+
+def test_stream_order(tmp_path, archives):
+    contents = {f"m{n}.fastq": SMALL_DATA for n in range(3)}
+    make_archive(tmp_path / "many.tgz", contents, mode='w:gz')
+    paths = [find_tar_member(str(tmp_path), name, sources=['auto'])[0].path
+             for name in ["m2.fastq", "a.fastq.gz", "m0.fastq", "c.fastq.gz", "m1.fastq"]]
+    assert stream_order(paths + [str(tmp_path / "d.fastq")]) == [2, 1, 4, 3, 0, 5]
+
+
+def test_find_tar_member(tmp_path, archives):
+    member, error_msg = find_tar_member(str(tmp_path), "a.fastq.gz", sources=['auto'])
+    assert error_msg is None and member.path == os.path.join(archives['tar'], 'run1/a.fastq.gz')
+    assert tar_member(member.path) is member
+    assert find_tar_member(str(tmp_path), "c.fastq.gz", sources=[archives['tar']])[0] is None
+    assert find_tar_member(str(tmp_path), "missing.fastq", sources=['auto']) == (None, None)
+    make_archive(tmp_path / "more.tgz", {'b.fastq': SMALL_DATA}, mode='w:gz')
+    member, error_msg = find_tar_member(str(tmp_path), "b.fastq", sources=[str(tmp_path / "*.t*")])
+    assert member is None
+    assert error_msg == (f"No upload attempted for file b.fastq because multiple copies were found in archives:"
+                         f" {archives['tar']}/b.fastq, {tmp_path}/more.tgz/b.fastq.")
+
+
+@pytest.mark.parametrize("kind", ['tar', 'tar.gz'])
+def test_upload_tar_member(archives, kind):
+    member = read_tar_members(archives[kind])[0]
+    with mock.patch.object(s3_upload_module, "MULTIPART_CHUNK_SIZE", 1000):
+        client = FakeS3Client()
+        upload_tar_member(member, make_credentials(), s3_client=client)
+        assert client.objects[('some-bucket', 'some/key.fastq.gz')] == DATA
+        assert len(client.parts) == 11
+    [member] = [member for member in read_tar_members(archives['tar']) if member.name == 'b.fastq']
+    client = FakeS3Client()
+    upload_tar_member(member, make_credentials(), s3_client=client)
+    assert client.objects[('some-bucket', 'some/key.fastq.gz')] == SMALL_DATA
+    assert client.calls == [('put_object', {})]
+
+
+def test_upload_stream_to_s3():
+    with mock.patch.object(s3_upload_module, "MULTIPART_CHUNK_SIZE", 1000):
+        client = FakeS3Client()
+        result = upload_stream_to_s3(io.BytesIO(DATA), make_credentials(), s3_client=client)
+        assert result == {'size': len(DATA), 'md5': hashlib.md5(DATA).hexdigest()}
+        assert client.objects[('some-bucket', 'some/key.fastq.gz')] == DATA
+        client = FakeS3Client()
+        upload_stream_to_s3(io.BytesIO(DATA[:3000]), make_credentials(), s3_client=client)
+        assert client.objects[('some-bucket', 'some/key.fastq.gz')] == DATA[:3000]  # ends at the end of a part
+        assert len(client.parts) == 3
+        client = FakeS3Client()
+        with raises_regexp(ValueError, "The stream has 10240 bytes, not the 20000 expected."):
+            upload_stream_to_s3(io.BytesIO(DATA), make_credentials(), s3_client=client, size=20000)
+        assert client.calls[-1] == ('abort_multipart_upload', {})
+        with raises_regexp(ValueError, "The stream has more than the 5000 bytes expected."):
+            upload_stream_to_s3(io.BytesIO(DATA), make_credentials(), s3_client=FakeS3Client(), size=5000)
+        with mock.patch.object(s3_upload_module, "MULTIPART_GROWTH_INTERVAL", 2):
+            client = FakeS3Client()
+            upload_stream_to_s3(io.BytesIO(DATA), make_credentials(), s3_client=client)  # of unknown size
+            assert [len(client.parts[n]) for n in sorted(client.parts)] == [1000, 1000, 2000, 2000, 4000, 240]
+            client = FakeS3Client()
+            upload_stream_to_s3(io.BytesIO(DATA), make_credentials(), s3_client=client, max_size=len(DATA))
+            assert len(client.parts) == 11
+
+
+def test_find_upload_file_in_archives(tmp_path, archives):
+    (tmp_path / "d.fastq").write_bytes(SMALL_DATA)
+    with mock.patch.object(submission_module, "TAR_SOURCES", ['auto']):
+        with mock.patch.object(tar_sources_module, "TAR_SOURCES", ['auto']):
+            assert find_upload_file(str(tmp_path), "d.fastq") == (str(tmp_path / "d.fastq"), None)
+            path, error_msg = find_upload_file(str(tmp_path), "c.fastq.gz")
+            assert path == os.path.join(archives['tar.gz'], 'run2/c.fastq.gz') and error_msg is None
+            entry = check_upload_file('uuid-c', "c.fastq.gz", str(tmp_path))
+            assert entry.path == path and entry.size == len(DATA) and entry.problem is None
+            assert find_upload_file(str(tmp_path), "e.fastq") == (str(tmp_path / "e.fastq"), None)
+    assert find_upload_file(str(tmp_path), "c.fastq.gz") == (str(tmp_path / "c.fastq.gz"), None)
+
+
+def test_find_upload_file_with_unreadable_archive(tmp_path, archives):
+    (tmp_path / "broken.tar").write_bytes(b"This is not a tar archive." * 100)
+    with mock.patch.object(submission_module, "TAR_SOURCES", ['auto']):
+        with mock.patch.object(tar_sources_module, "TAR_SOURCES", ['auto']):
+            with shown_output() as shown:
+                path, error_msg = find_upload_file(str(tmp_path), "c.fastq.gz")
+                assert path == os.path.join(archives['tar.gz'], 'run2/c.fastq.gz') and error_msg is None
+                assert find_upload_file(str(tmp_path), "a.fastq.gz")[1] is None
+                [warning] = shown.lines
+                assert warning.startswith(f"Warning: Not looking for files in {tmp_path}/broken.tar,"
+                                          f" which can't be read as a tar archive:")
+
+
+def test_do_uploads_from_archives(tmp_path, archives):
+    uploaded = []
+
+    def mocked_upload_file_to_uuid(filename, uuid, auth):
+        uploaded.append((filename, uuid))
+        return {}
+
+    with mock.patch.object(submission_module, "TAR_SOURCES", ['auto']):
+        with mock.patch.object(tar_sources_module, "TAR_SOURCES", ['auto']):
+            with mock.patch.object(submission_module, "upload_file_to_uuid", mocked_upload_file_to_uuid):
+                with shown_output():
+                    do_uploads([{'uuid': 'uuid-a', 'filename': 'a.fastq.gz'},
+                                {'uuid': 'uuid-c', 'filename': 'c.fastq.gz'}],
+                               auth=SOME_AUTH, folder=str(tmp_path), no_query=True)
+    assert uploaded == [(os.path.join(archives['tar'], 'run1/a.fastq.gz'), 'uuid-a'),
+                        (os.path.join(archives['tar.gz'], 'run2/c.fastq.gz'), 'uuid-c')]
+
+
+def test_execute_prearranged_upload_of_member(tmp_path, archives):
+    member, _ = find_tar_member(str(tmp_path), "a.fastq.gz", sources=['auto'])
+    with mock.patch.object(submission_module, "upload_tar_member") as mock_upload_tar_member:
+        with mock.patch("subprocess.check_call") as mock_check_call:
+            with shown_output() as shown:
+                execute_prearranged_upload(member.path, make_credentials(), auth=SOME_AUTH)
+                assert shown.lines[0] == (f"Uploading run1/a.fastq.gz from archive {archives['tar']}"
+                                          f" directly (in-process) to: s3://some-bucket/some/key.fastq.gz")
+            assert mock_check_call.call_count == 0
+    mock_upload_tar_member.assert_called_once_with(member, make_credentials(), s3_encrypt_key_id=None,
+                                                   refresh_credentials=None, tuner=mock.ANY)
@@ -0,0 +1,93 @@
+import datetime
+import os
+import pytest
+
+from unittest import mock
+
+from .test_utils import shown_output
+from .. import submission as submission_module
+from .. import upload_backends as upload_backends_module
+from ..bandwidth import BandwidthSchedule
+from ..submission import do_uploads
+from ..upload_backends import (
+    UploadBackend, _compute_upload_backend, _compute_upload_workers, divided_schedule, run_upload_jobs,
+)
+from ..utils import show
+
+
+SOME_AUTH = {'key': 'my-key-id', 'secret': 'good-secret', 'server': 'http://localhost:7777'}
+
+
+def square_and_show(n):
+    if n < 0:
+        raise ValueError(f"Negative: {n}")
+    show(f"Squaring {n}.")
+    return n * n
+
+
+def test_compute_upload_backend():
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_UPLOAD_BACKEND": "processes", "SUBMITCGAP_UPLOAD_WORKERS": "8"}):
+        assert _compute_upload_backend() == UploadBackend.PROCESSES
+        assert _compute_upload_workers() == 8
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_UPLOAD_BACKEND": "fibers", "SUBMITCGAP_UPLOAD_WORKERS": "none"}):
+        with mock.patch.object(upload_backends_module, "PRINT") as mock_print:
+            assert _compute_upload_backend() == UploadBackend.SERIAL
+            assert _compute_upload_workers() == upload_backends_module.DEFAULT_UPLOAD_WORKERS
+            assert mock_print.call_count == 2
+
+
+def test_divided_schedule():
+    schedule = BandwidthSchedule.parse("08:00-18:00=40MB/s, 18:00-08:00=unlimited")
+    divided = divided_schedule(schedule, 4)
+    assert divided.rate_at(datetime.datetime(2024, 1, 1, 12, 0)) == schedule.rate_at(
+        datetime.datetime(2024, 1, 1, 12, 0)) / 4
+    assert divided.rate_at(datetime.datetime(2024, 1, 1, 20, 0)) is None
+
+
+@pytest.mark.parametrize("backend", [UploadBackend.SERIAL, UploadBackend.THREADS, UploadBackend.PROCESSES])
+def test_run_upload_jobs(backend):
+    with shown_output() as shown:
+        results = run_upload_jobs(square_and_show, [(1,), (2,), (-3,), (4,)], backend=backend, workers=2,
+                                  on_error=lambda args, e: str(e))
+        assert results == [1, 4, "Negative: -3", 16]
+        assert sorted(shown.lines) == ["Squaring 1.", "Squaring 2.", "Squaring 4."]  # shown by this process
+
+
+def test_run_upload_jobs_shares_bandwidth_among_threads(no_bandwidth_limit):
+    with mock.patch.object(no_bandwidth_limit, "schedule", BandwidthSchedule.parse("40MB/s")):
+        rates = run_upload_jobs(lambda n: no_bandwidth_limit.transfer_rate(), [(1,), (2,), (3,)],
+                                backend=UploadBackend.THREADS, workers=4)
+        assert rates == [40 * 1000 ** 2 / 3] * 3  # for each of 3 transfers by the AWS CLI at once
+        assert no_bandwidth_limit.transfers == 1
+        assert no_bandwidth_limit.transfer_rate() == 40 * 1000 ** 2
+
+
+@pytest.mark.parametrize("backend", [UploadBackend.THREADS, UploadBackend.PROCESSES])
+def test_run_upload_jobs_raises_errors(backend):
+    with pytest.raises(ValueError):
+        run_upload_jobs(square_and_show, [(1,), (-2,)], backend=backend, workers=2)
+
+
+@pytest.mark.parametrize("backend", [UploadBackend.THREADS, UploadBackend.PROCESSES])
+def test_do_uploads_at_once(tmp_path, backend):
+
+    for name in ["a.fastq", "b.fastq", "c.fastq"]:
+        (tmp_path / name).write_text(name)
+    upload_spec_list = [{'uuid': 'uuid-a', 'filename': 'a.fastq'}, {'uuid': 'uuid-b', 'filename': 'b.fastq'},
+                        {'uuid': 'uuid-c', 'filename': 'c.fastq'}]
+
+    def mocked_upload_file_to_uuid(filename, uuid, auth):
+        assert auth == SOME_AUTH
+        if uuid == 'uuid-b':
+            raise RuntimeError("Connection reset.")
+        return {}
+
+    with mock.patch.object(submission_module, "UPLOAD_BACKEND", backend):
+        with mock.patch.object(submission_module, "upload_file_to_uuid", mocked_upload_file_to_uuid):
+            with shown_output() as shown:
+                do_uploads(upload_spec_list, auth=SOME_AUTH, folder=str(tmp_path), no_query=True)
+                assert shown.lines[0] == f"Uploading 3 files, 3 at once, with the {backend} backend."
+                for name, uuid in [("a", "uuid-a"), ("c", "uuid-c")]:
+                    assert f"Upload of {tmp_path}/{name}.fastq to item {uuid} was successful." in shown.lines
+                assert "RuntimeError: Connection reset." in shown.lines
+                assert shown.lines[-1] == "Uploaded 2 of 3 files (1 failed)."
@@ -43,6 +43,7 @@ def test_upload_item_data_script(keyfile, mocked_s3_encrypt_key_id):
         'server': None,
         'uuid': None,
         'no_query': False,
+        'file_name': None,
     })
     expect_call_args = {
         'item_filename': 'some.file',
@@ -50,6 +51,7 @@ def test_upload_item_data_script(keyfile, mocked_s3_encrypt_key_id):
         'server': None,
         'uuid': 'some-guid',
         'no_query': False,
+        'file_name': None,
     }
     test_it(args_in=['-u', 'some-guid', 'some.file'],
             expect_exit_code=0,
@@ -65,6 +67,7 @@ def test_upload_item_data_script(keyfile, mocked_s3_encrypt_key_id):
         'server': 'some-server',
         'uuid': 'some-guid',
         'no_query': False,
+        'file_name': None,
     }
     test_it(args_in=['some.file', '-e', 'some-env', '--server', 'some-server', '-u', 'some-guid'],
             expect_exit_code=0,
@@ -80,8 +83,13 @@ def test_upload_item_data_script(keyfile, mocked_s3_encrypt_key_id):
         'server': 'some-server',
         'uuid': 'some-guid',
         'no_query': True,
+        'file_name': None,
     }
     test_it(args_in=['some.file', '-e', 'some-env', '--server', 'some-server', '-u', 'some-guid', '-nq'],
             expect_exit_code=0,
             expect_called=True,
             expect_call_args=expect_call_args)
+    test_it(args_in=['-', '-u', 'some-guid', '-nq', '--name', 'some.bam'],
+            expect_exit_code=0,
+            expect_called=True,
+            expect_call_args=dict(expect_call_args, item_filename='-', env=None, server=None, file_name='some.bam'))
@@ -0,0 +1,193 @@
+import os
+import pytest
+import threading
+
+from unittest import mock
+
+from .test_utils import shown_output
+from .. import submission as submission_module
+from .. import upload_ledger as upload_ledger_module
+from ..scripts import show_upload_progress as show_upload_progress_module
+from ..scripts.show_upload_progress import main as show_upload_progress_main
+from ..submission import do_any_uploads, show_upload_progress
+from ..upload_ledger import UploadLedger, UploadStatus
+from .testing_helpers import system_exit_expected
+
+
+SOME_SERVER = 'http://localhost:7777'
+SOME_KEYDICT = {'key': 'my-key-id', 'secret': 'good-secret', 'server': SOME_SERVER}
+SOME_SUBMISSION_UUID = 'some-submission-uuid'
+
+
+def test_upload_ledger(tmp_path):
+
+    ledger = UploadLedger(filename=str(tmp_path / "ledger" / "ledger.sqlite3"))
+    key = (SOME_SERVER, SOME_SUBMISSION_UUID, 'file-uuid')
+
+    ledger.record_submission(SOME_SERVER, SOME_SUBMISSION_UUID, bundle_filename='bundle.xlsx')
+    ledger.record_submission(SOME_SERVER, SOME_SUBMISSION_UUID, upload_folder='/some/folder')
+    [submission] = ledger.get_submissions()
+    assert submission['bundle_filename'] == 'bundle.xlsx'
+    assert submission['upload_folder'] == '/some/folder'
+    assert ledger.get_submissions(server='http://other.server') == []
+
+    assert not ledger.is_complete(*key)  # Nothing recorded
+    ledger.record_planned(*key, ['f1.fastq.gz', 'f1.fastq.gz.bai'])
+    assert not ledger.is_complete(*key)
+    ledger.record_started(*key, 'f1.fastq.gz', path='/some/folder/f1.fastq.gz', size=100)
+    ledger.record_failed(*key, 'f1.fastq.gz', error='RuntimeError: oops')
+    ledger.record_started(*key, 'f1.fastq.gz', path='/some/folder/f1.fastq.gz', size=100)
+    ledger.record_done(*key, 'f1.fastq.gz', md5='abc')
+    ledger.record_planned(*key, ['f1.fastq.gz'])  # Doesn't disturb what's recorded
+    assert not ledger.is_complete(*key)  # The extra file isn't done
+    ledger.record_started(*key, 'f1.fastq.gz.bai', size=10)
+    ledger.record_done(*key, 'f1.fastq.gz.bai')
+    assert ledger.is_complete(*key)
+
+    main_upload, extra_upload = ledger.get_uploads(SOME_SERVER, SOME_SUBMISSION_UUID)
+    assert main_upload['status'] == UploadStatus.DONE
+    assert main_upload['attempts'] == 2
+    assert main_upload['error'] is None
+    assert main_upload['md5'] == 'abc'
+    assert main_upload['size'] == 100
+    assert main_upload['duration'] >= 0
+    assert extra_upload['filename'] == 'f1.fastq.gz.bai'
+
+    # An unusable ledger just stops being used.
+    blocked = tmp_path / "blocked"
+    blocked.write_text("not a directory")
+    broken_ledger = UploadLedger(filename=str(blocked / "ledger.sqlite3"))
+    with mock.patch.object(upload_ledger_module, "PRINT") as mock_print:
+        broken_ledger.record_submission(SOME_SERVER, SOME_SUBMISSION_UUID)
+        assert mock_print.call_count == 1
+    assert not broken_ledger.enabled
+    assert broken_ledger.get_submissions() == []
+
+
+def test_do_any_uploads_records_and_resumes(tmp_path, isolated_upload_ledger):
+
+    folder = tmp_path / "uploads"
+    folder.mkdir()
+    for name in ['f1.fastq.gz', 'f2.fastq.gz']:
+        (folder / name).write_text(name)
+    res = {
+        'uuid': SOME_SUBMISSION_UUID,
+        'additional_data': {
+            'upload_info': [{'uuid': '1111', 'filename': 'f1.fastq.gz'}, {'uuid': '2222', 'filename': 'f2.fastq.gz'}]
+        },
+    }
+    uploaded = []
+    failures = ['f2.fastq.gz']  # The first attempt at this will fail
+
+    def mocked_upload_file_to_uuid(filename, uuid, auth):
+        assert auth == SOME_KEYDICT
+        if os.path.basename(filename) in failures:
+            failures.remove(os.path.basename(filename))
+            raise RuntimeError("Upload failed with exit code 1")
+        uploaded.append(os.path.basename(filename))
+        return {'uuid': uuid}
+
+    with mock.patch.object(submission_module, "upload_file_to_uuid", side_effect=mocked_upload_file_to_uuid):
+        with shown_output() as shown:
+            with mock.patch.object(submission_module, "yes_or_no", return_value=False):
+                do_any_uploads(res, keydict=SOME_KEYDICT, upload_folder=str(folder))
+            # Declining uploads records nothing about them.
+            assert isolated_upload_ledger.get_uploads(SOME_SERVER, SOME_SUBMISSION_UUID) == []
+            with mock.patch.object(submission_module, "yes_or_no", side_effect=AssertionError("No query expected")):
+                do_any_uploads(res, keydict=SOME_KEYDICT, upload_folder=str(folder), no_query=True)
+                assert uploaded == ['f1.fastq.gz']
+                statuses = [(upload['filename'], upload['status'])
+                            for upload in isolated_upload_ledger.get_uploads(SOME_SERVER, SOME_SUBMISSION_UUID)]
+                assert statuses == [('f1.fastq.gz', UploadStatus.DONE), ('f2.fastq.gz', UploadStatus.FAILED)]
+                shown.lines.clear()
+                do_any_uploads(res, keydict=SOME_KEYDICT, upload_folder=str(folder), no_query=True)
+                assert uploaded == ['f1.fastq.gz', 'f2.fastq.gz']  # Only the incomplete upload was retried
+                assert shown.lines[0] == "Skipping f1.fastq.gz, which was already uploaded to item 1111."
+
+    with shown_output() as shown:
+        show_upload_progress(uuid=SOME_SUBMISSION_UUID)
+        assert shown.lines == [
+            f"IngestionSubmission uuid {SOME_SUBMISSION_UUID} on {SOME_SERVER}:",
+            f"  Upload folder: {folder}",
+            "  2 of 2 files uploaded (22 bytes).",
+            "  done        f1.fastq.gz (11 bytes, %.2f seconds)"
+            % isolated_upload_ledger.get_uploads(SOME_SERVER, SOME_SUBMISSION_UUID)[0]['duration'],
+            "  done        f2.fastq.gz (11 bytes, %.2f seconds, 2 attempts)"
+            % isolated_upload_ledger.get_uploads(SOME_SERVER, SOME_SUBMISSION_UUID)[1]['duration'],
+        ]
+
+    with shown_output() as shown:
+        show_upload_progress(uuid='some-other-uuid')
+        assert shown.lines == ["No uploads are recorded for IngestionSubmission uuid some-other-uuid."]
+
+
+def test_do_any_uploads_records_file_names_with_folders(tmp_path, isolated_upload_ledger):
+
+    (tmp_path / "run1").mkdir()
+    (tmp_path / "run1" / "f1.fastq.gz").write_text("f1")
+    res = {'uuid': SOME_SUBMISSION_UUID,
+           'additional_data': {'upload_info': [{'uuid': '1111', 'filename': 'run1/f1.fastq.gz'}]}}
+    with mock.patch.object(submission_module, "upload_file_to_uuid", return_value={'uuid': '1111'}):
+        with shown_output():
+            do_any_uploads(res, keydict=SOME_KEYDICT, upload_folder=str(tmp_path), no_query=True)
+    # The file planned and the file uploaded are recorded as one and the same.
+    statuses = [(upload['filename'], upload['status'])
+                for upload in isolated_upload_ledger.get_uploads(SOME_SERVER, SOME_SUBMISSION_UUID)]
+    assert statuses == [('f1.fastq.gz', UploadStatus.DONE)]
+    assert isolated_upload_ledger.is_complete(SOME_SERVER, SOME_SUBMISSION_UUID, '1111')
+
+
+def test_upload_ledger_connections(tmp_path):
+
+    ledger = UploadLedger(filename=str(tmp_path / "ledger.sqlite3"))
+    ledger.record_submission(SOME_SERVER, SOME_SUBMISSION_UUID)
+    connection = ledger._connection()  # noQA - testing protected member
+    assert ledger._connection() is connection  # noQA - Each thread keeps its connection.
+    other_connections = []
+    thread = threading.Thread(target=lambda: other_connections.append(ledger._connection()))  # noQA
+    thread.start()
+    thread.join()
+    assert other_connections[0] is not connection
+    with mock.patch.object(ledger, "filename", str(tmp_path / "other.sqlite3")):
+        assert ledger._connection() is not connection  # noQA - A ledger moved elsewhere is connected to anew.
+        assert ledger.get_submissions() == []
+
+
+def test_extra_files_recorded_before_main_file_is_done(tmp_path, isolated_upload_ledger):
+
+    (tmp_path / "f1.bam").write_text("f1")
+    (tmp_path / "f1.bam.bai").write_text("index")
+    res = {'uuid': SOME_SUBMISSION_UUID,
+           'additional_data': {'upload_info': [{'uuid': '1111', 'filename': 'f1.bam'}]}}
+    metadata = {'uuid': '1111', 'extra_files_creds': [{'filename': 'f1.bam.bai', 'upload_credentials': {}}]}
+
+    recorded_when_done = []
+    record_done = isolated_upload_ledger.record_done
+
+    def mocked_record_done(server, submission_uuid, file_uuid, filename, **kwargs):
+        recorded_when_done.append([upload['filename'] for upload in isolated_upload_ledger.get_uploads(
+            server, submission_uuid)])
+        record_done(server, submission_uuid, file_uuid, filename, **kwargs)
+
+    with mock.patch.object(submission_module, "upload_file_to_uuid", return_value=metadata):
+        with mock.patch.object(isolated_upload_ledger, "record_done", mocked_record_done):
+            with mock.patch.object(submission_module, "upload_extra_files", side_effect=KeyboardInterrupt):
+                with shown_output():
+                    with pytest.raises(KeyboardInterrupt):  # as if it crashed before starting on the extra file
+                        do_any_uploads(res, keydict=SOME_KEYDICT, upload_folder=str(tmp_path), no_query=True)
+    assert recorded_when_done == [['f1.bam', 'f1.bam.bai']]  # The extra file was known before f1.bam was done.
+    statuses = [(upload['filename'], upload['status'])
+                for upload in isolated_upload_ledger.get_uploads(SOME_SERVER, SOME_SUBMISSION_UUID)]
+    assert statuses == [('f1.bam', UploadStatus.DONE), ('f1.bam.bai', UploadStatus.PENDING)]
+    assert not isolated_upload_ledger.is_complete(SOME_SERVER, SOME_SUBMISSION_UUID, '1111')
+
+
+def test_show_upload_progress_script():
+
+    with mock.patch.object(show_upload_progress_module, "show_upload_progress") as mock_show_upload_progress:
+        with system_exit_expected(exit_code=0):
+            show_upload_progress_main([])
+        mock_show_upload_progress.assert_called_with(uuid=None, server=None, env=None)
+        with system_exit_expected(exit_code=0):
+            show_upload_progress_main(['some-guid', '-e', 'some-env'])
+        mock_show_upload_progress.assert_called_with(uuid='some-guid', server=None, env='some-env')
@@ -0,0 +1,127 @@
+import pytest
+
+from unittest import mock
+
+from .test_utils import shown_output
+from .. import submission as submission_module
+from ..submission import do_uploads
+from ..upload_backends import UploadBackend
+from ..upload_ledger import UPLOAD_LEDGER
+from ..upload_scheduling import (
+    UploadOrder, format_duration, makespan_message, predict_makespan, priority_rank, schedule_uploads,
+)
+
+
+SOME_AUTH = {'key': 'my-key-id', 'secret': 'good-secret', 'server': 'http://localhost:7777'}
+
+GB = 1000 ** 3
+
+
+def test_priority_rank():
+
+    priorities = ["*proband*", "*.cram"]
+    assert priority_rank("/data/proband_1.fastq.gz", priorities) == 0
+    assert priority_rank("proband_1.cram", priorities) == 0
+    assert priority_rank("mother.cram", priorities) == 1
+    assert priority_rank("mother.fastq.gz", priorities) == 2
+    assert priority_rank("mother.fastq.gz", []) == 0
+
+
+ITEMS = [("a.fastq.gz", 1, "a"), ("b.bam", 300, "b"), ("c.fastq.gz", 5, "c"), ("proband.vcf", 2, "d"),
+         ("e.bam", 100, "e"), ("f.bam", 100, "f")]
+
+
+@pytest.mark.parametrize("order, priorities, workers, expected", [
+    (UploadOrder.LISTED, [], 1, ["a", "b", "c", "d", "e", "f"]),
+    (UploadOrder.LISTED, ["*proband*"], 1, ["d", "a", "b", "c", "e", "f"]),
+    (UploadOrder.LARGEST_FIRST, [], 1, ["b", "e", "f", "c", "d", "a"]),
+    (UploadOrder.LARGEST_FIRST, ["*proband*", "*.fastq.gz"], 1, ["d", "c", "a", "b", "e", "f"]),
+    (UploadOrder.LPT, [], 1, ["b", "e", "f", "c", "d", "a"]),
+    # With 2 workers, b goes to one and e, f, c, d and a to the other, in the order they'll start.
+    (UploadOrder.LPT, [], 2, ["b", "e", "f", "c", "d", "a"]),
+    (UploadOrder.LPT, [], 3, ["b", "e", "f", "c", "d", "a"]),
+])
+def test_schedule_uploads(order, priorities, workers, expected):
+
+    assert schedule_uploads(ITEMS, order=order, priorities=priorities, workers=workers) == expected
+
+
+def test_predict_makespan():
+
+    assert predict_makespan([]) == 0
+    assert predict_makespan([1, 300, 5, 2, 100, 100]) == 508
+    assert predict_makespan([300, 100, 100, 5, 2, 1], workers=2) == 300
+    assert predict_makespan([1, 2, 5, 100, 100, 300], workers=2) == 402  # The big one, started last, holds things up
+
+
+def test_makespan_message():
+
+    assert format_duration(5) == "5s"
+    assert format_duration(65) == "1m 05s"
+    assert format_duration(3 * 3600 + 12 * 60 + 30) == "3h 12m"
+
+    assert makespan_message([300 * GB, 10 * GB], order=UploadOrder.LARGEST_FIRST, throughput=31 * 1000 ** 2) == (
+        "Planning to upload 2 files (310.0 GB) in largest-first order."
+        " Predicted time to upload them all: 2h 46m (at 31.0 MB/s, as in past uploads).")
+    assert makespan_message([5 * 1000 ** 2], order=UploadOrder.LISTED) == (
+        "Planning to upload 1 file (5.0 MB) in listed order."
+        " There are no past uploads from which to predict how long that will take.")
+
+
+def test_observed_throughput():
+
+    server = SOME_AUTH['server']
+    assert UPLOAD_LEDGER.observed_throughput(server) is None
+    for file_uuid, size, seconds in [('uuid-1', 1000, 10), ('uuid-2', 3000, 10)]:
+        with mock.patch("time.time", return_value=100.0):
+            UPLOAD_LEDGER.record_started(server, 'sub-uuid', file_uuid, f'{file_uuid}.bam', size=size)
+        with mock.patch("time.time", return_value=100.0 + seconds):
+            UPLOAD_LEDGER.record_done(server, 'sub-uuid', file_uuid, f'{file_uuid}.bam')
+    UPLOAD_LEDGER.record_started(server, 'sub-uuid', 'uuid-3', 'uuid-3.bam', size=5000)  # Not done, so not counted
+    assert UPLOAD_LEDGER.observed_throughput(server) == 200
+    assert UPLOAD_LEDGER.observed_throughput(server, recent=1) in (100, 300)
+    assert UPLOAD_LEDGER.observed_throughput('http://elsewhere') is None
+
+
+def test_do_uploads_schedules_uploads(tmp_path):
+
+    upload_spec_list = []
+    for name, size in [("small.fastq.gz", 10), ("big.bam", 1000), ("proband.vcf.gz", 1)]:
+        (tmp_path / name).write_bytes(b"x" * size)
+        upload_spec_list.append({'uuid': f'uuid-{name}', 'filename': name})
+    upload_spec_list.append({'uuid': 'uuid-missing', 'filename': 'missing.cram'})
+    uploaded = []
+
+    def mocked_upload_file_to_uuid(filename, uuid, auth, **kwargs):
+        ignored_kwargs = kwargs
+        assert ignored_kwargs.keys() <= {'upload_metadata'}
+        uploaded.append(uuid)
+        return {}
+
+    with mock.patch.object(submission_module, "UPLOAD_ORDER", UploadOrder.LARGEST_FIRST):
+        with mock.patch.object(submission_module, "UPLOAD_PRIORITIES", ["proband*"]):
+            with mock.patch.object(submission_module, "upload_file_to_uuid", mocked_upload_file_to_uuid):
+                with shown_output() as shown:
+                    do_uploads(upload_spec_list, auth=SOME_AUTH, folder=str(tmp_path), no_query=True)
+                    assert shown.lines[0] == ("Planning to upload 4 files (0.0 MB) in largest-first order."
+                                              " There are no past uploads from which to predict how long"
+                                              " that will take.")
+    # A file that can't be found (and so can't be sized) goes last.
+    assert uploaded == ['uuid-proband.vcf.gz', 'uuid-big.bam', 'uuid-small.fastq.gz', 'uuid-missing']
+
+
+@pytest.mark.parametrize("backend, workers", [(UploadBackend.SERIAL, 1), (UploadBackend.THREADS, 3)])
+def test_do_uploads_schedules_for_workers(tmp_path, backend, workers):
+
+    (tmp_path / "a.fastq.gz").write_bytes(b"x" * 10)
+    upload_spec_list = [{'uuid': 'uuid-a', 'filename': 'a.fastq.gz'}]
+    with mock.patch.object(submission_module, "UPLOAD_ORDER", UploadOrder.LPT):
+        with mock.patch.object(submission_module, "UPLOAD_BACKEND", backend):
+            with mock.patch.object(submission_module, "UPLOAD_WORKERS", 3):
+                with mock.patch.object(submission_module, "schedule_uploads", return_value=[0]) as mock_schedule:
+                    with mock.patch.object(submission_module, "makespan_message", return_value="") as mock_message:
+                        with mock.patch.object(submission_module, "upload_file_to_uuid", return_value={}):
+                            with shown_output():
+                                do_uploads(upload_spec_list, auth=SOME_AUTH, folder=str(tmp_path), no_query=True)
+    assert mock_schedule.call_args.kwargs['workers'] == workers
+    assert mock_message.call_args.kwargs['workers'] == workers
@@ -0,0 +1,156 @@
+import pytest
+
+from botocore.exceptions import ClientError
+from dcicutils.qa_utils import raises_regexp
+from unittest import mock
+
+from .test_s3_upload import FakeS3Client, make_credentials
+from .test_utils import shown_output
+from .. import s3_upload as s3_upload_module
+from .. import upload_tuning as upload_tuning_module
+from ..s3_upload import MULTIPART_RETRY_DELAY, retry_delay, upload_file_to_s3
+from ..upload_tuning import (
+    MIB, UploadTuner, format_size, is_throttling_error, make_upload_tuner, parse_bounds, parse_size,
+)
+
+
+def test_parse_size_and_bounds():
+
+    assert parse_size("64MiB") == parse_size("64MB") == parse_size("64m") == 64 * MIB
+    assert parse_size("1GiB") == 1024 * MIB
+    assert parse_size("5000") == 5000
+    with raises_regexp(ValueError, "Not a size"):
+        parse_size("big")
+
+    assert format_size(96 * MIB) == "96MiB"
+    assert format_size(5000) == "5000"
+
+    assert parse_bounds("8") == (8, 8)
+    assert parse_bounds("2-16") == (2, 16)
+    assert parse_bounds("16MiB-512MiB", parse=parse_size) == (16 * MIB, 512 * MIB)
+    for bad_bounds in ["0", "16-2", "two"]:
+        with pytest.raises(ValueError):
+            parse_bounds(bad_bounds)
+
+
+def test_make_upload_tuner():
+
+    tuner = make_upload_tuner(concurrency=4, part_size=64 * MIB)
+    assert (tuner.concurrency, tuner.part_size) == (4, 64 * MIB)
+
+    tuner = make_upload_tuner(concurrency=4, part_size=64 * MIB, concurrency_spec="8", part_size_spec="1MiB-32MiB")
+    assert (tuner.concurrency, tuner.part_size) == (8, 32 * MIB)
+    assert tuner.concurrency_bounds == (8, 8)
+    assert tuner.part_size_bounds == (5 * MIB, 32 * MIB)  # S3 won't take smaller parts
+
+    with mock.patch.object(upload_tuning_module, "PRINT") as mock_print:
+        tuner = make_upload_tuner(concurrency=4, part_size=64 * MIB, concurrency_spec="lots")
+        mock_print.assert_called_once_with("Ignoring SUBMITCGAP_UPLOAD_CONCURRENCY='lots'."
+                                           " invalid literal for int() with base 10: 'lots'")
+    assert tuner.concurrency == 4
+
+
+def test_upload_tuner_aimd():
+
+    tuner = UploadTuner(concurrency=2, part_size=64 * MIB, concurrency_bounds=(1, 4))
+
+    def upload_round(seconds_per_part, start=0.0):
+        for _ in range(tuner.concurrency):
+            tuner.record_part(MIB, started=start, finished=start + seconds_per_part)
+
+    upload_round(1)
+    assert tuner.concurrency == 3  # Additive increase
+    upload_round(1)
+    assert tuner.concurrency == 4
+    upload_round(1)
+    assert tuner.concurrency == 4  # No more than the upper bound
+    upload_round(2)  # Throughput has halved
+    assert tuner.concurrency == 3  # Multiplicative decrease
+    tuner.record_failure(throttled=True)
+    assert tuner.concurrency == 1
+    tuner.record_failure()
+    assert tuner.concurrency == 1  # No less than the lower bound
+    assert tuner.parts_observed == 13
+    assert tuner.failures_observed == 2
+    assert tuner.summary() == ("Upload settings reached: 1 parts at once, of 64MiB each. To keep to these,"
+                               " set SUBMITCGAP_UPLOAD_CONCURRENCY=1 and SUBMITCGAP_UPLOAD_PART_SIZE=64MiB.")
+
+
+def test_upload_tuner_part_size():
+
+    tuner = UploadTuner(concurrency=1, part_size=64 * MIB, part_size_bounds=(16 * MIB, 72 * MIB))
+    tuner.record_part(MIB, started=0, finished=1)
+    tuner.file_finished()
+    assert tuner.part_size == 72 * MIB  # Fast parts grow
+    tuner.record_part(MIB, started=0, finished=1)
+    tuner.file_finished()
+    assert tuner.part_size == 72 * MIB  # No more than the upper bound
+    tuner.file_finished()
+    assert tuner.part_size == 72 * MIB  # Nothing observed, nothing changed
+    tuner.record_part(MIB, started=0, finished=100)
+    tuner.file_finished()
+    assert tuner.part_size == 36 * MIB  # Slow parts shrink
+    tuner.record_part(MIB, started=0, finished=1)
+    tuner.record_failure()
+    tuner.file_finished()
+    assert tuner.part_size == 18 * MIB  # So do parts that fail
+
+
+def slow_down():
+    return ClientError({'Error': {'Code': 'SlowDown', 'Message': "Please reduce your request rate."}}, 'UploadPart')
+
+
+def test_retry_delay():
+
+    with mock.patch.object(s3_upload_module.random, "uniform", lambda low, high: high):
+        assert [retry_delay(attempt) for attempt in range(1, 8)] == [1, 2, 4, 8, 16, 30, 30]
+    assert all(0 <= retry_delay(2) <= 2 for _ in range(100))
+
+
+def test_is_throttling_error():
+
+    assert is_throttling_error(slow_down())
+    assert not is_throttling_error(ClientError({'Error': {'Code': 'AccessDenied'}}, 'UploadPart'))
+    assert not is_throttling_error(RuntimeError("Connection reset."))
+
+
+class ThrottlingS3Client(FakeS3Client):
+
+    def __init__(self, throttle_part, times=1):
+        super().__init__()
+        self.throttle_part = throttle_part
+        self.times = times
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):  # noQA - argument names are as boto3 has them
+        if PartNumber == self.throttle_part and self.times > 0:
+            self.times -= 1
+            raise slow_down()
+        return super().upload_part(Bucket=Bucket, Key=Key, UploadId=UploadId, PartNumber=PartNumber, Body=Body)
+
+
+def test_upload_file_to_s3_with_tuner(tmp_path):
+
+    path = tmp_path / "key.fastq.gz"
+    data = bytes(range(256)) * (44 * 1024)  # 11MiB, or 3 parts of 5MiB
+    path.write_bytes(data)
+    key = ('some-bucket', 'some/key.fastq.gz')
+
+    tuner = UploadTuner(concurrency=2, part_size=5 * MIB, part_size_bounds=(5 * MIB, 5 * MIB))
+    client = ThrottlingS3Client(throttle_part=2)
+    with mock.patch.object(s3_upload_module.time, "sleep") as mock_sleep:
+        with shown_output():
+            upload_file_to_s3(str(path), make_credentials(), s3_client=client, tuner=tuner)
+        [[delay], _] = mock_sleep.call_args
+        assert mock_sleep.call_count == 1 and 0 <= delay <= MULTIPART_RETRY_DELAY  # before trying it again
+    assert client.objects[key] == data  # The throttled part was tried again.
+    assert len(client.parts) == 3
+    assert tuner.failures_observed == 1
+    assert tuner.parts_observed == 3
+
+    client = ThrottlingS3Client(throttle_part=2, times=3)
+    with mock.patch.object(s3_upload_module.time, "sleep") as mock_sleep:
+        with shown_output():
+            with raises_regexp(ClientError, "SlowDown"):
+                upload_file_to_s3(str(path), make_credentials(), s3_client=client, tuner=tuner)
+        assert mock_sleep.call_count == 2
+    assert client.calls[-1] == ('abort_multipart_upload', {})
@@ -0,0 +1,145 @@
+import hashlib
+import pytest
+
+from unittest import mock
+
+from .test_utils import shown_output
+from .testing_helpers import system_exit_expected, argparse_errors_muffled
+from .. import submission as submission_module
+from ..scripts import verify_uploads as verify_uploads_script_module
+from ..scripts.verify_uploads import main as verify_uploads_main
+from ..submission import verify_uploads
+from ..upload_verification import is_settled, verification_report, verify_file_item, verify_file_items
+
+
+SOME_AUTH = {'key': 'my-key-id', 'secret': 'good-secret', 'server': 'http://localhost:7777'}
+
+
+def md5_of(data):
+    return hashlib.md5(data).hexdigest()
+
+
+@pytest.fixture()
+def local_files(tmp_path):
+    (tmp_path / "a.bam").write_bytes(b"bam data")
+    (tmp_path / "a.bam.bai").write_bytes(b"index")
+    return {name: str(tmp_path / name) for name in ["a.bam", "a.bam.bai"]}
+
+
+def test_verify_file_item(local_files):
+
+    def find_local(uuid, name):
+        assert uuid == 'uuid-1'
+        return local_files.get(name)
+
+    item = {'uuid': 'uuid-1', 'filename': 'a.bam', 'status': 'uploaded', 'file_size': 8, 'md5sum': md5_of(b"bam data"),
+            'extra_files': [{'filename': 'a.bam.bai', 'status': 'uploaded', 'file_size': 5}]}
+    results = verify_file_item(item, find_local=find_local, local_md5=lambda path: md5_of(open(path, 'rb').read()))
+    assert [(result.file_name, result.extra_file, result.passed) for result in results] == [
+        ('a.bam', False, True), ('a.bam.bai', True, True)]
+
+    item = dict(item, md5sum=md5_of(b"other data"),
+                extra_files=[{'filename': 'a.bam.bai', 'status': 'upload failed'}])
+    [main_result, extra_result] = verify_file_item(item, find_local=find_local,
+                                                   local_md5=lambda path: md5_of(open(path, 'rb').read()))
+    assert main_result.problems == [f"The portal has its md5 checksum as {md5_of(b'other data')},"
+                                    f" but the local file's is {md5_of(b'bam data')}."]
+    assert extra_result.problems == ["Its status is 'upload failed'."]
+
+    [result] = verify_file_item({'uuid': 'uuid-1', 'filename': 'a.bam', 'status': 'uploaded', 'file_size': 9},
+                                find_local=find_local)
+    assert result.problems == ["The portal has its size as 9 bytes, but the local file has 8."]
+
+    [result] = verify_file_item({'uuid': 'uuid-1', 'filename': 'a.bam', 'status': 'uploading'})
+    assert result.problems == ["Its status is still 'uploading'."]
+
+
+def test_is_settled():
+    assert is_settled({'status': 'uploaded'})
+    assert not is_settled({'status': 'uploading'})
+    assert not is_settled({'status': 'uploaded', 'extra_files': [{'status': 'uploading'}]})
+
+
+def test_verify_file_items_waits_for_status_to_settle():
+    now = [0]
+    fetches = []
+
+    def fetch_item(uuid):
+        fetches.append((uuid, now[0]))
+        if uuid == 'uuid-broken':
+            raise RuntimeError("Server error.")
+        settled = uuid == 'uuid-fast' or now[0] >= 20
+        return {'filename': f"{uuid}.fastq", 'status': 'uploaded' if settled else 'uploading'}
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    results = verify_file_items(['uuid-fast', 'uuid-slow', 'uuid-broken'], fetch_item=fetch_item, timeout=60,
+                                poll_interval=10, max_workers=1, clock=lambda: now[0], sleep=sleep)
+    assert [(result.uuid, result.passed) for result in results] == [
+        ('uuid-fast', True), ('uuid-slow', True), ('uuid-broken', False)]
+    assert results[2].problems == ["It could not be looked up. RuntimeError: Server error."]
+    assert [uuid for uuid, _ in fetches].count('uuid-slow') == 3
+
+    now[0] = 0
+    [result] = verify_file_items(['uuid-slow'], fetch_item=fetch_item, timeout=15, poll_interval=10,
+                                 clock=lambda: now[0], sleep=sleep)
+    assert result.problems == ["Its status is still 'uploading'."]
+
+
+def test_verification_report():
+    results = verify_file_item({'uuid': 'uuid-1', 'filename': 'a.bam', 'status': 'uploaded',
+                                'extra_files': [{'filename': 'a.bam.bai', 'status': 'uploading'}]})
+    assert verification_report(results) == [
+        "Verification FAILED: 1 of 2 files registered as uploaded.",
+        "  ok     a.bam for item uuid-1 (uploaded)",
+        "  FAILED a.bam.bai [extra file] for item uuid-1 (uploading)",
+        "         Its status is still 'uploading'.",
+    ]
+    assert verification_report(results[:1])[0] == "Verification PASSED: 1 of 1 file registered as uploaded."
+
+
+def test_verify_uploads(tmp_path, local_files):
+
+    items = {
+        'uuid-1': {'uuid': 'uuid-1', 'filename': 'a.bam', 'status': 'uploaded', 'file_size': 8,
+                   'extra_files': [{'filename': 'a.bam.bai', 'status': 'uploaded', 'file_size': 5}]},
+        'uuid-2': {'uuid': 'uuid-2', 'filename': 'b.fastq', 'status': 'upload failed'},
+    }
+
+    def mocked_get_file_item(uuid, auth):
+        assert auth == SOME_AUTH
+        return items[uuid]
+
+    with mock.patch.object(submission_module, "get_file_item", mocked_get_file_item):
+        with shown_output() as shown:
+            assert verify_uploads([{'uuid': 'uuid-1', 'filename': 'a.bam'}], auth=SOME_AUTH,
+                                  folder=str(tmp_path)) is True
+            assert shown.lines[0] == "Verifying that the portal registered 1 File item as uploaded."
+            assert shown.lines[1] == "Verification PASSED: 2 of 2 files registered as uploaded."
+        with shown_output() as shown:
+            assert verify_uploads([{'uuid': 'uuid-1', 'filename': 'a.bam'}, {'uuid': 'uuid-2', 'filename': 'b.fastq'}],
+                                  auth=SOME_AUTH, folder=str(tmp_path)) is False
+            assert shown.lines[1] == "Verification FAILED: 2 of 3 files registered as uploaded."
+
+
+def test_verify_uploads_script():
+
+    def test_it(args_in, expect_exit_code, expect_called, expect_call_args=None, passed=True):
+        with argparse_errors_muffled():
+            with mock.patch.object(verify_uploads_script_module, "verify_submission_uploads") as mock_verify:
+                mock_verify.return_value = passed
+                with system_exit_expected(exit_code=expect_exit_code):
+                    verify_uploads_main(args_in)
+                    raise AssertionError("verify_uploads_main should not exit normally.")  # pragma: no cover
+                assert mock_verify.call_count == (1 if expect_called else 0)
+                if expect_called:
+                    mock_verify.assert_called_with(**expect_call_args)
+
+    test_it(args_in=[], expect_exit_code=2, expect_called=False)  # Missing args
+    expect_call_args = {'uuid': 'some-guid', 'server': None, 'env': None, 'upload_folder': None, 'subfolders': False}
+    test_it(args_in=['some-guid'], expect_exit_code=0, expect_called=True, expect_call_args=expect_call_args)
+    test_it(args_in=['some-guid'], expect_exit_code=1, expect_called=True, expect_call_args=expect_call_args,
+            passed=False)
+    test_it(args_in=['some-guid', '-u', 'data', '-sf'], expect_exit_code=0, expect_called=True,
+            expect_call_args=dict(expect_call_args, upload_folder='data', subfolders=True))
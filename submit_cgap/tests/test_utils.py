@@ -1,6 +1,7 @@
 import contextlib
 import pytest
 import re
+import threading
 
 from dcicutils.misc_utils import ignored, override_environ, environ_bool
 from unittest import mock
@@ -8,6 +9,7 @@ from unittest import mock
 from .. import utils as utils_module
 from ..utils import (
     show, keyword_as_title, FakeResponse, script_catch_errors, ERROR_HERALD, ERASE_LINE, TIMESTAMP_REGEXP,
+    TaskGraph,
 )
 
 
@@ -182,3 +184,51 @@ def test_script_catch_errors():
     with override_environ(DEBUG_CGAP="TRUE"):
         assert environ_bool("DEBUG_CGAP")      # Set to "TRUE", the value is True
     # As it happens, random other values are false, but we just don't care about that.
+
+
+def test_task_graph():
+
+    release_root = threading.Event()
+    calls = []
+
+    def root():
+        # Holding this task open shows that independent tasks get to run in the meantime.
+        assert release_root.wait(timeout=5)
+        calls.append('root')
+        return 3
+
+    def independent():
+        calls.append('independent')
+        return 'independent value'
+
+    def dependent(root, increment):
+        calls.append('dependent')
+        return root + increment
+
+    with TaskGraph() as graph:
+        graph.add('root', root)
+        graph.add('independent', independent)
+        graph.add('dependent', dependent, depends_on=['root'], increment=4)
+        assert graph.result('independent') == 'independent value'
+        assert calls == ['independent']
+        release_root.set()
+        assert graph.result('dependent') == 7
+        assert graph.result('root') == 3
+        assert calls == ['independent', 'root', 'dependent']
+
+    def broken():
+        raise RuntimeError("broken")
+
+    with TaskGraph() as graph:
+        graph.add('broken', broken)
+        graph.add('dependent', lambda broken: broken, depends_on=['broken'])
+        graph.add('fine', lambda: 'fine')
+        assert graph.result('fine') == 'fine'
+        with pytest.raises(RuntimeError, match="broken"):
+            graph.result('broken')
+        with pytest.raises(RuntimeError, match="broken"):
+            graph.result('dependent')  # The error of a dependency is the error of its dependents
+        with pytest.raises(ValueError, match="already added"):
+            graph.add('fine', lambda: 'again')
+        with pytest.raises(ValueError, match="has not been added"):
+            graph.add('orphan', lambda missing: missing, depends_on=['missing'])
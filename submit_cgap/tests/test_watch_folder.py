@@ -0,0 +1,227 @@
+import os
+import pytest
+import sys
+
+from dcicutils.qa_utils import raises_regexp
+from unittest import mock
+
+from .test_utils import shown_output
+from .testing_helpers import argparse_errors_muffled, system_exit_expected
+from .. import submission as submission_module
+from .. import watch_folder as watch_folder_module
+from ..scripts import watch_folder as watch_folder_script_module
+from ..scripts.watch_folder import main as watch_folder_main
+from ..watch_folder import (
+    BundleState, FileState, FolderEvents, FolderWatcher, WatchJournal, _compute_seconds, watch_folder,
+)
+
+
+SOME_SERVER = 'http://localhost:7777'
+SOME_AUTH = {'key': 'my-key-id', 'secret': 'good-secret', 'server': SOME_SERVER}
+
+UPLOAD_INFO = [{'uuid': 'uuid-a', 'filename': 'a.fastq.gz'}, {'uuid': 'uuid-b', 'filename': 'b.fastq.gz'}]
+
+
+def write_old_file(path, content=b"some data"):
+    """Writes a file that was last written long enough ago to be taken as finished."""
+    path.write_bytes(content)
+    os.utime(path, (1_000_000, 1_000_000))
+    return str(path)
+
+
+class FakePortal:
+    """Stands in for the portal, processing each submission on the second check."""
+
+    def __init__(self, outcome="success", upload_info=UPLOAD_INFO):
+        self.outcome = outcome
+        self.upload_info = upload_info
+        self.submitted = []
+        self.checks = {}
+
+    def post_ingestion_submission(self, path, **kwargs):
+        self.submitted.append(path)
+        return f"submission-{len(self.submitted)}"
+
+    def check_ingestion_progress(self, uuid, *, keypair, server, poll_state):
+        self.checks[uuid] = self.checks.get(uuid, 0) + 1
+        if self.checks[uuid] < 2:
+            return False, "processing", {}
+        return True, self.outcome, {'uuid': uuid, 'additional_data': {'upload_info': self.upload_info}}
+
+
+@pytest.fixture()
+def portal():
+    portal = FakePortal()
+    with mock.patch.object(watch_folder_module, "post_ingestion_submission", portal.post_ingestion_submission):
+        with mock.patch.object(watch_folder_module, "_check_ingestion_progress", portal.check_ingestion_progress):
+            with mock.patch.object(watch_folder_module, "PROGRESS_CHECK_INTERVAL", 0):
+                yield portal
+
+
+def make_watcher(folder, journal, **kwargs):
+    return FolderWatcher(str(folder), server=SOME_SERVER, keydict=SOME_AUTH, app_args={}, journal=journal,
+                         events=FolderEvents(use_inotify=False, sleep=lambda seconds: None), settle=60, interval=0,
+                         workers=1, **kwargs)
+
+
+def finish_uploads(watcher):
+    for upload in list(watcher._uploading):
+        upload.result()
+    watcher.collect_uploads()
+
+
+def test_compute_seconds():
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_WATCH_SETTLE": "5"}):
+        assert _compute_seconds("SUBMITCGAP_WATCH_SETTLE", 60) == 5
+    with mock.patch.dict(os.environ, {"SUBMITCGAP_WATCH_SETTLE": "soon"}):
+        with mock.patch.object(watch_folder_module, "PRINT") as mock_print:
+            assert _compute_seconds("SUBMITCGAP_WATCH_SETTLE", 60) == 60
+            assert mock_print.call_count == 1
+
+
+def test_watch_journal(tmp_path):
+    journal = WatchJournal(str(tmp_path / "journal" / "watch.sqlite3"))
+    journal.record_bundle(SOME_SERVER, "/drop/b.xlsx", 100, 1.5, state=BundleState.SUBMITTED, submission_uuid="s1")
+    journal.record_bundle(SOME_SERVER, "/drop/b.xlsx", 100, 1.5, state=BundleState.UPLOADING, outcome="success")
+    bundle = journal.get_bundle(SOME_SERVER, "/drop/b.xlsx", 100, 1.5)
+    assert (bundle['state'], bundle['submission_uuid'], bundle['outcome']) == ('uploading', 's1', 'success')
+    assert journal.get_bundle(SOME_SERVER, "/drop/b.xlsx", 200, 2.5) is None  # a replaced bundle is another bundle
+    assert [b['path'] for b in journal.get_bundles(SOME_SERVER, [BundleState.UPLOADING, BundleState.DONE])] == [
+        "/drop/b.xlsx"]
+    assert journal.get_bundles(SOME_SERVER, [BundleState.SUBMITTED]) == []
+    journal.record_planned_files(SOME_SERVER, "s1", UPLOAD_INFO)
+    journal.record_file(SOME_SERVER, "s1", "uuid-a", state=FileState.DONE, attempted=True)
+    journal.record_planned_files(SOME_SERVER, "s1", UPLOAD_INFO)  # Already-recorded files are left as they are.
+    assert [(f['filename'], f['state'], f['attempts']) for f in journal.get_files(SOME_SERVER, "s1")] == [
+        ('a.fastq.gz', 'done', 1), ('b.fastq.gz', 'waiting', 0)]
+    journal.close()
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="inotify is only on Linux")
+def test_folder_events_with_inotify(tmp_path):
+    events = FolderEvents()
+    try:
+        assert events.uses_inotify
+        events.watch(str(tmp_path))
+        assert not events.wait(0)
+        (tmp_path / "bundle.xlsx").write_bytes(b"some bundle")
+        assert events.wait(5)
+        assert not events.wait(0)  # The events were all taken.
+    finally:
+        events.close()
+
+
+def test_folder_events_polling(tmp_path):
+    slept = []
+    events = FolderEvents(use_inotify=False, sleep=slept.append)
+    events.watch(str(tmp_path))
+    assert not events.uses_inotify
+    assert not events.wait(7)
+    assert slept == [7]
+
+
+def test_folder_watcher(tmp_path, portal):
+    drop = tmp_path / "drop"
+    drop.mkdir()
+    journal = WatchJournal(str(tmp_path / "watch.sqlite3"))
+    bundle = write_old_file(drop / "bundle.xlsx")
+    (drop / "~$bundle.xlsx").write_bytes(b"Excel's lock file")
+    (drop / "new.xlsx").write_bytes(b"still being written")
+    write_old_file(drop / "a.fastq.gz")
+    uploaded = []
+
+    def mocked_upload_found_file(uuid, file_path, auth, folder, subfolders, submission_uuid):
+        uploaded.append((uuid, file_path, submission_uuid))
+        return True
+
+    with mock.patch.object(watch_folder_module, "upload_found_file", mocked_upload_found_file):
+        with shown_output() as shown:
+            watcher = make_watcher(drop, journal)
+            assert watcher.find_bundles() == [bundle, str(drop / "new.xlsx")]
+            watcher.step()
+            assert portal.submitted == [bundle]  # The new bundle isn't finished yet.
+            watcher.step()
+            finish_uploads(watcher)
+            assert uploaded == [('uuid-a', str(drop / "a.fastq.gz"), 'submission-1')]
+            watcher.step()  # b.fastq.gz isn't there yet.
+            assert not watcher.is_idle()
+            write_old_file(drop / "b.fastq.gz")
+            watcher.step()
+            finish_uploads(watcher)
+            watcher.step()
+            watcher.close()
+            assert uploaded[1:] == [('uuid-b', str(drop / "b.fastq.gz"), 'submission-1')]
+            assert journal.get_bundles(SOME_SERVER, [BundleState.DONE])[0]['path'] == bundle
+            assert any(line.endswith(f"All 2 files called for by bundle {bundle} were uploaded.")
+                       for line in shown.lines)
+        # A watcher started again doesn't submit (or upload for) what's been done again, only the new bundle.
+        os.utime(drop / "new.xlsx", (1_000_000, 1_000_000))
+        watcher = make_watcher(drop, journal)
+        with shown_output():
+            watcher.run(until_done=True)
+        assert portal.submitted == [bundle, str(drop / "new.xlsx")]
+        assert [(uuid, submission_uuid) for uuid, _, submission_uuid in uploaded[2:]] == [
+            ('uuid-a', 'submission-2'), ('uuid-b', 'submission-2')]
+    journal.close()
+
+
+def test_folder_watcher_failures(tmp_path, portal):
+    journal = WatchJournal(str(tmp_path / "watch.sqlite3"))
+    portal.upload_info = UPLOAD_INFO[:1]
+    write_old_file(tmp_path / "bundle.xlsx")
+    write_old_file(tmp_path / "a.fastq.gz")
+    with mock.patch.object(watch_folder_module, "upload_found_file", return_value=False) as mock_upload:
+        with shown_output() as shown:
+            watcher = make_watcher(tmp_path, journal)
+            watcher.run(until_done=True)  # It tries again (here, with no wait), and gives up.
+            assert mock_upload.call_count == watch_folder_module.WATCH_UPLOAD_ATTEMPTS
+            [failed] = journal.get_bundles(SOME_SERVER, [BundleState.FAILED])
+            assert any("1 of the 1 files called for by bundle" in line and
+                       "resume-uploads submission-1" in line for line in shown.lines)
+    portal.outcome = "error"
+    write_old_file(tmp_path / "other.xlsx")
+    with shown_output() as shown:
+        make_watcher(tmp_path, journal).run(until_done=True)
+        assert any(line.endswith("Final status: Error") for line in shown.lines)
+    assert len(journal.get_bundles(SOME_SERVER, [BundleState.FAILED])) == 2
+    journal.close()
+
+
+def test_watch_folder(tmp_path):
+    with raises_regexp(ValueError, "does not exist"):
+        watch_folder(str(tmp_path / "missing"), server=SOME_SERVER)
+    with mock.patch.object(watch_folder_module, "WATCH_JOURNAL", str(tmp_path / "watch.sqlite3")):
+        with mock.patch.object(watch_folder_module.KEY_MANAGER, "get_keydict_for_server", return_value=SOME_AUTH):
+            with mock.patch.object(submission_module, "get_user_record", return_value={}):
+                with mock.patch.object(submission_module, "do_app_arg_defaulting") as mock_defaulting:
+                    with mock.patch.object(FolderWatcher, "run") as mock_run:
+                        watch_folder(str(tmp_path), server=SOME_SERVER, institution='/institutions/hms-dbmi/',
+                                     project='/projects/test/', until_done=True)
+    mock_defaulting.assert_called_once_with({'institution': '/institutions/hms-dbmi/',
+                                             'project': '/projects/test/'}, {})
+    mock_run.assert_called_once_with(until_done=True)
+
+
+def test_watch_folder_script():
+
+    def test_it(args_in, expect_exit_code, expect_call_args=None):
+        with argparse_errors_muffled():
+            with mock.patch.object(watch_folder_script_module, "watch_folder") as mock_watch_folder:
+                with system_exit_expected(exit_code=expect_exit_code):
+                    watch_folder_main(args_in)
+                    raise AssertionError("watch_folder_main should not exit normally.")  # pragma: no cover
+                if expect_call_args:
+                    mock_watch_folder.assert_called_with('/drop', **expect_call_args)
+                else:
+                    assert mock_watch_folder.call_count == 0
+
+    default_args = {
+        'institution': None, 'project': None, 'server': None, 'env': None, 'validate_only': False,
+        'upload_folder': None, 'ingestion_type': 'metadata_bundle', 'subfolders': False, 'app': 'cgap',
+        'submission_protocol': 'upload', 'until_done': False,
+    }
+    test_it([], expect_exit_code=2)
+    test_it(['/drop'], expect_exit_code=0, expect_call_args=default_args)
+    test_it(['/drop', '-s', SOME_SERVER, '-u', '/data', '-sf', '--until-done'], expect_exit_code=0,
+            expect_call_args=dict(default_args, server=SOME_SERVER, upload_folder='/data', subfolders=True,
+                                  until_done=True))
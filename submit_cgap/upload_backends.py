@@ -0,0 +1,150 @@
+# This file contains the ways in which the files of a submission can be uploaded: one at a time (as they always have
+# been), several at once on threads, or several at once in separate processes.
+#
+# With many transfers going on at once, the work of encrypting (TLS) and checksumming the data sent can use up all
+# of the one CPU a Python process gets to use, so that a fast network goes underused. Setting SUBMITCGAP_UPLOAD_BACKEND
+# to "processes" spreads files across SUBMITCGAP_UPLOAD_WORKERS worker processes. Their output is sent back to be
+# shown by the main process, and any bandwidth limit (see bandwidth.py) is divided equally among them. (Threads share
+# the limit as they go, except that each transfer by the AWS CLI, which can't, is held to an equal share of it.)
+
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+from dcicutils.misc_utils import PRINT
+from typing import Any, Callable, List, Sequence
+from . import utils as utils_module
+from .bandwidth import BANDWIDTH_LIMITER, BandwidthSchedule
+
+
+UPLOAD_BACKEND_VAR = 'SUBMITCGAP_UPLOAD_BACKEND'
+UPLOAD_WORKERS_VAR = 'SUBMITCGAP_UPLOAD_WORKERS'
+
+
+class UploadBackend:
+    SERIAL = 'serial'
+    THREADS = 'threads'
+    PROCESSES = 'processes'
+
+
+UPLOAD_BACKENDS = [UploadBackend.SERIAL, UploadBackend.THREADS, UploadBackend.PROCESSES]
+DEFAULT_UPLOAD_BACKEND = UploadBackend.SERIAL
+DEFAULT_UPLOAD_WORKERS = 4
+
+
+def _compute_upload_backend():  # factored out as a function for testing
+    backend = os.environ.get(UPLOAD_BACKEND_VAR) or DEFAULT_UPLOAD_BACKEND
+    if backend not in UPLOAD_BACKENDS:
+        PRINT(f"Ignoring {UPLOAD_BACKEND_VAR}={backend!r}, which is not one of {', '.join(UPLOAD_BACKENDS)}.")
+        backend = DEFAULT_UPLOAD_BACKEND
+    return backend
+
+
+def _compute_upload_workers():  # factored out as a function for testing
+    value = os.environ.get(UPLOAD_WORKERS_VAR)
+    try:
+        workers = int(value) if value else DEFAULT_UPLOAD_WORKERS
+        if workers < 1:
+            raise ValueError("It must be at least 1.")
+    except ValueError as e:
+        PRINT(f"Ignoring {UPLOAD_WORKERS_VAR}={value!r}. {e}")
+        workers = DEFAULT_UPLOAD_WORKERS
+    return workers
+
+
+UPLOAD_BACKEND = _compute_upload_backend()
+UPLOAD_WORKERS = _compute_upload_workers()
+
+
+def divided_schedule(schedule: BandwidthSchedule, n: int) -> BandwidthSchedule:
+    """Returns a schedule of rates 1/n of those of the given schedule (for each of n processes sharing it)."""
+    return BandwidthSchedule([(start, end, rate / n if rate is not None else None)
+                              for start, end, rate in schedule.periods])
+
+
+class _ForwardedPrint:
+    """Stands in for PRINT in a worker process, sending what's printed to the main process to be shown."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def __call__(self, *args, **kwargs):
+        self.queue.put((tuple(str(arg) for arg in args), kwargs))
+
+
+def _init_worker_process(queue, workers: int) -> None:
+    utils_module.PRINT = _ForwardedPrint(queue)  # This process's own copy of utils, so only its output is forwarded.
+    BANDWIDTH_LIMITER.schedule = divided_schedule(BANDWIDTH_LIMITER.schedule, workers)
+
+
+def _show_forwarded_output(queue) -> None:
+    while True:
+        item = queue.get()
+        if item is None:
+            return
+        args, kwargs = item
+        utils_module.PRINT(*args, **kwargs)
+
+
+def _call(function_and_args):
+    function, args = function_and_args
+    return function(*args)
+
+
+def run_upload_jobs(function: Callable[..., Any], jobs: Sequence[tuple], backend: str = UploadBackend.SERIAL,
+                    workers: int = DEFAULT_UPLOAD_WORKERS, on_error: Callable[[tuple, BaseException], Any] = None
+                    ) -> List[Any]:
+    """
+    Calls a function for each of a number of jobs, one at a time or several at once.
+
+    :param function: the function to call. For the processes backend, it (and its arguments) must be picklable,
+        so it must be a module-level function.
+    :param jobs: a tuple of arguments for each call
+    :param backend: one of UPLOAD_BACKENDS
+    :param workers: the number of threads or processes to use (for other than the serial backend)
+    :param on_error: a function called with the job's arguments and the exception, if a call raises an error
+        (default: the error is raised), whose result is taken as that of the call
+    :return: the results of the calls, in the order of the jobs
+    """
+
+    def call(args):
+        try:
+            return function(*args)
+        except Exception as e:
+            if on_error is None:
+                raise
+            return on_error(args, e)
+
+    if backend == UploadBackend.SERIAL or len(jobs) <= 1:
+        return [call(args) for args in jobs]
+    if backend == UploadBackend.THREADS:
+        workers = min(workers, len(jobs))
+        transfers, BANDWIDTH_LIMITER.transfers = BANDWIDTH_LIMITER.transfers, workers  # for transfers by the AWS CLI
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(call, jobs))
+        finally:
+            BANDWIDTH_LIMITER.transfers = transfers
+    workers = min(workers, len(jobs))
+    context = multiprocessing.get_context()
+    queue = context.Queue()
+    shower = threading.Thread(target=_show_forwarded_output, args=(queue,), daemon=True)
+    shower.start()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                                    initializer=_init_worker_process,
+                                                    initargs=(queue, workers)) as executor:
+            futures = [executor.submit(_call, (function, args)) for args in jobs]
+            results = []
+            for args, future in zip(jobs, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:  # including a worker process that died
+                    if on_error is None:
+                        raise
+                    results.append(on_error(args, e))
+            return results
+    finally:
+        queue.put(None)
+        shower.join()
+        queue.close()
@@ -0,0 +1,232 @@
+# This file contains a local SQLite ledger of submissions and of the state of each of their file uploads.
+#
+# The ledger lets resume-uploads skip files that were already uploaded (e.g., before a crash or a Ctrl-C),
+# and lets show-upload-progress report on uploads without contacting the portal.
+
+import os
+import sqlite3
+import threading
+import time
+from dcicutils.misc_utils import environ_bool, PRINT
+from typing import Callable, Iterable, List, Optional
+
+
+LEDGER_FILE_VAR = 'SUBMITCGAP_LEDGER_FILE'
+NO_LEDGER_VAR = 'SUBMITCGAP_NO_LEDGER'
+
+LEDGER_TIMEOUT = 30  # seconds to wait for another process's write to finish
+
+
+class UploadStatus:
+    PENDING = 'pending'
+    IN_PROGRESS = 'in-progress'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+UPLOAD_STATUSES = [UploadStatus.PENDING, UploadStatus.IN_PROGRESS, UploadStatus.DONE, UploadStatus.FAILED]
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    server TEXT NOT NULL,
+    submission_uuid TEXT NOT NULL,
+    bundle_filename TEXT,
+    upload_folder TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (server, submission_uuid)
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    server TEXT NOT NULL,
+    submission_uuid TEXT NOT NULL,
+    file_uuid TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    path TEXT,
+    status TEXT NOT NULL,
+    size INTEGER,
+    md5 TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    duration REAL,
+    error TEXT,
+    PRIMARY KEY (server, submission_uuid, file_uuid, filename)
+);
+"""
+
+
+def _compute_default_ledger_file():  # factored out as a function for testing
+    ledger_file = os.environ.get(LEDGER_FILE_VAR)
+    if not ledger_file:
+        data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+        ledger_file = os.path.join(data_home, 'submit-cgap', 'ledger.sqlite3')
+    return ledger_file
+
+
+class UploadLedger:
+    """
+    A record, in an SQLite database, of submissions and of the state of each file upload they call for.
+
+    Each upload is identified by server, submission uuid, File item uuid and filename (a File item's extra files
+    share its uuid but not its filename). The ledger is an aid, not a necessity: if the database can't be used,
+    a warning is shown and uploading goes on without it.
+    """
+
+    def __init__(self, filename: str, enabled: bool = True):
+        """
+        :param filename: the name of the SQLite database file (created as needed)
+        :param enabled: whether to keep a ledger at all
+        """
+        self.filename = filename
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._local = threading.local()  # each thread's connection, and the process and file it's for
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns this thread's connection to the database, connecting (and making the tables) if need be."""
+        key = (os.getpid(), self.filename)  # A connection can't be used in a process forked from its own.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.key != key:
+            if connection is not None and self._local.key[0] == key[0]:
+                connection.close()
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), mode=0o700, exist_ok=True)
+            connection = sqlite3.connect(self.filename, timeout=LEDGER_TIMEOUT)
+            connection.row_factory = sqlite3.Row
+            connection.executescript(LEDGER_SCHEMA)
+            self._local.connection, self._local.key = connection, key
+        return connection
+
+    def _execute(self, statement: str, parameters=()) -> List[dict]:
+        if not self.enabled:
+            return []
+        with self._lock:
+            try:
+                connection = self._connection()
+                with connection:  # commits on success, rolls back on error
+                    return [dict(row) for row in connection.execute(statement, parameters).fetchall()]
+            except (sqlite3.Error, OSError) as e:
+                self._local.connection = None
+                PRINT(f"Warning: Not keeping upload ledger {self.filename} because of {e.__class__.__name__}: {e}")
+                self.enabled = False
+                return []
+
+    def record_submission(self, server: str, submission_uuid: str, *,
+                          bundle_filename: Optional[str] = None, upload_folder: Optional[str] = None) -> None:
+        now = time.time()
+        self._execute("INSERT INTO submissions (server, submission_uuid, bundle_filename, upload_folder,"
+                      " created, updated) VALUES (?, ?, ?, ?, ?, ?)"
+                      " ON CONFLICT (server, submission_uuid) DO UPDATE SET"
+                      " bundle_filename = coalesce(excluded.bundle_filename, bundle_filename),"
+                      " upload_folder = coalesce(excluded.upload_folder, upload_folder),"
+                      " updated = excluded.updated",
+                      (server, submission_uuid, bundle_filename, upload_folder, now, now))
+
+    def record_planned(self, server: str, submission_uuid: str, file_uuid: str, filenames: Iterable[str]) -> None:
+        """Records uploads as pending, unless they're already recorded."""
+        for filename in filenames:
+            self._execute("INSERT OR IGNORE INTO uploads (server, submission_uuid, file_uuid, filename, status)"
+                          " VALUES (?, ?, ?, ?, ?)",
+                          (server, submission_uuid, file_uuid, filename, UploadStatus.PENDING))
+
+    def record_started(self, server: str, submission_uuid: str, file_uuid: str, filename: str, *,
+                       path: Optional[str] = None, size: Optional[int] = None) -> None:
+        self._execute("INSERT INTO uploads (server, submission_uuid, file_uuid, filename, path, status, size,"
+                      " attempts, started) VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?)"
+                      " ON CONFLICT (server, submission_uuid, file_uuid, filename) DO UPDATE SET"
+                      " path = excluded.path, status = excluded.status, size = excluded.size,"
+                      " attempts = attempts + 1, started = excluded.started,"
+                      " finished = NULL, duration = NULL, error = NULL",
+                      (server, submission_uuid, file_uuid, filename, path, UploadStatus.IN_PROGRESS, size,
+                       time.time()))
+
+    def _record_finished(self, server, submission_uuid, file_uuid, filename, *, status, md5=None, error=None):
+        now = time.time()
+        self._execute("UPDATE uploads SET status = ?, md5 = coalesce(?, md5), error = ?,"
+                      " finished = ?, duration = ? - started"
+                      " WHERE server = ? AND submission_uuid = ? AND file_uuid = ? AND filename = ?",
+                      (status, md5, error, now, now, server, submission_uuid, file_uuid, filename))
+
+    def record_done(self, server: str, submission_uuid: str, file_uuid: str, filename: str, *,
+                    md5: Optional[str] = None) -> None:
+        self._record_finished(server, submission_uuid, file_uuid, filename, status=UploadStatus.DONE, md5=md5)
+
+    def record_failed(self, server: str, submission_uuid: str, file_uuid: str, filename: str, *, error: str) -> None:
+        self._record_finished(server, submission_uuid, file_uuid, filename, status=UploadStatus.FAILED, error=error)
+
+    def is_complete(self, server: str, submission_uuid: str, file_uuid: str) -> bool:
+        """Returns True if uploads for the given File item are recorded, and all of them are done."""
+        statuses = {row['status'] for row in self._execute("SELECT status FROM uploads WHERE server = ?"
+                                                           " AND submission_uuid = ? AND file_uuid = ?",
+                                                           (server, submission_uuid, file_uuid))}
+        return statuses == {UploadStatus.DONE}
+
+    def get_submissions(self, server: Optional[str] = None, submission_uuid: Optional[str] = None) -> List[dict]:
+        """Returns the recorded submissions, optionally only those for a given server and/or uuid, oldest first."""
+        return self._execute("SELECT * FROM submissions WHERE coalesce(?, server) = server"
+                             " AND coalesce(?, submission_uuid) = submission_uuid ORDER BY created",
+                             (server, submission_uuid))
+
+    def get_uploads(self, server: str, submission_uuid: str) -> List[dict]:
+        """Returns the recorded uploads for a given submission, in the order they were first recorded."""
+        return self._execute("SELECT * FROM uploads WHERE server = ? AND submission_uuid = ? ORDER BY rowid",
+                             (server, submission_uuid))
+
+    def observed_throughput(self, server: Optional[str] = None, recent: int = 100) -> Optional[float]:
+        """
+        Returns the average throughput, in bytes per second, of the most recent completed uploads
+        (optionally only those to a given server), or None if there are none to go by.
+        """
+        [row] = self._execute("SELECT sum(size) AS size, sum(duration) AS duration FROM"
+                              " (SELECT size, duration FROM uploads WHERE status = ? AND coalesce(?, server) = server"
+                              " AND size > 0 AND duration > 0 ORDER BY finished DESC LIMIT ?)",
+                              (UploadStatus.DONE, server, recent)) or [{}]
+        return row['size'] / row['duration'] if row.get('size') and row.get('duration') else None
+
+    def tracker(self, server: str, submission_uuid: str, file_uuid: str,
+                md5_lookup: Optional[Callable[[str], Optional[str]]] = None) -> 'FileUploadTracker':
+        return FileUploadTracker(ledger=self, server=server, submission_uuid=submission_uuid, file_uuid=file_uuid,
+                                 md5_lookup=md5_lookup)
+
+
+class FileUploadTracker:
+    """Records, in an UploadLedger, the uploads for a given File item (its own file and any extra files)."""
+
+    def __init__(self, *, ledger: UploadLedger, server: str, submission_uuid: str, file_uuid: str,
+                 md5_lookup: Optional[Callable[[str], Optional[str]]] = None):
+        """
+        :param md5_lookup: a function that, given a file path, returns its md5 checksum if that's known
+            without reading the file again (e.g., LocalFileIndex.cached_md5), or else None
+        """
+        self.ledger = ledger
+        self.server = server
+        self.submission_uuid = submission_uuid
+        self.file_uuid = file_uuid
+        self.md5_lookup = md5_lookup
+
+    def _key(self):
+        return self.server, self.submission_uuid, self.file_uuid
+
+    def planned(self, file_names: Iterable[str]) -> None:
+        self.ledger.record_planned(*self._key(), [os.path.basename(file_name) for file_name in file_names])
+
+    def started(self, file_path: str) -> None:
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = None
+        self.ledger.record_started(*self._key(), os.path.basename(file_path), path=file_path, size=size)
+
+    def succeeded(self, file_path: str, md5: Optional[str] = None) -> None:
+        if md5 is None and self.md5_lookup is not None:
+            md5 = self.md5_lookup(file_path)
+        self.ledger.record_done(*self._key(), os.path.basename(file_path), md5=md5)
+
+    def failed(self, file_path: str, error: Exception) -> None:
+        self.ledger.record_failed(*self._key(), os.path.basename(file_path),
+                                  error=f"{error.__class__.__name__}: {error}")
+
+    def is_complete(self) -> bool:
+        return self.ledger.is_complete(*self._key())
+
+
+UPLOAD_LEDGER = UploadLedger(filename=_compute_default_ledger_file(), enabled=not environ_bool(NO_LEDGER_VAR))
@@ -0,0 +1,154 @@
+# This file contains size-aware ordering of the files a submission calls for uploading.
+#
+# Uploads normally go in the order the submission lists its files. SUBMITCGAP_UPLOAD_ORDER can instead ask for
+# the largest files first ("largest-first"), or for a longest-processing-time schedule across workers ("lpt"),
+# so that one very large file doesn't start last and hold up the end of the whole submission.
+# SUBMITCGAP_UPLOAD_PRIORITY can name, as a comma-separated list of filename patterns (e.g., "*proband*,*.cram"),
+# files to go first: those matching the first pattern, then those matching the second, and so on, then the rest.
+
+import fnmatch
+import heapq
+import os
+from dcicutils.misc_utils import PRINT
+from typing import Any, List, Optional, Sequence, Tuple
+
+
+UPLOAD_ORDER_VAR = 'SUBMITCGAP_UPLOAD_ORDER'
+UPLOAD_PRIORITY_VAR = 'SUBMITCGAP_UPLOAD_PRIORITY'
+
+
+class UploadOrder:
+    LISTED = 'listed'
+    LARGEST_FIRST = 'largest-first'
+    LPT = 'lpt'
+
+
+UPLOAD_ORDERS = [UploadOrder.LISTED, UploadOrder.LARGEST_FIRST, UploadOrder.LPT]
+DEFAULT_UPLOAD_ORDER = UploadOrder.LISTED
+
+
+def _compute_upload_order():  # factored out as a function for testing
+    order = os.environ.get(UPLOAD_ORDER_VAR) or DEFAULT_UPLOAD_ORDER
+    if order not in UPLOAD_ORDERS:
+        PRINT(f"Ignoring {UPLOAD_ORDER_VAR}={order!r}, which is not one of {', '.join(UPLOAD_ORDERS)}.")
+        order = DEFAULT_UPLOAD_ORDER
+    return order
+
+
+def _compute_upload_priorities():  # factored out as a function for testing
+    return [pattern.strip() for pattern in (os.environ.get(UPLOAD_PRIORITY_VAR) or '').split(',') if pattern.strip()]
+
+
+UPLOAD_ORDER = _compute_upload_order()
+UPLOAD_PRIORITIES = _compute_upload_priorities()
+
+
+def priority_rank(file_name: str, priorities: Sequence[str]) -> int:
+    """
+    Returns the index of the first of the given filename patterns that the file's name matches (lower goes first),
+    or len(priorities) if it matches none of them.
+    """
+    base_name = os.path.basename(file_name)
+    for rank, pattern in enumerate(priorities):
+        if fnmatch.fnmatch(base_name, pattern):
+            return rank
+    return len(priorities)
+
+
+def file_size_or_zero(file_path: Optional[str]) -> int:
+    try:
+        return os.path.getsize(file_path) if file_path else 0
+    except OSError:
+        return 0
+
+
+def assign_to_workers(sizes: Sequence[int], workers: int) -> List[List[int]]:
+    """
+    Assigns jobs of the given sizes, in the order given, each to the worker with the least work so far
+    (which, for jobs given largest first, is the longest-processing-time heuristic).
+
+    :return: a list, for each worker, of the indexes of the jobs assigned to it, in order
+    """
+    loads = [(0, worker) for worker in range(max(1, workers))]
+    heapq.heapify(loads)
+    assignments = [[] for _ in loads]
+    for index, size in enumerate(sizes):
+        load, worker = heapq.heappop(loads)
+        assignments[worker].append(index)
+        heapq.heappush(loads, (load + size, worker))
+    return assignments
+
+
+def predict_makespan(sizes: Sequence[int], workers: int = 1) -> int:
+    """
+    Returns the number of bytes the busiest worker will have to upload, if uploads of the given sizes are
+    started in the order given, each by the first worker free.
+    """
+    return max((sum(sizes[index] for index in assigned) for assigned in assign_to_workers(sizes, workers)),
+               default=0)
+
+
+def schedule_uploads(items: Sequence[Tuple[str, int, Any]], order: str = UploadOrder.LISTED,
+                     priorities: Sequence[str] = (), workers: int = 1) -> List[Any]:
+    """
+    Orders uploads.
+
+    :param items: a sequence of (file_name, size, payload) tuples, in the order listed
+    :param order: one of UPLOAD_ORDERS
+    :param priorities: filename patterns for files to go first, in order (see priority_rank)
+    :param workers: the number of uploads to be done at once
+    :return: the payloads, in the order in which their uploads should be started
+    """
+    ranked = sorted(range(len(items)), key=lambda index: (priority_rank(items[index][0], priorities),
+                                                          0 if order == UploadOrder.LISTED else -items[index][1],
+                                                          index))
+    if order != UploadOrder.LPT or workers <= 1:
+        return [items[index][2] for index in ranked]
+    # Interleave the workers' queues in the order their uploads will start: at each step, the next upload of
+    # the worker that will soonest be free.
+    queues = [[ranked[position] for position in assigned]
+              for assigned in assign_to_workers([items[index][1] for index in ranked], workers)]
+    result = []
+    free_at = [(0, worker) for worker in range(len(queues))]
+    heapq.heapify(free_at)
+    while free_at:
+        t, worker = heapq.heappop(free_at)
+        if queues[worker]:
+            index = queues[worker].pop(0)
+            result.append(items[index][2])
+            heapq.heappush(free_at, (t + items[index][1], worker))
+    return result
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    if minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
+
+
+def format_size(nbytes: int) -> str:
+    return f"{nbytes / 1000 ** 3:.1f} GB" if nbytes >= 1000 ** 3 else f"{nbytes / 1000 ** 2:.1f} MB"
+
+
+def makespan_message(sizes: Sequence[int], order: str, workers: int = 1,
+                     throughput: Optional[float] = None) -> str:
+    """
+    Describes the uploads planned and, given the throughput (in bytes per second) of each worker in past uploads,
+    predicts how long they'll take.
+
+    :param sizes: the sizes of the files to be uploaded, in the order their uploads will start
+    """
+    message = (f"Planning to upload {len(sizes)} file{'' if len(sizes) == 1 else 's'}"
+               f" ({format_size(sum(sizes))}) in {order} order.")
+    if throughput:
+        makespan = predict_makespan(sizes, workers=workers) / throughput
+        message += (f" Predicted time to upload them all: {format_duration(makespan)}"
+                    f" (at {throughput / 1000 ** 2:.1f} MB/s, as in past uploads).")
+    else:
+        message += " There are no past uploads from which to predict how long that will take."
+    return message
@@ -0,0 +1,185 @@
+# This file contains an adaptive controller of the concurrency and part size of in-process (boto3) uploads.
+#
+# The best number of parts to upload at once, and the best part size, depend on the network and on the storage
+# being read from (e.g., NFS vs. local SSD), so rather than leave them to guesswork, an UploadTuner adjusts them
+# as uploads go on. Concurrency is adjusted by AIMD (additive increase, multiplicative decrease): it goes up by one
+# after each round of parts that went well, and is cut back sharply when throughput drops or S3 reports errors or
+# throttles requests. The part size, which can only change between files, grows while parts upload quickly and
+# shrinks when they're slow or fail.
+#
+# The bounds within which these are tuned can be set, or the settings pinned, by SUBMITCGAP_UPLOAD_CONCURRENCY
+# (e.g., "8" or "2-16") and SUBMITCGAP_UPLOAD_PART_SIZE (e.g., "64MiB" or "16MiB-512MiB").
+
+import re
+import threading
+from dcicutils.misc_utils import PRINT
+from typing import List, Optional, Tuple
+
+
+UPLOAD_CONCURRENCY_VAR = 'SUBMITCGAP_UPLOAD_CONCURRENCY'
+UPLOAD_PART_SIZE_VAR = 'SUBMITCGAP_UPLOAD_PART_SIZE'
+
+MIB = 1024 * 1024
+
+DEFAULT_CONCURRENCY_BOUNDS = (1, 16)
+DEFAULT_PART_SIZE_BOUNDS = (8 * MIB, 512 * MIB)
+
+S3_MIN_PART_SIZE = 5 * MIB  # for all but the last part
+
+PART_SIZE_STEP = 8 * MIB  # how much the part size grows after a file whose parts all uploaded quickly
+FAST_PART_SECONDS = 5  # parts uploading faster than this are small enough to grow
+SLOW_PART_SECONDS = 60  # parts uploading slower than this are big enough to shrink
+THROUGHPUT_DROP = 0.9  # a round with less than this fraction of the previous round's throughput is a drop
+DROP_DECREASE = 0.75  # the factor by which concurrency is cut after a drop in throughput
+FAILURE_DECREASE = 0.5  # the factor by which concurrency (and part size) are cut after an error or throttle
+
+SIZE_REGEXP = re.compile(r"^([0-9]+)\s*([KMGkmg]?)(?:i?[Bb])?$")
+SIZE_MULTIPLIERS = {'': 1, 'k': 1024, 'm': MIB, 'g': 1024 * MIB}
+
+THROTTLING_ERROR_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                          'ServiceUnavailable', 'RequestTimeout', '503'}
+
+
+def parse_size(spec: str) -> int:
+    """Parses a size such as "64MiB" (or "64MB" or "64M", all of which are taken to mean 64 * 1024 * 1024 bytes)."""
+    matched = SIZE_REGEXP.match(spec.strip())
+    if not matched:
+        raise ValueError(f"Not a size (such as 64MiB): {spec!r}")
+    number, prefix = matched.groups()
+    return int(number) * SIZE_MULTIPLIERS[prefix.lower()]
+
+
+def format_size(nbytes: int) -> str:
+    """Returns a size in the form parse_size understands, in MiB if that's a whole number."""
+    return f"{nbytes // MIB}MiB" if nbytes % MIB == 0 else str(nbytes)
+
+
+def parse_bounds(spec: str, parse=int) -> Tuple[int, int]:
+    """Parses a setting such as "8" (which pins it) or "2-16" (which bounds it), returning its (low, high) bounds."""
+    low, _, high = spec.partition('-')
+    low = parse(low)
+    high = parse(high) if high else low
+    if not 0 < low <= high:
+        raise ValueError(f"Not a valid range: {spec!r}")
+    return low, high
+
+
+def is_throttling_error(error: BaseException) -> bool:
+    """Returns True if the given exception is S3 asking us to slow down (rather than some other failure)."""
+    response = getattr(error, 'response', None)
+    code = ((response or {}).get('Error') or {}).get('Code') if isinstance(response, dict) else None
+    return str(code) in THROTTLING_ERROR_CODES
+
+
+class UploadTuner:
+    """
+    Tunes the number of parts uploaded at once, and the size of those parts, from observed throughput, latency
+    and failures. One tuner is shared by all the uploads of a run, so what's learned from one file carries over
+    to the next.
+    """
+
+    def __init__(self, concurrency: int, part_size: int,
+                 concurrency_bounds: Tuple[int, int] = DEFAULT_CONCURRENCY_BOUNDS,
+                 part_size_bounds: Tuple[int, int] = DEFAULT_PART_SIZE_BOUNDS):
+        """
+        :param concurrency: the number of parts to upload at once, to begin with
+        :param part_size: the part size, in bytes, to begin with
+        :param concurrency_bounds: the (low, high) bounds within which concurrency is tuned
+        :param part_size_bounds: the (low, high) bounds within which part size is tuned
+        """
+        self.concurrency_bounds = concurrency_bounds
+        self.part_size_bounds = (max(part_size_bounds[0], S3_MIN_PART_SIZE), max(part_size_bounds[1], S3_MIN_PART_SIZE))
+        self.concurrency = self._clamp(concurrency, self.concurrency_bounds)
+        self.part_size = self._clamp(part_size, self.part_size_bounds)
+        self._lock = threading.Lock()
+        self._round: List[Tuple[int, float, float]] = []  # (nbytes, started, finished) for each part of this round
+        self._round_failed = False
+        self._previous_throughput: Optional[float] = None
+        self._file_part_seconds: List[float] = []
+        self._file_failed = False
+        self.parts_observed = 0
+        self.failures_observed = 0
+
+    @staticmethod
+    def _clamp(value, bounds):
+        low, high = bounds
+        return int(min(max(value, low), high))
+
+    @property
+    def max_concurrency(self) -> int:
+        return self.concurrency_bounds[1]
+
+    def record_part(self, nbytes: int, started: float, finished: float) -> None:
+        """Records a part that uploaded successfully, having started and finished at the given (clock) times."""
+        with self._lock:
+            self.parts_observed += 1
+            self._round.append((nbytes, started, finished))
+            self._file_part_seconds.append(finished - started)
+            if len(self._round) >= self.concurrency:
+                self._end_round()
+
+    def record_failure(self, throttled: bool = False) -> None:
+        """Records a failed attempt to upload a part (throttled if S3 asked us to slow down), cutting back at once."""
+        with self._lock:
+            self.failures_observed += 1
+            self._file_failed = True
+            self.concurrency = self._clamp(self.concurrency * FAILURE_DECREASE, self.concurrency_bounds)
+            self._round = []
+            self._previous_throughput = None  # What the throughput was before doesn't say what it should be now.
+
+    def _end_round(self):
+        nbytes = sum(part[0] for part in self._round)
+        elapsed = max(part[2] for part in self._round) - min(part[1] for part in self._round)
+        self._round = []
+        if elapsed <= 0:
+            return
+        throughput = nbytes / elapsed
+        previous, self._previous_throughput = self._previous_throughput, throughput
+        if previous is not None and throughput < previous * THROUGHPUT_DROP:
+            self.concurrency = self._clamp(self.concurrency * DROP_DECREASE, self.concurrency_bounds)
+        else:
+            self.concurrency = self._clamp(self.concurrency + 1, self.concurrency_bounds)
+
+    def file_finished(self) -> None:
+        """Adjusts the part size for the next file, from how quickly this file's parts uploaded."""
+        with self._lock:
+            part_seconds, self._file_part_seconds = self._file_part_seconds, []
+            failed, self._file_failed = self._file_failed, False
+            if failed:
+                self.part_size = self._clamp(self.part_size * FAILURE_DECREASE, self.part_size_bounds)
+            elif part_seconds:
+                mean_seconds = sum(part_seconds) / len(part_seconds)
+                if mean_seconds > SLOW_PART_SECONDS:
+                    self.part_size = self._clamp(self.part_size * FAILURE_DECREASE, self.part_size_bounds)
+                elif mean_seconds < FAST_PART_SECONDS:
+                    self.part_size = self._clamp(self.part_size + PART_SIZE_STEP, self.part_size_bounds)
+
+    def summary(self) -> str:
+        """Describes the settings reached, and how to pin them."""
+        return (f"Upload settings reached: {self.concurrency} parts at once, of {format_size(self.part_size)} each."
+                f" To keep to these, set {UPLOAD_CONCURRENCY_VAR}={self.concurrency}"
+                f" and {UPLOAD_PART_SIZE_VAR}={format_size(self.part_size)}.")
+
+
+def make_upload_tuner(concurrency: int, part_size: int, concurrency_spec: Optional[str] = None,
+                      part_size_spec: Optional[str] = None) -> UploadTuner:
+    """
+    Returns an UploadTuner starting from the given settings, within bounds given as by SUBMITCGAP_UPLOAD_CONCURRENCY
+    and SUBMITCGAP_UPLOAD_PART_SIZE. (Bad bounds are ignored, with a warning.)
+    """
+    concurrency_bounds, part_size_bounds = DEFAULT_CONCURRENCY_BOUNDS, DEFAULT_PART_SIZE_BOUNDS
+    for var, spec, parse in [(UPLOAD_CONCURRENCY_VAR, concurrency_spec, int),
+                             (UPLOAD_PART_SIZE_VAR, part_size_spec, parse_size)]:
+        if not spec:
+            continue
+        try:
+            bounds = parse_bounds(spec, parse=parse)
+        except ValueError as e:
+            PRINT(f"Ignoring {var}={spec!r}. {e}")
+            continue
+        if var == UPLOAD_CONCURRENCY_VAR:
+            concurrency_bounds = bounds
+        else:
+            part_size_bounds = bounds
+    return UploadTuner(concurrency=concurrency, part_size=part_size,
+                       concurrency_bounds=concurrency_bounds, part_size_bounds=part_size_bounds)
@@ -0,0 +1,162 @@
+# This file contains verification, after uploading, that the portal registered each file as uploaded.
+#
+# An upload counts as done as soon as the transfer to S3 finishes, but it's the portal that decides, some time later,
+# whether a File item (and each of its extra files) was uploaded: its status moves on from "uploading" once the
+# upload has been noticed and checked. Verification asks the portal about several File items at once, waits for
+# the status of each to settle, compares the size and md5 checksum the portal has with those of the local file,
+# and reports, for the whole submission, which files passed and which didn't.
+
+import concurrent.futures
+import os
+import time
+from dcicutils.misc_utils import PRINT, environ_bool
+from typing import Callable, List, Optional, Sequence
+
+
+VERIFY_UPLOADS_VAR = 'SUBMITCGAP_VERIFY_UPLOADS'
+VERIFY_TIMEOUT_VAR = 'SUBMITCGAP_VERIFY_TIMEOUT'
+
+VERIFY_CONCURRENCY = 16  # File items asked about at once
+VERIFY_POLL_INTERVAL = 10  # seconds between asking again about a File item whose status hasn't settled
+DEFAULT_VERIFY_TIMEOUT = 300  # seconds to wait for statuses to settle
+
+PENDING_STATUSES = {'uploading'}  # statuses a File item has until the portal has checked its upload
+FAILED_STATUSES = {'upload failed', 'to be uploaded by workflow', 'deleted'}
+
+
+def _compute_verify_timeout():  # factored out as a function for testing
+    value = os.environ.get(VERIFY_TIMEOUT_VAR)
+    if not value:
+        return DEFAULT_VERIFY_TIMEOUT
+    try:
+        return float(value)
+    except ValueError:
+        PRINT(f"Ignoring {VERIFY_TIMEOUT_VAR}={value!r}, which is not a number of seconds.")
+        return DEFAULT_VERIFY_TIMEOUT
+
+
+VERIFY_UPLOADS = environ_bool(VERIFY_UPLOADS_VAR)
+VERIFY_TIMEOUT = _compute_verify_timeout()
+
+
+class FileVerification:
+    """The outcome of verifying the upload of one file (to a File item, or as one of its extra files)."""
+
+    def __init__(self, uuid: str, file_name: str, status: Optional[str] = None, problems: Optional[List[str]] = None,
+                 extra_file: bool = False):
+        self.uuid = uuid
+        self.file_name = file_name
+        self.status = status
+        self.problems = problems or []
+        self.extra_file = extra_file
+
+    @property
+    def passed(self) -> bool:
+        return not self.problems
+
+
+def compare_with_local_file(record: dict, local_path: Optional[str],
+                            local_md5: Optional[Callable[[str], Optional[str]]] = None) -> List[str]:
+    """
+    Compares the size and md5 checksum the portal has for a file (from a File item, or one of its extra_files)
+    with those of the local file, returning descriptions of any differences.
+
+    :param record: the File item, or the entry in its extra_files, for the file
+    :param local_path: the name of the local file, or None if it isn't known
+    :param local_md5: a function returning the md5 of a local file (or None, if it can't be had),
+        called only if the portal has an md5 to compare it with
+    """
+    problems = []
+    if not local_path or not os.path.isfile(local_path):
+        return problems
+    size = os.path.getsize(local_path)
+    portal_size = record.get('file_size')
+    if portal_size is not None and portal_size != size:
+        problems.append(f"The portal has its size as {portal_size} bytes, but the local file has {size}.")
+    portal_md5 = record.get('md5sum') or record.get('content_md5sum')
+    if portal_md5 and local_md5 is not None:
+        md5 = local_md5(local_path)
+        if md5 and md5 != portal_md5:
+            problems.append(f"The portal has its md5 checksum as {portal_md5}, but the local file's is {md5}.")
+    return problems
+
+
+def verify_file_item(item: dict, find_local: Optional[Callable[[str, str], Optional[str]]] = None,
+                     local_md5: Optional[Callable[[str], Optional[str]]] = None) -> List[FileVerification]:
+    """
+    Verifies a File item, as the portal now has it, and its extra files.
+
+    :param item: the File item (in frame=object)
+    :param find_local: a function returning, given the uuid of the File item and the name of its file or of one of
+        its extra files, the name of the local file uploaded (or None if it isn't known)
+    :param local_md5: see compare_with_local_file
+    :return: a FileVerification for the File item's file, followed by one for each of its extra files
+    """
+    uuid = item.get('uuid')
+    file_name = item.get('filename') or uuid
+    results = []
+    records = [(item, file_name, False)] + [(extra, extra.get('filename'), True)
+                                            for extra in item.get('extra_files') or []]
+    for record, name, extra_file in records:
+        status = record.get('status') or (item.get('status') if extra_file else None)
+        result = FileVerification(uuid, name, status=status, extra_file=extra_file)
+        if status in PENDING_STATUSES:
+            result.problems.append(f"Its status is still {status!r}.")
+        elif status in FAILED_STATUSES or not status:
+            result.problems.append(f"Its status is {status!r}.")
+        else:
+            local_path = find_local(uuid, name) if find_local is not None and name else None
+            result.problems.extend(compare_with_local_file(record, local_path, local_md5=local_md5))
+        results.append(result)
+    return results
+
+
+def is_settled(item: dict) -> bool:
+    """Returns True if neither a File item nor any of its extra files is waiting for the portal to check it."""
+    return (item.get('status') not in PENDING_STATUSES
+            and all(extra.get('status') not in PENDING_STATUSES for extra in item.get('extra_files') or []))
+
+
+def verify_file_items(uuids: Sequence[str], fetch_item: Callable[[str], dict],
+                      find_local: Optional[Callable[[str, str], Optional[str]]] = None,
+                      local_md5: Optional[Callable[[str], Optional[str]]] = None,
+                      timeout: float = DEFAULT_VERIFY_TIMEOUT, poll_interval: float = VERIFY_POLL_INTERVAL,
+                      max_workers: int = VERIFY_CONCURRENCY, clock: Callable[[], float] = time.monotonic,
+                      sleep: Callable[[float], None] = time.sleep) -> List[FileVerification]:
+    """
+    Verifies several File items at once, waiting (up to timeout seconds in all) for their statuses to settle.
+
+    :param uuids: the uuids of the File items
+    :param fetch_item: a function returning the File item (in frame=object) with a given uuid
+    :param find_local: see verify_file_item
+    :param local_md5: see compare_with_local_file
+    :return: FileVerifications for all the files, in the order of the File items given
+    """
+    deadline = clock() + timeout
+
+    def verify(uuid):
+        try:
+            item = fetch_item(uuid)
+            while not is_settled(item) and clock() + poll_interval <= deadline:
+                sleep(poll_interval)
+                item = fetch_item(uuid)
+        except Exception as e:
+            return [FileVerification(uuid, uuid, problems=[f"It could not be looked up. {e.__class__.__name__}: {e}"])]
+        return verify_file_item(dict(item, uuid=item.get('uuid') or uuid), find_local=find_local, local_md5=local_md5)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(uuids)))) as executor:
+        return [result for results in executor.map(verify, uuids) for result in results]
+
+
+def verification_report(results: Sequence[FileVerification]) -> List[str]:
+    """Returns the lines of a pass/fail report on the verification of all the files of a submission."""
+    failed = [result for result in results if not result.passed]
+    lines = [f"Verification {'FAILED' if failed else 'PASSED'}:"
+             f" {len(results) - len(failed)} of {len(results)} file{'' if len(results) == 1 else 's'}"
+             f" registered as uploaded."]
+    for result in results:
+        extra = " [extra file]" if result.extra_file else ""
+        lines.append(f"  {'ok' if result.passed else 'FAILED':6} {result.file_name}{extra}"
+                     f" for item {result.uuid} ({result.status or 'no status'})")
+        lines.extend(f"         {problem}" for problem in result.problems)
+    return lines
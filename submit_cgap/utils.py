@@ -1,8 +1,9 @@
+import concurrent.futures
 import contextlib
 import datetime
 import io
 import time
-from typing import Any, Callable, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple, Union
 from dcicutils.misc_utils import PRINT, environ_bool
 from json import dumps as json_dumps, loads as json_loads
 
@@ -53,8 +54,9 @@ def keyword_as_title(keyword):
 
 class FakeResponse:
 
-    def __init__(self, status_code, json=None, content=None):
+    def __init__(self, status_code, json=None, content=None, headers=None):
         self.status_code = status_code
+        self.headers = headers or {}
         if json is not None and content is not None:
             raise Exception("FakeResponse cannot have both content and json.")
         elif content is not None:
@@ -164,3 +166,61 @@ def check_repeatedly(check_function: Callable,
                 output(f"{wait_message} {f'| Status: {check_status.title()}' if check_status else ''}"
                        f" | Checked: {ntimes} time{'s' if ntimes != 1 else ''}"
                        f" | Next check: {wait_seconds - i} second{'s' if wait_seconds - i != 1 else ''} ...")
+
+
+class TaskGraph:
+    """
+    Runs a small graph of named tasks on a thread pool, starting each task as soon as the tasks it depends on
+    have finished. The values of a task's dependencies are passed to it as keyword arguments named by those
+    dependencies. If a task raises an error, asking for its result (or for the result of any task depending on it)
+    raises that same error, so callers that consume results in the order they'd have computed them serially will
+    see the same errors at the same points.
+
+    Use this as a context manager so that the pool is shut down (after any tasks still running finish) on exit.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._futures: Dict[str, concurrent.futures.Future] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def add(self, name: str, function: Callable, *, depends_on: Iterable[str] = (),
+            **kwargs) -> concurrent.futures.Future:
+        """
+        Adds a task that will call the given function once the named tasks it depends on have finished.
+
+        Because dependencies must already have been added, tasks are queued in dependency order and so
+        a task never occupies a worker that is needed by something it waits on.
+
+        :param name: a name for the task, by which its result can be requested
+        :param function: the function to call
+        :param depends_on: names of previously added tasks whose values are to be passed as keyword arguments
+        :param kwargs: any other keyword arguments to pass to the function
+        :return: a future for the task's value
+        """
+        if name in self._futures:
+            raise ValueError(f"A task named {name!r} was already added.")
+        dependencies = {}
+        for dependency in depends_on:
+            if dependency not in self._futures:
+                raise ValueError(f"The task {name!r} depends on {dependency!r}, which has not been added.")
+            dependencies[dependency] = self._futures[dependency]
+
+        def run_task():
+            dependency_values = {dependency: future.result() for dependency, future in dependencies.items()}
+            return function(**dependency_values, **kwargs)
+
+        future = self._futures[name] = self._executor.submit(run_task)
+        return future
+
+    def result(self, name: str) -> Any:
+        """Waits for the named task to finish and returns its value (or raises its error)."""
+        return self._futures[name].result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,547 @@
+# This file contains a watch mode, in which a drop folder is watched for metadata bundles, and each bundle that lands
+# there is submitted, its processing is followed, and the files it calls for are uploaded as they arrive, with no one
+# having to run submit-metadata-bundle (and answer its questions) and then resume-uploads for stragglers.
+#
+# A bundle (an Excel file) is submitted once it's finished being written (as is_being_written in growing_files.py
+# judges, with SUBMITCGAP_WATCH_SETTLE seconds of quiet, or a sentinel if SUBMITCGAP_FOLLOW_SENTINEL names one).
+# The processing of all the submissions under way is checked on together, every PROGRESS_CHECK_INTERVAL seconds.
+# Once a submission has been processed, each file it calls for is uploaded, on one of SUBMITCGAP_UPLOAD_WORKERS
+# threads, as soon as it's found in the upload folder and finished. (It's not waited for if SUBMITCGAP_FOLLOW_UPLOADS
+# is set, since then it's uploaded as it grows.) What has been submitted and uploaded is kept in a journal, an SQLite
+# database (SUBMITCGAP_WATCH_JOURNAL), so a watcher that's stopped and started again picks up where it left off,
+# without submitting or uploading anything twice.
+#
+# On Linux, folders are watched with inotify, so new files are noticed at once. Otherwise, or if
+# SUBMITCGAP_WATCH_POLLING is set (as it should be for network file systems, where inotify doesn't see changes made
+# on other hosts), they're looked at every SUBMITCGAP_WATCH_INTERVAL seconds. (They're looked at that often anyway,
+# to see whether files have finished being written.)
+
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import os
+import select
+import sqlite3
+import sys
+import time
+from dcicutils.misc_utils import PRINT, environ_bool
+from typing import Callable, Dict, List, Optional
+from .base import DEFAULT_APP, KEY_MANAGER
+from .bgzf import uncompressed_source
+from .growing_files import FOLLOW_UPLOADS, is_being_written
+from .local_files import EXCEL_EXTENSIONS
+from .submission import (
+    DEFAULT_INGESTION_TYPE, DEFAULT_SUBMISSION_PROTOCOL, PROGRESS_CHECK_INTERVAL, _check_ingestion_progress,
+    find_upload_file, get_section, post_ingestion_submission, resolve_submission_context, show_section,
+    upload_found_file, verify_uploads,
+)
+from .tar_sources import tar_member
+from .upload_backends import UPLOAD_WORKERS
+from .upload_verification import VERIFY_UPLOADS
+from .utils import show
+
+
+WATCH_JOURNAL_VAR = 'SUBMITCGAP_WATCH_JOURNAL'
+WATCH_SETTLE_VAR = 'SUBMITCGAP_WATCH_SETTLE'
+WATCH_INTERVAL_VAR = 'SUBMITCGAP_WATCH_INTERVAL'
+WATCH_POLLING_VAR = 'SUBMITCGAP_WATCH_POLLING'
+
+DEFAULT_WATCH_SETTLE = 60  # seconds a file must go unchanged to be taken as finished
+DEFAULT_WATCH_INTERVAL = 10  # seconds between looks at the folders
+
+WATCH_CHECK_CONCURRENCY = 8  # submissions whose processing is checked on at once
+WATCH_UPLOAD_ATTEMPTS = 3  # times a file is tried before it's given up on
+
+JOURNAL_TIMEOUT = 30  # seconds to wait for another process's write to finish
+
+# inotify events that mean a file may have been put in a folder: written and closed, moved in, or created.
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+WATCH_EVENT_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+class BundleState:
+    SUBMITTED = 'submitted'  # awaiting processing
+    UPLOADING = 'uploading'  # processed, with files still to be uploaded
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class FileState:
+    WAITING = 'waiting'  # for the file to be found, finished, or (after a failure) tried again
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bundles (
+    server TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    state TEXT NOT NULL,
+    submission_uuid TEXT,
+    outcome TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (server, path, size, mtime)
+);
+CREATE TABLE IF NOT EXISTS files (
+    server TEXT NOT NULL,
+    submission_uuid TEXT NOT NULL,
+    file_uuid TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (server, submission_uuid, file_uuid)
+);
+"""
+
+
+def _compute_default_watch_journal():  # factored out as a function for testing
+    journal = os.environ.get(WATCH_JOURNAL_VAR)
+    if not journal:
+        data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+        journal = os.path.join(data_home, 'submit-cgap', 'watch.sqlite3')
+    return journal
+
+
+def _compute_seconds(var, default):  # factored out as a function for testing
+    value = os.environ.get(var)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        PRINT(f"Ignoring {var}={value!r}, which is not a number of seconds.")
+        return default
+
+
+WATCH_JOURNAL = _compute_default_watch_journal()
+WATCH_SETTLE = _compute_seconds(WATCH_SETTLE_VAR, DEFAULT_WATCH_SETTLE)
+WATCH_INTERVAL = _compute_seconds(WATCH_INTERVAL_VAR, DEFAULT_WATCH_INTERVAL)
+WATCH_POLLING = environ_bool(WATCH_POLLING_VAR)
+
+
+class WatchJournal:
+    """
+    A record, in an SQLite database, of the bundles a watcher has submitted (identified by server, path, size and
+    modification time, so a bundle that's replaced is submitted again), and of the files each calls for.
+    """
+
+    def __init__(self, filename: str):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), mode=0o700, exist_ok=True)
+        self.filename = filename
+        self._connection = sqlite3.connect(filename, timeout=JOURNAL_TIMEOUT)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.executescript(JOURNAL_SCHEMA)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def _execute(self, statement: str, parameters=()) -> List[dict]:
+        with self._connection:  # commits on success, rolls back on error
+            return [dict(row) for row in self._connection.execute(statement, parameters).fetchall()]
+
+    def get_bundle(self, server: str, path: str, size: int, mtime: float) -> Optional[dict]:
+        [bundle] = self._execute("SELECT * FROM bundles WHERE server = ? AND path = ? AND size = ? AND mtime = ?",
+                                 (server, path, size, mtime)) or [None]
+        return bundle
+
+    def record_bundle(self, server: str, path: str, size: int, mtime: float, *, state: str,
+                      submission_uuid: Optional[str] = None, outcome: Optional[str] = None) -> None:
+        now = time.time()
+        self._execute("INSERT INTO bundles (server, path, size, mtime, state, submission_uuid, outcome, created,"
+                      " updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                      " ON CONFLICT (server, path, size, mtime) DO UPDATE SET state = excluded.state,"
+                      " submission_uuid = coalesce(excluded.submission_uuid, submission_uuid),"
+                      " outcome = coalesce(excluded.outcome, outcome), updated = excluded.updated",
+                      (server, path, size, mtime, state, submission_uuid, outcome, now, now))
+
+    def get_bundles(self, server: str, states: List[str]) -> List[dict]:
+        """Returns the bundles for a server that are in any of the given states, oldest first."""
+        return self._execute(f"SELECT * FROM bundles WHERE server = ? AND state IN ({', '.join('?' * len(states))})"
+                             f" ORDER BY created", (server, *states))
+
+    def record_planned_files(self, server: str, submission_uuid: str, upload_info: List[dict]) -> None:
+        """Records the files (given as upload_info) that a submission calls for, unless they're already recorded."""
+        now = time.time()
+        for upload_spec in upload_info:
+            self._execute("INSERT OR IGNORE INTO files (server, submission_uuid, file_uuid, filename, state, updated)"
+                          " VALUES (?, ?, ?, ?, ?, ?)",
+                          (server, submission_uuid, upload_spec['uuid'], upload_spec['filename'],
+                           FileState.WAITING, now))
+
+    def record_file(self, server: str, submission_uuid: str, file_uuid: str, *, state: str,
+                    error: Optional[str] = None, attempted: bool = False) -> None:
+        self._execute("UPDATE files SET state = ?, error = ?, attempts = attempts + ?, updated = ?"
+                      " WHERE server = ? AND submission_uuid = ? AND file_uuid = ?",
+                      (state, error, int(attempted), time.time(), server, submission_uuid, file_uuid))
+
+    def get_files(self, server: str, submission_uuid: str) -> List[dict]:
+        """Returns the files a submission calls for, in the order they were recorded."""
+        return self._execute("SELECT * FROM files WHERE server = ? AND submission_uuid = ? ORDER BY rowid",
+                             (server, submission_uuid))
+
+
+def _inotify_library():
+    """Returns the C library, if it has inotify (as on Linux), or else None."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch  # noqa - just checking they're there
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class FolderEvents:
+    """
+    A way to wait until something may have changed in some folders: until inotify says something has, if it can
+    be used, or else just for as long as can be waited.
+    """
+
+    def __init__(self, use_inotify: bool = True, sleep: Callable[[float], None] = time.sleep):
+        self._sleep = sleep
+        self._libc = _inotify_library() if use_inotify else None
+        self._fd = None
+        self._watched = set()
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self._fd is not None
+
+    def watch(self, folder: str) -> None:
+        if self._fd is not None and folder not in self._watched:
+            if self._libc.inotify_add_watch(self._fd, os.fsencode(folder), WATCH_EVENT_MASK) >= 0:
+                self._watched.add(folder)
+
+    def wait(self, timeout: float) -> bool:
+        """Waits up to timeout seconds for something to change, returning True if something (may have)."""
+        if self._fd is None:
+            self._sleep(timeout)
+            return False
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return False
+        with contextlib.suppress(BlockingIOError):
+            while os.read(self._fd, 64 * 1024):  # It's enough to know there were events, not what they were.
+                pass
+        return True
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class FolderWatcher:
+    """
+    Submits the bundles that land in a folder, follows their processing, and uploads the files they call for
+    as they turn up, keeping track of it all in a WatchJournal.
+    """
+
+    def __init__(self, folder: str, *, server: str, keydict: dict, app_args: dict, journal: WatchJournal,
+                 ingestion_type: str = DEFAULT_INGESTION_TYPE, validate_only: bool = False,
+                 submission_protocol: str = DEFAULT_SUBMISSION_PROTOCOL, upload_folder: Optional[str] = None,
+                 subfolders: bool = False, events: Optional[FolderEvents] = None, settle: Optional[float] = None,
+                 interval: Optional[float] = None, workers: int = UPLOAD_WORKERS,
+                 clock: Callable[[], float] = time.time):
+        """
+        :param folder: the folder in which bundles land
+        :param server: the server to submit to
+        :param keydict: keydict-style auth for the server
+        :param app_args: the (defaulted) app args for submissions (see submit_any_ingestion)
+        :param journal: the WatchJournal in which to keep track of what's been done
+        :param upload_folder: the folder in which to find files to upload (default: the folder the bundle is in)
+        :param subfolders: whether to search subfolders of the upload folder for files
+        :param events: the FolderEvents with which to wait for changes (default: a new one)
+        :param settle: seconds a file must go unchanged to be taken as finished (default: WATCH_SETTLE)
+        :param interval: the most seconds to go between looks at the folders (default: WATCH_INTERVAL)
+        :param workers: the number of files to upload at once
+        (The other arguments are as for submit_any_ingestion.)
+        """
+        self.folder = os.path.abspath(folder)
+        self.server = server
+        self.keydict = keydict
+        self.keypair = KEY_MANAGER.keydict_to_keypair(keydict)
+        self.app_args = app_args
+        self.journal = journal
+        self.ingestion_type = ingestion_type
+        self.validate_only = validate_only
+        self.submission_protocol = submission_protocol
+        self.upload_folder = os.path.abspath(upload_folder) if upload_folder else None
+        self.subfolders = subfolders
+        self.events = events if events is not None else FolderEvents(use_inotify=not WATCH_POLLING)
+        self.settle = WATCH_SETTLE if settle is None else settle
+        self.interval = WATCH_INTERVAL if interval is None else interval
+        self._clock = clock
+        self._checkers = concurrent.futures.ThreadPoolExecutor(max_workers=WATCH_CHECK_CONCURRENCY)
+        self._uploaders = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._poll_states: Dict[str, dict] = {}  # for _check_ingestion_progress, by submission uuid
+        self._last_checked: Dict[str, float] = {}  # by submission uuid
+        self._uploading: Dict[concurrent.futures.Future, tuple] = {}  # (submission uuid, file uuid, filename)
+
+    def _is_finished(self, path: str) -> bool:
+        return not is_being_written(path, quiescence=self.settle, clock=self._clock)
+
+    def _upload_folder_for(self, bundle: dict) -> str:
+        return self.upload_folder or os.path.dirname(bundle['path'])
+
+    def find_bundles(self) -> List[str]:
+        """Returns the paths of the bundles in the folder (finished or not), in order by name."""
+        return [os.path.join(self.folder, name) for name in sorted(os.listdir(self.folder))
+                if name.endswith(tuple(EXCEL_EXTENSIONS)) and not name.startswith(('.', '~$'))  # not Excel's lock files
+                and os.path.isfile(os.path.join(self.folder, name))]
+
+    def submit_new_bundles(self) -> None:
+        for path in self.find_bundles():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # It's been moved away since it was seen.
+            key = (self.server, path, stat.st_size, stat.st_mtime)
+            if self.journal.get_bundle(*key) is not None or not self._is_finished(path):
+                continue
+            try:
+                uuid = post_ingestion_submission(path, ingestion_type=self.ingestion_type, server=self.server,
+                                                 keydict=self.keydict, validate_only=self.validate_only,
+                                                 app_args=self.app_args, submission_protocol=self.submission_protocol)
+            except Exception as e:
+                show(f"Submitting bundle {path} failed. {e.__class__.__name__}: {e}"
+                     f" (It'll be submitted again if it's replaced or touched.)", with_time=True)
+                self.journal.record_bundle(*key, state=BundleState.FAILED, outcome=f"{e.__class__.__name__}: {e}")
+                continue
+            self.journal.record_bundle(*key, state=BundleState.SUBMITTED, submission_uuid=uuid)
+            show(f"Submitted bundle {path}, assigned uuid {uuid} for tracking. Awaiting processing...",
+                 with_time=True)
+
+    def _check_progress(self, uuid: str):
+        return _check_ingestion_progress(uuid, keypair=self.keypair, server=self.server,
+                                         poll_state=self._poll_states.setdefault(uuid, {}))
+
+    def check_submissions(self) -> None:
+        """Checks, all at once, on the processing of the submitted bundles that are due to be checked on."""
+        now = self._clock()
+        due = [bundle for bundle in self.journal.get_bundles(self.server, [BundleState.SUBMITTED])
+               if now - self._last_checked.get(bundle['submission_uuid'], -PROGRESS_CHECK_INTERVAL)
+               >= PROGRESS_CHECK_INTERVAL]
+        checks = [(bundle, self._checkers.submit(self._check_progress, bundle['submission_uuid'])) for bundle in due]
+        for bundle, check in checks:
+            uuid = bundle['submission_uuid']
+            self._last_checked[uuid] = now
+            try:
+                done, outcome, response = check.result()
+            except Exception as e:
+                show(f"Checking on submission {uuid} failed. {e.__class__.__name__}: {e}", with_time=True)
+                continue
+            if done:
+                self._processed(bundle, outcome, response)
+
+    def _processed(self, bundle: dict, outcome: str, response: dict) -> None:
+        uuid = bundle['submission_uuid']
+        key = (self.server, bundle['path'], bundle['size'], bundle['mtime'])
+        self._poll_states.pop(uuid, None)
+        self._last_checked.pop(uuid, None)
+        show(f"Processing of bundle {bundle['path']} (uuid {uuid}) finished."
+             f" Final status: {(outcome or 'unknown').title()}", with_time=True)
+        if outcome != "success":
+            if outcome == "error" and response.get("errors"):
+                show_section(response, "errors")
+            show_section(response, "validation_output", caveat_outcome=outcome)
+            self.journal.record_bundle(*key, state=BundleState.FAILED, outcome=outcome)
+            return
+        upload_info = [] if self.validate_only else get_section(response, 'upload_info') or []
+        self.journal.record_planned_files(self.server, uuid, upload_info)
+        self.journal.record_bundle(*key, state=BundleState.UPLOADING, outcome=outcome)
+        if upload_info:
+            show(f"Bundle {bundle['path']} calls for {len(upload_info)} files, which will be uploaded as they're"
+                 f" found finished.")
+
+    def _is_ready(self, file_path: str) -> bool:
+        """Returns True if a file to upload (as find_upload_file found it) is there and finished."""
+        if os.path.exists(file_path):
+            return FOLLOW_UPLOADS or self._is_finished(file_path)  # If it's followed, it needn't be finished.
+        source = uncompressed_source(file_path)  # It may be there to be compressed (see bgzf.py) ...
+        if source:
+            return self._is_finished(source)
+        member = tar_member(file_path)  # ... or in an archive (see tar_sources.py).
+        return member is not None and self._is_finished(member.archive)
+
+    def start_uploads(self) -> None:
+        """Starts uploading each file that's called for, and that has been found finished, that isn't under way."""
+        in_progress = set(self._uploading.values())
+        now = self._clock()
+        for bundle in self.journal.get_bundles(self.server, [BundleState.UPLOADING]):
+            uuid = bundle['submission_uuid']
+            folder = self._upload_folder_for(bundle)
+            search_folder = os.path.join(folder, '**') if self.subfolders else folder
+            for file in self.journal.get_files(self.server, uuid):
+                if file['state'] != FileState.WAITING or (uuid, file['file_uuid'], file['filename']) in in_progress:
+                    continue
+                if file['attempts'] and now - file['updated'] < self.interval * 2 ** file['attempts']:
+                    continue  # It failed, and it's not yet time to try it again.
+                file_path, error_msg = find_upload_file(search_folder, file['filename'], recursive=self.subfolders)
+                if error_msg:
+                    show(error_msg)
+                    self.journal.record_file(self.server, uuid, file['file_uuid'], state=FileState.FAILED,
+                                             error=error_msg)
+                    continue
+                if not self._is_ready(file_path):
+                    continue
+                upload = self._uploaders.submit(upload_found_file, file['file_uuid'], file_path, auth=self.keydict,
+                                                folder=folder, subfolders=self.subfolders, submission_uuid=uuid)
+                self._uploading[upload] = (uuid, file['file_uuid'], file['filename'])
+
+    def collect_uploads(self) -> None:
+        """Records the outcomes of the uploads that have finished."""
+        for upload in [upload for upload in self._uploading if upload.done()]:
+            uuid, file_uuid, filename = self._uploading.pop(upload)
+            try:
+                succeeded, error = upload.result(), None
+            except Exception as e:
+                succeeded, error = False, f"{e.__class__.__name__}: {e}"
+                show(f"Upload of {filename} failed. {error}")
+            if succeeded:
+                self.journal.record_file(self.server, uuid, file_uuid, state=FileState.DONE, attempted=True)
+                continue
+            [file] = [file for file in self.journal.get_files(self.server, uuid) if file['file_uuid'] == file_uuid]
+            gave_up = file['attempts'] + 1 >= WATCH_UPLOAD_ATTEMPTS
+            self.journal.record_file(self.server, uuid, file_uuid, state=FileState.FAILED if gave_up else
+                                     FileState.WAITING, error=error or "The upload failed.", attempted=True)
+            if gave_up:
+                show(f"Giving up on uploading {filename}, after {WATCH_UPLOAD_ATTEMPTS} attempts.")
+
+    def finish_bundles(self) -> None:
+        """Marks as done (or failed) the bundles whose files have all been uploaded (or given up on)."""
+        in_progress = {uuid for uuid, _, _ in self._uploading.values()}
+        for bundle in self.journal.get_bundles(self.server, [BundleState.UPLOADING]):
+            uuid = bundle['submission_uuid']
+            files = self.journal.get_files(self.server, uuid)
+            if uuid in in_progress or any(file['state'] == FileState.WAITING for file in files):
+                continue
+            key = (self.server, bundle['path'], bundle['size'], bundle['mtime'])
+            failed = [file for file in files if file['state'] == FileState.FAILED]
+            if failed:
+                show(f"{len(failed)} of the {len(files)} files called for by bundle {bundle['path']} couldn't be"
+                     f" uploaded. Once they're fixed, they can be uploaded with: resume-uploads {uuid}"
+                     f" --server {self.server} --upload_folder {self._upload_folder_for(bundle)} --no_query",
+                     with_time=True)
+                self.journal.record_bundle(*key, state=BundleState.FAILED)
+                continue
+            if files:
+                show(f"All {len(files)} files called for by bundle {bundle['path']} were uploaded.", with_time=True)
+                if VERIFY_UPLOADS:
+                    verify_uploads([{'uuid': file['file_uuid'], 'filename': file['filename']} for file in files],
+                                   auth=self.keydict, folder=self._upload_folder_for(bundle),
+                                   subfolders=self.subfolders, submission_uuid=uuid)
+            self.journal.record_bundle(*key, state=BundleState.DONE)
+
+    def step(self) -> None:
+        """Does whatever can be done now: submitting, checking on submissions, and starting and finishing uploads."""
+        self.submit_new_bundles()
+        self.check_submissions()
+        self.collect_uploads()
+        self.start_uploads()
+        self.finish_bundles()
+
+    def is_idle(self) -> bool:
+        """Returns True if nothing is under way: no bundle waiting to be submitted, processed, or uploaded for."""
+        if self._uploading or self.journal.get_bundles(self.server, [BundleState.SUBMITTED, BundleState.UPLOADING]):
+            return False
+        for path in self.find_bundles():
+            with contextlib.suppress(FileNotFoundError):
+                stat = os.stat(path)
+                if self.journal.get_bundle(self.server, path, stat.st_size, stat.st_mtime) is None:
+                    return False
+        return True
+
+    def _watch_folders(self) -> None:
+        folders = [self.folder]
+        for bundle in self.journal.get_bundles(self.server, [BundleState.UPLOADING]):
+            upload_folder = self._upload_folder_for(bundle)
+            if self.subfolders:
+                folders.extend(directory for directory, _, _ in os.walk(upload_folder))
+            else:
+                folders.append(upload_folder)
+        for folder in folders:
+            self.events.watch(folder)
+
+    def run(self, until_done: bool = False) -> None:
+        """
+        Watches the folder, doing whatever can be done as things change, until interrupted (or, if until_done,
+        until there's nothing left to do).
+        """
+        how = "with inotify" if self.events.uses_inotify else f"every {self.interval:g} seconds"
+        show(f"Watching {self.folder} ({how}) for bundles to submit to {self.server}.", with_time=True)
+        try:
+            while True:
+                self.step()
+                if until_done and self.is_idle():
+                    break
+                if self.events.uses_inotify:
+                    self._watch_folders()
+                self.events.wait(self.interval)
+        except KeyboardInterrupt:
+            show("Stopped watching. (Anything unfinished will be picked up when watching starts again.)")
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        for upload in self._uploading:  # (Python 3.8's shutdown can't be asked to cancel them.)
+            upload.cancel()
+        self._checkers.shutdown(wait=True)
+        self._uploaders.shutdown(wait=True)
+        self.events.close()
+
+
+def watch_folder(folder, *, server=None, env=None, institution=None, project=None, lab=None, award=None,
+                 consortium=None, submission_center=None, app=None, ingestion_type=DEFAULT_INGESTION_TYPE,
+                 validate_only=False, upload_folder=None, subfolders=False,
+                 submission_protocol=DEFAULT_SUBMISSION_PROTOCOL, until_done=False):
+    """
+    Watches a folder, submitting the bundles that land in it and uploading the files they call for as they're found
+    (see FolderWatcher). The arguments are as for submit_any_ingestion, except:
+
+    :param folder: the folder in which bundles land
+    :param until_done: whether to stop once there's nothing left to do, rather than going on watching
+    """
+
+    if app is None:  # For legacy reasons, SubmitCGAP was the first so didn't expect this arg was needed
+        app = DEFAULT_APP
+
+    if KEY_MANAGER.selected_app != app:
+        with KEY_MANAGER.locally_selected_app(app):
+            return watch_folder(folder, server=server, env=env, institution=institution, project=project, lab=lab,
+                                award=award, consortium=consortium, submission_center=submission_center, app=app,
+                                ingestion_type=ingestion_type, validate_only=validate_only,
+                                upload_folder=upload_folder, subfolders=subfolders,
+                                submission_protocol=submission_protocol, until_done=until_done)
+
+    if not os.path.isdir(folder):
+        raise ValueError(f"The folder {folder!r} does not exist.")
+
+    # Everything a submission needs that doesn't depend on the bundle is worked out just once, up front.
+    server, keydict, app_args = resolve_submission_context(
+        server=server, env=env, app=app, institution=institution, project=project, lab=lab, award=award,
+        consortium=consortium, submission_center=submission_center)
+
+    journal = WatchJournal(WATCH_JOURNAL)
+    try:
+        # Submissions left being processed, or uploaded for, when the watcher last stopped are picked up again.
+        watcher = FolderWatcher(folder, server=server, keydict=keydict, app_args=app_args, journal=journal,
+                                ingestion_type=ingestion_type, validate_only=validate_only,
+                                submission_protocol=submission_protocol, upload_folder=upload_folder,
+                                subfolders=subfolders)
+        watcher.run(until_done=until_done)
+    finally:
+        journal.close()